@@ -0,0 +1,409 @@
+#!/usr/bin/env python
+#
+#  Copyright (c) 2012, Sean Reifschneider, tummy.com, ltd.
+#  All Rights Reserved.
+
+'''Accounting of the space used by hard-linked snapshots.
+
+With hard-links, the space a snapshot really costs is the space of the
+inodes that only it links to: removing the snapshot frees exactly those.
+Each snapshot is scanned once, and the inodes it links to are kept in an
+:py:class:`InodeTable` of arrays sorted by inode number, which is saved in a
+cache directory.  Snapshots do not change once they are made, so later
+runs only scan new snapshots, forget removed ones, and merge the saved
+tables to count how many links each inode has among all the snapshots.
+
+Links from outside the snapshots, such as those made by deduplication
+with the files of other hosts, are found from the link count of each
+inode when it is scanned: whatever the snapshots do not account for is
+external, and that does not change as snapshots come and go.
+'''
+
+import os
+import stat
+import array
+import heapq
+import struct
+import itertools
+
+#  array type code of inode numbers, link counts and sizes: unsigned long
+ARRAY_TYPE = 'L'
+CACHE_SUFFIX = '.inodes'
+CACHE_MAGIC = 'NABINOD2'
+#  directory entries sorted at a time while scanning, the sorted runs are
+#  kept packed in arrays and merged
+RUN_ENTRIES = 65536
+#  magic, device, inode and change time of the scanned directory, number
+#  of inodes
+cache_header = struct.Struct('<8sQQQQ')
+
+
+class InodeTable:
+    '''Inodes linked to from a directory tree, as parallel arrays sorted
+    by inode number.
+
+    .. py:attribute:: inodes
+
+    The inode numbers.
+
+    .. py:attribute:: links
+
+    Number of links to each inode within the tree.
+
+    .. py:attribute:: sizes
+
+    Bytes allocated to each inode.
+
+    .. py:attribute:: external
+
+    Number of links to each inode from outside the snapshots accounted
+    with the tree.  A table from :py:func:`scan_tree` holds the link count
+    of each inode (st_nlink) here until :py:func:`account_snapshots`
+    takes away the links it finds in the snapshots.
+    '''
+
+    def __init__(self):
+        self.inodes = array.array(ARRAY_TYPE)
+        self.links = array.array(ARRAY_TYPE)
+        self.sizes = array.array(ARRAY_TYPE)
+        self.external = array.array(ARRAY_TYPE)
+
+    def __len__(self):
+        return len(self.inodes)
+
+    def append(self, inode, links, size, external):
+        '''Add an inode, which must be numbered higher than the others.
+        '''
+        self.inodes.append(inode)
+        self.links.append(links)
+        self.sizes.append(size)
+        self.external.append(external)
+
+    def total_bytes(self):
+        '''Bytes allocated to all the inodes in the table.
+
+        :rtype: int
+        '''
+        return sum(self.sizes)
+
+    def save(self, filename, key):
+        '''Write the table to a file.
+
+        :param str filename: File to write, it is replaced atomically.
+
+        :param tuple key: (device, inode, change time in microseconds) of
+                the scanned directory, so a different directory of the
+                same name is not mistaken for it.
+
+        :rtype: None
+        '''
+        tmpname = filename + '.tmp'
+        with open(tmpname, 'wb') as fp:
+            fp.write(cache_header.pack(CACHE_MAGIC, key[0], key[1], key[2],
+                    len(self)))
+            self.inodes.tofile(fp)
+            self.links.tofile(fp)
+            self.sizes.tofile(fp)
+            self.external.tofile(fp)
+        os.rename(tmpname, filename)
+
+    @classmethod
+    def load(cls, filename, key):
+        '''Read a table written by :py:meth:`save`.
+
+        :param str filename: File to read.
+
+        :param tuple key: The key the table must have been saved with.
+
+        :rtype: :py:class:`InodeTable` or None if the file does not exist
+                or is not for this key.
+        '''
+        table = cls()
+        try:
+            with open(filename, 'rb') as fp:
+                header = fp.read(cache_header.size)
+                if len(header) != cache_header.size:
+                    return None
+                fields = cache_header.unpack(header)
+                if fields[0] != CACHE_MAGIC or fields[1:4] != tuple(key):
+                    return None
+                table.inodes.fromfile(fp, fields[4])
+                table.links.fromfile(fp, fields[4])
+                table.sizes.fromfile(fp, fields[4])
+                table.external.fromfile(fp, fields[4])
+        except (IOError, EOFError):
+            return None
+        return table
+
+
+def scan_tree(path):
+    '''Find the inodes linked to from a directory tree, without crossing
+    into other file-systems.
+
+    :param str path: Top directory of the tree.
+
+    :rtype: :py:class:`InodeTable` with the link count of each inode as its
+            external links.
+    '''
+    st = os.lstat(path)
+    device = st.st_dev
+    #  (inode, size, link count) of each entry, the links of directories
+    #  are their sub-directories, not copies
+    run = [(st.st_ino, st.st_blocks * 512, 1)]
+    runs = []
+
+    def end_run():
+        packed = array.array(ARRAY_TYPE)
+        for record in sorted(run):
+            packed.extend(record)
+        runs.append(packed)
+        del run[:]
+
+    directories = [path]
+    while directories:
+        directory = directories.pop()
+        for name in os.listdir(directory):
+            entry = os.path.join(directory, name)
+            st = os.lstat(entry)
+            if st.st_dev != device:
+                continue
+            if stat.S_ISDIR(st.st_mode):
+                directories.append(entry)
+                run.append((st.st_ino, st.st_blocks * 512, 1))
+            else:
+                run.append((st.st_ino, st.st_blocks * 512, st.st_nlink))
+            if len(run) >= RUN_ENTRIES:
+                end_run()
+    if run:
+        end_run()
+
+    def records(packed):
+        for i in xrange(0, len(packed), 3):
+            yield packed[i], packed[i + 1], packed[i + 2]
+
+    #  one entry was added per link, collapse them into link counts
+    table = InodeTable()
+    last = None
+    for inode, size, nlink in heapq.merge(*[records(x) for x in runs]):
+        if inode == last:
+            table.links[-1] += 1
+        else:
+            last = inode
+            table.append(inode, 1, size, nlink)
+    return table
+
+
+def sum_links(tables):
+    '''Merge tables, adding up the links to each inode.  The external links
+    of each inode are those of the last table that has it.
+
+    :param list tables: :py:class:`InodeTable` instances, oldest first.
+
+    :rtype: :py:class:`InodeTable`
+    '''
+    totals = InodeTable()
+    last = None
+    for inode, index, links, size, external in heapq.merge(*[
+            itertools.izip(table.inodes, itertools.repeat(index),
+            table.links, table.sizes, table.external)
+            for index, table in enumerate(tables)]):
+        if inode == last:
+            totals.links[-1] += links
+            totals.external[-1] = external
+        else:
+            last = inode
+            totals.append(inode, links, size, external)
+    return totals
+
+
+def count_external(table, totals):
+    '''Replace the link counts of a newly scanned table with the number of
+    links that are not in the snapshots.
+
+    :param InodeTable table: Inodes of one tree, from :py:func:`scan_tree`.
+
+    :param InodeTable totals: Inodes of all the snapshots, from
+            :py:func:`sum_links`, which must include `table`.
+
+    :rtype: None
+    '''
+    position = 0
+    total_inodes = totals.inodes
+    for i in xrange(len(table)):
+        while total_inodes[position] != table.inodes[i]:
+            position += 1
+        table.external[i] = max(table.external[i] - totals.links[position],
+                0)
+
+
+def exclusive_bytes(table, totals):
+    '''Bytes of the inodes that have all their links in `table`, and none
+    from outside the snapshots.
+
+    :param InodeTable table: Inodes of one tree.
+
+    :param InodeTable totals: Inodes of all the trees, from
+            :py:func:`sum_links`, which must include `table`.
+
+    :rtype: int
+    '''
+    exclusive = 0
+    position = 0
+    total_inodes = totals.inodes
+    for i in xrange(len(table)):
+        inode = table.inodes[i]
+        while total_inodes[position] != inode:
+            position += 1
+        if (totals.links[position] == table.links[i]
+                and totals.external[position] == 0):
+            exclusive += table.sizes[i]
+    return exclusive
+
+
+class SnapshotUsage:
+    '''Space used by a snapshot.
+
+    .. py:attribute:: name
+
+    Name of the snapshot.
+
+    .. py:attribute:: total_bytes
+
+    Bytes of all the inodes the snapshot links to.
+
+    .. py:attribute:: exclusive_bytes
+
+    Bytes of the inodes only this snapshot links to, which would be freed
+    by removing it.
+
+    .. py:attribute:: shared_bytes
+
+    Bytes of the inodes also linked to from elsewhere.
+    '''
+
+    def __init__(self, name, total_bytes, exclusive_bytes):
+        self.name = name
+        self.total_bytes = total_bytes
+        self.exclusive_bytes = exclusive_bytes
+        self.shared_bytes = total_bytes - exclusive_bytes
+
+    def __repr__(self):
+        return '<SnapshotUsage(%s: exclusive=%d, shared=%d)>' % (
+                self.name, self.exclusive_bytes, self.shared_bytes)
+
+
+class AccountingReport:
+    '''Results of :py:func:`account_snapshots`.
+
+    .. py:attribute:: snapshots
+
+    List of :py:class:`SnapshotUsage`, in the order given.
+
+    .. py:attribute:: used_by_dataset
+
+    Bytes of the current backup, the newest snapshot.
+
+    .. py:attribute:: used_by_snapshots
+
+    Bytes used only by the older snapshots, freed if they were all removed.
+
+    .. py:attribute:: removable_bytes
+
+    Bytes that removing the snapshots listed in `removing` would free, or
+    None if none were listed.
+
+    .. py:attribute:: scanned
+
+    Number of snapshots that were scanned.
+
+    .. py:attribute:: reused
+
+    Number of snapshots whose saved scan was used.
+    '''
+
+    def __init__(self):
+        self.snapshots = []
+        self.used_by_dataset = 0
+        self.used_by_snapshots = 0
+        self.removable_bytes = None
+        self.scanned = 0
+        self.reused = 0
+
+    def __repr__(self):
+        return ('<AccountingReport(dataset=%d, snapshots=%d, scanned=%d, '
+                'reused=%d)>' % (self.used_by_dataset, self.used_by_snapshots,
+                self.scanned, self.reused))
+
+
+def account_snapshots(snapshots, cache_directory, mirror_newest=False,
+        removing=None):
+    '''Work out the space used by each of the snapshots of a host.  Scans
+    are saved in `cache_directory`, and those of snapshots that are no
+    longer listed are removed.
+
+    :param list snapshots: (name, path) of each snapshot, oldest first.
+            The paths must all be on the same file-system.
+
+    :param str cache_directory: Directory to save the scans in, created
+            if necessary.
+
+    :param Boolean mirror_newest: (Default False)  The newest snapshot is
+            also linked to from another tree, such as the "data" directory
+            of a hardlinks storage in "snapshot" mode, so none of its inodes
+            are exclusive to it.
+
+    :param list removing: (Default None)  Names of snapshots which are to
+            be removed together, to work out the bytes that would free.
+
+    :rtype: :py:class:`AccountingReport`
+    '''
+    report = AccountingReport()
+    if not os.path.exists(cache_directory):
+        os.mkdir(cache_directory, 0700)
+
+    tables = []
+    scanned = []
+    for name, path in snapshots:
+        st = os.lstat(path)
+        key = (st.st_dev, st.st_ino, int(st.st_ctime * 1000000))
+        filename = os.path.join(cache_directory, name + CACHE_SUFFIX)
+        table = InodeTable.load(filename, key)
+        if table == None:
+            table = scan_tree(path)
+            scanned.append((table, filename, key))
+            report.scanned += 1
+        else:
+            report.reused += 1
+        tables.append(table)
+
+    names = set([name + CACHE_SUFFIX for name, path in snapshots])
+    for filename in os.listdir(cache_directory):
+        if filename not in names:
+            os.remove(os.path.join(cache_directory, filename))
+
+    if not tables:
+        return report
+    if mirror_newest:
+        tables_linked = tables + tables[-1:]
+    else:
+        tables_linked = tables
+    totals = sum_links(tables_linked)
+    if scanned:
+        for table, filename, key in scanned:
+            count_external(table, totals)
+            table.save(filename, key)
+        totals = sum_links(tables_linked)
+    for (name, path), table in zip(snapshots, tables):
+        report.snapshots.append(SnapshotUsage(name, table.total_bytes(),
+                exclusive_bytes(table, totals)))
+
+    report.used_by_dataset = tables[-1].total_bytes()
+    report.used_by_snapshots = totals.total_bytes() - report.used_by_dataset
+
+    if removing != None:
+        #  inodes with all their links in the removed snapshots
+        removing = set(removing)
+        removed = [table for (name, path), table in zip(snapshots, tables)
+                if name in removing]
+        report.removable_bytes = exclusive_bytes(sum_links(removed), totals)
+    return report
@@ -0,0 +1,583 @@
+#!/usr/bin/env python
+#
+#  Copyright (c) 2012, Sean Reifschneider, tummy.com, ltd.
+#  All Rights Reserved.
+
+'''Catalog of the files in all the snapshots of a host.
+
+The catalog is an SQLite database kept with the manifests of the host.  It
+answers which snapshots hold a path, and which paths match a pattern,
+without reading the manifests of every snapshot.
+
+Each name used in a path is stored once, and each path is stored once as
+its parent path and its name.  A version of a path is its inode, size,
+modification time and mode, with the range of snapshots it is in: from the
+snapshot it appeared in to the last one before it changed, or open while
+it is in the newest snapshot.  Adding a snapshot only writes the paths
+that changed, found by comparing its manifest with the previous one (see
+:py:mod:`nabdiff`), so snapshots must be added oldest first; one older than
+the newest in the catalog is added by taking out the newer snapshots and
+adding them again after it.  Removing snapshots leaves the ranges as they
+are, and versions in no remaining snapshot are deleted.
+
+Names are indexed by their three-byte substrings, in lower case, so a
+pattern with a few literal characters only looks at the names that
+contain them, and a pattern of a path only looks under the directory
+before its first wildcard.
+'''
+
+import os
+import sqlite3
+import fnmatch
+import nabdiff
+import nabmanifest
+
+CATALOG_FILENAME = 'catalog.sqlite'
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS snapshots (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        name TEXT UNIQUE NOT NULL);
+CREATE TABLE IF NOT EXISTS names (
+        id INTEGER PRIMARY KEY,
+        name TEXT UNIQUE NOT NULL);
+CREATE TABLE IF NOT EXISTS trigrams (
+        trigram TEXT NOT NULL,
+        name INTEGER NOT NULL,
+        PRIMARY KEY (trigram, name)) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS paths (
+        id INTEGER PRIMARY KEY,
+        parent INTEGER NOT NULL,
+        name INTEGER NOT NULL,
+        UNIQUE (parent, name));
+CREATE INDEX IF NOT EXISTS paths_name ON paths (name);
+CREATE TABLE IF NOT EXISTS versions (
+        id INTEGER PRIMARY KEY,
+        path INTEGER NOT NULL,
+        inode INTEGER NOT NULL,
+        size INTEGER NOT NULL,
+        mtime INTEGER NOT NULL,
+        mode INTEGER NOT NULL,
+        first INTEGER NOT NULL,
+        last INTEGER);
+CREATE INDEX IF NOT EXISTS versions_path ON versions (path, first);
+'''
+
+#  path ID of the top of the snapshot, the parent of the top-level entries
+TOP = 0
+#  characters which are not matched literally by a pattern
+WILDCARDS = '*?['
+
+
+def trigrams(name):
+    '''Return the three-byte substrings of a name, in lower case.
+
+    :rtype: set of str
+    '''
+    name = name.lower()
+    return set([name[x:x + 3] for x in range(len(name) - 2)])
+
+
+def pattern_literals(pattern):
+    '''Split a pattern into the runs of characters it matches literally.
+
+    :param str pattern: A pattern as used by :py:mod:`fnmatch`.
+
+    :rtype: list of str, the last being '' unless the pattern ends with a
+            literal.
+    '''
+    literals = ['']
+    offset = 0
+    while offset < len(pattern):
+        c = pattern[offset]
+        offset += 1
+        if c not in WILDCARDS:
+            literals[-1] += c
+            continue
+        if c == '[':
+            end = pattern.find(']', offset + 1)
+            if end < 0:
+                literals[-1] += c
+                continue
+            offset = end + 1
+        literals.append('')
+    return literals
+
+
+class CatalogVersion:
+    '''A version of a path, from :py:meth:`Catalog.versions`.
+
+    .. py:attribute:: snapshots
+
+    Names of the snapshots the version is in, oldest first.
+    '''
+
+    def __init__(self, inode, size, mtime, mode, snapshots):
+        self.inode = inode
+        self.size = size
+        self.mtime = mtime
+        self.mode = mode
+        self.snapshots = snapshots
+
+    def __repr__(self):
+        return '<CatalogVersion(size=%d, mtime=%d, snapshots=%d)>' % (
+                self.size, self.mtime, len(self.snapshots))
+
+
+class CatalogMatch:
+    '''A path found by :py:meth:`Catalog.find`.
+
+    .. py:attribute:: path
+
+    The path, relative to the top of the snapshots.
+
+    .. py:attribute:: snapshots
+
+    Number of snapshots the path is in.
+
+    .. py:attribute:: first
+
+    Name of the oldest snapshot the path is in, and likewise `last`.
+    '''
+
+    def __init__(self, path, snapshots, first, last):
+        self.path = path
+        self.snapshots = snapshots
+        self.first = first
+        self.last = last
+
+    def __repr__(self):
+        return '<CatalogMatch(%s, snapshots=%d)>' % (self.path,
+                self.snapshots)
+
+
+class Catalog:
+    '''The catalog of the snapshots of a host.
+
+    :param str filename: SQLite database, created if necessary.
+    '''
+
+    def __init__(self, filename):
+        self.db = sqlite3.connect(filename)
+        self.db.text_factory = str
+        self.db.executescript(SCHEMA)
+        self.name_ids = {}
+        self.path_ids = {'': TOP}
+        self.paths = {TOP: ''}
+
+    def close(self):
+        self.db.close()
+
+    def snapshot_names(self):
+        '''Return the names of the snapshots in the catalog, oldest first.
+
+        :rtype: list of str
+        '''
+        return [x[0] for x in self.db.execute('SELECT name FROM snapshots '
+                'ORDER BY id')]
+
+    def last_snapshot(self):
+        '''Return the newest snapshot in the catalog.
+
+        :rtype: tuple of (ID, name), or None if it is empty.
+        '''
+        return self.db.execute('SELECT id, name FROM snapshots '
+                'ORDER BY id DESC LIMIT 1').fetchone()
+
+    def name_id(self, name, create=True):
+        '''Return the ID of a name, adding it and its trigrams if it is
+        new.
+
+        :rtype: int, or None if it is new and `create` is False.
+        '''
+        name_id = self.name_ids.get(name)
+        if name_id != None:
+            return name_id
+        row = self.db.execute('SELECT id FROM names WHERE name = ?',
+                (name, )).fetchone()
+        if row != None:
+            name_id = row[0]
+        elif not create:
+            return None
+        else:
+            name_id = self.db.execute('INSERT INTO names (name) VALUES (?)',
+                    (name, )).lastrowid
+            self.db.executemany('INSERT INTO trigrams (trigram, name) '
+                    'VALUES (?, ?)', [(x, name_id) for x in trigrams(name)])
+        self.name_ids[name] = name_id
+        return name_id
+
+    def path_id(self, path, create=True):
+        '''Return the ID of a path, adding it and its parents if they are
+        new.  The IDs of parents are cached, as they are looked up again
+        for each of their entries.
+
+        :rtype: int, or None if it is new and `create` is False.
+        '''
+        path_id = self.path_ids.get(path)
+        if path_id != None:
+            return path_id
+        if '/' in path:
+            parent, name = path.rsplit('/', 1)
+            parent_id = self.path_id(parent, create)
+            if parent_id == None:
+                return None
+        else:
+            parent, name, parent_id = '', path, TOP
+        name_id = self.name_id(name, create)
+        if name_id == None:
+            return None
+        row = self.db.execute('SELECT id FROM paths WHERE parent = ? AND '
+                'name = ?', (parent_id, name_id)).fetchone()
+        if row != None:
+            path_id = row[0]
+        elif not create:
+            return None
+        else:
+            path_id = self.db.execute('INSERT INTO paths (parent, name) '
+                    'VALUES (?, ?)', (parent_id, name_id)).lastrowid
+        #  only directories are parents
+        self.path_ids[parent] = parent_id
+        return path_id
+
+    def path_string(self, path_id):
+        '''Return the path with an ID, caching the paths of its parents.
+
+        :rtype: str
+        '''
+        path = self.paths.get(path_id)
+        if path != None:
+            return path
+        parent_id, name = self.db.execute('SELECT paths.parent, names.name '
+                'FROM paths JOIN names ON names.id = paths.name '
+                'WHERE paths.id = ?', (path_id, )).fetchone()
+        parent = self.paths.get(parent_id)
+        if parent == None:
+            parent = self.path_string(parent_id)
+            self.paths[parent_id] = parent
+        if parent:
+            return parent + '/' + name
+        return name
+
+    def open_entries(self):
+        '''List the versions in the newest snapshot, in manifest order.
+        They are all held in memory to be sorted, so this is only used when
+        the manifest of the newest snapshot is missing.
+
+        :rtype: list of :py:class:`nabmanifest.ManifestEntry`
+        '''
+        entries = [nabmanifest.ManifestEntry(self.path_string(x[0]), *x[1:])
+                for x in self.db.execute('SELECT path, inode, size, mtime, '
+                    'mode FROM versions WHERE last IS NULL').fetchall()]
+        entries.sort(key=lambda x: nabmanifest.path_key(x.path))
+        return entries
+
+    def add_snapshot(self, snapshotname, manifest_filename,
+            previous_manifest=None):
+        '''Add a snapshot, which must be newer than those in the catalog.
+
+        :param str snapshotname: Name of the snapshot.
+
+        :param str manifest_filename: Manifest of the snapshot.
+
+        :param str previous_manifest: (Default None)  Manifest of the
+                newest snapshot in the catalog.  If it is None or missing,
+                the catalog is listed instead.
+
+        :rtype: :py:class:`nabdiff.DiffStatistics` of the changes since the
+                previous snapshot.
+        '''
+        if self.db.execute('SELECT 1 FROM snapshots WHERE name = ?',
+                (snapshotname, )).fetchone():
+            raise ValueError('Snapshot "%s" is already in the catalog'
+                    % snapshotname)
+        last = self.last_snapshot()
+        if last == None:
+            old_entries = []
+        elif previous_manifest != None and os.path.exists(previous_manifest):
+            old_entries = nabmanifest.read_manifest(previous_manifest)
+        else:
+            old_entries = self.open_entries()
+
+        statistics = nabdiff.DiffStatistics()
+        try:
+            snapshot_id = self.db.execute('INSERT INTO snapshots (name) '
+                    'VALUES (?)', (snapshotname, )).lastrowid
+            for change, old, new in nabdiff.diff_entries(old_entries,
+                    nabmanifest.read_manifest(manifest_filename),
+                    statistics=statistics):
+                if old != None:
+                    self.db.execute('UPDATE versions SET last = ? WHERE '
+                            'path = ? AND last IS NULL', (last[0],
+                            self.path_id(old.path)))
+                if new != None:
+                    self.db.execute('INSERT INTO versions (path, inode, '
+                            'size, mtime, mode, first) VALUES (?, ?, ?, ?, '
+                            '?, ?)', (self.path_id(new.path), new.inode,
+                            new.size, new.mtime, new.mode, snapshot_id))
+            self.db.commit()
+        except:
+            self.db.rollback()
+            self.name_ids = {}
+            self.path_ids = {'': TOP}
+            raise
+        return statistics
+
+    def remove_snapshots(self, snapshotnames):
+        '''Remove snapshots, and the versions in none of those remaining.
+        Snapshots not in the catalog are skipped.
+
+        :param list snapshotnames: Names of the snapshots.
+
+        :rtype: int Number of snapshots removed.
+        '''
+        count = 0
+        for name in snapshotnames:
+            count += self.db.execute('DELETE FROM snapshots WHERE name = ?',
+                    (name, )).rowcount
+        if count == 0:
+            return 0
+        last = self.last_snapshot()
+        if last == None:
+            self.db.execute('DELETE FROM versions')
+        else:
+            #  versions open after the newest snapshot left were in it
+            self.db.execute('DELETE FROM versions WHERE first > ?',
+                    (last[0], ))
+            self.db.execute('UPDATE versions SET last = NULL WHERE '
+                    'last >= ?', (last[0], ))
+            self.db.execute('DELETE FROM versions WHERE last IS NOT NULL AND '
+                    'NOT EXISTS (SELECT 1 FROM snapshots WHERE id >= '
+                    'versions.first AND id <= versions.last)')
+        self.db.commit()
+        return count
+
+    def versions(self, path):
+        '''Return the versions of a path, oldest first.
+
+        :param str path: Path relative to the top of the snapshots, with or
+                without a leading "/".
+
+        :rtype: list of :py:class:`CatalogVersion`
+        '''
+        path_id = self.path_id(path.strip('/'), create=False)
+        if path_id == None:
+            return []
+        versions = []
+        for inode, size, mtime, mode, first, last in self.db.execute(
+                'SELECT inode, size, mtime, mode, first, last FROM versions '
+                'WHERE path = ? ORDER BY first', (path_id, )).fetchall():
+            snapshots = [x[0] for x in self.db.execute('SELECT name FROM '
+                    'snapshots WHERE id >= ? AND (? IS NULL OR id <= ?) '
+                    'ORDER BY id', (first, last, last))]
+            if snapshots:
+                versions.append(CatalogVersion(inode, size, mtime, mode,
+                        snapshots))
+        return versions
+
+    def candidate_names(self, literal):
+        '''Return the IDs of the names which may contain a literal, using
+        the trigram index if it is long enough.
+
+        :rtype: list of int, or None if every name is a candidate.
+        '''
+        grams = trigrams(literal)
+        if not grams:
+            return None
+        query = ' INTERSECT '.join(['SELECT name FROM trigrams WHERE '
+                'trigram = ?'] * len(grams))
+        return [x[0] for x in self.db.execute(query, list(grams))]
+
+    def descendants(self, path_id, name_ids=None):
+        '''Return the IDs of the paths under a directory, walking down
+        from it through the parents of the paths.
+
+        :param list name_ids: (Default None)  Only return the paths with
+                one of these names, or with any name if None.
+
+        :rtype: list of int
+        '''
+        if name_ids != None:
+            name_ids = set(name_ids)
+        found = []
+        parents = [path_id]
+        while parents:
+            children = []
+            for offset in range(0, len(parents), 500):
+                chunk = parents[offset:offset + 500]
+                children.extend(self.db.execute('SELECT id, name FROM paths '
+                        'WHERE parent IN (%s)' % ','.join('?' * len(chunk)),
+                        chunk))
+            found.extend([x[0] for x in children
+                    if name_ids == None or x[1] in name_ids])
+            parents = [x[0] for x in children]
+        return found
+
+    def find(self, pattern, ignore_case=False, limit=None):
+        '''Find the paths matching a pattern in any snapshot.  A pattern
+        without "/" matches the names of entries, as with "find -name",
+        and otherwise it matches the whole path.  Only the paths under the
+        directory before its first wildcard are looked at, and all of them
+        if it starts with one.
+
+        :param str pattern: A pattern as used by :py:mod:`fnmatch`.
+
+        :param boolean ignore_case: (Default False)  Match regardless of
+                case.
+
+        :param int limit: (Default None)  Return at most this many paths.
+
+        :rtype: list of :py:class:`CatalogMatch`, in path order.
+        '''
+        by_name = '/' not in pattern.strip('/')
+        pattern = pattern.strip('/')
+        literals = pattern_literals(pattern)
+        if by_name:
+            #  a name has no "/", so every literal is in it
+            literal = max(literals, key=len)
+        else:
+            #  only a literal at the end is sure to be in the last name
+            literal = literals[-1].rsplit('/', 1)[-1]
+        directory = None
+        if not by_name and not ignore_case and '/' in literals[0]:
+            directory = literals[0].rsplit('/', 1)[0]
+        if ignore_case:
+            pattern = pattern.lower()
+
+        def matches(text):
+            if ignore_case:
+                return fnmatch.fnmatchcase(text.lower(), pattern)
+            return fnmatch.fnmatchcase(text, pattern)
+
+        name_ids = self.candidate_names(literal)
+        if directory != None:
+            directory_id = self.path_id(directory, create=False)
+            if directory_id == None:
+                return []
+            path_ids = self.descendants(directory_id, name_ids)
+        else:
+            if name_ids == None:
+                names = self.db.execute('SELECT id, name FROM names')
+            else:
+                names = []
+                for offset in range(0, len(name_ids), 500):
+                    chunk = name_ids[offset:offset + 500]
+                    names.extend(self.db.execute('SELECT id, name FROM '
+                            'names WHERE id IN (%s)' % ','.join(
+                            '?' * len(chunk)), chunk))
+            if by_name:
+                name_ids = [x[0] for x in names if matches(x[1])]
+            else:
+                name_ids = [x[0] for x in names]
+            path_ids = []
+            for offset in range(0, len(name_ids), 500):
+                chunk = name_ids[offset:offset + 500]
+                path_ids.extend([x[0] for x in self.db.execute('SELECT id '
+                        'FROM paths WHERE name IN (%s)' % ','.join(
+                        '?' * len(chunk)), chunk)])
+
+        paths = []
+        for path_id in path_ids:
+            path = self.path_string(path_id)
+            if by_name or matches(path):
+                paths.append((nabmanifest.path_key(path), path, path_id))
+        paths.sort()
+
+        found = []
+        for key, path, path_id in paths:
+            count, first, last = self.db.execute('SELECT COUNT(*), '
+                    'MIN(snapshots.id), MAX(snapshots.id) FROM versions '
+                    'JOIN snapshots ON snapshots.id >= versions.first AND '
+                    '(versions.last IS NULL OR snapshots.id <= versions.last) '
+                    'WHERE versions.path = ?', (path_id, )).fetchone()
+            if not count:
+                continue
+            found.append(CatalogMatch(path, count, self.snapshot_name(first),
+                    self.snapshot_name(last)))
+            if limit != None and len(found) >= limit:
+                break
+        return found
+
+    def snapshot_name(self, snapshot_id):
+        return self.db.execute('SELECT name FROM snapshots WHERE id = ?',
+                (snapshot_id, )).fetchone()[0]
+
+
+def catalog_path(plugin, hostname):
+    '''Return the catalog file of a host, which is kept with its manifests.
+
+    :rtype: str
+    '''
+    return os.path.join(plugin.get_backup_top_directory(hostname),
+            CATALOG_FILENAME)
+
+
+def open_catalog(plugin, hostname):
+    '''Open the catalog of a host.
+
+    :rtype: :py:class:`Catalog`
+    '''
+    return Catalog(catalog_path(plugin, hostname))
+
+
+def update_catalog(plugin, hostname, snapshotnames):
+    '''Add new snapshots of a host to its catalog, from their manifests.
+    Snapshots without a manifest, or already in the catalog, are skipped.
+    The catalog is kept in order: if a snapshot is older than some already
+    in the catalog, those are removed and added again after it.
+
+    :param Storage plugin: Storage plugin of the host.
+
+    :param str hostname: Name of the host.
+
+    :param list snapshotnames: Names of the snapshots, oldest first.
+
+    :rtype: int Number of snapshots added.
+    '''
+    if not hasattr(plugin, 'get_manifest_path'):
+        return 0
+    catalog = open_catalog(plugin, hostname)
+    try:
+        existing = catalog.snapshot_names()
+        new = [x for x in snapshotnames if x not in existing and
+                os.path.exists(plugin.get_manifest_path(hostname, x))]
+        if not new:
+            return 0
+
+        #  the snapshots in the catalog from the first newer than a new one
+        start = snapshotnames.index(new[0])
+        newer = [x for x in existing if x in snapshotnames[start:]]
+        readd = []
+        if newer:
+            readd = existing[existing.index(newer[0]):]
+            catalog.remove_snapshots(readd)
+
+        for name in snapshotnames[start:]:
+            manifest = plugin.get_manifest_path(hostname, name)
+            if (name not in new and name not in readd) or not os.path.exists(
+                    manifest):
+                continue
+            last = catalog.last_snapshot()
+            previous = None
+            if last != None:
+                previous = plugin.get_manifest_path(hostname, last[1])
+            catalog.add_snapshot(name, manifest, previous)
+        return len(new)
+    finally:
+        catalog.close()
+
+
+def remove_from_catalog(plugin, hostname, snapshotnames):
+    '''Remove destroyed snapshots of a host from its catalog, if it has
+    one.
+
+    :rtype: int Number of snapshots removed.
+    '''
+    if not hasattr(plugin, 'get_manifest_path') or not os.path.exists(
+            catalog_path(plugin, hostname)):
+        return 0
+    catalog = open_catalog(plugin, hostname)
+    try:
+        return catalog.remove_snapshots(snapshotnames)
+    finally:
+        catalog.close()
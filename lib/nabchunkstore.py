@@ -0,0 +1,933 @@
+#!/usr/bin/env python
+#
+#  Copyright (c) 2012, Sean Reifschneider, tummy.com, ltd.
+#  All Rights Reserved.
+
+'''Content-addressed chunk storage for Network Attached Backup.
+
+Files are cut into chunks at boundaries chosen by their contents, so a
+change in the middle of a large file only changes the chunks around it,
+and the rest are shared with earlier snapshots.  Each
+chunk is identified by the SHA-1 of its contents, compressed with zlib
+and appended to a pack file.  The index, an SQLite database, maps each
+chunk to its pack, offset and length, and counts the snapshots which
+refer to it.
+
+A snapshot is a tree file listing every entry like a manifest (see
+:py:mod:`nabmanifest`), with the owner and, for files, the chunk IDs.
+Files whose size, times and inode are unchanged since the previous
+snapshot reuse its chunk IDs without being read.
+
+Destroying a snapshot only decrements the references of its chunks.
+:py:meth:`ChunkStore.collect_garbage` removes the unreferenced chunks a
+few packs at a time: packs holding only garbage are deleted, and packs
+with the most garbage have their live chunks copied to the current pack,
+without recompressing them.  Other packs are left alone.
+'''
+
+import os
+import stat
+import time
+import zlib
+import errno
+import fcntl
+import hashlib
+import sqlite3
+from nabmanifest import encode_number, decode_number, encode_signed, \
+        decode_signed, encode_path, path_key
+import nabmanifest
+import nabrestore
+
+TREE_MAGIC = 'NABTRE02\n'
+#  trees without the link counts and device numbers are still read
+TREE_MAGIC_V1 = 'NABTRE01\n'
+#  chunk sizes, the average must be a power of two
+MIN_CHUNK_SIZE = 16 * 1024
+AVERAGE_CHUNK_SIZE = 64 * 1024
+MAX_CHUNK_SIZE = 256 * 1024
+#  a new pack is started once the current one is this large
+PACK_SIZE = 64 * 1024 * 1024
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS chunks (
+    id BLOB PRIMARY KEY,
+    pack INTEGER NOT NULL,
+    offset INTEGER NOT NULL,
+    length INTEGER NOT NULL,
+    size INTEGER NOT NULL,
+    refs INTEGER NOT NULL DEFAULT 0);
+CREATE INDEX IF NOT EXISTS ix_chunks_pack ON chunks (pack);
+'''
+
+
+def make_byte_classes():
+    '''Return the "str.translate()" table putting each byte in one of 16
+    classes of 16 bytes, for finding chunk boundaries.  The classes are
+    derived from SHA-1 so every store cuts at the same places.
+
+    :rtype: str
+    '''
+    ranked = sorted(range(256), key=lambda x: hashlib.sha1(
+            'nab-class-%d' % x).digest())
+    classes = [0] * 256
+    for rank, byte in enumerate(ranked):
+        classes[byte] = rank // 16
+    return ''.join([chr(x) for x in classes])
+
+BYTE_CLASSES = make_byte_classes()
+#  a boundary may follow these classes, one place in 4096 of random data
+ANCHOR = '\x01\x02\x03'
+#  bytes before a possible boundary whose hash decides it
+WINDOW_SIZE = 32
+
+
+def find_boundary(data, min_size, max_size, mask, classes=None):
+    '''Find the end of the first chunk of `data`, the first position after
+    `min_size` which follows an :py:data:`ANCHOR` and where the CRC of
+    the last :py:data:`WINDOW_SIZE` bytes has none of the `mask` bits
+    set, or `max_size`.  Searching for the anchors with "str.find()"
+    leaves only a few positions in each chunk to hash in Python.
+
+    :param str classes: (Default None)  `data` translated with
+            :py:data:`BYTE_CLASSES`, if already done.
+
+    :rtype: int
+    '''
+    end = min(len(data), max_size)
+    if end <= min_size:
+        return end
+    if classes == None:
+        classes = data[:end].translate(BYTE_CLASSES)
+    start = max(0, min_size + 1 - len(ANCHOR))
+    while True:
+        found = classes.find(ANCHOR, start, end)
+        if found < 0:
+            return end
+        position = found + len(ANCHOR)
+        window = data[max(0, position - WINDOW_SIZE):position]
+        if not zlib.crc32(window) & mask:
+            return position
+        start = found + 1
+
+
+def chunk_file(fp, min_size=MIN_CHUNK_SIZE,
+        average_size=AVERAGE_CHUNK_SIZE, max_size=MAX_CHUNK_SIZE):
+    '''Read a file as content-defined chunks.
+
+    :param file fp: File to read.
+
+    :rtype: generator of str
+    '''
+    bits = average_size.bit_length() - 1
+    #  each class of the anchor is 4 bits of the average, the CRC the rest
+    mask = (1 << max(0, bits - 4 * len(ANCHOR))) - 1
+    data = ''
+    classes = ''
+    eof = False
+    while True:
+        while not eof and len(data) < max_size * 4:
+            block = fp.read(1024 * 1024)
+            if not block:
+                eof = True
+            data += block
+            classes += block.translate(BYTE_CLASSES)
+        if not data:
+            return
+        offset = 0
+        while len(data) - offset >= max_size or (eof and offset < len(data)):
+            end = offset + find_boundary(buffer(data, offset, max_size),
+                    min_size, max_size, mask,
+                    classes[offset:offset + max_size])
+            yield data[offset:end]
+            offset = end
+        data = data[offset:]
+        classes = classes[offset:]
+
+
+class TreeEntry(object):
+    '''An entry of a snapshot tree.
+
+    .. py:attribute:: chunks
+
+    List of the IDs of the chunks of a file, in order.
+
+    .. py:attribute:: link
+
+    Target of a symbolic link, or None.
+
+    .. py:attribute:: nlink
+
+    Number of hard links, or 0 if not known.
+
+    .. py:attribute:: rdev
+
+    Device number of a device file.
+    '''
+
+    __slots__ = ('path', 'mode', 'uid', 'gid', 'size', 'mtime', 'ctime',
+            'inode', 'chunks', 'link', 'nlink', 'rdev')
+
+    def __init__(self, path, mode, uid, gid, size, mtime, ctime, inode,
+            chunks=(), link=None, nlink=1, rdev=0):
+        self.path = path
+        self.mode = mode
+        self.uid = uid
+        self.gid = gid
+        self.size = size
+        self.mtime = mtime
+        self.ctime = ctime
+        self.inode = inode
+        self.chunks = chunks
+        self.link = link
+        self.nlink = nlink
+        self.rdev = rdev
+
+    def unchanged(self, st):
+        '''Is a file with this stat result the same as this entry?
+
+        :rtype: boolean
+        '''
+        return (st.st_size == self.size and int(st.st_mtime) == self.mtime
+                and int(st.st_ctime) == self.ctime
+                and st.st_ino == self.inode and st.st_mode == self.mode)
+
+    def __repr__(self):
+        return '<TreeEntry(%s, size=%d, chunks=%d)>' % (self.path,
+                self.size, len(self.chunks))
+
+
+class TreeWriter:
+    '''Write a snapshot tree, in manifest order.  Like a manifest, it is
+    written under a temporary name and renamed when it is closed.
+
+    :param str filename: Tree file to create.
+    '''
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.tmpname = filename + '.tmp'
+        self.fp = open(self.tmpname, 'wb')
+        self.fp.write(TREE_MAGIC)
+        self.compressor = zlib.compressobj()
+        self.previous = ''
+        self.buffer = []
+        self.buffered = 0
+        self.count = 0
+
+    def add(self, entry):
+        '''Add an entry.
+
+        :param TreeEntry entry: The entry.
+
+        :rtype: None
+        '''
+        path = encode_path(entry.path)
+        prefix = len(os.path.commonprefix([self.previous, path]))
+        record = [encode_number(prefix), encode_number(len(path) - prefix),
+                path[prefix:], encode_number(entry.mode),
+                encode_number(entry.uid), encode_number(entry.gid),
+                encode_number(entry.size), encode_signed(entry.mtime),
+                encode_signed(entry.ctime), encode_number(entry.inode),
+                encode_number(entry.nlink), encode_number(entry.rdev)]
+        if entry.link != None:
+            link = encode_path(entry.link)
+            record.extend([encode_number(len(link)), link])
+        else:
+            record.append(encode_number(len(entry.chunks)))
+            record.extend(entry.chunks)
+        record = ''.join(record)
+        self.buffer.append(encode_number(len(record)))
+        self.buffer.append(record)
+        self.buffered += len(record)
+        if self.buffered >= 65536:
+            self.flush()
+        self.previous = path
+        self.count += 1
+
+    def flush(self):
+        self.fp.write(self.compressor.compress(''.join(self.buffer)))
+        self.buffer = []
+        self.buffered = 0
+
+    def close(self):
+        '''Finish writing the tree.
+
+        :rtype: None
+        '''
+        self.flush()
+        self.fp.write(self.compressor.flush())
+        self.fp.close()
+        os.rename(self.tmpname, self.filename)
+
+    def abort(self):
+        '''Discard the tree.
+
+        :rtype: None
+        '''
+        self.fp.close()
+        os.remove(self.tmpname)
+
+
+def read_tree(filename):
+    '''Read the entries of a snapshot tree, in order.
+
+    :param str filename: Tree file.
+
+    :rtype: iterator of :py:class:`TreeEntry`
+    '''
+    with open(filename, 'rb') as fp:
+        magic = fp.read(len(TREE_MAGIC))
+        if magic not in (TREE_MAGIC, TREE_MAGIC_V1):
+            raise ValueError('"%s" is not a snapshot tree' % filename)
+        decompressor = zlib.decompressobj()
+
+        def read_more():
+            block = fp.read(65536)
+            if block:
+                return decompressor.decompress(block), False
+            return decompressor.flush(), True
+
+        data = ''
+        offset = 0
+        path = ''
+        eof = False
+        while True:
+            if len(data) - offset < 65536 and not eof:
+                more, eof = read_more()
+                data = data[offset:] + more
+                offset = 0
+                continue
+            if offset >= len(data):
+                return
+            length, offset = decode_number(data, offset)
+            #  the records of large files can be much larger than a block
+            if offset + length > len(data) and not eof:
+                parts = [data[offset:]]
+                have = len(parts[0])
+                while have < length and not eof:
+                    more, eof = read_more()
+                    parts.append(more)
+                    have += len(more)
+                data = ''.join(parts)
+                offset = 0
+            if offset + length > len(data):
+                raise ValueError('Tree "%s" is truncated' % filename)
+            prefix, offset = decode_number(data, offset)
+            suffix_length, offset = decode_number(data, offset)
+            path = path[:prefix] + data[offset:offset + suffix_length]
+            offset += suffix_length
+            mode, offset = decode_number(data, offset)
+            uid, offset = decode_number(data, offset)
+            gid, offset = decode_number(data, offset)
+            size, offset = decode_number(data, offset)
+            mtime, offset = decode_signed(data, offset)
+            ctime, offset = decode_signed(data, offset)
+            inode, offset = decode_number(data, offset)
+            nlink = 0
+            rdev = 0
+            if magic == TREE_MAGIC:
+                nlink, offset = decode_number(data, offset)
+                rdev, offset = decode_number(data, offset)
+            count, offset = decode_number(data, offset)
+            link = None
+            chunks = ()
+            if stat.S_ISLNK(mode):
+                link = data[offset:offset + count]
+                offset += count
+            else:
+                chunks = [data[offset + x * 20:offset + x * 20 + 20]
+                        for x in range(count)]
+                offset += count * 20
+            yield TreeEntry(path, mode, uid, gid, size, mtime, ctime, inode,
+                    chunks, link, nlink, rdev)
+
+
+def tree_chunk_counts(filename):
+    '''Return the chunks a snapshot tree refers to.
+
+    :rtype: dict Mapping chunk ID to the number of times it is used.
+    '''
+    counts = {}
+    for entry in read_tree(filename):
+        for chunk_id in entry.chunks:
+            counts[chunk_id] = counts.get(chunk_id, 0) + 1
+    return counts
+
+
+class SnapshotStatistics:
+    '''Results of :py:meth:`ChunkStore.snapshot`.
+
+    .. py:attribute:: files
+
+    Number of regular files in the snapshot.
+
+    .. py:attribute:: files_read
+
+    Number of files which were changed and read.
+
+    .. py:attribute:: bytes_read
+
+    Bytes of the files read.
+
+    .. py:attribute:: chunks_stored
+
+    Number of new chunks added to the store.
+
+    .. py:attribute:: bytes_stored
+
+    Compressed bytes of the new chunks.
+
+    .. py:attribute:: seconds
+
+    Elapsed time of the snapshot.
+    '''
+
+    def __init__(self):
+        self.files = 0
+        self.files_read = 0
+        self.bytes_read = 0
+        self.chunks_stored = 0
+        self.bytes_stored = 0
+        self.seconds = 0.0
+
+    def __repr__(self):
+        return '<SnapshotStatistics(read %d of %d files, stored %d)>' % (
+                self.files_read, self.files, self.bytes_stored)
+
+    def summary(self):
+        '''Return a line describing the snapshot, for the backup log.
+
+        :rtype: str
+        '''
+        return ('Read %d of %d files (%d bytes), stored %d new chunks '
+                '(%d bytes) in %.1f seconds' % (self.files_read, self.files,
+                self.bytes_read, self.chunks_stored, self.bytes_stored,
+                self.seconds))
+
+
+class GarbageStatistics:
+    '''Results of :py:meth:`ChunkStore.collect_garbage`.
+
+    .. py:attribute:: packs_removed
+
+    Number of packs deleted because they only held garbage.
+
+    .. py:attribute:: packs_rewritten
+
+    Number of packs whose live chunks were copied to the current pack.
+
+    .. py:attribute:: chunks_removed
+
+    Number of unreferenced chunks removed.
+
+    .. py:attribute:: bytes_freed
+
+    Bytes of pack files freed.
+    '''
+
+    def __init__(self):
+        self.packs_removed = 0
+        self.packs_rewritten = 0
+        self.chunks_removed = 0
+        self.bytes_freed = 0
+
+    def __repr__(self):
+        return '<GarbageStatistics(removed %d, rewrote %d, freed %d)>' % (
+                self.packs_removed, self.packs_rewritten, self.bytes_freed)
+
+
+class ChunkStore:
+    '''A store of compressed chunks in pack files, with their index.
+
+    Readers hold a shared lock on the store while it is open.  Writers
+    also hold an exclusive write lock, so backups of several hosts add
+    their snapshots one at a time, but do not stop readers: chunks are on
+    disk before the index refers to them.  Only
+    :py:meth:`collect_garbage`, which deletes packs, waits for the readers
+    to finish and excludes them.
+
+    :param str directory: Directory of the store, created if necessary.
+
+    :param int pack_size: (Default :py:data:`PACK_SIZE`)  Size at which a
+            new pack is started.
+
+    :param boolean write: (Default True)  Open the store for writing,
+            otherwise only reading is allowed.
+
+    :param boolean wait: (Default True)  Wait for the locks, otherwise
+            raise IOError if another user of the store holds them.
+    '''
+
+    def __init__(self, directory, pack_size=PACK_SIZE, write=True,
+            wait=True):
+        self.directory = directory
+        self.pack_size = pack_size
+        self.write = write
+        self.wait = wait
+        self.packs_directory = os.path.join(directory, 'packs')
+        if not os.path.exists(self.packs_directory):
+            os.makedirs(self.packs_directory)
+        self.write_lock_fp = None
+        self.lock_fp = open(os.path.join(directory, 'lock'), 'a')
+        try:
+            if write:
+                self.write_lock_fp = open(os.path.join(directory,
+                        'write.lock'), 'a')
+                self.lock(self.write_lock_fp, fcntl.LOCK_EX)
+            self.lock(self.lock_fp, fcntl.LOCK_SH)
+        except:
+            self.release()
+            raise
+        self.db = sqlite3.connect(os.path.join(directory, 'index.sqlite'))
+        self.db.text_factory = str
+        self.db.executescript(SCHEMA)
+        self.pack_fp = None
+        self.pack_id = None
+        self.read_fps = {}
+
+    def close(self):
+        '''Commit the index and release the store.
+
+        :rtype: None
+        '''
+        self.commit()
+        if self.pack_fp != None:
+            self.pack_fp.close()
+            self.pack_fp = None
+        for fp in self.read_fps.values():
+            fp.close()
+        self.read_fps = {}
+        self.db.close()
+        self.release()
+
+    def lock(self, fp, operation):
+        '''Lock a lock file of the store, without waiting unless
+        :py:attr:`wait` is set.
+
+        :param file fp: The lock file.
+
+        :param int operation: The "fcntl.flock()" operation.
+
+        :rtype: None
+        '''
+        if not self.wait:
+            operation |= fcntl.LOCK_NB
+        try:
+            fcntl.flock(fp, operation)
+        except IOError, e:
+            if e.errno not in (errno.EWOULDBLOCK, errno.EAGAIN):
+                raise
+            raise IOError(e.errno, 'Chunk store "%s" is busy' %
+                    self.directory)
+
+    def release(self):
+        '''Release the locks on the store.
+
+        :rtype: None
+        '''
+        if self.write_lock_fp != None:
+            self.write_lock_fp.close()
+            self.write_lock_fp = None
+        self.lock_fp.close()
+
+    def check_writable(self):
+        '''Raise ValueError if the store was opened only for reading.
+
+        :rtype: None
+        '''
+        if not self.write:
+            raise ValueError('Chunk store "%s" is open read-only' %
+                    self.directory)
+
+    def commit(self):
+        '''Make the chunks written so far durable, then commit the index,
+        so the index never refers to data that is not on disk.
+
+        :rtype: None
+        '''
+        if self.pack_fp != None:
+            self.pack_fp.flush()
+            os.fsync(self.pack_fp.fileno())
+        self.db.commit()
+
+    def pack_path(self, pack_id):
+        return os.path.join(self.packs_directory, 'pack-%08d' % pack_id)
+
+    def open_pack(self):
+        '''Return the pack to append to, starting a new one if the current
+        one is full.
+
+        :rtype: file
+        '''
+        self.check_writable()
+        if self.pack_fp != None and self.pack_fp.tell() < self.pack_size:
+            return self.pack_fp
+        if self.pack_fp != None:
+            self.pack_fp.flush()
+            os.fsync(self.pack_fp.fileno())
+            self.pack_fp.close()
+            self.pack_fp = None
+
+        existing = [int(x[5:]) for x in os.listdir(self.packs_directory)
+                if x.startswith('pack-')]
+        if existing and (self.pack_id == None or self.pack_id <
+                max(existing)):
+            pack_id = max(existing)
+            if os.path.getsize(self.pack_path(pack_id)) < self.pack_size:
+                self.pack_id = pack_id
+                self.pack_fp = open(self.pack_path(pack_id), 'ab')
+                return self.pack_fp
+        self.pack_id = max(existing + [0]) + 1
+        self.pack_fp = open(self.pack_path(self.pack_id), 'ab')
+        return self.pack_fp
+
+    def append(self, compressed):
+        '''Append compressed data to the current pack.
+
+        :rtype: tuple of (pack ID, offset)
+        '''
+        fp = self.open_pack()
+        fp.seek(0, os.SEEK_END)
+        offset = fp.tell()
+        fp.write(compressed)
+        return self.pack_id, offset
+
+    def add_chunk(self, data):
+        '''Store a chunk unless it is already stored.
+
+        :param str data: Contents of the chunk.
+
+        :rtype: tuple of the chunk ID and the compressed bytes stored, 0 if
+                it was already stored.
+        '''
+        chunk_id = hashlib.sha1(data).digest()
+        if self.db.execute('SELECT 1 FROM chunks WHERE id = ?',
+                (sqlite3.Binary(chunk_id), )).fetchone():
+            return chunk_id, 0
+        compressed = zlib.compress(data)
+        pack_id, offset = self.append(compressed)
+        self.db.execute('INSERT INTO chunks (id, pack, offset, length, size) '
+                'VALUES (?, ?, ?, ?, ?)', (sqlite3.Binary(chunk_id), pack_id,
+                offset, len(compressed), len(data)))
+        return chunk_id, len(compressed)
+
+    def read_chunk(self, chunk_id):
+        '''Return the contents of a chunk.
+
+        :rtype: str
+        '''
+        row = self.db.execute('SELECT pack, offset, length FROM chunks '
+                'WHERE id = ?', (sqlite3.Binary(chunk_id), )).fetchone()
+        if row == None:
+            raise ValueError('Chunk %s is not in the store'
+                    % chunk_id.encode('hex'))
+        pack_id, offset, length = row
+        if pack_id == self.pack_id and self.pack_fp != None:
+            self.pack_fp.flush()
+        fp = self.read_fps.get(pack_id)
+        if fp == None:
+            fp = self.read_fps[pack_id] = open(self.pack_path(pack_id), 'rb')
+        fp.seek(offset)
+        data = zlib.decompress(fp.read(length))
+        if hashlib.sha1(data).digest() != chunk_id:
+            raise ValueError('Chunk %s is corrupt' % chunk_id.encode('hex'))
+        return data
+
+    def add_references(self, counts, sign=1):
+        '''Count the references of a snapshot to its chunks.
+
+        :param dict counts: Mapping chunk ID to the number of references.
+
+        :param int sign: (Default 1)  -1 to remove the references.
+
+        :rtype: None
+        '''
+        self.check_writable()
+        self.db.executemany('UPDATE chunks SET refs = refs + ? WHERE id = ?',
+                [(sign * count, sqlite3.Binary(chunk_id))
+                for chunk_id, count in counts.iteritems()])
+
+    def reclaimable_bytes(self, counts):
+        '''Return the compressed bytes of the chunks that removing these
+        references would leave unreferenced.
+
+        :param dict counts: Mapping chunk ID to the number of references.
+
+        :rtype: int
+        '''
+        total = 0
+        ids = counts.keys()
+        for start in range(0, len(ids), 500):
+            chunk = ids[start:start + 500]
+            for chunk_id, refs, length in self.db.execute(
+                    'SELECT id, refs, length FROM chunks WHERE id IN (%s)'
+                    % ','.join('?' * len(chunk)),
+                    [sqlite3.Binary(x) for x in chunk]):
+                if refs <= counts[str(chunk_id)]:
+                    total += length
+        return total
+
+    def store_file(self, path, statistics):
+        '''Store the chunks of a file.
+
+        :rtype: list of chunk IDs
+        '''
+        chunks = []
+        with open(path, 'rb') as fp:
+            for data in chunk_file(fp):
+                chunk_id, stored = self.add_chunk(data)
+                chunks.append(chunk_id)
+                statistics.bytes_read += len(data)
+                if stored:
+                    statistics.chunks_stored += 1
+                    statistics.bytes_stored += stored
+        statistics.files_read += 1
+        return chunks
+
+    def snapshot(self, top, tree_filename, manifest_filename=None,
+            previous_tree=None):
+        '''Store a directory tree as a snapshot.
+
+        :param str top: Top directory of the tree.
+
+        :param str tree_filename: Tree file to create.
+
+        :param str manifest_filename: (Default None)  Manifest to write as
+                well, see :py:mod:`nabmanifest`.
+
+        :param str previous_tree: (Default None)  Tree of the previous
+                snapshot, whose chunks are reused for unchanged files.
+
+        :rtype: :py:class:`SnapshotStatistics`
+        '''
+        statistics = SnapshotStatistics()
+        start = time.time()
+        previous = iter(())
+        if previous_tree != None:
+            previous = read_tree(previous_tree)
+        previous_entry = next(previous, None)
+
+        writer = TreeWriter(tree_filename)
+        manifest = None
+        if manifest_filename != None:
+            manifest = nabmanifest.ManifestWriter(manifest_filename)
+        counts = {}
+        try:
+            stack = [('', iter(sorted(os.listdir(top))))]
+            while stack:
+                prefix, names = stack[-1]
+                name = next(names, None)
+                if name == None:
+                    stack.pop()
+                    continue
+                path = encode_path(prefix + name)
+                fullpath = os.path.join(top, path)
+                st = os.lstat(fullpath)
+                if manifest != None:
+                    manifest.add_stat(path, st)
+
+                key = path_key(path)
+                while (previous_entry != None and
+                        path_key(previous_entry.path) < key):
+                    previous_entry = next(previous, None)
+
+                chunks = ()
+                link = None
+                rdev = 0
+                if stat.S_ISREG(st.st_mode):
+                    statistics.files += 1
+                    if (previous_entry != None and previous_entry.path == path
+                            and previous_entry.unchanged(st)):
+                        chunks = previous_entry.chunks
+                    else:
+                        chunks = self.store_file(fullpath, statistics)
+                    for chunk_id in chunks:
+                        counts[chunk_id] = counts.get(chunk_id, 0) + 1
+                elif stat.S_ISLNK(st.st_mode):
+                    link = os.readlink(fullpath)
+                elif stat.S_ISCHR(st.st_mode) or stat.S_ISBLK(st.st_mode):
+                    rdev = st.st_rdev
+                writer.add(TreeEntry(path, st.st_mode, st.st_uid, st.st_gid,
+                        st.st_size, int(st.st_mtime), int(st.st_ctime),
+                        st.st_ino, chunks, link, st.st_nlink, rdev))
+                if stat.S_ISDIR(st.st_mode):
+                    stack.append((path + '/', iter(sorted(os.listdir(
+                            fullpath)))))
+            self.add_references(counts)
+            self.commit()
+        except:
+            writer.abort()
+            if manifest != None:
+                manifest.abort()
+            self.db.rollback()
+            raise
+        writer.close()
+        if manifest != None:
+            manifest.close()
+        statistics.seconds = time.time() - start
+        return statistics
+
+    def remove_snapshot(self, tree_filename):
+        '''Remove the references of a snapshot to its chunks, and its
+        tree.  The chunks are removed by :py:meth:`collect_garbage`.
+
+        :param str tree_filename: Tree file of the snapshot.
+
+        :rtype: None
+        '''
+        self.add_references(tree_chunk_counts(tree_filename), sign=-1)
+        self.commit()
+        os.remove(tree_filename)
+
+    def restore(self, tree_filename, destination, paths=None):
+        '''Recreate the files of a snapshot.  Files which were hard linked
+        are linked again, and devices and other special files are created
+        if permitted, or counted as skipped.
+
+        :param str tree_filename: Tree file of the snapshot.
+
+        :param str destination: Directory to create the files under.
+
+        :param list paths: (Default None)  Only restore these paths,
+                relative to the top of the snapshot, with what is under
+                them and the directories above them.  None restores it all.
+
+        :rtype: :py:class:`nabrestore.RestoreStatistics`
+        '''
+        statistics = nabrestore.RestoreStatistics()
+        start = time.time()
+        if not os.path.exists(destination):
+            os.makedirs(destination)
+        if paths != None and '' in paths:
+            paths = None
+        directories = []
+        #  the first file restored of each inode with several links
+        links = {}
+        for entry in read_tree(tree_filename):
+            if paths != None and not [x for x in paths if entry.path == x
+                    or entry.path.startswith(x + '/')
+                    or x.startswith(entry.path + '/')]:
+                continue
+            path = os.path.join(destination, entry.path)
+            if stat.S_ISDIR(entry.mode):
+                #  the mode and times are set once the contents are done
+                os.mkdir(path, 0700)
+                directories.append(entry)
+                statistics.directories += 1
+                continue
+            elif stat.S_ISLNK(entry.mode):
+                os.symlink(entry.link, path)
+                statistics.symlinks += 1
+            elif stat.S_ISREG(entry.mode):
+                #  the link count of older trees is not known
+                if entry.nlink != 1:
+                    first = links.get(entry.inode)
+                    if first != None:
+                        os.link(first, path)
+                        statistics.hardlinks += 1
+                        continue
+                    links[entry.inode] = path
+                with open(path, 'wb') as fp:
+                    for chunk_id in entry.chunks:
+                        data = self.read_chunk(chunk_id)
+                        fp.write(data)
+                        statistics.bytes += len(data)
+                statistics.files += 1
+            else:
+                try:
+                    os.mknod(path, entry.mode, entry.rdev)
+                except OSError, e:
+                    if e.errno != errno.EPERM:
+                        raise
+                    statistics.skipped += 1
+                    continue
+            set_attributes(path, entry)
+        for entry in reversed(directories):
+            set_attributes(os.path.join(destination, entry.path), entry)
+        statistics.seconds = time.time() - start
+        return statistics
+
+    def collect_garbage(self, max_packs=4, min_garbage_percent=20):
+        '''Remove unreferenced chunks from the packs with the most garbage.
+
+        :param int max_packs: (Default 4)  Number of packs to rewrite or
+                remove.
+
+        :param int min_garbage_percent: (Default 20)  Only rewrite packs
+                with at least this percentage of garbage.
+
+        :rtype: :py:class:`GarbageStatistics`
+        '''
+        statistics = GarbageStatistics()
+        self.open_pack()
+        #  packs are deleted, which readers must not have open
+        fcntl.flock(self.lock_fp, fcntl.LOCK_EX)
+        try:
+            self.remove_garbage(statistics, max_packs, min_garbage_percent)
+        finally:
+            fcntl.flock(self.lock_fp, fcntl.LOCK_SH)
+        return statistics
+
+    def remove_garbage(self, statistics, max_packs, min_garbage_percent):
+        '''Remove the garbage for :py:meth:`collect_garbage`, with the
+        readers of the store excluded.
+
+        :rtype: None
+        '''
+        candidates = self.db.execute('SELECT pack, SUM(CASE WHEN refs <= 0 '
+                'THEN length ELSE 0 END), SUM(length) FROM chunks '
+                'WHERE pack != ? GROUP BY pack', (self.pack_id, )).fetchall()
+        candidates = [x for x in candidates if x[1] > 0 and
+                (x[1] == x[2] or x[1] * 100 >= x[2] * min_garbage_percent)]
+        candidates.sort(key=lambda x: float(x[1]) / x[2], reverse=True)
+
+        for pack_id, garbage, total in candidates[:max_packs]:
+            if garbage < total:
+                fp = self.read_fps.pop(pack_id, None) or open(
+                        self.pack_path(pack_id), 'rb')
+                moved = []
+                for chunk_id, offset, length in self.db.execute(
+                        'SELECT id, offset, length FROM chunks WHERE pack = ? '
+                        'AND refs > 0', (pack_id, )).fetchall():
+                    fp.seek(offset)
+                    new_pack, new_offset = self.append(fp.read(length))
+                    moved.append((new_pack, new_offset, chunk_id))
+                fp.close()
+                self.db.executemany('UPDATE chunks SET pack = ?, offset = ? '
+                        'WHERE id = ?', moved)
+                statistics.packs_rewritten += 1
+            else:
+                statistics.packs_removed += 1
+            statistics.chunks_removed += self.db.execute('DELETE FROM chunks '
+                    'WHERE pack = ? AND refs <= 0', (pack_id, )).rowcount
+            self.commit()
+
+            fp = self.read_fps.pop(pack_id, None)
+            if fp != None:
+                fp.close()
+            path = self.pack_path(pack_id)
+            statistics.bytes_freed += os.path.getsize(path)
+            os.remove(path)
+            #  the live chunks of a rewritten pack still use space
+            statistics.bytes_freed -= total - garbage
+
+    def usage(self):
+        '''Return the bytes the snapshots refer to, counting shared chunks
+        once for each reference, and the compressed bytes stored.
+
+        :rtype: tuple of (logical bytes, stored bytes)
+        '''
+        logical, stored = self.db.execute('SELECT SUM(size * refs), '
+                'SUM(length) FROM chunks').fetchone()
+        return logical or 0, stored or 0
+
+
+def set_attributes(path, entry):
+    '''Set the owner, mode and times of a restored entry.  The owner is
+    only set when running as root.
+    '''
+    if os.geteuid() == 0:
+        os.lchown(path, entry.uid, entry.gid)
+    if not stat.S_ISLNK(entry.mode):
+        os.chmod(path, stat.S_IMODE(entry.mode))
+        os.utime(path, (entry.mtime, entry.mtime))
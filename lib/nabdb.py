@@ -107,6 +107,7 @@ class DbWrapper:
 
         from sqlalchemy import create_engine
         self.engine = create_engine(connect, echo=echo)
+        upgrade_database(self.engine)
 
         self.Base = Base        # Base is from nabmodel
         self.Base.metadata.bind = self.engine
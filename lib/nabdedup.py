@@ -0,0 +1,474 @@
+#!/usr/bin/env python
+#
+#  Copyright (c) 2012, Sean Reifschneider, tummy.com, ltd.
+#  All Rights Reserved.
+
+'''Deduplication of identical files between the hosts of a storage.
+
+Hosts with the same operating system have many identical files, which the
+hardlinks storage keeps a copy of for each host.  The :py:class:`Deduplicator`
+finds them from the manifests of new snapshots: files are grouped by size,
+only files sharing a size with another are hashed (in a pool of
+processes), and files with the same contents, mode, owner and modification
+time are replaced by hard-links to the copy seen first.  The two files
+are compared just before one is replaced, so an out of date cache entry
+never links a file to different contents.
+
+What is known about each inode is kept in an SQLite cache, keyed by the
+inode and checked against its size and modification time, so each run
+only reads the manifests of snapshots made since the last run and only
+hashes new files.  Each file found is also a row of the "copies" table,
+which follows the inode it is linked to and the newest snapshot of its
+host that has it, and is forgotten with that snapshot.
+'''
+
+import os
+import stat
+import time
+import errno
+import sqlite3
+import hashlib
+import itertools
+import multiprocessing
+import nabmanifest
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS inodes (
+        inode INTEGER PRIMARY KEY,
+        size INTEGER NOT NULL,
+        mtime INTEGER NOT NULL,
+        hostname TEXT NOT NULL,
+        snapshot TEXT NOT NULL,
+        path TEXT NOT NULL,
+        digest TEXT,
+        mode INTEGER,
+        uid INTEGER,
+        gid INTEGER);
+CREATE INDEX IF NOT EXISTS ix_inodes_size ON inodes (size);
+CREATE INDEX IF NOT EXISTS ix_inodes_digest ON inodes (digest);
+CREATE INDEX IF NOT EXISTS ix_inodes_snapshot ON inodes (hostname, snapshot);
+CREATE TABLE IF NOT EXISTS copies (
+        inode INTEGER NOT NULL,
+        hostname TEXT NOT NULL,
+        snapshot TEXT NOT NULL);
+CREATE INDEX IF NOT EXISTS ix_copies_inode ON copies (inode, hostname);
+CREATE INDEX IF NOT EXISTS ix_copies_snapshot ON copies (hostname, snapshot);
+CREATE TABLE IF NOT EXISTS snapshots (
+        hostname TEXT NOT NULL,
+        snapshot TEXT NOT NULL,
+        PRIMARY KEY (hostname, snapshot));
+'''
+
+
+def hash_file(item):
+    '''Hash a file, if it is still the inode expected.  This is run in the
+    worker processes.
+
+    :param tuple item: (inode, path) of the file.
+
+    :rtype: tuple (inode, digest, mode, uid, gid), the digest is None if
+            the file could not be read or is a different inode.
+    '''
+    inode, path = item
+    try:
+        st = os.lstat(path)
+        if st.st_ino != inode or not stat.S_ISREG(st.st_mode):
+            return (inode, None, None, None, None)
+        digest = hashlib.sha1()
+        with open(path, 'rb') as fp:
+            while True:
+                data = fp.read(1048576)
+                if not data:
+                    break
+                digest.update(data)
+    except (IOError, OSError):
+        return (inode, None, None, None, None)
+    return (inode, digest.hexdigest(), st.st_mode, st.st_uid, st.st_gid)
+
+
+def same_file(path, other_path):
+    '''Compare two regular files by their size, mode, owner, modification
+    time and contents.
+
+    :rtype: Boolean
+    '''
+    try:
+        st = os.lstat(path)
+        other_st = os.lstat(other_path)
+        if not stat.S_ISREG(st.st_mode) or ((st.st_size, int(st.st_mtime),
+                st.st_mode, st.st_uid, st.st_gid) != (other_st.st_size,
+                int(other_st.st_mtime), other_st.st_mode, other_st.st_uid,
+                other_st.st_gid)):
+            return False
+        with open(path, 'rb') as fp:
+            with open(other_path, 'rb') as other_fp:
+                while True:
+                    data = fp.read(1048576)
+                    if data != other_fp.read(1048576):
+                        return False
+                    if not data:
+                        return True
+    except (IOError, OSError):
+        return False
+
+
+class DedupStatistics:
+    '''What a :py:class:`Deduplicator` did.
+
+    .. py:attribute:: snapshots
+
+    Number of new snapshots read.
+
+    .. py:attribute:: files_hashed
+
+    Number of files hashed.
+
+    .. py:attribute:: bytes_hashed
+
+    Bytes of the files hashed.
+
+    .. py:attribute:: files_linked
+
+    Number of files replaced by a hard-link to an identical file.
+
+    .. py:attribute:: bytes_freed
+
+    Bytes of the files that no longer have any other links.
+
+    .. py:attribute:: files_mismatched
+
+    Number of files left alone because they differed from the file the
+    cache said they matched.
+
+    .. py:attribute:: seconds
+
+    Elapsed time.
+    '''
+
+    def __init__(self):
+        self.snapshots = 0
+        self.files_hashed = 0
+        self.bytes_hashed = 0
+        self.files_linked = 0
+        self.bytes_freed = 0
+        self.files_mismatched = 0
+        self.seconds = 0.0
+
+    def __repr__(self):
+        return ('<DedupStatistics(snapshots=%d, hashed=%d/%d, linked=%d, '
+                'freed=%d, mismatched=%d, seconds=%.3f)>' % (self.snapshots,
+                self.files_hashed, self.bytes_hashed, self.files_linked,
+                self.bytes_freed, self.files_mismatched, self.seconds))
+
+
+class Deduplicator:
+    '''Replace identical files in the snapshots of hosts with hard-links.
+    All the snapshots must be on the same file-system.
+
+    :param str cache_filename: SQLite database of the inodes seen.
+
+    :param int processes: (Default 4)  Number of processes hashing files,
+            1 or less to hash them in this process.
+
+    :param int min_size: (Default 4096)  Smaller files are left alone.
+    '''
+
+    def __init__(self, cache_filename, processes=4, min_size=4096):
+        self.db = sqlite3.connect(cache_filename)
+        self.db.text_factory = str
+        self.db.executescript(SCHEMA)
+        if self.db.execute('SELECT NOT EXISTS (SELECT 1 FROM copies) AND '
+                'EXISTS (SELECT 1 FROM inodes)').fetchone()[0]:
+            #  a cache from before copies were kept
+            self.db.execute('INSERT INTO copies (inode, hostname, snapshot) '
+                    'SELECT inode, hostname, snapshot FROM inodes')
+            self.db.commit()
+        self.processes = processes
+        self.min_size = max(min_size, 1)
+        self.statistics = DedupStatistics()
+        #  (hostname, snapshot) of files of other hosts given new links
+        self.linked_snapshots = set()
+
+    def close(self):
+        self.db.close()
+
+    def dedup_ratio_percent(self):
+        '''Bytes of the files in the snapshots, counting each copy that was
+        replaced by a link, as a percentage of the bytes they now use.
+
+        :rtype: int or None if no files have been seen.
+        '''
+        logical, physical = self.db.execute('SELECT SUM(size * (SELECT '
+                'COUNT(*) FROM copies WHERE copies.inode = inodes.inode)), '
+                'SUM(size) FROM inodes').fetchone()
+        if not physical:
+            return None
+        return int(round(logical * 100.0 / physical))
+
+    def forget_missing(self, hostname, snapshots):
+        '''Forget the snapshots of a host that no longer exist, and the
+        inodes last seen in them.
+
+        :param str hostname: Name of the host.
+
+        :param list snapshots: Names of the snapshots that exist.
+
+        :rtype: None
+        '''
+        existing = set(snapshots)
+        for (name, ) in self.db.execute('SELECT snapshot FROM snapshots '
+                'WHERE hostname = ?', (hostname, )).fetchall():
+            if name in existing:
+                continue
+            self.db.execute('DELETE FROM inodes WHERE hostname = ? AND '
+                    'snapshot = ?', (hostname, name))
+            self.db.execute('DELETE FROM copies WHERE hostname = ? AND '
+                    'snapshot = ?', (hostname, name))
+            self.db.execute('DELETE FROM snapshots WHERE hostname = ? AND '
+                    'snapshot = ?', (hostname, name))
+        self.db.commit()
+
+    def process_host(self, hostname, snapshots):
+        '''Deduplicate the snapshots of a host that have not been processed
+        yet.  Snapshots without a manifest are left for a later run.  No
+        rsync destination may link to the files of the snapshots, as rsync
+        changes the attributes of the files of its destination in place.
+
+        :param str hostname: Name of the host.
+
+        :param list snapshots: (name, data directory, manifest file) of each
+                snapshot, oldest first.
+
+        :rtype: list The names of the snapshots which were changed.
+        '''
+        start = time.time()
+        processed = set([x[0] for x in self.db.execute('SELECT snapshot '
+                'FROM snapshots WHERE hostname = ?', (hostname, ))])
+        new = [x for x in snapshots
+                if x[0] not in processed and os.path.exists(x[2])]
+        if not new:
+            return []
+
+        #  inode: [size, mtime, snapshot, paths]
+        inodes = {}
+        for name, directory, manifest in new:
+            for entry in nabmanifest.read_manifest(manifest):
+                if (not stat.S_ISREG(entry.mode)
+                        or entry.size < self.min_size):
+                    continue
+                info = inodes.get(entry.inode)
+                if info == None:
+                    info = [entry.size, entry.mtime, name, []]
+                    inodes[entry.inode] = info
+                info[2] = name
+                info[3].append((name, os.path.join(directory, entry.path)))
+
+        new_inodes = self.update_cache(hostname, inodes)
+        self.hash_files(new_inodes, inodes)
+        changed = self.link_files(hostname, new_inodes, inodes)
+        self.rewrite_manifests(new, changed)
+
+        for name, directory, manifest in new:
+            self.db.execute('INSERT OR REPLACE INTO snapshots (hostname, '
+                    'snapshot) VALUES (?, ?)', (hostname, name))
+        self.db.commit()
+        self.statistics.snapshots += len(new)
+        self.statistics.seconds += time.time() - start
+        return sorted(changed)
+
+    def update_cache(self, hostname, inodes):
+        '''Add the inodes to the cache, or record where they were seen.
+
+        :rtype: set of the inodes not in the cache before.
+        '''
+        new_inodes = set()
+        for inode, (size, mtime, name, paths) in inodes.iteritems():
+            row = self.db.execute('SELECT size, mtime FROM inodes WHERE '
+                    'inode = ?', (inode, )).fetchone()
+            if row != None and tuple(row) == (size, mtime):
+                self.db.execute('UPDATE inodes SET hostname = ?, '
+                        'snapshot = ?, path = ? WHERE inode = ?',
+                        (hostname, name, paths[0][1], inode))
+                if self.db.execute('UPDATE copies SET snapshot = ? WHERE '
+                        'inode = ? AND hostname = ?', (name, inode,
+                        hostname)).rowcount == 0:
+                    self.db.execute('INSERT INTO copies (inode, hostname, '
+                            'snapshot) VALUES (?, ?, ?)', (inode, hostname,
+                            name))
+                continue
+            if row != None:
+                #  the inode number was used by a file which is gone
+                self.db.execute('DELETE FROM copies WHERE inode = ?',
+                        (inode, ))
+            self.db.execute('INSERT OR REPLACE INTO inodes (inode, size, '
+                    'mtime, hostname, snapshot, path) VALUES '
+                    '(?, ?, ?, ?, ?, ?)', (inode, size, mtime, hostname, name,
+                    paths[0][1]))
+            self.db.execute('INSERT INTO copies (inode, hostname, snapshot) '
+                    'VALUES (?, ?, ?)', (inode, hostname, name))
+            new_inodes.add(inode)
+        return new_inodes
+
+    def hash_files(self, new_inodes, inodes):
+        '''Hash the files, new and old, that share their size with another
+        file.
+
+        :rtype: None
+        '''
+        work = []
+        sizes = {}
+        for size in set([inodes[x][0] for x in new_inodes]):
+            rows = self.db.execute('SELECT inode, path, digest FROM inodes '
+                    'WHERE size = ?', (size, )).fetchall()
+            if len(rows) < 2:
+                continue
+            for inode, path, digest in rows:
+                if digest == None:
+                    work.append((inode, path))
+                    sizes[inode] = size
+        if not work:
+            return
+
+        pool = None
+        if self.processes > 1:
+            pool = multiprocessing.Pool(self.processes)
+            results = pool.imap_unordered(hash_file, work, 16)
+        else:
+            results = itertools.imap(hash_file, work)
+        try:
+            for inode, digest, mode, uid, gid in results:
+                if digest == None:
+                    #  gone, or replaced by another file
+                    self.db.execute('DELETE FROM inodes WHERE inode = ?',
+                            (inode, ))
+                    self.db.execute('DELETE FROM copies WHERE inode = ?',
+                            (inode, ))
+                    new_inodes.discard(inode)
+                    continue
+                self.db.execute('UPDATE inodes SET digest = ?, mode = ?, '
+                        'uid = ?, gid = ? WHERE inode = ?',
+                        (digest, mode, uid, gid, inode))
+                self.statistics.files_hashed += 1
+                self.statistics.bytes_hashed += sizes[inode]
+        finally:
+            if pool != None:
+                pool.close()
+                pool.join()
+
+    def find_canonical(self, row, new_inodes):
+        '''Find an existing file identical to the one in `row`.
+
+        :rtype: tuple (inode, path) or None.
+        '''
+        for inode, path in self.db.execute('SELECT inode, path FROM inodes '
+                'WHERE digest = ? AND size = ? AND mtime = ? AND mode = ? '
+                'AND uid = ? AND gid = ? AND inode != ? ORDER BY inode',
+                row[1:] + (row[0], )).fetchall():
+            if inode in new_inodes:
+                continue
+            try:
+                if os.lstat(path).st_ino == inode:
+                    return (inode, path)
+            except OSError:
+                pass
+        return None
+
+    def link_files(self, hostname, new_inodes, inodes):
+        '''Replace the new files that are identical to another file by a
+        hard-link to it.  The snapshots of other hosts whose files are
+        linked to are added to `linked_snapshots`.
+
+        :rtype: dict Mapping the name of each snapshot changed to a dict of
+                the old inode to the new inode.
+        '''
+        changed = {}
+        chosen = {}
+        for inode in sorted(new_inodes):
+            row = self.db.execute('SELECT inode, digest, size, mtime, mode, '
+                    'uid, gid FROM inodes WHERE inode = ?',
+                    (inode, )).fetchone()
+            if row == None or row[1] == None:
+                continue
+            key = tuple(row[1:])
+            if key not in chosen:
+                chosen[key] = self.find_canonical(tuple(row), new_inodes)
+            if chosen[key] == None:
+                chosen[key] = (inode, inodes[inode][3][0][1])
+                continue
+
+            canonical, canonical_path = chosen[key]
+            if not same_file(canonical_path, inodes[inode][3][0][1]):
+                #  the cache was out of date for one of them, hash the
+                #  canonical file again when it next matters
+                self.statistics.files_mismatched += 1
+                self.db.execute('UPDATE inodes SET digest = NULL WHERE '
+                        'inode = ?', (canonical, ))
+                chosen[key] = (inode, inodes[inode][3][0][1])
+                continue
+            try:
+                linked, freed = self.link_paths(canonical_path,
+                        inode, inodes[inode][3])
+            except OSError, e:
+                if e.errno != errno.EMLINK:
+                    raise
+                #  the canonical file has as many links as it can have
+                chosen[key] = (inode, inodes[inode][3][0][1])
+                continue
+
+            for name in linked:
+                changed.setdefault(name, {})[inode] = canonical
+            owner = self.db.execute('SELECT hostname, snapshot FROM inodes '
+                    'WHERE inode = ?', (canonical, )).fetchone()
+            if owner != None and owner[0] != hostname:
+                self.linked_snapshots.add(tuple(owner))
+            self.statistics.files_linked += sum(linked.values())
+            if freed:
+                self.statistics.bytes_freed += row[2]
+                self.db.execute('DELETE FROM inodes WHERE inode = ?',
+                        (inode, ))
+                self.db.execute('UPDATE copies SET inode = ? WHERE '
+                        'inode = ?', (canonical, inode))
+        return changed
+
+    def link_paths(self, canonical_path, inode, paths):
+        '''Replace each path that is still `inode` with a hard-link to
+        `canonical_path`, keeping the times of the directories.
+
+        :rtype: tuple of a dict of the number of paths linked in each
+                snapshot, and True if the last link to `inode` was replaced.
+        '''
+        linked = {}
+        freed = False
+        for name, path in paths:
+            try:
+                st = os.lstat(path)
+            except OSError:
+                continue
+            if st.st_ino != inode:
+                continue
+            directory = os.path.dirname(path)
+            directory_stat = os.lstat(directory)
+            tmpname = os.path.join(directory, '.nab-dedup-%d' % os.getpid())
+            os.link(canonical_path, tmpname)
+            os.rename(tmpname, path)
+            os.utime(directory, (directory_stat.st_atime,
+                    directory_stat.st_mtime))
+            linked[name] = linked.get(name, 0) + 1
+            freed = st.st_nlink == 1
+        return linked, freed
+
+    def rewrite_manifests(self, snapshots, changed):
+        '''Rewrite the manifests of the snapshots with files replaced by
+        links, with the inodes they now have.
+
+        :rtype: None
+        '''
+        for name, directory, manifest in snapshots:
+            if name not in changed:
+                continue
+            replaced = changed[name]
+            writer = nabmanifest.ManifestWriter(manifest)
+            for entry in nabmanifest.read_manifest(manifest):
+                writer.add(entry.path, replaced.get(entry.inode, entry.inode),
+                        entry.size, entry.mtime, entry.mode)
+            writer.close()
@@ -0,0 +1,241 @@
+#!/usr/bin/env python
+#
+#  Copyright (c) 2012, Sean Reifschneider, tummy.com, ltd.
+#  All Rights Reserved.
+
+'''Differences between two snapshots of a host.
+
+Both snapshots are listed in manifest order, from their manifests when they
+have them (see :py:mod:`nabmanifest`) and otherwise by walking the
+snapshot directories, and the two listings are merged like sorted files,
+so memory use does not grow with the number of files.
+
+Entries are compared by their metadata, like the "quick check" of rsync.
+When asked to compare contents as well, files are only read if nothing
+else tells them apart.  On storage that never rewrites a file in place,
+such as hardlinks, a file with the same inode in both snapshots has the
+same contents, so it is never read, though its metadata is still compared.
+'''
+
+import os
+import stat
+import nabsupp
+import nabmanifest
+
+ADDED = 'A'
+REMOVED = 'D'
+MODIFIED = 'M'
+
+#  bytes read at a time when comparing contents
+BLOCK_SIZE = 1024 * 1024
+
+
+class DiffStatistics:
+    '''Counts of the differences found by :py:func:`diff_entries`.
+
+    .. py:attribute:: entries
+
+    Number of entries in either snapshot.
+
+    .. py:attribute:: added
+
+    Number of entries added, and likewise removed and modified.
+
+    .. py:attribute:: files_compared
+
+    Number of files whose contents were read.
+
+    .. py:attribute:: bytes_added
+
+    Size of the entries added, and the new size of those modified.
+
+    .. py:attribute:: bytes_removed
+
+    Size of the entries removed, and the old size of those modified.
+    '''
+
+    def __init__(self):
+        self.entries = 0
+        self.added = 0
+        self.removed = 0
+        self.modified = 0
+        self.files_compared = 0
+        self.bytes_added = 0
+        self.bytes_removed = 0
+
+    def __repr__(self):
+        return ('<DiffStatistics(added=%d, removed=%d, modified=%d, '
+                'compared=%d)>' % (self.added, self.removed, self.modified,
+                self.files_compared))
+
+
+def same_metadata(old, new):
+    '''Do two entries of the same path look unchanged?  The times of
+    directories and symbolic links are ignored, as they are recreated by
+    snapshots on some storage.
+
+    :param ManifestEntry old: Entry in the old snapshot.
+
+    :param ManifestEntry new: Entry in the new snapshot.
+
+    :rtype: boolean
+    '''
+    if stat.S_IFMT(old.mode) != stat.S_IFMT(new.mode):
+        return False
+    if stat.S_ISDIR(old.mode):
+        return old.mode == new.mode
+    if stat.S_ISLNK(old.mode):
+        return old.size == new.size
+    return (old.size == new.size and old.mtime == new.mtime
+            and old.mode == new.mode)
+
+
+def same_contents(old_path, new_path):
+    '''Compare two files, or the targets of two symbolic links.
+
+    :rtype: boolean
+    '''
+    if os.path.islink(old_path):
+        return os.readlink(old_path) == os.readlink(new_path)
+    with open(old_path, 'rb') as old_fp:
+        with open(new_path, 'rb') as new_fp:
+            while True:
+                old_data = old_fp.read(BLOCK_SIZE)
+                if old_data != new_fp.read(BLOCK_SIZE):
+                    return False
+                if not old_data:
+                    return True
+
+
+def diff_entries(old_entries, new_entries, trust_inodes=False,
+        compare=None, statistics=None):
+    '''Merge two listings in manifest order, and find the entries added,
+    removed and modified.
+
+    :param iterator old_entries: :py:class:`nabmanifest.ManifestEntry` of
+            the old snapshot, in manifest order.
+
+    :param iterator new_entries: :py:class:`nabmanifest.ManifestEntry` of
+            the new snapshot, in manifest order.
+
+    :param boolean trust_inodes: (Default False)  Files are never changed in
+            place, so a file with the same inode in both has the same
+            contents and is not compared.
+
+    :param function compare: (Default None)  Called with the path of a
+            file or link whose metadata is unchanged, returns True if the
+            contents are the same.  If None, contents are not compared.
+
+    :param DiffStatistics statistics: (Default None)  Counts to update.
+
+    :rtype: iterator of (change, old entry or None, new entry or None),
+            where change is :py:data:`ADDED`, :py:data:`REMOVED` or
+            :py:data:`MODIFIED`.
+    '''
+    if statistics == None:
+        statistics = DiffStatistics()
+    old_entries = iter(old_entries)
+    new_entries = iter(new_entries)
+    old = next(old_entries, None)
+    new = next(new_entries, None)
+    while old != None or new != None:
+        statistics.entries += 1
+        if new == None or (old != None and
+                nabmanifest.path_key(old.path) <
+                nabmanifest.path_key(new.path)):
+            statistics.removed += 1
+            statistics.bytes_removed += old.size
+            yield REMOVED, old, None
+            old = next(old_entries, None)
+            continue
+        if old == None or old.path != new.path:
+            statistics.added += 1
+            statistics.bytes_added += new.size
+            yield ADDED, None, new
+            new = next(new_entries, None)
+            continue
+
+        if not same_metadata(old, new):
+            changed = True
+        elif trust_inodes and old.inode == new.inode and stat.S_ISREG(
+                new.mode):
+            changed = False
+        elif compare != None and (stat.S_ISREG(new.mode) or
+                stat.S_ISLNK(new.mode)):
+            statistics.files_compared += 1
+            changed = not compare(new.path)
+        else:
+            changed = False
+        if changed:
+            statistics.modified += 1
+            statistics.bytes_removed += old.size
+            statistics.bytes_added += new.size
+            yield MODIFIED, old, new
+        old = next(old_entries, None)
+        new = next(new_entries, None)
+
+
+def snapshot_entries(plugin, hostname, snapshotname):
+    '''List a snapshot in manifest order, from its manifest if it has one.
+
+    :param Storage plugin: Storage plugin of the host.
+
+    :param str hostname: Name of the host.
+
+    :param str snapshotname: Name of the snapshot.
+
+    :rtype: iterator of :py:class:`nabmanifest.ManifestEntry`
+    '''
+    if hasattr(plugin, 'get_manifest_path'):
+        filename = plugin.get_manifest_path(hostname, snapshotname)
+        if os.path.exists(filename):
+            return nabmanifest.read_manifest(filename)
+    return nabmanifest.walk_tree(nabsupp.snapshot_data_directory(plugin,
+            hostname, snapshotname))
+
+
+def diff_snapshots(plugin, hostname, old_snapshotname, new_snapshotname,
+        contents=False, statistics=None):
+    '''Find the differences between two snapshots of a host.
+
+    :param Storage plugin: Storage plugin of the host.
+
+    :param str hostname: Name of the host.
+
+    :param str old_snapshotname: Name of the old snapshot.
+
+    :param str new_snapshotname: Name of the new snapshot.
+
+    :param boolean contents: (Default False)  Compare the contents of files
+            whose metadata is unchanged, unless they are the same inode on
+            storage which does not change files in place.
+
+    :param DiffStatistics statistics: (Default None)  Counts to update.
+
+    :rtype: iterator of (change, old entry or None, new entry or None), see
+            :py:func:`diff_entries`.
+    '''
+    trust_inodes = not plugin.rsync_inplace_compatible()
+    if not contents:
+        for change in diff_entries(snapshot_entries(plugin, hostname,
+                old_snapshotname), snapshot_entries(plugin, hostname,
+                new_snapshotname), trust_inodes=trust_inodes,
+                statistics=statistics):
+            yield change
+        return
+
+    #  the snapshots stay in use until the differences have all been read
+    with nabsupp.snapshot_data(plugin, hostname,
+            old_snapshotname) as old_directory:
+        with nabsupp.snapshot_data(plugin, hostname,
+                new_snapshotname) as new_directory:
+
+            def compare(path):
+                return same_contents(os.path.join(old_directory, path),
+                        os.path.join(new_directory, path))
+
+            for change in diff_entries(snapshot_entries(plugin, hostname,
+                    old_snapshotname), snapshot_entries(plugin, hostname,
+                    new_snapshotname), trust_inodes=trust_inodes,
+                    compare=compare, statistics=statistics):
+                yield change
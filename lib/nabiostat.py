@@ -0,0 +1,250 @@
+#!/usr/bin/env python
+#
+#  Copyright (c) 2012, Sean Reifschneider, tummy.com, ltd.
+#  All Rights Reserved.
+
+'''Disk I/O and capacity statistics for Network Attached Backup.
+
+Storage utilization is sampled from "/proc/diskstats" for the block device
+that a storage directory lives on.  This is used to avoid starting more
+work on storage that is already saturated.
+
+The space and inodes of a file-system are read with `os.statvfs()`, which
+is a single system call rather than running and parsing "df".
+'''
+
+import os
+import time
+
+DISKSTATS = '/proc/diskstats'
+
+
+class DiskStats:
+    '''A single sample of the counters for a block device from
+    "/proc/diskstats".
+    '''
+
+    def __init__(self, fields, sample_time):
+        self.name = fields[2]
+        self.reads = int(fields[3])
+        self.sectors_read = int(fields[5])
+        self.ms_reading = int(fields[6])
+        self.writes = int(fields[7])
+        self.sectors_written = int(fields[9])
+        self.ms_writing = int(fields[10])
+        self.ios_in_progress = int(fields[11])
+        self.ms_doing_io = int(fields[12])
+        self.sample_time = sample_time
+
+    def __repr__(self):
+        return '<DiskStats(%s: %s)>' % (self.name, self.sample_time)
+
+
+class CapacityStatistics:
+    '''Space and inode counts of a file-system.
+
+    .. py:attribute:: total_bytes
+
+    Size of the file-system.
+
+    .. py:attribute:: free_bytes
+
+    Bytes available for new data (excluding any space reserved for root).
+
+    .. py:attribute:: used_bytes
+
+    Bytes in use.
+
+    .. py:attribute:: total_inodes
+
+    Number of inodes, or None if the file-system does not report them.
+
+    .. py:attribute:: free_inodes
+
+    Inodes available for new files.
+
+    .. py:attribute:: used_inodes
+
+    Inodes in use.
+
+    .. py:attribute:: dedup_ratio_percent
+
+    Deduplication ratio as percentage, or None if the storage does not
+    deduplicate.
+    '''
+
+    def __init__(self, total_bytes, free_bytes, used_bytes,
+            total_inodes=None, free_inodes=None, used_inodes=None,
+            dedup_ratio_percent=None):
+        self.total_bytes = total_bytes
+        self.free_bytes = free_bytes
+        self.used_bytes = used_bytes
+        self.total_inodes = total_inodes
+        self.free_inodes = free_inodes
+        self.used_inodes = used_inodes
+        self.dedup_ratio_percent = dedup_ratio_percent
+
+    def usage_percent(self):
+        '''Percentage of the space in use, rounded up like "df" does.
+
+        :rtype: int
+        '''
+        available = self.used_bytes + self.free_bytes
+        if available <= 0:
+            return 0
+        return int((self.used_bytes * 100 + available - 1) // available)
+
+    def __repr__(self):
+        return ('<CapacityStatistics(total=%s, free=%s, used=%s, '
+                'inodes=%s/%s)>' % (self.total_bytes, self.free_bytes,
+                self.used_bytes, self.used_inodes, self.total_inodes))
+
+
+def capacity_statistics(path):
+    '''Get the space and inode counts of the file-system holding `path`.
+
+    :param str path: File or directory on the file-system.
+
+    :rtype: :py:class:`CapacityStatistics`
+    '''
+    st = os.statvfs(path)
+    total_inodes = free_inodes = used_inodes = None
+    if st.f_files:
+        total_inodes = st.f_files
+        free_inodes = st.f_favail
+        used_inodes = st.f_files - st.f_ffree
+    return CapacityStatistics(st.f_blocks * st.f_frsize,
+            st.f_bavail * st.f_frsize,
+            (st.f_blocks - st.f_bfree) * st.f_frsize,
+            total_inodes, free_inodes, used_inodes)
+
+
+def read_diskstats(major, minor, diskstats=DISKSTATS, now=None):
+    '''Read the statistics of a block device.
+
+    :param int major: Major number of the device.
+
+    :param int minor: Minor number of the device.
+
+    :param str diskstats: (Default "/proc/diskstats")  File to read.
+
+    :param float now: (Default None)  Sample time to record, or the current
+            time if None.
+
+    :rtype: :py:class:`DiskStats` or None if the device is not listed.
+    '''
+    if now == None:
+        now = time.time()
+    with open(diskstats, 'r') as fp:
+        for line in fp:
+            fields = line.split()
+            if len(fields) < 14:
+                continue
+            if int(fields[0]) == major and int(fields[1]) == minor:
+                return DiskStats(fields, now)
+    return None
+
+
+class DeviceMonitor:
+    '''Track the utilization of the block device holding a path.
+
+    :param str path: A file or directory on the device to monitor.
+
+    :param str diskstats: (Default "/proc/diskstats")  File to read
+            statistics from.
+
+    :param function clock: (Default `time.time`)  Source of the current
+            time, in seconds.
+    '''
+
+    def __init__(self, path, diskstats=DISKSTATS, clock=time.time):
+        st_dev = os.stat(path).st_dev
+        self.major = os.major(st_dev)
+        self.minor = os.minor(st_dev)
+        self.diskstats = diskstats
+        self.clock = clock
+        self.last = None
+        self.busy_percent = None
+        self.bytes_per_second = None
+        self.latency_ms = None
+
+    def available(self):
+        '''Does the kernel report statistics for this device?  Network and
+        virtual file-systems (including ZFS datasets) do not.
+
+        :rtype: Boolean
+        '''
+        if not os.path.exists(self.diskstats):
+            return False
+        return read_diskstats(self.major, self.minor, self.diskstats) != None
+
+    def sample(self):
+        '''Take a sample of the device statistics, updating the
+        "busy_percent", "bytes_per_second" and "latency_ms" attributes
+        from the change since the previous sample.
+
+        :rtype: float The percentage of the time the device was busy since
+                the last sample, or None if there is no previous sample.
+        '''
+        if not os.path.exists(self.diskstats):
+            return None
+        current = read_diskstats(self.major, self.minor, self.diskstats,
+                self.clock())
+        if current == None:
+            return None
+
+        last = self.last
+        self.last = current
+        if last == None:
+            return None
+
+        elapsed_ms = (current.sample_time - last.sample_time) * 1000.0
+        if elapsed_ms <= 0:
+            return self.busy_percent
+        self.busy_percent = min(100.0,
+                (current.ms_doing_io - last.ms_doing_io) * 100.0 / elapsed_ms)
+        self.bytes_per_second = ((current.sectors_read - last.sectors_read
+                + current.sectors_written - last.sectors_written)
+                * 512 * 1000.0 / elapsed_ms)
+        ios = (current.reads - last.reads + current.writes - last.writes)
+        if ios > 0:
+            self.latency_ms = float(current.ms_reading - last.ms_reading
+                    + current.ms_writing - last.ms_writing) / ios
+        else:
+            self.latency_ms = 0.0
+        return self.busy_percent
+
+    def is_saturated(self, max_busy_percent):
+        '''Was the device busier than `max_busy_percent` at the last
+        sample?
+
+        :rtype: Boolean
+        '''
+        if max_busy_percent == None or self.busy_percent == None:
+            return False
+        return self.busy_percent >= max_busy_percent
+
+    def wait_until_idle(self, max_busy_percent, interval=5, timeout=3600,
+            sleep=time.sleep):
+        '''Wait until the device is less busy than `max_busy_percent`.
+
+        :param int max_busy_percent: Utilization considered saturated.
+
+        :param int interval: (Default 5)  Seconds between samples.
+
+        :param int timeout: (Default 3600)  Give up waiting after this
+                many seconds.
+
+        :rtype: Boolean True if the device became idle, False on timeout.
+        '''
+        if max_busy_percent == None:
+            return True
+        end = self.clock() + timeout
+        self.sample()
+        while True:
+            sleep(interval)
+            self.sample()
+            if not self.is_saturated(max_busy_percent):
+                return True
+            if self.clock() >= end:
+                return False
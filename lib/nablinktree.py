@@ -0,0 +1,214 @@
+#!/usr/bin/env python
+#
+#  Copyright (c) 2012, Sean Reifschneider, tummy.com, ltd.
+#  All Rights Reserved.
+
+'''Parallel hard-link copies of directory trees for Network Attached Backup.
+
+This does the work of "cp -al" using a pool of threads: each directory is a
+unit of work, so the tree is partitioned among the workers by subtree as
+it is walked.  Files are hard-linked, symbolic links are re-created, and
+the ownership, permissions and times of directories are copied once all
+of their entries have been created.  A file that already has as many
+links as the file-system allows is copied instead.  The entries found can
+also be given to a :py:class:`nabmanifest.ManifestBuilder`, so the manifest
+of the copy is made without walking it again.
+'''
+
+import os
+import sys
+import stat
+import time
+import errno
+import shutil
+import Queue
+import threading
+
+
+class LinkTreeStatistics:
+    '''Counts of what :py:func:`link_tree` created.
+
+    .. py:attribute:: files
+
+    Number of files (and other non-directories) hard-linked or copied.
+
+    .. py:attribute:: copied
+
+    Number of the files that were copied because they could not be given
+    another link.
+
+    .. py:attribute:: directories
+
+    Number of directories created.
+
+    .. py:attribute:: symlinks
+
+    Number of symbolic links created.
+
+    .. py:attribute:: seconds
+
+    Elapsed time of the copy.
+    '''
+
+    def __init__(self):
+        self.files = 0
+        self.copied = 0
+        self.directories = 0
+        self.symlinks = 0
+        self.seconds = 0.0
+
+    def __repr__(self):
+        return ('<LinkTreeStatistics(files=%d, copied=%d, directories=%d, '
+                'symlinks=%d, seconds=%.3f)>' % (self.files, self.copied,
+                self.directories, self.symlinks, self.seconds))
+
+    def summary(self):
+        '''Return a line describing the snapshot, for the backup log.
+
+        :rtype: str
+        '''
+        summary = ('Linked %d files, %d directories and %d symlinks in '
+                '%.1f seconds' % (self.files, self.directories,
+                self.symlinks, self.seconds))
+        if self.copied:
+            summary += ', %d files copied at their link limit' % self.copied
+        return summary
+
+
+def copy_owner(path, st, link=False):
+    '''Set the owner of `path` from the stat result `st`, if this process
+    is allowed to.
+    '''
+    try:
+        if link:
+            os.lchown(path, st.st_uid, st.st_gid)
+        else:
+            os.chown(path, st.st_uid, st.st_gid)
+    except OSError, e:
+        if e.errno != errno.EPERM:
+            raise
+
+
+class LinkTree:
+    '''Hard-link copy of a directory tree.  See :py:func:`link_tree`.
+    '''
+
+    def __init__(self, source, destination, threads, manifest=None):
+        self.source = source
+        self.destination = destination
+        self.threads = threads
+        self.manifest = manifest
+        self.statistics = LinkTreeStatistics()
+        self.queue = Queue.Queue()
+        self.lock = threading.Lock()
+        self.directories = []
+        self.error = None
+
+    def run(self):
+        start = time.time()
+        source_stat = os.lstat(self.source)
+        os.mkdir(self.destination, 0700)
+        self.directories.append((0, self.destination, source_stat))
+        self.queue.put(('', self.source, self.destination, 0))
+
+        workers = []
+        for i in range(self.threads):
+            worker = threading.Thread(target=self.worker)
+            worker.daemon = True
+            worker.start()
+            workers.append(worker)
+        self.queue.join()
+        for worker in workers:
+            self.queue.put(None)
+        for worker in workers:
+            worker.join()
+        if self.error != None:
+            raise self.error[0], self.error[1], self.error[2]
+
+        #  deepest first, so setting times is not undone by later changes
+        self.directories.sort(reverse=True)
+        for depth, path, st in self.directories:
+            copy_owner(path, st)
+            os.chmod(path, stat.S_IMODE(st.st_mode))
+            os.utime(path, (st.st_atime, st.st_mtime))
+
+        self.statistics.directories = len(self.directories)
+        self.statistics.seconds = time.time() - start
+        return self.statistics
+
+    def worker(self):
+        while True:
+            item = self.queue.get()
+            if item == None:
+                self.queue.task_done()
+                return
+            try:
+                if self.error == None:
+                    self.link_directory(*item)
+            except Exception:
+                with self.lock:
+                    if self.error == None:
+                        self.error = sys.exc_info()
+            self.queue.task_done()
+
+    def link_directory(self, path, source, destination, depth):
+        files = 0
+        copied = 0
+        symlinks = 0
+        directories = []
+        entries = []
+        for name in os.listdir(source):
+            source_path = os.path.join(source, name)
+            destination_path = os.path.join(destination, name)
+            st = os.lstat(source_path)
+            if stat.S_ISDIR(st.st_mode):
+                os.mkdir(destination_path, 0700)
+                directories.append((depth + 1, destination_path, st))
+                self.queue.put((path + name + '/', source_path,
+                        destination_path, depth + 1))
+            elif stat.S_ISLNK(st.st_mode):
+                os.symlink(os.readlink(source_path), destination_path)
+                copy_owner(destination_path, st, link=True)
+                symlinks += 1
+            else:
+                try:
+                    os.link(source_path, destination_path)
+                except OSError, e:
+                    if e.errno != errno.EMLINK or not stat.S_ISREG(
+                            st.st_mode):
+                        raise
+                    #  the file has as many links as it can have
+                    shutil.copy2(source_path, destination_path)
+                    copy_owner(destination_path, st)
+                    st = os.lstat(destination_path)
+                    copied += 1
+                files += 1
+            entries.append((name, st))
+        if self.manifest != None:
+            self.manifest.add_directory(path.rstrip('/'), entries)
+
+        with self.lock:
+            self.statistics.files += files
+            self.statistics.copied += copied
+            self.statistics.symlinks += symlinks
+            self.directories.extend(directories)
+
+
+def link_tree(source, destination, threads=8, manifest=None):
+    '''Create `destination` as a copy of the directory `source`, with
+    hard-links to the files in `source`.  The destination must not exist.
+
+    :param str source: Directory to copy.
+
+    :param str destination: Directory to create.
+
+    :param int threads: (Default 8)  Number of directories to work on at
+            once.
+
+    :param ManifestBuilder manifest: (Default None)  Given the entries of
+            each directory as they are copied.  The inodes of directories
+            and symbolic links are those of the source.
+
+    :rtype: :py:class:`LinkTreeStatistics`
+    '''
+    return LinkTree(source, destination, threads, manifest).run()
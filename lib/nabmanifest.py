@@ -0,0 +1,378 @@
+#!/usr/bin/env python
+#
+#  Copyright (c) 2012, Sean Reifschneider, tummy.com, ltd.
+#  All Rights Reserved.
+
+'''Manifests of the contents of snapshots for Network Attached Backup.
+
+A manifest lists every entry of a snapshot with its inode, size,
+modification time and mode, so a snapshot can be listed, searched or
+compared by reading one file sequentially rather than calling "stat" on
+every file.  Entries are in depth-first order, with the names in each
+directory sorted, which is the order of :py:func:`path_key`.
+
+The file starts with `MAGIC`, and the rest is compressed with zlib.  Each
+entry is a length followed by the entry, and the path is stored as the
+number of bytes it shares with the previous path and the rest of the
+path.  All numbers are variable-length integers.
+'''
+
+import os
+import sys
+import stat
+import zlib
+import tempfile
+import threading
+
+MAGIC = 'NABMAN01\n'
+
+
+def encode_number(value):
+    '''Encode a non-negative integer in 7-bit groups, least significant
+    first, with the high bit set on all but the last byte.
+
+    :rtype: str
+    '''
+    data = []
+    while value > 0x7f:
+        data.append(chr(0x80 | (value & 0x7f)))
+        value >>= 7
+    data.append(chr(value))
+    return ''.join(data)
+
+
+def decode_number(data, offset):
+    '''Decode a number written by :py:func:`encode_number`.
+
+    :rtype: tuple of the number and the offset after it.
+    '''
+    value = 0
+    shift = 0
+    while True:
+        byte = ord(data[offset])
+        offset += 1
+        value |= (byte & 0x7f) << shift
+        if byte < 0x80:
+            return value, offset
+        shift += 7
+
+
+def encode_signed(value):
+    '''Encode an integer that may be negative, such as a time.
+
+    :rtype: str
+    '''
+    if value < 0:
+        return encode_number((-value << 1) - 1)
+    return encode_number(value << 1)
+
+
+def decode_signed(data, offset):
+    '''Decode a number written by :py:func:`encode_signed`.
+
+    :rtype: tuple of the number and the offset after it.
+    '''
+    value, offset = decode_number(data, offset)
+    if value & 1:
+        return -((value + 1) >> 1), offset
+    return value >> 1, offset
+
+
+def encode_path(path):
+    '''Return a path as bytes, encoding it if it is unicode, as it is when
+    listing a directory given as unicode.
+
+    :rtype: str
+    '''
+    if isinstance(path, unicode):
+        return path.encode(sys.getfilesystemencoding() or 'utf-8')
+    return path
+
+
+def path_key(path):
+    '''Key that sorts paths in manifest order.
+
+    :rtype: list
+    '''
+    return path.split('/')
+
+
+class ManifestEntry(object):
+    '''An entry of a manifest.
+
+    .. py:attribute:: path
+
+    Path of the entry, relative to the top of the snapshot.
+    '''
+
+    __slots__ = ('path', 'inode', 'size', 'mtime', 'mode')
+
+    def __init__(self, path, inode, size, mtime, mode):
+        self.path = path
+        self.inode = inode
+        self.size = size
+        self.mtime = mtime
+        self.mode = mode
+
+    def is_directory(self):
+        return stat.S_ISDIR(self.mode)
+
+    def __repr__(self):
+        return '<ManifestEntry(%s, inode=%d, size=%d)>' % (self.path,
+                self.inode, self.size)
+
+
+class ManifestWriter:
+    '''Write a manifest, one entry at a time.  The file is written under a
+    temporary name and renamed when it is closed, so a manifest either is
+    complete or does not exist.
+
+    :param str filename: Manifest file to create.
+    '''
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.tmpname = filename + '.tmp'
+        self.fp = open(self.tmpname, 'wb')
+        self.fp.write(MAGIC)
+        self.compressor = zlib.compressobj()
+        self.previous = ''
+        self.previous_key = None
+        self.buffer = []
+        self.buffered = 0
+        self.count = 0
+
+    def add(self, path, inode, size, mtime, mode):
+        '''Add an entry, which must come after the previous one in
+        manifest order.
+
+        :param str path: Path relative to the top of the snapshot.
+
+        :rtype: None
+        '''
+        path = encode_path(path)
+        key = path_key(path)
+        if self.previous_key != None and key <= self.previous_key:
+            raise ValueError('Manifest entry "%s" is out of order' % path)
+        prefix = len(os.path.commonprefix([self.previous, path]))
+        record = ''.join([encode_number(prefix),
+                encode_number(len(path) - prefix), path[prefix:],
+                encode_number(inode), encode_number(size),
+                encode_signed(int(mtime)), encode_number(mode)])
+        self.buffer.append(encode_number(len(record)))
+        self.buffer.append(record)
+        self.buffered += len(record)
+        if self.buffered >= 65536:
+            self.flush()
+        self.previous = path
+        self.previous_key = key
+        self.count += 1
+
+    def add_stat(self, path, st):
+        '''Add an entry from the result of `os.lstat()`.
+
+        :rtype: None
+        '''
+        self.add(path, st.st_ino, st.st_size, st.st_mtime, st.st_mode)
+
+    def flush(self):
+        self.fp.write(self.compressor.compress(''.join(self.buffer)))
+        self.buffer = []
+        self.buffered = 0
+
+    def close(self):
+        '''Finish writing the manifest.
+
+        :rtype: None
+        '''
+        self.flush()
+        self.fp.write(self.compressor.flush())
+        self.fp.close()
+        os.rename(self.tmpname, self.filename)
+
+    def abort(self):
+        '''Discard the manifest.
+
+        :rtype: None
+        '''
+        self.fp.close()
+        os.remove(self.tmpname)
+
+
+def read_manifest(filename):
+    '''Read the entries of a manifest, in order.
+
+    :param str filename: Manifest file.
+
+    :rtype: iterator of :py:class:`ManifestEntry`
+    '''
+    with open(filename, 'rb') as fp:
+        if fp.read(len(MAGIC)) != MAGIC:
+            raise ValueError('"%s" is not a manifest' % filename)
+        decompressor = zlib.decompressobj()
+        data = ''
+        offset = 0
+        path = ''
+        eof = False
+        while True:
+            #  a length is at most 10 bytes, and records are much smaller
+            #  than a block, so only refill when running short
+            if len(data) - offset < 65536 and not eof:
+                block = fp.read(65536)
+                if block:
+                    data = data[offset:] + decompressor.decompress(block)
+                else:
+                    data = data[offset:] + decompressor.flush()
+                    eof = True
+                offset = 0
+                continue
+            if offset >= len(data):
+                return
+            length, offset = decode_number(data, offset)
+            if offset + length > len(data):
+                raise ValueError('Manifest "%s" is truncated' % filename)
+            prefix, offset = decode_number(data, offset)
+            suffix_length, offset = decode_number(data, offset)
+            path = path[:prefix] + data[offset:offset + suffix_length]
+            offset += suffix_length
+            inode, offset = decode_number(data, offset)
+            size, offset = decode_number(data, offset)
+            mtime, offset = decode_signed(data, offset)
+            mode, offset = decode_number(data, offset)
+            yield ManifestEntry(path, inode, size, mtime, mode)
+
+
+def walk_tree(top):
+    '''List an existing directory tree in manifest order, as its manifest
+    would.
+
+    :param str top: Top directory of the tree, which is not included.
+
+    :rtype: iterator of :py:class:`ManifestEntry`
+    '''
+    stack = [('', iter(sorted(os.listdir(top))))]
+    while stack:
+        prefix, names = stack[-1]
+        name = next(names, None)
+        if name == None:
+            stack.pop()
+            continue
+        path = encode_path(prefix + name)
+        st = os.lstat(os.path.join(top, path))
+        yield ManifestEntry(path, st.st_ino, st.st_size, int(st.st_mtime),
+                st.st_mode)
+        if stat.S_ISDIR(st.st_mode):
+            stack.append((path + '/', iter(sorted(os.listdir(
+                    os.path.join(top, path))))))
+
+
+def write_tree_manifest(top, filename):
+    '''Write the manifest of an existing directory tree.
+
+    :param str top: Top directory of the tree, which is not included in
+            the manifest.
+
+    :param str filename: Manifest file to create.
+
+    :rtype: int Number of entries written.
+    '''
+    writer = ManifestWriter(filename)
+    try:
+        for entry in walk_tree(top):
+            writer.add(entry.path, entry.inode, entry.size, entry.mtime,
+                    entry.mode)
+    except:
+        writer.abort()
+        raise
+    writer.close()
+    return writer.count
+
+
+class ManifestBuilder:
+    '''Build a manifest from directories listed in any order, for example
+    by several threads copying a tree.  Each directory is spooled to a
+    temporary file as it is added, and :py:meth:`finish` writes the
+    manifest by reading them back in depth-first order, so only the
+    location of each directory is kept in memory.
+
+    :param str filename: Manifest file to create.
+    '''
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.spool = tempfile.TemporaryFile(
+                dir=os.path.dirname(os.path.abspath(filename)))
+        self.directories = {}
+        self.lock = threading.Lock()
+
+    def add_directory(self, path, entries):
+        '''Add the contents of a directory.
+
+        :param str path: Path of the directory relative to the top of the
+                snapshot, '' for the top.
+
+        :param list entries: (name, stat result) of each entry.
+
+        :rtype: None
+        '''
+        data = []
+        for name, st in sorted([(encode_path(x[0]), x[1])
+                for x in entries]):
+            data.extend([encode_number(len(name)), name,
+                    encode_number(st.st_ino), encode_number(st.st_size),
+                    encode_signed(int(st.st_mtime)),
+                    encode_number(st.st_mode)])
+        data = ''.join(data)
+        path = encode_path(path)
+        with self.lock:
+            self.spool.seek(0, os.SEEK_END)
+            self.directories[path] = (self.spool.tell(), len(data))
+            self.spool.write(data)
+
+    def read_directory(self, path):
+        '''Return the entries spooled for a directory, sorted by name.
+
+        :rtype: list of (name, inode, size, mtime, mode)
+        '''
+        offset, length = self.directories.pop(path)
+        self.spool.seek(offset)
+        data = self.spool.read(length)
+        entries = []
+        offset = 0
+        while offset < len(data):
+            name_length, offset = decode_number(data, offset)
+            name = data[offset:offset + name_length]
+            offset += name_length
+            inode, offset = decode_number(data, offset)
+            size, offset = decode_number(data, offset)
+            mtime, offset = decode_signed(data, offset)
+            mode, offset = decode_number(data, offset)
+            entries.append((name, inode, size, mtime, mode))
+        return entries
+
+    def finish(self):
+        '''Write the manifest.
+
+        :rtype: int Number of entries written.
+        '''
+        writer = ManifestWriter(self.filename)
+        try:
+            stack = [('', iter(self.read_directory('')))]
+            while stack:
+                prefix, entries = stack[-1]
+                entry = next(entries, None)
+                if entry == None:
+                    stack.pop()
+                    continue
+                path = prefix + entry[0]
+                writer.add(path, *entry[1:])
+                if stat.S_ISDIR(entry[4]) and path in self.directories:
+                    stack.append((path + '/',
+                            iter(self.read_directory(path))))
+        except:
+            writer.abort()
+            raise
+        finally:
+            self.spool.close()
+        writer.close()
+        return writer.count
@@ -8,28 +8,54 @@
 from sqlalchemy.ext.declarative import declarative_base
 Base = declarative_base()
 from sqlalchemy import Column, Integer, String, ForeignKey
-from sqlalchemy import BigInteger, SmallInteger
+from sqlalchemy import BigInteger, SmallInteger, Float
 from sqlalchemy import Interval, CheckConstraint, Boolean, DateTime, Time, Date
-from sqlalchemy.orm import relationship
+from sqlalchemy import Index, event, inspect
+from sqlalchemy.orm import relationship, aliased, backref
+from sqlalchemy.orm import Session, object_session
 from sqlalchemy.exc import IntegrityError
-from sqlalchemy import or_
+from sqlalchemy import or_, and_, case, exists, select, func, bindparam
 import datetime
+import weakref
 import nabsupp
 
 
+#  columns added to existing tables, by the database version that added
+#  them, as (table, column, value for the existing rows)
+SCHEMA_UPGRADES = [
+        (2, [('storage', 'max_concurrent_backups', None),
+            ('storage', 'max_io_busy_percent', None)]),
+        (3, [('config', 'filter_revision', 0),
+            ('hosts', 'filter_revision', 0)]),
+        (4, [('storage_usage', 'total_inodes', None),
+            ('storage_usage', 'free_inodes', None),
+            ('storage_usage', 'used_inodes', None)]),
+        (5, [('backups', 'expired', False)]),
+        ]
+
+#  version of the schema described by this model
+DATABASE_VERSION = SCHEMA_UPGRADES[-1][0]
+
+
 class Metadata(Base):
     '''Global information about the installation.
     There is only one row in this table.
+
+    .. py:attribute:: filter_revision
+
+    Incremented whenever a global :py:class:`FilterRule` is changed.
     '''
 
     __tablename__ = 'config'
     id = Column(Integer, CheckConstraint('id = 1'), primary_key=True,
             unique=True)
     database_version = Column(Integer)
+    filter_revision = Column(Integer, default=0)
 
     def __init__(self):
         self.id = 1
-        self.database_version = 1
+        self.database_version = DATABASE_VERSION
+        self.filter_revision = 0
 
     def __repr__(self):
         return '<Config(id=%s, dbver=%s)>' % (self.id, self.database_version)
@@ -44,6 +70,62 @@ class Metadata(Base):
         return session.query(Metadata).filter(Metadata.id == 1)[0]
 
 
+def upgrade_database(engine):
+    '''Bring the tables of an existing database up to the version of this
+    model.  Columns added since the recorded database version are added to
+    their tables (see `SCHEMA_UPGRADES`), and missing tables and indexes
+    are created.  A database without a "config" table has not been
+    initialized, and is left alone.
+
+    :param Engine engine: SQLAlchemy engine of the database.
+
+    :rtype: int The database version before the upgrade, or None if the
+            database has no "config" table or record.
+    '''
+    from sqlalchemy import literal
+
+    if not engine.has_table(Metadata.__tablename__):
+        return None
+    config = Metadata.__table__
+    version = engine.execute(select([config.c.database_version]).where(
+            config.c.id == 1)).scalar()
+    if version != None and version >= DATABASE_VERSION:
+        return version
+
+    with engine.begin() as connection:
+        inspector = inspect(connection)
+        for step_version, columns in SCHEMA_UPGRADES:
+            if version != None and step_version <= version:
+                continue
+            for table_name, column_name, value in columns:
+                if column_name in [x['name'] for x in
+                        inspector.get_columns(table_name)]:
+                    continue
+                column = Base.metadata.tables[table_name].c[column_name]
+                definition = column.type.compile(dialect=engine.dialect)
+                if value != None:
+                    definition += ' DEFAULT %s' % literal(value,
+                            column.type).compile(dialect=engine.dialect,
+                            compile_kwargs={'literal_binds': True})
+                    if not column.nullable:
+                        definition += ' NOT NULL'
+                connection.execute('ALTER TABLE %s ADD COLUMN %s %s' % (
+                        table_name, column_name, definition))
+
+        Base.metadata.create_all(connection)
+        inspector = inspect(connection)
+        for table in Base.metadata.sorted_tables:
+            existing = set([x['name'] for x in
+                    inspector.get_indexes(table.name)])
+            for index in table.indexes:
+                if index.name not in existing:
+                    index.create(connection)
+
+        connection.execute(config.update().where(config.c.id == 1).values(
+                database_version=DATABASE_VERSION))
+    return version
+
+
 class BackupServer(Base):
     '''The host which stores and runs backups of :py:class:`Host`
 
@@ -84,25 +166,28 @@ class Storage(Base):
 
     .. py:attribute:: method
 
-    Type of backup storage, for example "zfs" or "hardlinks".
+    Type of backup storage, for example "zfs", "hardlinks" or "chunks".
 
     .. py:attribute:: arg1
 
     Method-defined argument.
     zfs: The backup pool name.
     hardlinks: Backup directory path.
+    chunks: Backup directory path.
 
     .. py:attribute:: arg2
 
     Method-defined argument.
     zfs: Backup file-system name.
-    hardlinks: Unused
+    hardlinks: Mode, "snapshot" (the default) or "link-dest".
+    chunks: Unused
 
     .. py:attribute:: arg3
 
     Method-defined argument.
     zfs: Backup file-system mount-point.
     hardlinks: Unused
+    chunks: Unused
 
     .. py:attribute:: arg4
 
@@ -111,6 +196,16 @@ class Storage(Base):
     .. py:attribute:: arg5
 
     Method-defined argument.  Currently unused.
+
+    .. py:attribute:: max_concurrent_backups
+
+    Maximum number of backups that the scheduler will run at once on this
+    storage, or None for no limit beyond the server's scheduler slots.
+
+    .. py:attribute:: max_io_busy_percent
+
+    If not None, new backups and snapshots are not started on this storage
+    while the device it is on is busy at least this percentage of the time.
     '''
 
     __tablename__ = 'storage'
@@ -124,6 +219,64 @@ class Storage(Base):
     arg3 = Column(String, default=None)
     arg4 = Column(String, default=None)
     arg5 = Column(String, default=None)
+    max_concurrent_backups = Column(Integer, default=None)
+    max_io_busy_percent = Column(SmallInteger, default=None)
+
+    def get_plugin(self):
+        '''Return the storage plugin instance for this storage.
+
+        :rtype: Object A Storage() instance from the plugin.
+        '''
+        storage_plugin = nabsupp.get_storage_plugin(self.method)
+        return storage_plugin.Storage([self.arg1, self.arg2, self.arg3,
+                self.arg4, self.arg5])
+
+    def sample_usage(self, db, sample_date=None, wait=True):
+        '''Record the current space and inode usage of this storage as its
+        :py:class:`StorageUsage` for the day.
+
+        :param Session db: Database session.
+
+        :param date sample_date: (Default None)  Date of the sample, or
+                today if None.
+
+        :param boolean wait: (Default True)  Wait for other users of the
+                storage, otherwise raise IOError if it is busy.
+
+        :rtype: :py:class:`StorageUsage`
+        '''
+        return StorageUsage.record(db, self,
+                self.get_plugin().storage_statistics(wait), sample_date)
+
+    def are_backups_currently_running(self, db):
+        '''Are backups of any host running on this storage?
+
+        :rtype: Boolean
+        '''
+        nabsupp.clear_stale_backup_pids(db)
+        return db.query(exists().where(and_(Backup.backup_pid != None,
+                Backup.host_id == Host.id,
+                Host.storage_id == self.id))).scalar()
+
+    def in_backup_window(self, db, now=None):
+        '''Is any active host of this storage inside its backup window?
+        Hosts without a window, which are backed up at any time, are left
+        out.
+
+        :param Session db: Database session.
+
+        :param datetime now: (Default None)  Time to check, or the current
+                time if None.
+
+        :rtype: Boolean
+        '''
+        hosts = db.query(Host).filter(Host.storage_id == self.id,
+                Host.active == True, Host.window_start != None,
+                Host.window_end != None)
+        for host in hosts:
+            if host.in_backup_window(now):
+                return True
+        return False
 
     def __init__(self):
         pass
@@ -133,6 +286,33 @@ class Storage(Base):
                 self.method, self.arg1)
 
 
+#  settings of a :py:class:`HostConfig`
+CONFIG_FIELDS = ('alerts_mail_address', 'failure_warn_after',
+        'use_global_filters', 'check_connectivity', 'ping_max_ms',
+        'daily_history', 'weekly_history', 'monthly_history', 'priority',
+        'rsync_checksum_frequency', 'rsync_compression')
+
+
+class ResolvedConfig(object):
+    '''The configuration of a host, with the global config applied for the
+    settings the host does not override.  The attributes are those of
+    :py:class:`HostConfig` and cannot be changed.
+    '''
+
+    __slots__ = CONFIG_FIELDS
+
+    def __init__(self, **values):
+        for attr in CONFIG_FIELDS:
+            object.__setattr__(self, attr, values.get(attr))
+
+    def __setattr__(self, attr, value):
+        raise AttributeError('ResolvedConfig is read-only')
+
+    def __repr__(self):
+        return '<ResolvedConfig(%s)>' % ', '.join(['%s=%s' % (x,
+                getattr(self, x)) for x in CONFIG_FIELDS])
+
+
 class Host(Base):
     '''A backed-up host.
 
@@ -165,12 +345,21 @@ class Host(Base):
 
     Time of day that the backup window starts.
 
-    .. py:attribute:: window_start
+    .. py:attribute:: window_end
+
+    Time of day that the backup window ends.  If the end is earlier than
+    the start, the window spans midnight.  If either end of the window is
+    None, backups may run at any time of day.
+
+    .. py:attribute:: filter_revision
 
-    Time of day that the backup window ends.
+    Incremented whenever a :py:class:`FilterRule` of this host is changed.
     '''
 
     __tablename__ = 'hosts'
+    __table_args__ = (
+            Index('ix_hosts_active_next_backup', 'active', 'next_backup'),
+            )
     id = Column(Integer, primary_key=True)
     storage_id = Column(Integer, ForeignKey('storage.id'))
     storage = relationship(Storage, order_by=id, backref='hosts')
@@ -181,23 +370,39 @@ class Host(Base):
     window_start = Column(Time)
     window_end = Column(Time)
     last_rsync_checksum = Column(DateTime)
+    filter_revision = Column(Integer, default=0)
 
     def get_filter_rules(self, db):
         '''Return a string containing the rsync rules for this host.
+        The rules are cached until the filter revision of the host, or the
+        global filter revision if global filters are used, changes.
 
         :rtype: str with embedded newlines, one rsync rule per line.
         '''
-        if self.merged_configs(db).use_global_filters:
+        use_global_filters = bool(self.merged_configs(db).use_global_filters)
+        host_revision, global_revision = db.query(Host.filter_revision,
+                Metadata.filter_revision).outerjoin(Metadata,
+                Metadata.id == 1).filter(Host.id == self.id).one()
+        if not use_global_filters:
+            global_revision = 0
+        key = (host_revision, global_revision, use_global_filters)
+        cache = filter_rules_cache.setdefault(db.get_bind(), {})
+        if self.id in cache and cache[self.id][0] == key:
+            return cache[self.id][1]
+
+        if use_global_filters:
             args = [or_(FilterRule.host_id == self.id,
                     FilterRule.host_id == None)]
         else:
             args = [FilterRule.host_id == self.id]
 
-        rules = ''
-        for rule in db.query(FilterRule).filter(*args).order_by(
-                FilterRule.priority, FilterRule.rsync_rule):
-            rules += '%s\n' % rule.rsync_rule
+        rules = ''.join(['%s\n' % rule for rule, in db.query(
+                FilterRule.rsync_rule).filter(*args).order_by(
+                FilterRule.priority, FilterRule.rsync_rule)])
 
+        #  without the metadata record, global changes cannot be tracked
+        if host_revision != None and global_revision != None:
+            cache[self.id] = (key, rules)
         return rules
 
     def ready_for_checksum(self, db):
@@ -227,20 +432,60 @@ class Host(Base):
         return [backup for backup in self.backups if backup.backup_pid != None]
 
     def merged_configs(self, db):
-        '''Return an object that combines the host and global configs.'''
-        class MergedConfigs:
-            def __init__(self, configs, db):
-                self.configs = configs[0]
-                self.global_configs = db.query(HostConfig).filter_by(
-                        host_id=None).first()
+        '''Return an object that combines the host and global configs.
+
+        :rtype: :py:class:`ResolvedConfig`
+        '''
+        return self.resolve_configs(db, [self.id])[self.id]
+
+    @classmethod
+    def resolve_configs(cls, db, host_ids):
+        '''Combine the host and global configs of many hosts at once.
+        The results are cached in the session until a :py:class:`HostConfig`
+        is changed or the session is rolled back, so the configs of hosts
+        that have already been resolved do not need a query.
+
+        :param Session db: Database session.
+
+        :param list host_ids: IDs of the hosts to resolve.
+
+        :rtype: dict Mapping the host ID to a :py:class:`ResolvedConfig`.
+        '''
+        cache = db.info.setdefault('resolved_configs', {})
+        missing = [x for x in set(host_ids) if x not in cache]
+        for start in range(0, len(missing), 500):
+            chunk = missing[start:start + 500]
+            query = db.query(HostConfig).filter(HostConfig.host_id.in_(chunk))
+            if 'global' not in cache:
+                query = db.query(HostConfig).filter(or_(
+                        HostConfig.host_id == None,
+                        HostConfig.host_id.in_(chunk)))
+            configs = {}
+            for config in query.order_by(HostConfig.id):
+                if config.host_id == None:
+                    cache.setdefault('global', config.resolve())
+                else:
+                    configs[config.host_id] = config
+            global_config = cache.setdefault('global', ResolvedConfig())
+            for host_id in chunk:
+                if host_id in configs:
+                    cache[host_id] = configs[host_id].resolve(global_config)
+                else:
+                    cache[host_id] = global_config
+        return dict([(x, cache[x]) for x in host_ids])
 
-            def __getattr__(self, attr):
-                hostconfig = getattr(self.configs, attr)
-                if hostconfig != None:
-                    return hostconfig
-                return getattr(self.global_configs, attr)
+    def find_previous_snapshot(self, db):
+        '''Return the snapshot name of the most recent successful backup.
 
-        return MergedConfigs(self.configs, db)
+        :rtype: str or None if there is no successful backup.
+        '''
+        row = db.query(Backup.snapshot_name).filter(Backup.host_id == self.id,
+                Backup.successful == True, Backup.snapshot_name != None,
+                Backup.expired == False
+                ).order_by(Backup.start_time.desc()).first()
+        if row == None:
+            return None
+        return row.snapshot_name
 
     def find_backup_generation(self, db):
         '''Return the name of the backup generation for the next backup.'''
@@ -259,6 +504,123 @@ class Host(Base):
 
         return 'daily'
 
+    def in_backup_window(self, now=None):
+        '''Is the time of day inside this host's backup window?
+
+        :param datetime now: (Default None)  Time to check, or the current
+                time if None.
+
+        :rtype: Boolean
+        '''
+        if self.window_start == None or self.window_end == None:
+            return True
+        if now == None:
+            now = datetime.datetime.now()
+
+        t = now.time()
+        if self.window_start <= self.window_end:
+            return self.window_start <= t < self.window_end
+        return t >= self.window_start or t < self.window_end
+
+    def compute_next_backup(self, now=None, successful=True,
+            retry_interval=datetime.timedelta(hours=1)):
+        '''Return when the next backup of this host should run.
+        After a successful backup, this is the start of the next backup
+        window (or one day later for hosts without a window).  After a
+        failed backup, the backup is retried after `retry_interval`.
+
+        :param datetime now: (Default None)  Time the last backup completed,
+                or the current time if None.
+
+        :param Boolean successful: (Default True)  Was the last backup
+                successful?
+
+        :param timedelta retry_interval: (Default 1 hour)  Delay before
+                retrying a failed backup.
+
+        :rtype: datetime
+        '''
+        if now == None:
+            now = datetime.datetime.now()
+        if not successful:
+            return now + retry_interval
+        if self.window_start == None or self.window_end == None:
+            return now + datetime.timedelta(days=1)
+
+        next_backup = datetime.datetime.combine(now.date(), self.window_start)
+        if next_backup <= now:
+            next_backup += datetime.timedelta(days=1)
+        return next_backup
+
+    @classmethod
+    def find_due(cls, db, now=None, backup_server_id=None):
+        '''Find the hosts that are due to be backed up, in a single query.
+        A host is due if it is active, its `next_backup` time has passed
+        (or is not set), and `now` is within its backup window.
+
+        The rows are ordered by priority (lowest first, with hosts without
+        a priority last), and have the attributes: "id", "hostname",
+        "ip_address", "storage_id", "window_start", "window_end",
+        "priority", "check_connectivity" and "ping_max_ms" (merged with the
+        global config),
+        "last_successful_backup" (start time of the last successful backup,
+        or None), and "running" (True if a backup has a "backup_pid" set,
+        which may be stale).
+
+        :param Session db: Database session.
+
+        :param datetime now: (Default None)  Time to check, or the current
+                time if None.
+
+        :param int backup_server_id: (Default None)  If not None, only
+                hosts with storage on this backup server are returned.
+
+        :rtype: list of rows.
+        '''
+        if now == None:
+            now = datetime.datetime.now()
+        t = now.time()
+
+        host_config = aliased(HostConfig)
+        global_config = aliased(HostConfig)
+        global_config_id = select([func.min(HostConfig.id)]).where(
+                HostConfig.host_id == None).as_scalar()
+        priority = func.coalesce(host_config.priority, global_config.priority)
+        check_connectivity = func.coalesce(host_config.check_connectivity,
+                global_config.check_connectivity)
+        ping_max_ms = func.coalesce(host_config.ping_max_ms,
+                global_config.ping_max_ms)
+        last_successful_backup = select([func.max(Backup.start_time)]).where(
+                and_(Backup.host_id == cls.id, Backup.successful == True)
+                ).correlate(cls.__table__).as_scalar()
+        running = exists().where(and_(Backup.host_id == cls.id,
+                Backup.backup_pid != None)).correlate(cls.__table__)
+
+        query = db.query(cls.id, cls.hostname, cls.ip_address,
+                cls.storage_id, cls.window_start, cls.window_end,
+                priority.label('priority'),
+                check_connectivity.label('check_connectivity'),
+                ping_max_ms.label('ping_max_ms'),
+                last_successful_backup.label('last_successful_backup'),
+                running.label('running'),
+                ).outerjoin(host_config, host_config.host_id == cls.id
+                ).outerjoin(global_config, global_config.id == global_config_id
+                ).filter(
+                cls.active == True,
+                or_(cls.next_backup == None, cls.next_backup <= now),
+                or_(cls.window_start == None, cls.window_end == None,
+                    and_(cls.window_start <= cls.window_end,
+                        cls.window_start <= t, cls.window_end > t),
+                    and_(cls.window_start > cls.window_end,
+                        or_(cls.window_start <= t, cls.window_end > t))))
+        if backup_server_id != None:
+            query = query.filter(cls.storage_id.in_(
+                    select([Storage.id]).where(
+                        Storage.backup_server_id == backup_server_id)))
+
+        return query.order_by(case([(priority == None, 1)], else_=0),
+                priority, cls.hostname).all()
+
     def __init__(self):
         pass
 
@@ -347,6 +709,22 @@ class HostConfig(Base):
     rsync_checksum_frequency = Column(Interval)
     rsync_compression = Column(Boolean)
 
+    def resolve(self, defaults=None):
+        '''Return the values of this config, with values that are None
+        taken from `defaults`.
+
+        :param ResolvedConfig defaults: (Default None)  Values for settings
+                that are not set in this config.
+
+        :rtype: :py:class:`ResolvedConfig`
+        '''
+        values = {}
+        for attr in CONFIG_FIELDS:
+            values[attr] = getattr(self, attr)
+            if values[attr] == None and defaults != None:
+                values[attr] = getattr(defaults, attr)
+        return ResolvedConfig(**values)
+
     def get_hostname(self):
         '''Return the hostname or "<GLOBAL>" for the global config.'''
         if self.host_id == None:
@@ -356,19 +734,7 @@ class HostConfig(Base):
     def as_string(self):
         '''Return a string of the values of this record'''
         s = ''
-        for attr in (
-                'alerts_mail_address',
-                'failure_warn_after',
-                'use_global_filters',
-                'check_connectivity',
-                'ping_max_ms',
-                'daily_history',
-                'weekly_history',
-                'monthly_history',
-                'priority',
-                'rsync_checksum_frequency',
-                'rsync_compression',
-                ):
+        for attr in CONFIG_FIELDS:
             s += '%s=%s ' % (attr, getattr(self, attr))
         return s
 
@@ -380,6 +746,21 @@ class HostConfig(Base):
                 self.get_hostname())
 
 
+def invalidate_resolved_configs(*args):
+    '''Discard the configs cached by :py:meth:`Host.resolve_configs` when
+    a :py:class:`HostConfig` is changed or the session is rolled back.
+    '''
+    session = args[-1]
+    if isinstance(session, HostConfig):
+        session = object_session(session)
+    if session != None:
+        session.info.pop('resolved_configs', None)
+
+for event_name in ['after_insert', 'after_update', 'after_delete']:
+    event.listen(HostConfig, event_name, invalidate_resolved_configs)
+event.listen(Session, 'after_rollback', invalidate_resolved_configs)
+
+
 class Backup(Base):
     '''Information about each backed-up data-set.
 
@@ -426,9 +807,17 @@ class Backup(Base):
     .. py:attribute:: snapshot_name
 
     Storage-specific name of the backup snapshot.
+
+    .. py:attribute:: expired
+
+    True once the snapshot has been destroyed by the retention policy.
     '''
 
     __tablename__ = 'backups'
+    __table_args__ = (
+            Index('ix_backups_host_successful_start', 'host_id', 'successful',
+                'start_time'),
+            )
     id = Column(Integer, primary_key=True)
     host_id = Column(Integer, ForeignKey('hosts.id'))
     host = relationship(Host, order_by=id, backref='backups')
@@ -445,17 +834,308 @@ class Backup(Base):
     full_checksum = Column(Boolean, nullable=False)
     harness_returncode = Column(Integer, default=None)
     snapshot_name = Column(String)
+    expired = Column(Boolean, nullable=False, default=False)
 
     def __init__(self, host, generation, full_checksum):
         self.generation = generation
         self.full_checksum = full_checksum
         self.host = host
+        self.expired = False
 
     def __repr__(self):
         return '<Backup(%s: %s@%s)>' % (self.id, self.host.hostname,
                 self.start_time)
 
 
+class BackupPhase(Base):
+    '''Time spent in a phase of a backup, such as the rsync transfer or
+    the creation of the snapshot.
+
+    .. py:attribute:: backup
+
+    Reference to the :py:class:`Backup` that this phase was part of.
+
+    .. py:attribute:: name
+
+    Name of the phase: "setup", "generation", "filter_rules", "transfer",
+    "storage_wait", "snapshot", or "commit" (database commits).
+
+    .. py:attribute:: start_time
+
+    When the phase was first entered.
+
+    .. py:attribute:: seconds
+
+    Total number of seconds spent in the phase.
+    '''
+
+    __tablename__ = 'backup_phases'
+    id = Column(Integer, primary_key=True)
+    backup_id = Column(Integer, ForeignKey('backups.id'), nullable=False,
+            index=True)
+    backup = relationship(Backup, order_by=id, backref='phases')
+    name = Column(String, nullable=False)
+    start_time = Column(DateTime)
+    seconds = Column(Float, nullable=False)
+
+    def __init__(self, backup, name, start_time, seconds):
+        self.backup = backup
+        self.name = name
+        self.start_time = start_time
+        self.seconds = seconds
+
+    def __repr__(self):
+        return '<BackupPhase(%s: %s=%.3f)>' % (self.backup_id, self.name,
+                self.seconds)
+
+    @classmethod
+    def summarize(cls, db, hostname=None, since=None, by_host=False):
+        '''Summarize the time spent in each phase across backups.
+
+        :param Session db: Database session.
+
+        :param str hostname: (Default None)  Only include backups of this
+                host.
+
+        :param datetime since: (Default None)  Only include backups started
+                after this time.
+
+        :param Boolean by_host: (Default False)  Summarize each host
+                separately.
+
+        :rtype: list of rows with the attributes "hostname" (None unless
+                `by_host`), "name", "count", "total", "average" and
+                "maximum".
+        '''
+        from sqlalchemy import null
+
+        if by_host:
+            host_column = Host.hostname
+        else:
+            host_column = null()
+        query = db.query(host_column.label('hostname'), cls.name,
+                func.count(cls.id).label('count'),
+                func.sum(cls.seconds).label('total'),
+                func.avg(cls.seconds).label('average'),
+                func.max(cls.seconds).label('maximum')).select_from(
+                cls).join(Backup, cls.backup_id == Backup.id).join(Host,
+                Backup.host_id == Host.id)
+        if hostname != None:
+            query = query.filter(Host.hostname == hostname)
+        if since != None:
+            query = query.filter(Backup.start_time >= since)
+        if by_host:
+            return query.group_by(Host.hostname, cls.name).order_by(
+                    Host.hostname, func.sum(cls.seconds).desc()).all()
+        return query.group_by(cls.name).order_by(
+                func.sum(cls.seconds).desc()).all()
+
+
+class BackupStatistics(Base):
+    '''Transfer statistics of a backup, from the output of rsync.
+
+    .. py:attribute:: backup
+
+    Reference to the :py:class:`Backup` these are the statistics of.
+
+    .. py:attribute:: files_created
+
+    Number of new files transferred.
+
+    .. py:attribute:: files_updated
+
+    Number of changed files transferred.
+
+    .. py:attribute:: files_deleted
+
+    Number of files and directories deleted.
+
+    .. py:attribute:: directories_created
+
+    Number of new directories.
+
+    .. py:attribute:: links_created
+
+    Number of new symbolic and hard links.
+
+    .. py:attribute:: attributes_changed
+
+    Number of items where only the attributes were changed.
+
+    .. py:attribute:: bytes_created
+
+    Total size of the new files.
+
+    .. py:attribute:: bytes_updated
+
+    Total size of the changed files.
+
+    .. py:attribute:: errors
+
+    Number of errors reported by rsync.
+
+    .. py:attribute:: total_files
+
+    Number of files in the backup, from the rsync "--stats".  This and the
+    remaining attributes are None if rsync did not report them.
+
+    .. py:attribute:: files_transferred
+
+    Number of regular files transferred.
+
+    .. py:attribute:: total_file_size
+
+    Total size of the files in the backup.
+
+    .. py:attribute:: transferred_file_size
+
+    Total size of the transferred files.
+
+    .. py:attribute:: literal_data
+
+    Bytes of file data that were sent over the network.
+
+    .. py:attribute:: matched_data
+
+    Bytes of file data that were matched against the previous backup.
+
+    .. py:attribute:: file_list_size
+
+    Size of the file list, in bytes.
+
+    .. py:attribute:: file_list_generation_seconds
+
+    Time taken to build the file list.
+
+    .. py:attribute:: file_list_transfer_seconds
+
+    Time taken to transfer the file list.
+
+    .. py:attribute:: bytes_sent
+
+    Total bytes sent by rsync.
+
+    .. py:attribute:: bytes_received
+
+    Total bytes received by rsync.
+    '''
+
+    __tablename__ = 'backup_statistics'
+    id = Column(Integer, primary_key=True)
+    backup_id = Column(Integer, ForeignKey('backups.id'), nullable=False,
+            unique=True)
+    backup = relationship(Backup, order_by=id, backref=backref('statistics',
+            uselist=False))
+    files_created = Column(Integer)
+    files_updated = Column(Integer)
+    files_deleted = Column(Integer)
+    directories_created = Column(Integer)
+    links_created = Column(Integer)
+    attributes_changed = Column(Integer)
+    bytes_created = Column(BigInteger)
+    bytes_updated = Column(BigInteger)
+    errors = Column(Integer)
+    total_files = Column(Integer)
+    files_transferred = Column(Integer)
+    total_file_size = Column(BigInteger)
+    transferred_file_size = Column(BigInteger)
+    literal_data = Column(BigInteger)
+    matched_data = Column(BigInteger)
+    file_list_size = Column(BigInteger)
+    file_list_generation_seconds = Column(Float)
+    file_list_transfer_seconds = Column(Float)
+    bytes_sent = Column(BigInteger)
+    bytes_received = Column(BigInteger)
+
+    def __init__(self, backup):
+        self.backup = backup
+
+    def __repr__(self):
+        return '<BackupStatistics(%s: +%s ~%s -%s)>' % (self.backup_id,
+                self.files_created, self.files_updated, self.files_deleted)
+
+
+class BackupProgress(Base):
+    '''Progress of a running backup, updated periodically by the harness.
+
+    .. py:attribute:: backup
+
+    Reference to the :py:class:`Backup` this is the progress of.
+
+    .. py:attribute:: update_time
+
+    When the progress was last updated.
+
+    .. py:attribute:: bytes_transferred
+
+    Bytes transferred so far.
+
+    .. py:attribute:: percent
+
+    Percentage of the transfer complete, as estimated by rsync, or None if
+    not known.
+
+    .. py:attribute:: files_transferred
+
+    Number of files transferred so far.
+
+    .. py:attribute:: files_total
+
+    Number of files rsync knows of so far, or None if not known.
+
+    .. py:attribute:: last_item
+
+    Name of the last file or directory changed.
+    '''
+
+    __tablename__ = 'backup_progress'
+    id = Column(Integer, primary_key=True)
+    backup_id = Column(Integer, ForeignKey('backups.id'), nullable=False,
+            unique=True)
+    backup = relationship(Backup, order_by=id, backref=backref('progress',
+            uselist=False))
+    update_time = Column(DateTime)
+    bytes_transferred = Column(BigInteger)
+    percent = Column(SmallInteger)
+    files_transferred = Column(Integer)
+    files_total = Column(Integer)
+    last_item = Column(String)
+
+    def __init__(self, backup):
+        self.backup = backup
+
+    def __repr__(self):
+        return '<BackupProgress(%s: %s bytes at %s)>' % (self.backup_id,
+                self.bytes_transferred, self.update_time)
+
+    def throughput(self):
+        '''Average bytes per second since the backup started.
+
+        :rtype: float or None if not known.
+        '''
+        if (self.update_time == None or self.bytes_transferred == None
+                or self.backup.start_time == None):
+            return None
+        elapsed = self.update_time - self.backup.start_time
+        seconds = elapsed.days * 86400 + elapsed.seconds
+        if seconds <= 0:
+            return None
+        return float(self.bytes_transferred) / seconds
+
+    def eta(self):
+        '''Estimated time that the transfer will complete, from the percent
+        complete reported by rsync.
+
+        :rtype: datetime or None if not known.
+        '''
+        if (self.update_time == None or not self.percent
+                or self.backup.start_time == None):
+            return None
+        elapsed = self.update_time - self.backup.start_time
+        return self.update_time + elapsed * (100 - self.percent
+                ) / self.percent
+
+
 class FilterRule(Base):
     '''Rsync filter rules for the various backups.
 
@@ -490,6 +1170,31 @@ class FilterRule(Base):
                 self.rsync_rule)
 
 
+#  compiled rules by engine and host ID, see :py:meth:`Host.get_filter_rules`
+filter_rules_cache = weakref.WeakKeyDictionary()
+
+
+def bump_filter_revision(mapper, connection, target):
+    '''Increment the filter revision of the host of a :py:class:`FilterRule`
+    that was changed, or the global filter revision for global rules.
+    '''
+    host_ids = set([target.host_id])
+    host_ids.update(inspect(target).attrs.host_id.history.deleted or [])
+    for host_id in host_ids:
+        if host_id == None:
+            table = Metadata.__table__
+            where = table.c.id == 1
+        else:
+            table = Host.__table__
+            where = table.c.id == host_id
+        connection.execute(table.update().where(where).values(
+                filter_revision=func.coalesce(table.c.filter_revision, 0)
+                + 1))
+
+for event_name in ['after_insert', 'after_update', 'after_delete']:
+    event.listen(FilterRule, event_name, bump_filter_revision)
+
+
 class HostUsage(Base):
     '''Historic space usage of a particular host.
     This depends on the backend, some backends do not support quick
@@ -521,6 +1226,9 @@ class HostUsage(Base):
     '''
 
     __tablename__ = 'host_usage'
+    __table_args__ = (
+            Index('ix_host_usage_host_date', 'host_id', 'sample_date'),
+            )
     id = Column(Integer, primary_key=True)
     host_id = Column(Integer, ForeignKey('hosts.id'))
     host = relationship(Host, order_by=id, backref='usage')
@@ -530,6 +1238,206 @@ class HostUsage(Base):
     compression_ratio_percent = Column(SmallInteger, default=None)
     runtime = Column(Interval)
 
+    @classmethod
+    def record_runtime(cls, db, host, runtime, sample_date=None):
+        '''Record the runtime of a backup in the usage for that day.
+
+        :param Session db: Database session.
+
+        :param Host host: Host that was backed up.
+
+        :param timedelta runtime: Length of time the backup took.
+
+        :param date sample_date: (Default None)  Date of the backup, or
+                today if None.
+
+        :rtype: :py:class:`HostUsage`
+        '''
+        usage = cls.get_sample(db, host, sample_date)
+        usage.runtime = runtime
+        return usage
+
+    @classmethod
+    def record_space(cls, db, host, used_by_dataset, used_by_snapshots,
+            sample_date=None):
+        '''Record the space used by a host in the usage for that day.
+
+        :param Session db: Database session.
+
+        :param Host host: Host the space is used by.
+
+        :param int used_by_dataset: Bytes used by the current backup.
+
+        :param int used_by_snapshots: Bytes used only by snapshots.
+
+        :param date sample_date: (Default None)  Date of the sample, or
+                today if None.
+
+        :rtype: :py:class:`HostUsage`
+        '''
+        usage = cls.get_sample(db, host, sample_date)
+        usage.used_by_dataset = used_by_dataset
+        usage.used_by_snapshots = used_by_snapshots
+        return usage
+
+    @classmethod
+    def get_sample(cls, db, host, sample_date=None):
+        '''Return the usage of a host for a day, adding it if necessary.
+
+        :param Session db: Database session.
+
+        :param Host host: Host to get the usage of.
+
+        :param date sample_date: (Default None)  Date of the usage, or
+                today if None.
+
+        :rtype: :py:class:`HostUsage`
+        '''
+        if sample_date == None:
+            sample_date = datetime.date.today()
+        usage = db.query(cls).filter_by(host_id=host.id,
+                sample_date=sample_date).first()
+        if usage == None:
+            usage = cls()
+            usage.host = host
+            usage.sample_date = sample_date
+            db.add(usage)
+        return usage
+
+    @classmethod
+    def record_many(cls, db, rows, sample_date=None, chunk_size=500):
+        '''Record the space used by many hosts in the usage for that day,
+        with bulk inserts and updates of the usage table.  Objects of the
+        session are not updated, commit the session to reload them.
+
+        :param Session db: Database session.
+
+        :param iterable rows: (host_id, used_by_dataset, used_by_snapshots,
+                compression_ratio_percent) of each host.
+
+        :param date sample_date: (Default None)  Date of the sample, or
+                today if None.
+
+        :param int chunk_size: (Default 500)  Number of rows to write at
+                once.
+
+        :rtype: int Number of hosts recorded.
+        '''
+        if sample_date == None:
+            sample_date = datetime.date.today()
+        db.flush()
+        table = cls.__table__
+        existing = dict(db.query(cls.host_id, cls.id).filter(
+                cls.sample_date == sample_date))
+        insert = table.insert()
+        update = table.update().where(table.c.id == bindparam('usage_id')
+                ).values(used_by_dataset=bindparam('dataset'),
+                used_by_snapshots=bindparam('snapshots'),
+                compression_ratio_percent=bindparam('ratio'))
+
+        inserts = []
+        updates = []
+        count = 0
+        for host_id, dataset, snapshots, ratio in rows:
+            count += 1
+            if host_id in existing:
+                updates.append({'usage_id': existing[host_id],
+                        'dataset': dataset, 'snapshots': snapshots,
+                        'ratio': ratio})
+            else:
+                existing[host_id] = None
+                inserts.append({'host_id': host_id,
+                        'sample_date': sample_date,
+                        'used_by_dataset': dataset,
+                        'used_by_snapshots': snapshots,
+                        'compression_ratio_percent': ratio})
+            if len(inserts) >= chunk_size:
+                db.execute(insert, inserts)
+                inserts = []
+            if len(updates) >= chunk_size:
+                db.execute(update, updates)
+                updates = []
+        if inserts:
+            db.execute(insert, inserts)
+        if updates:
+            db.execute(update, updates)
+        return count
+
+    @classmethod
+    def sample_storages(cls, db, storages, sample_date=None):
+        '''Record the space used by the hosts of the storages whose plugin
+        can collect the usage of all its hosts at once, with a
+        "collect_usage()" function.
+
+        :param Session db: Database session.
+
+        :param list storages: :py:class:`Storage` records to sample.
+
+        :param date sample_date: (Default None)  Date of the sample, or
+                today if None.
+
+        :rtype: int Number of hosts recorded.
+        '''
+        modules = {}
+        for storage in storages:
+            module = nabsupp.get_storage_plugin(storage.method)
+            if hasattr(module, 'collect_usage'):
+                modules.setdefault(module, []).append(storage)
+        if not modules:
+            return 0
+
+        host_ids = {}
+        for row in db.query(Host.id, Host.storage_id, Host.hostname).filter(
+                Host.storage_id.in_([x.id for x in storages])):
+            host_ids[(row.storage_id, row.hostname)] = row.id
+
+        def rows():
+            for module, module_storages in modules.items():
+                plugins = [x.get_plugin() for x in module_storages]
+                storage_ids = dict([(id(plugin), storage.id) for plugin,
+                        storage in zip(plugins, module_storages)])
+                for row in module.collect_usage(plugins):
+                    host_id = host_ids.get((storage_ids[id(row[0])], row[1]))
+                    if host_id != None:
+                        yield (host_id, ) + row[2:]
+        return cls.record_many(db, rows(), sample_date)
+
+    @classmethod
+    def runtime_estimates(cls, db, host_ids, samples=5):
+        '''Estimate how long the next backup of each host will take, from
+        the average of its most recent runtimes.
+
+        :param Session db: Database session.
+
+        :param list host_ids: IDs of the hosts to estimate.
+
+        :param int samples: (Default 5)  Number of recent runtimes to use.
+
+        :rtype: dict Mapping host ID to a timedelta, hosts without any
+                recorded runtimes are not included.
+        '''
+        runtimes = {}
+        if not host_ids:
+            return runtimes
+
+        #  only the newest samples of each host are read: those with fewer
+        #  than "samples" newer runtimes of the same host
+        newer = aliased(cls)
+        newer_count = db.query(func.count(newer.id)).filter(
+                newer.host_id == cls.host_id, newer.runtime != None,
+                newer.sample_date > cls.sample_date).correlate(
+                cls).as_scalar()
+        for host_id, runtime in db.query(cls.host_id, cls.runtime).filter(
+                cls.host_id.in_(host_ids), cls.runtime != None,
+                newer_count < samples):
+            runtimes.setdefault(host_id, []).append(runtime)
+
+        estimates = {}
+        for host_id, host_runtimes in runtimes.items():
+            estimates[host_id] = (sum(host_runtimes, datetime.timedelta(0))
+                    / len(host_runtimes))
+        return estimates
+
     def __init__(self):
         pass
 
@@ -571,9 +1479,25 @@ class StorageUsage(Base):
     100 means no deduplication, 200 means a 2:1 deduplication, values less
     than 100 indicate negative deduplication.  None if not available for
     this storage.
+
+    .. py:attribute:: total_inodes
+
+    Total number of inodes, None if the file-system does not report them.
+
+    .. py:attribute:: free_inodes
+
+    Inodes that are unused.
+
+    .. py:attribute:: used_inodes
+
+    Inodes that are used.
     '''
 
     __tablename__ = 'storage_usage'
+    __table_args__ = (
+            Index('ix_storage_usage_storage_date', 'storage_id',
+                'sample_date'),
+            )
     id = Column(Integer, primary_key=True)
     storage_id = Column(Integer, ForeignKey('storage.id'))
     storage = relationship(Storage, order_by=id, backref='usage')
@@ -583,10 +1507,131 @@ class StorageUsage(Base):
     used_bytes = Column(BigInteger, default=None)
     usage_percent = Column(SmallInteger, default=None)
     dedup_ratio_percent = Column(SmallInteger, default=None)
+    total_inodes = Column(BigInteger, default=None)
+    free_inodes = Column(BigInteger, default=None)
+    used_inodes = Column(BigInteger, default=None)
 
     def __init__(self):
         pass
 
+    @classmethod
+    def record(cls, db, storage, statistics, sample_date=None):
+        '''Record a sample of the capacity of a storage as the usage for
+        that day, replacing any earlier sample of the same day.
+
+        :param Session db: Database session.
+
+        :param Storage storage: Storage that was sampled.
+
+        :param CapacityStatistics statistics: The sample, from the
+                "storage_statistics()" method of the storage plugin.
+
+        :param date sample_date: (Default None)  Date of the sample, or
+                today if None.
+
+        :rtype: :py:class:`StorageUsage`
+        '''
+        if sample_date == None:
+            sample_date = datetime.date.today()
+        usage = db.query(cls).filter_by(storage_id=storage.id,
+                sample_date=sample_date).first()
+        if usage == None:
+            usage = cls()
+            usage.storage = storage
+            usage.sample_date = sample_date
+            db.add(usage)
+        for field in ['total_bytes', 'free_bytes', 'used_bytes',
+                'dedup_ratio_percent', 'total_inodes', 'free_inodes',
+                'used_inodes']:
+            setattr(usage, field, getattr(statistics, field))
+        usage.usage_percent = statistics.usage_percent()
+        return usage
+
     def __repr__(self):
         return '<StorageUsage(%s: %s@%s)>' % (self.id, self.storage_id,
                 self.sample_date)
+
+
+class Replication(Base):
+    '''Replication of the snapshots of a host to a target, see
+    :py:mod:`nabreplicate`.
+
+    .. py:attribute:: host
+
+    Reference to the :py:class:`Host` being replicated.
+
+    .. py:attribute:: target
+
+    Where the snapshots are sent: a zfs file-system, optionally prefixed
+    with the host to reach over ssh, as in "offsite.example.com:tank/nab".
+
+    .. py:attribute:: snapshot_name
+
+    Name of the last snapshot replicated, which the next replication is
+    sent incrementally from, or None.
+
+    .. py:attribute:: snapshot_time
+
+    When the last snapshot replicated was taken.
+
+    .. py:attribute:: replicated_time
+
+    When the last replication succeeded.
+
+    .. py:attribute:: lag
+
+    How old the replicated copy was at the last replication: the time
+    from when its snapshot was taken.
+
+    .. py:attribute:: bytes_sent
+
+    Size of the stream of the last replication.
+
+    .. py:attribute:: error
+
+    Error of the last replication, or None if it succeeded.
+    '''
+
+    __tablename__ = 'replications'
+    __table_args__ = (
+            Index('ix_replications_host_target', 'host_id', 'target',
+                unique=True),
+            )
+    id = Column(Integer, primary_key=True)
+    host_id = Column(Integer, ForeignKey('hosts.id'), nullable=False)
+    host = relationship(Host, order_by=id, backref='replications')
+    target = Column(String, nullable=False)
+    snapshot_name = Column(String, default=None)
+    snapshot_time = Column(DateTime, default=None)
+    replicated_time = Column(DateTime, default=None)
+    lag = Column(Interval, default=None)
+    bytes_sent = Column(BigInteger, default=None)
+    error = Column(String, default=None)
+
+    def __init__(self, host, target):
+        self.host = host
+        self.target = target
+
+    @classmethod
+    def get(cls, db, host, target):
+        '''Return the replication of a host to a target, adding it if
+        necessary.
+
+        :param Session db: Database session.
+
+        :param Host host: Host being replicated.
+
+        :param str target: Target of the replication.
+
+        :rtype: :py:class:`Replication`
+        '''
+        replication = db.query(cls).filter_by(host_id=host.id,
+                target=target).first()
+        if replication == None:
+            replication = cls(host, target)
+            db.add(replication)
+        return replication
+
+    def __repr__(self):
+        return '<Replication(%s: %s->%s@%s)>' % (self.id, self.host_id,
+                self.target, self.snapshot_name)
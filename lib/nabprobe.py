@@ -0,0 +1,271 @@
+#!/usr/bin/env python
+#
+#  Copyright (c) 2012, Sean Reifschneider, tummy.com, ltd.
+#  All Rights Reserved.
+
+'''Connectivity checks for Network Attached Backup.
+
+Hosts are probed concurrently before their backups are started: a TCP
+connection is attempted to the SSH port of every host at once, and an
+ICMP echo is sent to each if the system allows this process to send them.
+This way, probing hundreds of hosts takes no longer than the timeout.
+'''
+
+import os
+import time
+import errno
+import struct
+import socket
+import select
+from multiprocessing.pool import ThreadPool
+
+
+class ProbeResult:
+    '''Result of probing a host.
+
+    .. py:attribute:: address
+
+    The hostname or IP address that was probed.
+
+    .. py:attribute:: reachable
+
+    True if a TCP connection to the port was made.
+
+    .. py:attribute:: rtt_ms
+
+    Round-trip time in milliseconds, from the ICMP echo if one was
+    answered, otherwise from the TCP connection.  None if neither
+    responded.
+
+    .. py:attribute:: probe_time
+
+    Time (as returned by `time.time()`) that the probe was made.
+    '''
+
+    def __init__(self, address, reachable, rtt_ms, probe_time):
+        self.address = address
+        self.reachable = reachable
+        self.rtt_ms = rtt_ms
+        self.probe_time = probe_time
+
+    def __repr__(self):
+        return '<ProbeResult(%s: reachable=%s, rtt_ms=%s)>' % (
+                self.address, self.reachable, self.rtt_ms)
+
+
+def resolve(address):
+    '''Look up the IPv4 address of a host.
+
+    :rtype: str The IP address, or None if it could not be resolved.
+    '''
+    try:
+        return socket.getaddrinfo(address, None, socket.AF_INET,
+                socket.SOCK_STREAM)[0][4][0]
+    except socket.error:
+        return None
+
+
+def icmp_checksum(data):
+    '''Compute the internet checksum of `data`.
+
+    :rtype: int
+    '''
+    if len(data) % 2:
+        data += '\0'
+    total = sum(struct.unpack('!%dH' % (len(data) / 2), data))
+    total = (total >> 16) + (total & 0xffff)
+    total += total >> 16
+    return ~total & 0xffff
+
+
+def open_icmp_socket():
+    '''Open a socket for sending ICMP echo requests.  Unprivileged "ping"
+    sockets are used if the system allows them, otherwise a raw socket,
+    which needs root.
+
+    :rtype: tuple (socket, is_raw) or (None, None) if ICMP is unavailable.
+    '''
+    for socktype, is_raw in [(socket.SOCK_DGRAM, False),
+            (socket.SOCK_RAW, True)]:
+        try:
+            sock = socket.socket(socket.AF_INET, socktype,
+                    socket.IPPROTO_ICMP)
+            sock.setblocking(0)
+            return sock, is_raw
+        except socket.error:
+            pass
+    return None, None
+
+
+def probe_hosts(addresses, port=22, timeout=2.0, icmp=True):
+    '''Probe hosts concurrently.
+
+    :param list addresses: Hostnames or IP addresses to probe.
+
+    :param int port: (Default 22)  TCP port to connect to.
+
+    :param float timeout: (Default 2.0)  Seconds to wait for responses.
+
+    :param Boolean icmp: (Default True)  Also send ICMP echo requests, if
+            possible.
+
+    :rtype: dict Mapping the address to a :py:class:`ProbeResult`.
+    '''
+    addresses = list(set(addresses))
+    if not addresses:
+        return {}
+    pool = ThreadPool(min(32, len(addresses)))
+    try:
+        ips = dict(zip(addresses, pool.map(resolve, addresses)))
+    finally:
+        pool.close()
+
+    start = time.time()
+    tcp_rtt = {}
+    icmp_rtt = {}
+    poller = select.poll()
+    connecting = {}
+
+    for address in addresses:
+        if ips[address] == None:
+            continue
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setblocking(0)
+        sent = time.time()
+        err = sock.connect_ex((ips[address], port))
+        if err == 0:
+            tcp_rtt[address] = (time.time() - sent) * 1000.0
+            sock.close()
+        elif err in (errno.EINPROGRESS, errno.EWOULDBLOCK):
+            connecting[sock.fileno()] = (sock, address, sent)
+            poller.register(sock, select.POLLOUT)
+        else:
+            sock.close()
+
+    icmp_sock = None
+    if icmp:
+        icmp_sock, is_raw = open_icmp_socket()
+    icmp_sent = {}
+    if icmp_sock != None:
+        ident = os.getpid() & 0xffff
+        for seq, address in enumerate(sorted(addresses)):
+            if ips[address] == None:
+                continue
+            header = struct.pack('!BBHHH', 8, 0, 0, ident, seq & 0xffff)
+            payload = 'network-attached-backup'
+            packet = struct.pack('!BBHHH', 8, 0,
+                    icmp_checksum(header + payload), ident,
+                    seq & 0xffff) + payload
+            try:
+                icmp_sent[ips[address]] = time.time()
+                icmp_sock.sendto(packet, (ips[address], 0))
+            except socket.error:
+                del icmp_sent[ips[address]]
+        poller.register(icmp_sock, select.POLLIN)
+
+    while connecting or (icmp_sock != None
+            and len(icmp_rtt) < len(icmp_sent)):
+        remaining = timeout - (time.time() - start)
+        if remaining <= 0:
+            break
+        try:
+            events = poller.poll(remaining * 1000)
+        except select.error, e:
+            if e.args[0] == errno.EINTR:
+                continue
+            raise
+        now = time.time()
+        for fd, event in events:
+            if icmp_sock != None and fd == icmp_sock.fileno():
+                try:
+                    data, peer = icmp_sock.recvfrom(2048)
+                except socket.error:
+                    continue
+                if is_raw:
+                    data = data[(ord(data[0]) & 0x0f) * 4:]
+                if len(data) < 8 or ord(data[0]) != 0:
+                    continue
+                #  ping sockets rewrite the identifier, raw sockets see
+                #  every reply on the system
+                if is_raw and struct.unpack('!H', data[4:6])[0] != ident:
+                    continue
+                if peer[0] in icmp_sent:
+                    icmp_rtt.setdefault(peer[0],
+                            (now - icmp_sent[peer[0]]) * 1000.0)
+                continue
+
+            sock, address, sent = connecting.pop(fd)
+            poller.unregister(fd)
+            if sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR) == 0:
+                tcp_rtt[address] = (now - sent) * 1000.0
+            sock.close()
+
+    for sock, address, sent in connecting.values():
+        sock.close()
+    if icmp_sock != None:
+        icmp_sock.close()
+
+    results = {}
+    for address in addresses:
+        rtt_ms = icmp_rtt.get(ips[address], tcp_rtt.get(address))
+        results[address] = ProbeResult(address, address in tcp_rtt, rtt_ms,
+                start)
+    return results
+
+
+class ProbeCache:
+    '''Probe hosts, remembering the results for a short time.
+
+    :param int ttl: (Default 60)  Seconds that a result is reused for.
+
+    :param function probe_function: (Default `probe_hosts`)  Called as
+            `probe_function(addresses)` to probe hosts that are not
+            cached.
+
+    :param function clock: (Default `time.time`)  Source of the current
+            time, in seconds.
+    '''
+
+    def __init__(self, ttl=60, probe_function=probe_hosts, clock=time.time):
+        self.ttl = ttl
+        self.probe_function = probe_function
+        self.clock = clock
+        self.results = {}
+
+    def probe(self, addresses):
+        '''Return probe results for the addresses, probing any that do not
+        have a recent result.
+
+        :param list addresses: Hostnames or IP addresses to probe.
+
+        :rtype: dict Mapping the address to a :py:class:`ProbeResult`.
+        '''
+        now = self.clock()
+        stale = [x for x in addresses if x not in self.results
+                or self.results[x][0] + self.ttl <= now]
+        if stale:
+            for address, result in self.probe_function(stale).items():
+                self.results[address] = (now, result)
+        return dict([(x, self.results[x][1]) for x in addresses])
+
+    def acceptable(self, address, check_connectivity, ping_max_ms):
+        '''Should a backup be started on this host, given its connectivity
+        configuration?  Hosts are only probed if `check_connectivity` is
+        set or `ping_max_ms` is not None.
+
+        :param str address: Hostname or IP address of the host.
+
+        :param Boolean check_connectivity: Must the host be reachable?
+
+        :param int ping_max_ms: If not None, the maximum round-trip time.
+
+        :rtype: Boolean
+        '''
+        if not check_connectivity and ping_max_ms == None:
+            return True
+        result = self.probe([address])[address]
+        if not result.reachable:
+            return False
+        if ping_max_ms != None:
+            return result.rtt_ms != None and result.rtt_ms <= ping_max_ms
+        return True
@@ -0,0 +1,306 @@
+#!/usr/bin/env python
+#
+#  Copyright (c) 2012, Sean Reifschneider, tummy.com, ltd.
+#  All Rights Reserved.
+
+'''Background removal of deleted snapshots and hosts.
+
+Removing a hard-linked tree can take longer than the backup that created
+it, so the storage plugins only rename trees into a trash directory, which
+is quick and survives restarts.  The :py:class:`Reaper` empties the trash
+later, with several threads unlinking files, limited to a number of
+operations per second, and pausing while the storage is busy or while
+backups are running.
+'''
+
+import os
+import sys
+import stat
+import time
+import Queue
+import threading
+
+TRASH_DIRECTORY = '.nab-trash'
+
+
+def move_to_trash(path, top_directory):
+    '''Move `path` into the trash directory under `top_directory`, which
+    must be on the same file-system.
+
+    :param str path: File or directory to be removed.
+
+    :param str top_directory: Directory holding the trash directory.
+
+    :rtype: str The new path of the file or directory.
+    '''
+    trash = os.path.join(top_directory, TRASH_DIRECTORY)
+    if not os.path.exists(trash):
+        os.mkdir(trash, 0700)
+    name = '%s-%d-%s' % (time.strftime('%Y%m%d%H%M%S'), os.getpid(),
+            os.path.basename(path.rstrip('/')))
+    destination = os.path.join(trash, name)
+    count = 0
+    while os.path.lexists(destination):
+        count += 1
+        destination = os.path.join(trash, '%s.%d' % (name, count))
+    os.rename(path, destination)
+    return destination
+
+
+class RateLimiter:
+    '''Limit operations to a rate, shared between threads.
+
+    :param float rate: Operations per second, or None for no limit.
+
+    :param function clock: (Default `time.time`)  Source of the current
+            time, in seconds.
+
+    :param function sleep: (Default `time.sleep`)  Called to wait.
+    '''
+
+    def __init__(self, rate, clock=time.time, sleep=time.sleep):
+        self.rate = rate
+        self.clock = clock
+        self.sleep = sleep
+        self.lock = threading.Lock()
+        self.next_time = None
+
+    def acquire(self, count=1):
+        '''Wait until `count` more operations are allowed.
+
+        :rtype: None
+        '''
+        if not self.rate:
+            return
+        with self.lock:
+            now = self.clock()
+            if self.next_time == None or self.next_time < now:
+                self.next_time = now
+            start = self.next_time
+            self.next_time += float(count) / self.rate
+        if start > now:
+            self.sleep(start - now)
+
+
+class ReapStatistics:
+    '''What a :py:class:`Reaper` removed.
+
+    .. py:attribute:: entries
+
+    Number of trash entries completely removed.
+
+    .. py:attribute:: files
+
+    Number of files (and other non-directories) unlinked.
+
+    .. py:attribute:: directories
+
+    Number of directories removed.
+
+    .. py:attribute:: seconds
+
+    Elapsed time.
+    '''
+
+    def __init__(self):
+        self.entries = 0
+        self.files = 0
+        self.directories = 0
+        self.seconds = 0.0
+
+    def __repr__(self):
+        return ('<ReapStatistics(entries=%d, files=%d, directories=%d, '
+                'seconds=%.3f)>' % (self.entries, self.files,
+                self.directories, self.seconds))
+
+
+class Reaper:
+    '''Empty a trash directory.
+
+    :param str trash_directory: The trash directory to empty.
+
+    :param int workers: (Default 4)  Number of threads unlinking files.
+
+    :param float ops_per_second: (Default None)  Limit on the number of
+            files and directories removed per second.
+
+    :param DeviceMonitor monitor: (Default None)  Monitor of the storage
+            device, used with `max_io_busy_percent`.
+
+    :param int max_io_busy_percent: (Default None)  Pause while the device
+            is at least this busy.
+
+    :param function paused: (Default None)  If given, called regularly,
+            and removal pauses while it returns True.  It is only called
+            from the thread calling :py:meth:`reap`.
+
+    :param float check_interval: (Default 5)  Seconds between checks of
+            `paused` and the device utilization.
+
+    :param function clock: (Default `time.time`)  Source of the current
+            time, in seconds.
+
+    :param function sleep: (Default `time.sleep`)  Called to wait.
+    '''
+
+    def __init__(self, trash_directory, workers=4, ops_per_second=None,
+            monitor=None, max_io_busy_percent=None, paused=None,
+            check_interval=5, clock=time.time, sleep=time.sleep):
+        self.trash_directory = trash_directory
+        self.workers = workers
+        self.limiter = RateLimiter(ops_per_second, clock, sleep)
+        self.monitor = monitor
+        self.max_io_busy_percent = max_io_busy_percent
+        self.paused = paused
+        self.check_interval = check_interval
+        self.clock = clock
+        self.sleep = sleep
+        self.running = threading.Event()
+        self.running.set()
+        self.stopped = False
+        self.statistics = ReapStatistics()
+        self.lock = threading.Lock()
+
+    def pending(self):
+        '''Return the entries in the trash, oldest first.
+
+        :rtype: list of paths
+        '''
+        if not os.path.isdir(self.trash_directory):
+            return []
+        return [os.path.join(self.trash_directory, x)
+                for x in sorted(os.listdir(self.trash_directory))]
+
+    def stop(self):
+        '''Stop removing files as soon as possible, for example from a
+        signal handler.  Partially removed entries stay in the trash.
+        '''
+        self.stopped = True
+        self.running.set()
+
+    def check(self):
+        '''Pause or resume the workers, depending on `paused` and the
+        device utilization.
+
+        :rtype: Boolean True if the workers may run.
+        '''
+        run = True
+        if self.paused != None and self.paused():
+            run = False
+        if run and self.monitor != None and self.max_io_busy_percent:
+            self.monitor.sample()
+            run = not self.monitor.is_saturated(self.max_io_busy_percent)
+        if run or self.stopped:
+            self.running.set()
+        else:
+            self.running.clear()
+        return run
+
+    def reap(self):
+        '''Remove the entries in the trash.
+
+        :rtype: :py:class:`ReapStatistics` of everything removed by this
+                reaper so far.
+        '''
+        start = self.clock()
+        for path in self.pending():
+            if self.stopped:
+                break
+            while not self.check() and not self.stopped:
+                self.sleep(self.check_interval)
+            self.remove(path)
+            if not self.stopped:
+                self.statistics.entries += 1
+        self.statistics.seconds += self.clock() - start
+        return self.statistics
+
+    def remove(self, path):
+        '''Remove a file or directory tree, using the worker threads.
+
+        :rtype: None
+        '''
+        if not stat.S_ISDIR(os.lstat(path).st_mode):
+            self.limiter.acquire()
+            os.unlink(path)
+            self.statistics.files += 1
+            return
+
+        work = Queue.Queue()
+        directories = [(0, path)]
+        errors = []
+        work.put((path, 0))
+
+        def worker():
+            while True:
+                item = work.get()
+                if item == None:
+                    work.task_done()
+                    return
+                try:
+                    if not self.stopped and not errors:
+                        found = self.unlink_files(item[0], item[1], work)
+                        with self.lock:
+                            directories.extend(found)
+                except Exception:
+                    errors.append(sys.exc_info())
+                work.task_done()
+
+        threads = []
+        for i in range(self.workers):
+            thread = threading.Thread(target=worker)
+            thread.daemon = True
+            thread.start()
+            threads.append(thread)
+        joiner = threading.Thread(target=work.join)
+        joiner.daemon = True
+        joiner.start()
+        while joiner.is_alive():
+            self.check()
+            joiner.join(self.check_interval)
+        for thread in threads:
+            work.put(None)
+        for thread in threads:
+            thread.join()
+        if errors:
+            raise errors[0][0], errors[0][1], errors[0][2]
+        if self.stopped:
+            return
+
+        directories.sort(reverse=True)
+        last_check = self.clock()
+        for depth, directory in directories:
+            if self.clock() - last_check >= self.check_interval:
+                while not self.check() and not self.stopped:
+                    self.sleep(self.check_interval)
+                last_check = self.clock()
+            if self.stopped:
+                return
+            self.limiter.acquire()
+            os.rmdir(directory)
+            self.statistics.directories += 1
+
+    def unlink_files(self, directory, depth, work):
+        '''Unlink the files in `directory` and queue its subdirectories.
+
+        :rtype: list of (depth, path) of the subdirectories.
+        '''
+        subdirectories = []
+        names = os.listdir(directory)
+        for offset in range(0, len(names), 100):
+            self.running.wait()
+            if self.stopped:
+                break
+            batch = names[offset:offset + 100]
+            self.limiter.acquire(len(batch))
+            files = 0
+            for name in batch:
+                path = os.path.join(directory, name)
+                if stat.S_ISDIR(os.lstat(path).st_mode):
+                    subdirectories.append((depth + 1, path))
+                    work.put((path, depth + 1))
+                else:
+                    os.unlink(path)
+                    files += 1
+            with self.lock:
+                self.statistics.files += files
+        return subdirectories
@@ -0,0 +1,426 @@
+#!/usr/bin/env python
+#
+#  Copyright (c) 2012, Sean Reifschneider, tummy.com, ltd.
+#  All Rights Reserved.
+
+'''Replication of the snapshots of zfs storage to a second pool.
+
+The newest snapshot of each host is sent to the target with "zfs send",
+incrementally from the newest snapshot that the host and the target both
+have.  The last snapshot replicated is recorded in the
+:py:class:`Replication` of the host, and retention keeps it so that the
+next stream can be sent from it.  A full stream is only sent while the
+target has no snapshots of the host, as "zfs receive" will not overwrite
+them with one.  The target is reached with ssh if it names a host.
+
+The stream is copied from "zfs send" to "zfs receive" through a
+:py:class:`BufferedPipe`, which holds several megabytes in memory so that
+neither side waits for the other while the disks are bursty.  Several
+hosts are replicated at once, sharing a bandwidth limit.
+'''
+
+from nabdb import *
+import os
+import time
+import Queue
+import tempfile
+import threading
+import subprocess
+import nabreaper
+
+#  bytes held between "zfs send" and "zfs receive" for each stream
+DEFAULT_BUFFER_SIZE = 64 * 1024 * 1024
+#  bytes read from "zfs send" at a time
+CHUNK_SIZE = 1024 * 1024
+
+
+def parse_target(target):
+    '''Split a target into the host to ssh to and the file-system.
+
+    :param str target: "[HOST:]FILESYSTEM"
+
+    :rtype: tuple of (host or None, filesystem)
+    '''
+    if ':' in target:
+        remote, filesystem = target.split(':', 1)
+        return remote, filesystem
+    return None, target
+
+
+def send_command(plugin, hostname, snapshotname, base=None):
+    '''Return the command sending a snapshot of a host.
+
+    :param Storage plugin: The zfs storage plugin of the host.
+
+    :param str hostname: Name of the host.
+
+    :param str snapshotname: Name of the snapshot to send.
+
+    :param str base: (Default None)  Name of the snapshot to send the
+            changes since, or None for a full stream.
+
+    :rtype: list of str
+    '''
+    command = ['zfs', 'send']
+    if base != None:
+        command += ['-i', '@' + base]
+    return command + ['%s@%s' % (plugin.get_dataset(hostname), snapshotname)]
+
+
+def target_snapshots(target):
+    '''List the snapshots on a target, with a single "zfs list".
+
+    :param str target: Target of the replication.
+
+    :rtype: dict Mapping the host name to the set of the names of its
+            snapshots on the target.
+    '''
+    remote, filesystem = parse_target(target)
+    command = ['zfs', 'list', '-H', '-r', '-t', 'snapshot', '-o', 'name',
+            filesystem]
+    if remote != None:
+        command = ['ssh', remote] + command
+    prefix = filesystem + '/'
+    snapshots = {}
+    for line in subprocess.check_output(command).splitlines():
+        if not line.startswith(prefix):
+            continue
+        name, _, snapshotname = line[len(prefix):].partition('@')
+        if snapshotname and '/' not in name:
+            snapshots.setdefault(name, set()).add(snapshotname)
+    return snapshots
+
+
+def receive_command(target, hostname):
+    '''Return the command receiving the snapshots of a host on the target.
+
+    :param str target: Target of the replication.
+
+    :param str hostname: Name of the host.
+
+    :rtype: list of str
+    '''
+    remote, filesystem = parse_target(target)
+    command = ['zfs', 'receive', '-F', '%s/%s' % (filesystem, hostname)]
+    if remote != None:
+        command = ['ssh', remote] + command
+    return command
+
+
+class BufferedPipe:
+    '''Copy a stream from one file to another through a buffer in memory.
+    One thread reads and another writes, so reading continues while
+    writing is stalled until the buffer is full, and writing continues
+    while reading is stalled until the buffer is empty.
+
+    :param file source: File to read from, read with its file descriptor.
+
+    :param file destination: File to write to.
+
+    :param int buffer_size: (Default :py:data:`DEFAULT_BUFFER_SIZE`)  Bytes
+            to hold in memory.
+
+    :param int chunk_size: (Default :py:data:`CHUNK_SIZE`)  Bytes to read
+            at a time.
+
+    :param RateLimiter limiter: (Default None)  A
+            :py:class:`nabreaper.RateLimiter` of bytes per second, which
+            may be shared between pipes.
+
+    .. py:attribute:: bytes
+
+    Number of bytes copied.
+
+    .. py:attribute:: peak_buffered
+
+    Largest number of chunks held in the buffer.
+    '''
+
+    def __init__(self, source, destination, buffer_size=DEFAULT_BUFFER_SIZE,
+            chunk_size=CHUNK_SIZE, limiter=None):
+        self.source = source
+        self.destination = destination
+        self.chunk_size = chunk_size
+        self.limiter = limiter
+        self.queue = Queue.Queue(max(1, buffer_size // chunk_size))
+        self.stopped = False
+        self.bytes = 0
+        self.peak_buffered = 0
+
+    def put(self, data):
+        '''Add data to the buffer, unless the copy has been stopped.
+        '''
+        while not self.stopped:
+            try:
+                self.queue.put(data, timeout=0.1)
+                return
+            except Queue.Full:
+                pass
+
+    def reader(self):
+        '''Read the source into the buffer until the end of the file.
+        '''
+        fd = self.source.fileno()
+        try:
+            while not self.stopped:
+                data = os.read(fd, self.chunk_size)
+                if not data:
+                    break
+                self.put(data)
+                self.peak_buffered = max(self.peak_buffered,
+                        self.queue.qsize())
+        finally:
+            self.put(None)
+
+    def run(self):
+        '''Copy the source to the destination.  If writing fails, reading
+        stops and the error is raised.
+
+        :rtype: int Number of bytes copied.
+        '''
+        thread = threading.Thread(target=self.reader)
+        thread.daemon = True
+        thread.start()
+        try:
+            while True:
+                data = self.queue.get()
+                if data == None:
+                    break
+                if self.limiter != None:
+                    self.limiter.acquire(len(data))
+                self.destination.write(data)
+                self.bytes += len(data)
+            self.destination.flush()
+        finally:
+            self.stopped = True
+            thread.join()
+        return self.bytes
+
+
+class ReplicationResult:
+    '''Result of replicating a host.
+
+    .. py:attribute:: hostname
+
+    Name of the host.
+
+    .. py:attribute:: snapshot
+
+    The :py:class:`nabstorageplugins.zfs.Dataset` of the snapshot sent.
+
+    .. py:attribute:: base
+
+    Name of the snapshot the stream was incremental from, or None if it
+    was a full stream.
+
+    .. py:attribute:: bytes_sent
+
+    Size of the stream.
+
+    .. py:attribute:: seconds
+
+    How long the replication took.
+
+    .. py:attribute:: error
+
+    Error message, or None if the replication succeeded.
+    '''
+
+    def __init__(self, hostname, snapshot, base):
+        self.hostname = hostname
+        self.snapshot = snapshot
+        self.base = base
+        self.bytes_sent = 0
+        self.seconds = 0.0
+        self.error = None
+
+    def __repr__(self):
+        return '<ReplicationResult(%s@%s: %s)>' % (self.hostname,
+                self.snapshot.name, self.error or self.bytes_sent)
+
+
+class Replicator:
+    '''Replicate the newest snapshots of the hosts of zfs storages to a
+    target.
+
+    :param Session db: Database session.
+
+    :param str target: Target of the replication, see
+            :py:attr:`Replication.target`.
+
+    :param int streams: (Default 4)  Number of hosts to replicate at once.
+
+    :param int bytes_per_second: (Default None)  Limit on the bytes sent
+            per second by all the streams together, or None for no limit.
+
+    :param int buffer_size: (Default :py:data:`DEFAULT_BUFFER_SIZE`)  Bytes
+            buffered between "zfs send" and "zfs receive" for each stream.
+    '''
+
+    def __init__(self, db, target, streams=4, bytes_per_second=None,
+            buffer_size=DEFAULT_BUFFER_SIZE):
+        self.db = db
+        self.target = target
+        self.streams = streams
+        self.buffer_size = buffer_size
+        self.limiter = nabreaper.RateLimiter(bytes_per_second)
+
+    def plan(self, hostnames=None):
+        '''Find the snapshots to send, with one listing of each storage and
+        one of the target.
+
+        :param list hostnames: (Default None)  Only replicate these hosts.
+
+        :rtype: tuple of a list of (:py:class:`Host`, plugin, snapshot,
+                base) to send, a list of the :py:class:`Host` which are
+                already up to date, and a list of (:py:class:`Host`,
+                snapshot) of the hosts whose snapshots on the target have
+                none in common with the host.
+        '''
+        query = self.db.query(Host).join(Storage).filter(
+                Storage.method == 'zfs').order_by(Host.hostname)
+        if hostnames:
+            query = query.filter(Host.hostname.in_(hostnames))
+        hosts = query.all()
+        replications = dict([(x.host_id, x) for x in self.db.query(
+                Replication).filter_by(target=self.target)])
+
+        on_target = target_snapshots(self.target)
+
+        datasets = {}
+        jobs = []
+        current = []
+        diverged = []
+        for host in hosts:
+            if host.storage_id not in datasets:
+                plugin = host.storage.get_plugin()
+                datasets[host.storage_id] = (plugin, plugin.list_datasets())
+            plugin, hosts_datasets = datasets[host.storage_id]
+            dataset = hosts_datasets.get(host.hostname)
+            if dataset == None or not dataset.snapshots:
+                continue
+
+            snapshot = dataset.snapshots[-1]
+            replication = replications.get(host.id)
+            last = None
+            if replication != None:
+                last = replication.snapshot_name
+            if last == snapshot.name:
+                current.append(host)
+                continue
+            received = on_target.get(host.hostname, set())
+            if snapshot.name in received:
+                current.append(host)
+                continue
+            common = [x.name for x in dataset.snapshots[:-1]
+                    if x.name in received]
+            if received and not common:
+                diverged.append((host, snapshot))
+                continue
+            base = None
+            if common:
+                base = common[-1]
+            jobs.append((host, plugin, snapshot, base))
+        return jobs, current, diverged
+
+    def replicate(self, plugin, hostname, snapshot, base):
+        '''Send a snapshot of a host to the target.
+
+        :rtype: :py:class:`ReplicationResult`
+        '''
+        result = ReplicationResult(hostname, snapshot, base)
+        start = time.time()
+        send_errors = tempfile.TemporaryFile()
+        receive_errors = tempfile.TemporaryFile()
+        send = subprocess.Popen(send_command(plugin, hostname,
+                snapshot.name, base), stdout=subprocess.PIPE,
+                stderr=send_errors)
+        receive = subprocess.Popen(receive_command(self.target, hostname),
+                stdin=subprocess.PIPE, stdout=receive_errors,
+                stderr=receive_errors)
+        pipe = BufferedPipe(send.stdout, receive.stdin,
+                buffer_size=self.buffer_size, limiter=self.limiter)
+        try:
+            pipe.run()
+        except (IOError, OSError), e:
+            result.error = str(e)
+            send.terminate()
+        send.stdout.close()
+        receive.stdin.close()
+        send_code = send.wait()
+        receive_code = receive.wait()
+
+        for code, errors, name in [(send_code, send_errors, 'send'),
+                (receive_code, receive_errors, 'receive')]:
+            if code != 0:
+                errors.seek(0)
+                result.error = 'zfs %s failed (%d): %s' % (name, code,
+                        errors.read().strip())
+        send_errors.close()
+        receive_errors.close()
+        result.bytes_sent = pipe.bytes
+        result.seconds = time.time() - start
+        return result
+
+    def run(self, hostnames=None, now=None):
+        '''Replicate the hosts, several at once, and record the results and
+        the lag of each host.
+
+        :param list hostnames: (Default None)  Only replicate these hosts.
+
+        :param datetime now: (Default None)  The current time.
+
+        :rtype: list of :py:class:`ReplicationResult`
+        '''
+        jobs, current, diverged = self.plan(hostnames)
+        queue = Queue.Queue()
+        for job in jobs:
+            queue.put(job)
+        results = {}
+        for host, snapshot in diverged:
+            result = ReplicationResult(host.hostname, snapshot, None)
+            result.error = ('the target has no snapshot in common with the '
+                    'host, destroy its snapshots there to send it again')
+            results[host.id] = result
+
+        def worker():
+            while True:
+                try:
+                    host, plugin, snapshot, base = queue.get_nowait()
+                except Queue.Empty:
+                    return
+                try:
+                    result = self.replicate(plugin, host.hostname,
+                            snapshot, base)
+                except Exception, e:
+                    #  such as ssh or zfs missing, the other hosts go on
+                    result = ReplicationResult(host.hostname, snapshot, base)
+                    result.error = '%s: %s' % (e.__class__.__name__, e)
+                results[host.id] = result
+
+        threads = [threading.Thread(target=worker)
+                for i in range(min(self.streams, len(jobs)))]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        if now == None:
+            now = datetime.datetime.now()
+        sent = [x[0] for x in jobs] + [x[0] for x in diverged]
+        for host in sent + current:
+            replication = Replication.get(self.db, host, self.target)
+            result = results.get(host.id)
+            if result != None:
+                replication.error = result.error
+                if result.error == None:
+                    replication.snapshot_name = result.snapshot.name
+                    replication.snapshot_time = (
+                            datetime.datetime.fromtimestamp(
+                            result.snapshot.creation))
+                    replication.replicated_time = now
+                    replication.bytes_sent = result.bytes_sent
+            if replication.snapshot_time != None:
+                replication.lag = now - replication.snapshot_time
+        self.db.commit()
+        return [results[x.id] for x in sent]
@@ -0,0 +1,496 @@
+#!/usr/bin/env python
+#
+#  Copyright (c) 2012, Sean Reifschneider, tummy.com, ltd.
+#  All Rights Reserved.
+
+'''Restores from snapshots for Network Attached Backup.
+
+A :py:class:`Restorer` copies files out of a snapshot with a pool of
+threads, like :py:mod:`nablinktree`: each directory is a unit of work, and
+large files are queued on their own so several are copied at once.  File
+data is copied by the kernel with "copy_file_range" or "sendfile" where
+they are available, falling back to reading and writing.  Files which are
+hard-linked to each other within the restore are linked again, and the
+owner, permissions, times and extended attributes are copied.  Note that
+files linked by deduplication (see :py:mod:`nabdedup`) are restored as
+links as well.
+
+Alternatively, :py:func:`write_tar` streams the files as a tar archive, for
+example to be piped over ssh.
+'''
+
+import os
+import sys
+import stat
+import time
+import errno
+import Queue
+import tarfile
+import itertools
+import threading
+import ctypes
+import ctypes.util
+import nabmanifest
+from nablinktree import copy_owner
+
+#  files at least this large are copied by a worker of their own
+LARGE_FILE_SIZE = 1024 * 1024
+#  bytes copied by the kernel per call
+KERNEL_COPY_SIZE = 64 * 1024 * 1024
+#  bytes read and written at a time when the kernel cannot copy
+COPY_SIZE = 1024 * 1024
+#  errors meaning a way of copying is not supported between two files
+UNSUPPORTED_ERRORS = (errno.ENOSYS, errno.EXDEV, errno.EINVAL, errno.EBADF,
+        errno.EOPNOTSUPP, errno.ENOTSUP)
+#  errors meaning extended attributes cannot be copied
+XATTR_ERRORS = (errno.ENOTSUP, errno.EOPNOTSUPP, errno.EPERM, errno.EACCES,
+        errno.ENODATA, errno.ENOSYS)
+
+
+def load_libc():
+    '''Return the C library, or None if it cannot be loaded.
+    '''
+    name = ctypes.util.find_library('c')
+    if name == None:
+        return None
+    try:
+        return ctypes.CDLL(name, use_errno=True)
+    except OSError:
+        return None
+
+
+def libc_function(name, restype, argtypes):
+    '''Return a function of the C library, or None if it does not have it.
+    '''
+    function = getattr(libc, name, None)
+    if function != None:
+        function.restype = restype
+        function.argtypes = argtypes
+    return function
+
+
+def check_result(result):
+    '''Raise the error of a C library call which returned -1.
+
+    :rtype: int The result.
+    '''
+    if result < 0:
+        error = ctypes.get_errno()
+        raise OSError(error, os.strerror(error))
+    return result
+
+
+libc = load_libc()
+libc_copy_file_range = libc_function('copy_file_range', ctypes.c_ssize_t,
+        [ctypes.c_int, ctypes.c_void_p, ctypes.c_int, ctypes.c_void_p,
+        ctypes.c_size_t, ctypes.c_uint])
+libc_sendfile = libc_function('sendfile', ctypes.c_ssize_t,
+        [ctypes.c_int, ctypes.c_int, ctypes.c_void_p, ctypes.c_size_t])
+libc_llistxattr = libc_function('llistxattr', ctypes.c_ssize_t,
+        [ctypes.c_char_p, ctypes.c_char_p, ctypes.c_size_t])
+libc_lgetxattr = libc_function('lgetxattr', ctypes.c_ssize_t,
+        [ctypes.c_char_p, ctypes.c_char_p, ctypes.c_char_p, ctypes.c_size_t])
+libc_lsetxattr = libc_function('lsetxattr', ctypes.c_int,
+        [ctypes.c_char_p, ctypes.c_char_p, ctypes.c_char_p, ctypes.c_size_t,
+        ctypes.c_int])
+
+
+def copy_file_range(source_fd, destination_fd, count):
+    '''Copy up to `count` bytes between the offsets of two files in the
+    kernel, which may share the blocks on file-systems that support it.
+
+    :rtype: int Bytes copied, 0 at the end of the source.
+    '''
+    return check_result(libc_copy_file_range(source_fd, None,
+            destination_fd, None, count, 0))
+
+
+def sendfile(source_fd, destination_fd, count):
+    '''Copy up to `count` bytes between the offsets of two files in the
+    kernel.
+
+    :rtype: int Bytes copied, 0 at the end of the source.
+    '''
+    return check_result(libc_sendfile(destination_fd, source_fd, None,
+            count))
+
+
+#  ways the kernel can copy, best first
+KERNEL_COPIES = [x[1] for x in [(libc_copy_file_range, copy_file_range),
+        (libc_sendfile, sendfile)] if x[0] != None]
+
+
+def copy_data(source_fd, destination_fd, kernel_copies=None):
+    '''Copy a file from its offset to the end, with the first of the
+    kernel copies that works, or by reading and writing.
+
+    :param int source_fd: File descriptor to read.
+
+    :param int destination_fd: File descriptor to write.
+
+    :param list kernel_copies: (Default :py:data:`KERNEL_COPIES`)  Functions
+            like :py:func:`copy_file_range` to try.
+
+    :rtype: int Bytes copied.
+    '''
+    if kernel_copies == None:
+        kernel_copies = KERNEL_COPIES
+    copied = 0
+    for function in kernel_copies:
+        try:
+            while True:
+                count = function(source_fd, destination_fd,
+                        KERNEL_COPY_SIZE)
+                if count == 0:
+                    return copied
+                copied += count
+        except OSError, e:
+            #  anything copied so far has moved both offsets along
+            if e.errno not in UNSUPPORTED_ERRORS:
+                raise
+    while True:
+        data = os.read(source_fd, COPY_SIZE)
+        if not data:
+            return copied
+        copied += len(data)
+        while data:
+            data = data[os.write(destination_fd, data):]
+
+
+def copy_xattrs(source, destination):
+    '''Copy the extended attributes of a file, as far as the file-systems
+    and permissions allow.
+
+    :rtype: None
+    '''
+    if libc_llistxattr == None or libc_lgetxattr == None or \
+            libc_lsetxattr == None:
+        return
+    try:
+        size = check_result(libc_llistxattr(source, None, 0))
+        names = ctypes.create_string_buffer(max(size, 1))
+        size = check_result(libc_llistxattr(source, names, size))
+    except OSError, e:
+        if e.errno not in XATTR_ERRORS:
+            raise
+        return
+    for name in names.raw[:size].split('\0')[:-1]:
+        #  an attribute that cannot be set, such as a security label,
+        #  does not stop the others being copied
+        try:
+            size = check_result(libc_lgetxattr(source, name, None, 0))
+            value = ctypes.create_string_buffer(max(size, 1))
+            size = check_result(libc_lgetxattr(source, name, value, size))
+            check_result(libc_lsetxattr(destination, name, value.raw[:size],
+                    size, 0))
+        except OSError, e:
+            if e.errno not in XATTR_ERRORS:
+                raise
+
+
+def clean_path(path):
+    '''Return a path to restore relative to the top of the snapshot.
+
+    :param str path: Path in the snapshot, with or without a leading "/".
+
+    :rtype: str The path, or '' for the whole snapshot.
+    '''
+    return os.path.normpath('/' + path).lstrip('/')
+
+
+def top_paths(paths):
+    '''Return the paths to restore, leaving out those inside another.
+
+    :rtype: list of str
+    '''
+    paths = sorted(set([clean_path(x) for x in paths or ['']]),
+            key=nabmanifest.path_key)
+    top = []
+    for path in paths:
+        if top and (top[-1] == '' or path.startswith(top[-1] + '/')):
+            continue
+        top.append(path)
+    return top
+
+
+class RestoreStatistics:
+    '''Counts of what a :py:class:`Restorer` restored.
+
+    .. py:attribute:: files
+
+    Number of files copied.
+
+    .. py:attribute:: hardlinks
+
+    Number of files linked to a file already restored.
+
+    .. py:attribute:: skipped
+
+    Number of devices and other special files which could not be created.
+    '''
+
+    def __init__(self):
+        self.files = 0
+        self.hardlinks = 0
+        self.directories = 0
+        self.symlinks = 0
+        self.skipped = 0
+        self.bytes = 0
+        self.seconds = 0.0
+
+    def __repr__(self):
+        return ('<RestoreStatistics(files=%d, bytes=%d, seconds=%.3f)>'
+                % (self.files, self.bytes, self.seconds))
+
+    def summary(self):
+        '''Return a line describing the restore.
+
+        :rtype: str
+        '''
+        return ('Restored %d files (%d bytes), %d hard-links, %d directories '
+                'and %d symlinks in %.1f seconds' % (self.files, self.bytes,
+                self.hardlinks, self.directories, self.symlinks,
+                self.seconds))
+
+
+class Restorer:
+    '''Copy files out of a snapshot with a pool of threads.
+
+    :param str source: Directory of the backed up files of the snapshot.
+
+    :param str destination: Directory to restore into, created if
+            necessary.  The restored paths keep their place relative to the
+            top of the snapshot, and must not already exist.
+
+    :param int threads: (Default 8)  Number of directories and large files
+            to work on at once.
+
+    :param boolean hardlinks: (Default True)  Restore files linked to each
+            other within the restore as links.
+    '''
+
+    def __init__(self, source, destination, threads=8, hardlinks=True):
+        self.source = source
+        self.destination = destination
+        self.threads = threads
+        self.hardlinks = hardlinks
+        self.statistics = RestoreStatistics()
+        self.queue = Queue.Queue()
+        self.lock = threading.Lock()
+        self.directories = []
+        self.links = {}
+        self.error = None
+
+    def run(self, paths=None):
+        '''Restore paths from the snapshot.
+
+        :param list paths: (Default None)  Paths in the snapshot, or None
+                for all of it.
+
+        :rtype: :py:class:`RestoreStatistics`
+        '''
+        start = time.time()
+        paths = top_paths(paths)
+        for path in paths:
+            if path and not os.path.lexists(os.path.join(self.source, path)):
+                raise ValueError('"%s" is not in the snapshot' % path)
+        if not os.path.exists(self.destination):
+            os.makedirs(self.destination)
+        for path in paths:
+            self.queue.put((self.restore_top, (path, )))
+
+        workers = []
+        for i in range(self.threads):
+            worker = threading.Thread(target=self.worker)
+            worker.daemon = True
+            worker.start()
+            workers.append(worker)
+        self.queue.join()
+        for worker in workers:
+            self.queue.put(None)
+        for worker in workers:
+            worker.join()
+        if self.error != None:
+            raise self.error[0], self.error[1], self.error[2]
+
+        #  deepest first, so setting times is not undone by later changes
+        self.directories.sort(reverse=True)
+        for depth, source, destination, st in self.directories:
+            self.copy_attributes(source, destination, st)
+        self.statistics.directories = len(self.directories)
+        self.statistics.seconds = time.time() - start
+        return self.statistics
+
+    def worker(self):
+        while True:
+            item = self.queue.get()
+            if item == None:
+                self.queue.task_done()
+                return
+            try:
+                if self.error == None:
+                    item[0](*item[1])
+            except Exception:
+                with self.lock:
+                    if self.error == None:
+                        self.error = sys.exc_info()
+            self.queue.task_done()
+
+    def copy_attributes(self, source, destination, st):
+        '''Copy the owner, extended attributes, mode and times of an entry.
+        '''
+        link = stat.S_ISLNK(st.st_mode)
+        copy_owner(destination, st, link=link)
+        copy_xattrs(source, destination)
+        if not link:
+            os.chmod(destination, stat.S_IMODE(st.st_mode))
+            os.utime(destination, (st.st_atime, st.st_mtime))
+
+    def restore_top(self, path):
+        '''Restore a path given to :py:meth:`run`, creating the directories
+        above it with the attributes they have in the snapshot.
+        '''
+        parent = ''
+        for name in path.split('/')[:-1]:
+            parent = os.path.join(parent, name)
+            destination = os.path.join(self.destination, parent)
+            with self.lock:
+                if os.path.isdir(destination):
+                    continue
+                os.mkdir(destination, 0700)
+                self.directories.append((parent.count('/') + 1,
+                        os.path.join(self.source, parent), destination,
+                        os.lstat(os.path.join(self.source, parent))))
+        source = os.path.join(self.source, path)
+        if path == '':
+            self.restore_directory(source, self.destination, 0)
+            return
+        self.restore_entry(source, os.path.join(self.destination, path),
+                os.lstat(source), path.count('/') + 1)
+
+    def restore_directory(self, source, destination, depth):
+        '''Restore the entries of a directory, queueing its subdirectories
+        and large files for the other workers.
+        '''
+        for name in os.listdir(source):
+            source_path = os.path.join(source, name)
+            self.restore_entry(source_path, os.path.join(destination, name),
+                    os.lstat(source_path), depth + 1)
+
+    def restore_entry(self, source, destination, st, depth):
+        '''Restore a directory entry.
+        '''
+        if stat.S_ISDIR(st.st_mode):
+            os.mkdir(destination, 0700)
+            with self.lock:
+                self.directories.append((depth, source, destination, st))
+            self.queue.put((self.restore_directory,
+                    (source, destination, depth)))
+        elif stat.S_ISREG(st.st_mode):
+            if st.st_size >= LARGE_FILE_SIZE:
+                self.queue.put((self.restore_file,
+                        (source, destination, st)))
+            else:
+                self.restore_file(source, destination, st)
+        elif stat.S_ISLNK(st.st_mode):
+            os.symlink(os.readlink(source), destination)
+            self.copy_attributes(source, destination, st)
+            with self.lock:
+                self.statistics.symlinks += 1
+        else:
+            try:
+                os.mknod(destination, st.st_mode, st.st_rdev)
+            except OSError, e:
+                if e.errno != errno.EPERM:
+                    raise
+                with self.lock:
+                    self.statistics.skipped += 1
+                return
+            self.copy_attributes(source, destination, st)
+
+    def restore_file(self, source, destination, st):
+        '''Copy a file, or link it to the copy of a file it is linked to.
+        '''
+        flags = os.O_WRONLY | os.O_CREAT | os.O_EXCL
+        if self.hardlinks and st.st_nlink > 1:
+            key = (st.st_dev, st.st_ino)
+            #  the first copy is created while holding the lock, so the
+            #  others can link to it while it is being written
+            with self.lock:
+                first = self.links.get(key)
+                if first == None:
+                    destination_fd = os.open(destination, flags, 0600)
+                    self.links[key] = destination
+            if first != None:
+                os.link(first, destination)
+                with self.lock:
+                    self.statistics.hardlinks += 1
+                return
+        else:
+            destination_fd = os.open(destination, flags, 0600)
+
+        try:
+            source_fd = os.open(source, os.O_RDONLY)
+            try:
+                copied = copy_data(source_fd, destination_fd)
+            finally:
+                os.close(source_fd)
+        finally:
+            os.close(destination_fd)
+        self.copy_attributes(source, destination, st)
+        with self.lock:
+            self.statistics.files += 1
+            self.statistics.bytes += copied
+
+
+def restore(source, destination, paths=None, threads=8, hardlinks=True):
+    '''Copy paths out of a snapshot, see :py:class:`Restorer`.
+
+    :param str source: Directory of the backed up files of the snapshot.
+
+    :param str destination: Directory to restore into.
+
+    :param list paths: (Default None)  Paths in the snapshot, or None for
+            all of it.
+
+    :rtype: :py:class:`RestoreStatistics`
+    '''
+    return Restorer(source, destination, threads, hardlinks).run(paths)
+
+
+def write_tar(source, fileobj, paths=None):
+    '''Write paths of a snapshot to a stream as a tar archive, in manifest
+    order.  Files linked to each other are archived as links.
+
+    :param str source: Directory of the backed up files of the snapshot.
+
+    :param file fileobj: File to write the archive to, which need not be
+            seekable.
+
+    :param list paths: (Default None)  Paths in the snapshot, or None for
+            all of it.
+
+    :rtype: int Number of entries written.
+    '''
+    paths = top_paths(paths)
+    for path in paths:
+        if path and not os.path.lexists(os.path.join(source, path)):
+            raise ValueError('"%s" is not in the snapshot' % path)
+    tar = tarfile.open(fileobj=fileobj, mode='w|', bufsize=COPY_SIZE)
+    count = 0
+    try:
+        for path in paths:
+            names = []
+            if path != '':
+                names.append(path)
+            top = os.path.join(source, path)
+            if os.path.isdir(top) and not os.path.islink(top):
+                names = itertools.chain(names, (os.path.join(path, x.path)
+                        for x in nabmanifest.walk_tree(top)))
+            for name in names:
+                tar.add(os.path.join(source, name), arcname=name,
+                        recursive=False)
+                count += 1
+    finally:
+        tar.close()
+    return count
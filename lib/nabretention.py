@@ -0,0 +1,191 @@
+#!/usr/bin/env python
+#
+#  Copyright (c) 2012, Sean Reifschneider, tummy.com, ltd.
+#  All Rights Reserved.
+
+'''Expiry of old snapshots for Network Attached Backup.
+
+Each host keeps its newest "daily_history" daily, "weekly_history" weekly
+and "monthly_history" monthly successful backups, and all the backups of a
+generation if its history is not set.  The newest successful backup is
+always kept, and unsuccessful backups are expired once a newer backup has
+succeeded.  The last snapshot replicated to each target is kept as well,
+as the next replication is sent incrementally from it.
+
+The backups of all the hosts are read in one query.  The snapshots are
+destroyed host by host, starting with the hosts whose backup windows open
+furthest in the future, and hosts which are being backed up or are inside
+their backup window are left for a later run.
+'''
+
+from nabdb import *
+import datetime
+import nabcatalog
+
+
+class Expiry:
+    '''A snapshot which falls outside the retention policy of its host.
+
+    .. py:attribute:: backup_id
+
+    ID of the :py:class:`Backup` of the snapshot.
+    '''
+
+    def __init__(self, backup_id, host_id, snapshot_name, generation,
+            start_time):
+        self.backup_id = backup_id
+        self.host_id = host_id
+        self.snapshot_name = snapshot_name
+        self.generation = generation
+        self.start_time = start_time
+
+    def __repr__(self):
+        return '<Expiry(%s: %s %s)>' % (self.backup_id, self.snapshot_name,
+                self.generation)
+
+
+def find_expired(db, host_ids=None):
+    '''Find the snapshots that fall outside the retention policies.
+
+    :param Session db: Database session.
+
+    :param list host_ids: (Default None)  Only look at these hosts, or all
+            hosts if None.
+
+    :rtype: dict Mapping host ID to a list of :py:class:`Expiry`, oldest
+            first.
+    '''
+    query = db.query(Backup.id, Backup.host_id, Backup.generation,
+            Backup.start_time, Backup.successful, Backup.snapshot_name
+            ).filter(Backup.snapshot_name != None, Backup.expired == False,
+            Backup.backup_pid == None)
+    if host_ids != None:
+        query = query.filter(Backup.host_id.in_(host_ids))
+    rows = query.order_by(Backup.host_id, Backup.start_time.desc()).all()
+    configs = Host.resolve_configs(db, set([row.host_id for row in rows]))
+    replicated = set(db.query(Replication.host_id,
+            Replication.snapshot_name).filter(
+            Replication.snapshot_name != None))
+
+    expired = {}
+    kept = {}
+    for row in rows:
+        expire = False
+        if not row.successful:
+            expire = row.host_id in kept
+        elif row.host_id not in kept:
+            kept[row.host_id] = {row.generation: 1}
+        else:
+            history = getattr(configs[row.host_id],
+                    '%s_history' % row.generation)
+            count = kept[row.host_id].get(row.generation, 0)
+            if history == None or count < history:
+                kept[row.host_id][row.generation] = count + 1
+            else:
+                expire = True
+        if expire and (row.host_id, row.snapshot_name) not in replicated:
+            expired.setdefault(row.host_id, []).insert(0, Expiry(row.id,
+                    row.host_id, row.snapshot_name, row.generation,
+                    row.start_time))
+    return expired
+
+
+def time_until_window(host, now):
+    '''Return how long until the backup window of a host next opens.
+
+    :param Host host: The host.
+
+    :param datetime now: The current time.
+
+    :rtype: timedelta or None if the host has no backup window.
+    '''
+    if host.window_start == None or host.window_end == None:
+        return None
+    start = datetime.datetime.combine(now.date(), host.window_start)
+    if start <= now:
+        start += datetime.timedelta(days=1)
+    return start - now
+
+
+def plan_expiry(db, now=None, host_ids=None, force=False):
+    '''Decide which snapshots to destroy now, and in what order.
+
+    :param Session db: Database session.
+
+    :param datetime now: (Default None)  The current time.
+
+    :param list host_ids: (Default None)  Only look at these hosts, or all
+            hosts if None.
+
+    :param Boolean force: (Default False)  Include hosts inside their
+            backup window.
+
+    :rtype: tuple of two lists of (:py:class:`Host`, list of
+            :py:class:`Expiry`), the hosts to expire now in order, and the
+            hosts left for later.
+    '''
+    if now == None:
+        now = datetime.datetime.now()
+    expired = find_expired(db, host_ids)
+    if not expired:
+        return [], []
+
+    batch = []
+    deferred = []
+    for host in db.query(Host).filter(Host.id.in_(expired.keys())):
+        item = (host, expired[host.id])
+        if host.are_backups_currently_running(db):
+            deferred.append(item)
+        elif (not force and host.window_start != None
+                and host.window_end != None and host.in_backup_window(now)):
+            deferred.append(item)
+        else:
+            batch.append(item)
+
+    #  furthest from their backup window first, hosts without one last
+    def sort_key(item):
+        until = time_until_window(item[0], now)
+        if until == None:
+            return (1, 0, item[0].hostname)
+        return (0, -until.days * 86400 - until.seconds, item[0].hostname)
+    batch.sort(key=sort_key)
+    deferred.sort(key=lambda x: x[0].hostname)
+    return batch, deferred
+
+
+def reclaimable_bytes(host, expiries):
+    '''Return the bytes destroying the snapshots of a host would free.
+
+    :rtype: int or None if the storage cannot tell.
+    '''
+    plugin = host.storage.get_plugin()
+    if not hasattr(plugin, 'reclaimable_bytes'):
+        return None
+    return plugin.reclaimable_bytes(host.hostname,
+            [x.snapshot_name for x in expiries])
+
+
+def expire_snapshots(db, batch):
+    '''Destroy the snapshots, with one call to the storage for each host,
+    and mark their backups as expired.  Snapshots that no longer exist are
+    just marked.
+
+    :param Session db: Database session.
+
+    :param list batch: (:py:class:`Host`, list of :py:class:`Expiry`), as
+            returned by :py:func:`plan_expiry`.
+
+    :rtype: int Number of backups expired.
+    '''
+    count = 0
+    for host, expiries in batch:
+        plugin = host.storage.get_plugin()
+        names = [x.snapshot_name for x in expiries]
+        plugin.destroy_snapshots(host.hostname, names)
+        nabcatalog.remove_from_catalog(plugin, host.hostname, names)
+        db.query(Backup).filter(Backup.id.in_([x.backup_id
+                for x in expiries])).update({'expired': True},
+                synchronize_session=False)
+        count += len(expiries)
+        db.commit()
+    return count
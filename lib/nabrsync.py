@@ -0,0 +1,233 @@
+#!/usr/bin/env python
+#
+#  Copyright (c) 2012, Sean Reifschneider, tummy.com, ltd.
+#  All Rights Reserved.
+
+'''Running rsync and parsing its output for Network Attached Backup.
+
+The output of rsync is read as it is produced, so the statistics of a
+backup are known as soon as rsync exits, without re-reading the log.
+Each changed item is written by rsync using `OUT_FORMAT`: the itemized
+change flags, the length of the file, and the name.  The totals printed
+by the "--stats" option are parsed at the end.  While the transfer runs,
+rsync reports its overall progress ("--info=progress2") on lines ending in
+a carriage return.
+'''
+
+import os
+import re
+import errno
+import subprocess
+import threading
+
+OUT_FORMAT = '%i %l %n%L'
+
+#  "YXcstpoguax 1234 name", or "*deleting   0 name" for deletions
+item_re = re.compile(r'^(?P<flags>[<>ch.*][^ ]{8}.{2}) (?P<length>\d+) '
+        r'(?P<name>.*)$')
+#  "  1,234,567  12%   1.23MB/s    0:00:10 (xfr#5, ir-chk=1000/2000)"
+progress_re = re.compile(r'^ *(?P<bytes>[\d,]+) +(?P<percent>\d+)% +\S+ +'
+        r'\d+:\d\d:\d\d(?: \(xfr#(?P<transferred>\d+), [a-z]+-chk='
+        r'(?P<remaining>\d+)/(?P<total>\d+)\))?')
+stats_re = re.compile(r'^(?P<key>[A-Z][A-Za-z ]+): (?P<value>[\d,.]+)')
+
+#  map of "--stats" labels to the :py:class:`BackupStatistics` attributes
+STATS_LABELS = {
+        'Number of files': 'total_files',
+        'Number of regular files transferred': 'files_transferred',
+        'Number of files transferred': 'files_transferred',
+        'Total file size': 'total_file_size',
+        'Total transferred file size': 'transferred_file_size',
+        'Literal data': 'literal_data',
+        'Matched data': 'matched_data',
+        'File list size': 'file_list_size',
+        'File list generation time': 'file_list_generation_seconds',
+        'File list transfer time': 'file_list_transfer_seconds',
+        'Total bytes sent': 'bytes_sent',
+        'Total bytes received': 'bytes_received',
+        }
+
+#  attributes counted from the itemized changes
+ITEM_FIELDS = ['files_created', 'files_updated', 'files_deleted',
+        'directories_created', 'links_created', 'attributes_changed',
+        'bytes_created', 'bytes_updated', 'errors']
+
+
+class RsyncOutputParser:
+    '''Accumulate statistics from the output of rsync, a line at a time.
+    For example:
+
+        parser = RsyncOutputParser()
+        for line in rsync_output:
+            parser.feed(line)
+        print parser.files_created, parser.stats.get('literal_data')
+
+    Counters of the itemized changes are attributes named after the entries
+    in `ITEM_FIELDS`, and the "--stats" totals are in the "stats"
+    dictionary, keyed by the values of `STATS_LABELS`.
+
+    The latest progress report is in the "progress_bytes",
+    "progress_percent", "progress_files" and "progress_total_files"
+    attributes, and the name of the last item changed is in "last_item".
+
+    :param function progress: (Default None)  Called as `progress(parser)`
+            after each progress report or itemized change.
+    '''
+
+    def __init__(self, progress=None):
+        for field in ITEM_FIELDS:
+            setattr(self, field, 0)
+        self.stats = {}
+        self.progress = progress
+        self.progress_bytes = None
+        self.progress_percent = None
+        self.progress_files = None
+        self.progress_total_files = None
+        self.last_item = None
+
+    def transferred_bytes(self):
+        '''Bytes transferred so far, from the progress reports if rsync
+        makes them, otherwise the size of the files transferred.
+
+        :rtype: int
+        '''
+        if self.progress_bytes != None:
+            return self.progress_bytes
+        return self.bytes_created + self.bytes_updated
+
+    def feed(self, line):
+        '''Process a line of rsync output.
+
+        :param str line: Line of output, with or without the line ending.
+
+        :rtype: None
+        '''
+        line = line.rstrip('\r\n')
+        m = item_re.match(line)
+        if m:
+            self.item(m.group('flags'), int(m.group('length')))
+            self.last_item = m.group('name')
+            if self.progress != None:
+                self.progress(self)
+            return
+
+        m = progress_re.match(line)
+        if m:
+            self.progress_bytes = int(m.group('bytes').replace(',', ''))
+            self.progress_percent = int(m.group('percent'))
+            if m.group('transferred') != None:
+                self.progress_files = int(m.group('transferred'))
+                self.progress_total_files = int(m.group('total'))
+            if self.progress != None:
+                self.progress(self)
+            return
+
+        if line.startswith('rsync: ') or line.startswith('rsync error: '):
+            self.errors += 1
+            return
+
+        m = stats_re.match(line)
+        if m and m.group('key') in STATS_LABELS:
+            value = m.group('value').replace(',', '')
+            if '.' in value:
+                value = float(value)
+            else:
+                value = int(value)
+            self.stats[STATS_LABELS[m.group('key')]] = value
+
+    def item(self, flags, length):
+        '''Count an itemized change.
+
+        :param str flags: The "%i" flags of the item, such as ">f.st......".
+
+        :param int length: Length of the file.
+
+        :rtype: None
+        '''
+        if flags.startswith('*deleting'):
+            self.files_deleted += 1
+            return
+
+        is_new = flags[2:].strip('+') == ''
+        if flags[0] == 'h' or flags[1] == 'L':
+            if is_new:
+                self.links_created += 1
+        elif flags[1] == 'd':
+            if is_new:
+                self.directories_created += 1
+            else:
+                self.attributes_changed += 1
+        elif flags[0] in '<>':
+            if is_new:
+                self.files_created += 1
+                self.bytes_created += length
+            else:
+                self.files_updated += 1
+                self.bytes_updated += length
+        elif flags[0] == '.':
+            self.attributes_changed += 1
+
+    def fill(self, record):
+        '''Copy the statistics to the attributes of `record`, typically a
+        :py:class:`BackupStatistics`.
+
+        :rtype: None
+        '''
+        for field in ITEM_FIELDS:
+            setattr(record, field, getattr(self, field))
+        for field in set(STATS_LABELS.values()):
+            setattr(record, field, self.stats.get(field))
+
+
+def run_rsync(args, parser, log_fp, input=None):
+    '''Run rsync, feeding its output to `parser` and copying it to
+    `log_fp` as it is produced.  Lines ending in either a newline or a
+    carriage return (progress reports) are fed to the parser.
+
+    :param list args: The rsync command and its arguments.
+
+    :param RsyncOutputParser parser: Parser to feed the output to.
+
+    :param file log_fp: File to copy the output to.
+
+    :param str input: (Default None)  Data written to the standard input
+            of rsync, such as the filter rules for "--filter=merge -".
+            If None, rsync gets no input.
+
+    :rtype: int The exit code of rsync.
+    '''
+    def write_input():
+        try:
+            if input:
+                proc.stdin.write(input)
+            proc.stdin.close()
+        except IOError, e:
+            #  rsync exited without reading its input, the output says why
+            if e.errno != errno.EPIPE:
+                raise
+
+    proc = subprocess.Popen(args, stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+
+    #  the input is written while the output is read, rsync may produce
+    #  output before it has read all of the input
+    writer = threading.Thread(target=write_input)
+    writer.daemon = True
+    writer.start()
+
+    pending = ''
+    while True:
+        data = os.read(proc.stdout.fileno(), 65536)
+        if not data:
+            break
+        log_fp.write(data)
+        lines = re.split(r'[\r\n]', pending + data)
+        pending = lines.pop()
+        for line in lines:
+            if line:
+                parser.feed(line)
+    if pending:
+        parser.feed(pending)
+    proc.stdout.close()
+    writer.join()
+    return proc.wait()
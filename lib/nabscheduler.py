@@ -0,0 +1,495 @@
+#!/usr/bin/env python
+#
+#  Copyright (c) 2012, Sean Reifschneider, tummy.com, ltd.
+#  All Rights Reserved.
+
+'''Backup scheduler for Network Attached Backup.
+
+The scheduler repeatedly looks for hosts that are due for a backup and
+inside their backup window, and runs up to `BackupServer.scheduler_slots`
+backups at a time, each in its own child process.  Backups are also
+limited per :py:class:`Storage`, both by a fixed number of concurrent
+backups and by how busy the storage device is.  Hosts configured to check
+connectivity are probed, all at once, before their backups are started.
+
+Within a priority, the hosts expected to take the longest (based on their
+recent runtimes) are started first, and hosts which are not expected to
+finish before their backup window closes are left for the next window.
+
+Once a day, the space and inode usage of each storage is recorded, and
+the space used by each host of storages that can report it all at once.
+'''
+
+from nabdb import *
+import nabsupp
+import nabiostat
+import nabprobe
+import os
+import sys
+import time
+import errno
+import syslog
+import datetime
+import subprocess
+
+
+def window_length(window_start, window_end):
+    '''Return the length of a backup window.
+
+    :param time window_start: Start of the window.
+
+    :param time window_end: End of the window.
+
+    :rtype: timedelta or None if the host has no window.
+    '''
+    if window_start == None or window_end == None:
+        return None
+    day = datetime.date(2000, 1, 1)
+    length = (datetime.datetime.combine(day, window_end)
+            - datetime.datetime.combine(day, window_start))
+    if length <= datetime.timedelta(0):
+        length += datetime.timedelta(days=1)
+    return length
+
+
+def window_remaining(window_start, window_end, now):
+    '''Return the time left until a backup window that `now` is in closes.
+
+    :param time window_start: Start of the window.
+
+    :param time window_end: End of the window.
+
+    :param datetime now: The current time.
+
+    :rtype: timedelta or None if the host has no window.
+    '''
+    if window_start == None or window_end == None:
+        return None
+    end = datetime.datetime.combine(now.date(), window_end)
+    if end <= now:
+        end += datetime.timedelta(days=1)
+    return end - now
+
+
+def order_by_runtime(rows, estimates, now):
+    '''Order the due hosts so that, within each priority, the longest
+    expected backups start first.  Hosts without a runtime history are
+    treated as the longest.  Hosts that are not expected to finish before
+    their window closes are dropped, unless their backups take longer than
+    the whole window anyway.
+
+    :param list rows: Due hosts, from :py:meth:`Host.find_due`, in
+            priority order.
+
+    :param dict estimates: Expected runtimes, from
+            :py:meth:`HostUsage.runtime_estimates`.
+
+    :param datetime now: The current time.
+
+    :rtype: list of rows.
+    '''
+    ordered = []
+    for row in rows:
+        estimate = estimates.get(row.id)
+        if estimate != None:
+            remaining = window_remaining(row.window_start, row.window_end,
+                    now)
+            if (remaining != None and estimate > remaining
+                    and estimate <= window_length(row.window_start,
+                        row.window_end)):
+                continue
+
+        if estimate == None:
+            runtime_key = (0, 0)
+        else:
+            runtime_key = (1, -(estimate.days * 86400 + estimate.seconds))
+        ordered.append(((row.priority == None, row.priority) + runtime_key,
+                row))
+
+    ordered.sort(key=lambda x: x[0])
+    return [x[1] for x in ordered]
+
+
+class RunningBackup:
+    '''A backup that the scheduler has started in a child process.'''
+
+    def __init__(self, pid, host_id, hostname, storage_id, start_time):
+        self.pid = pid
+        self.host_id = host_id
+        self.hostname = hostname
+        self.storage_id = storage_id
+        self.start_time = start_time
+
+    def __repr__(self):
+        return '<RunningBackup(%s: %s)>' % (self.pid, self.hostname)
+
+
+class StorageAdmission:
+    '''Decide whether another backup may be started on a storage.
+    A storage refuses new backups when it is running its
+    "max_concurrent_backups", or when the device it is on was busier than
+    its "max_io_busy_percent" when last sampled.
+
+    :param str diskstats: (Default "/proc/diskstats")  File to read device
+            statistics from.
+    '''
+
+    def __init__(self, diskstats=nabiostat.DISKSTATS):
+        self.diskstats = diskstats
+        self.monitors = {}
+
+    def get_monitor(self, storage):
+        '''Return the device monitor for a storage.
+
+        :rtype: :py:class:`nabiostat.DeviceMonitor` or None if the device
+                statistics are not available.
+        '''
+        if storage.id not in self.monitors:
+            monitor = None
+            try:
+                monitor = nabiostat.DeviceMonitor(
+                        storage.get_plugin().storage_path(), self.diskstats)
+                if not monitor.available():
+                    monitor = None
+            except (OSError, IOError):
+                pass
+            self.monitors[storage.id] = monitor
+        return self.monitors[storage.id]
+
+    def sample(self, storages):
+        '''Sample the devices of the storages that have an I/O limit.
+
+        :param list storages: :py:class:`Storage` records to sample.
+
+        :rtype: None
+        '''
+        for storage in storages:
+            if storage.max_io_busy_percent == None:
+                continue
+            monitor = self.get_monitor(storage)
+            if monitor != None:
+                monitor.sample()
+
+    def admit(self, storage, running):
+        '''May another backup be started on this storage?
+
+        :param Storage storage: The storage the backup would use.
+
+        :param int running: Number of backups running on the storage.
+
+        :rtype: Boolean
+        '''
+        if (storage.max_concurrent_backups != None
+                and running >= storage.max_concurrent_backups):
+            return False
+        if storage.max_io_busy_percent == None:
+            return True
+        monitor = self.get_monitor(storage)
+        if monitor == None:
+            return True
+        return not monitor.is_saturated(storage.max_io_busy_percent)
+
+
+class Scheduler:
+    '''Keep the backup server's scheduler slots busy with backups.
+
+    :param Session db: Database session.
+
+    :param BackupServer server: The backup server to schedule for.
+
+    :param function backup_function: (Default
+            `nabsupp.run_backup_for_host`)  Called in the child process as
+            `backup_function(db, hostname)`, and should return True if the
+            backup completed.
+
+    :param int poll_interval: (Default 60)  Seconds between checks for
+            new hosts to back up.
+
+    :param StorageAdmission admission: (Default None)  Controls starting
+            backups on each storage, a default one is created if None.
+
+    :param ProbeCache prober: (Default None)  Checks the connectivity of
+            hosts, a default one is created if None.
+    '''
+
+    def __init__(self, db, server, backup_function=None, poll_interval=60,
+            admission=None, prober=None):
+        self.db = db
+        self.server_id = server.id
+        if backup_function == None:
+            backup_function = nabsupp.run_backup_for_host
+        self.backup_function = backup_function
+        self.poll_interval = poll_interval
+        if admission == None:
+            admission = StorageAdmission()
+        self.admission = admission
+        if prober == None:
+            prober = nabprobe.ProbeCache()
+        self.prober = prober
+        self.running = {}
+        self.stopping = False
+        self.usage_sampled_date = None
+        self.usage_busy = set()
+
+    def slots(self):
+        '''Number of backups that may run at once.
+
+        :rtype: int
+        '''
+        server = self.db.query(BackupServer).filter_by(
+                id=self.server_id).first()
+        return server.scheduler_slots
+
+    def free_slots(self):
+        '''Number of scheduler slots that are not running a backup.
+
+        :rtype: int
+        '''
+        return max(0, self.slots() - len(self.running))
+
+    def due_hosts(self, now=None):
+        '''Return the hosts that are ready to be backed up, in the order
+        they should be started.  See :py:meth:`Host.find_due` for the
+        attributes of the returned rows.
+
+        :param datetime now: (Default None)  The current time.
+
+        :rtype: list of rows.
+        '''
+        running_ids = set([x.host_id for x in self.running.values()])
+
+        candidates = []
+        for row in Host.find_due(self.db, now, self.server_id):
+            if row.id in running_ids:
+                continue
+            if row.running:
+                #  the backup_pid may be stale, check with the host
+                host = self.db.query(Host).filter_by(id=row.id).first()
+                if host.are_backups_currently_running(self.db):
+                    continue
+            candidates.append(row)
+
+        return candidates
+
+    def sample_usage(self, storages, today):
+        '''Record the usage of the storages, if not already done today.
+        Storages that are busy are not waited for, but retried on the next
+        pass, and those that cannot be sampled are logged and skipped.
+
+        :param list storages: :py:class:`Storage` records to sample.
+
+        :param date today: The current date.
+
+        :rtype: None
+        '''
+        retry = self.usage_sampled_date == today
+        if retry and not self.usage_busy:
+            return
+        busy = set()
+        for storage in storages:
+            if retry and storage.id not in self.usage_busy:
+                continue
+            try:
+                storage.sample_usage(self.db, today, wait=False)
+            except IOError, e:
+                if e.errno in (errno.EWOULDBLOCK, errno.EAGAIN):
+                    busy.add(storage.id)
+                    continue
+                syslog.syslog('Unable to sample usage of storage %s: %s'
+                        % (storage.id, e))
+            except (OSError, subprocess.CalledProcessError), e:
+                syslog.syslog('Unable to sample usage of storage %s: %s'
+                        % (storage.id, e))
+        if not retry:
+            try:
+                HostUsage.sample_storages(self.db, storages, today)
+            except (OSError, IOError, subprocess.CalledProcessError), e:
+                syslog.syslog('Unable to sample usage of hosts: %s' % e)
+        self.db.commit()
+        self.usage_sampled_date = today
+        self.usage_busy = busy
+
+    def start_backup(self, host_id, hostname, storage_id=None):
+        '''Start a backup of a host in a child process.
+
+        :param int host_id: Database ID of the host to back up.
+
+        :param str hostname: Name of the host to back up.
+
+        :param int storage_id: (Default None)  Database ID of the storage
+                the host is backed up to.
+
+        :rtype: :py:class:`RunningBackup`
+        '''
+        #  the child must not share the parent's database connections
+        self.db.commit()
+        self.db.close()
+        nabdb.engine.dispose()
+
+        pid = os.fork()
+        if pid == 0:
+            exitcode = 1
+            try:
+                db = nabdb.session()
+                if self.backup_function(db, hostname):
+                    exitcode = 0
+                db.close()
+            except:
+                sys.excepthook(*sys.exc_info())
+                exitcode = 2
+            os._exit(exitcode)
+
+        syslog.syslog('Started backup of %s (pid %d)' % (hostname, pid))
+        running = RunningBackup(pid, host_id, hostname, storage_id,
+                datetime.datetime.now())
+        self.running[pid] = running
+        return running
+
+    def backup_finished(self, running, status):
+        '''Record the completion of a backup and schedule the next one.
+
+        :param RunningBackup running: The backup that completed.
+
+        :param int status: Exit status from `os.waitpid()`.
+
+        :rtype: None
+        '''
+        host = self.db.query(Host).filter_by(id=running.host_id).first()
+        successful = os.WIFEXITED(status) and os.WEXITSTATUS(status) == 0
+
+        last_backup = self.db.query(Backup).filter(
+                Backup.host_id == running.host_id,
+                Backup.start_time >= running.start_time).order_by(
+                Backup.start_time.desc()).first()
+        if last_backup != None and not last_backup.successful:
+            successful = False
+
+        now = datetime.datetime.now()
+        host.next_backup = host.compute_next_backup(now, successful)
+        self.db.commit()
+
+        syslog.syslog('Finished backup of %s (pid %d, %s), next backup at %s'
+                % (running.hostname, running.pid,
+                    'successful' if successful else 'failed',
+                    host.next_backup))
+
+    def reap_children(self, block=False):
+        '''Collect any backup child processes that have exited.
+
+        :param Boolean block: (Default False)  Wait for at least one child
+                to exit, if any are running.
+
+        :rtype: int The number of children collected.
+        '''
+        reaped = 0
+        while self.running:
+            flags = 0
+            if not block or reaped:
+                flags = os.WNOHANG
+            try:
+                pid, status = os.waitpid(-1, flags)
+            except OSError, e:
+                if e.errno == 4:
+                    continue
+                raise
+            if pid == 0:
+                break
+            running = self.running.pop(pid, None)
+            if running == None:
+                continue
+            self.backup_finished(running, status)
+            reaped += 1
+
+        return reaped
+
+    def run_once(self, now=None):
+        '''Reap finished backups and fill any free slots.
+
+        :param datetime now: (Default None)  The current time.
+
+        :rtype: list of :py:class:`RunningBackup` that were started.
+        '''
+        self.reap_children()
+        if self.stopping:
+            return []
+
+        storages = dict([(x.id, x) for x in self.db.query(Storage).filter_by(
+                backup_server_id=self.server_id)])
+        self.admission.sample(storages.values())
+        if now == None:
+            now = datetime.datetime.now()
+        self.sample_usage(storages.values(), now.date())
+
+        started = []
+        free = self.free_slots()
+        if free == 0:
+            return started
+
+        running = {}
+        for backup in self.running.values():
+            running[backup.storage_id] = running.get(backup.storage_id, 0) + 1
+
+        candidates = self.due_hosts(now)
+        candidates = order_by_runtime(candidates,
+                HostUsage.runtime_estimates(self.db,
+                    [row.id for row in candidates]), now)
+        self.prober.probe([row.ip_address or row.hostname
+                for row in candidates
+                if row.check_connectivity or row.ping_max_ms != None])
+
+        #  starting a backup closes the session, so only keep plain values
+        due = []
+        for row in candidates:
+            if len(due) >= free:
+                break
+            storage = storages[row.storage_id]
+            if not self.admission.admit(storage,
+                    running.get(row.storage_id, 0)):
+                continue
+            if not self.prober.acceptable(row.ip_address or row.hostname,
+                    row.check_connectivity, row.ping_max_ms):
+                continue
+            running[row.storage_id] = running.get(row.storage_id, 0) + 1
+            due.append((row.id, row.hostname, row.storage_id))
+
+        for host_id, hostname, storage_id in due:
+            started.append(self.start_backup(host_id, hostname, storage_id))
+        return started
+
+    def wait(self):
+        '''Wait for all running backups to complete.
+
+        :rtype: None
+        '''
+        while self.running:
+            self.reap_children(block=True)
+
+    def stop(self):
+        '''Stop starting new backups.  Running backups are not interrupted.
+
+        :rtype: None
+        '''
+        self.stopping = True
+
+    def run(self):
+        '''Run the scheduler until `stop()` is called, then wait for the
+        running backups to complete.
+
+        :rtype: None
+        '''
+        while not self.stopping:
+            self.run_once()
+            self.sleep(self.poll_interval)
+        self.wait()
+
+    def sleep(self, seconds):
+        '''Sleep until `seconds` have passed, waking early to start another
+        backup when one completes.
+
+        :rtype: None
+        '''
+        end = time.time() + seconds
+        while not self.stopping and time.time() < end:
+            if self.running and self.reap_children():
+                return
+            time.sleep(min(1, max(0, end - time.time())))
@@ -3,7 +3,8 @@
 #  Copyright (c) 2012, Sean Reifschneider, tummy.com, ltd.
 #  All Rights Reserved.
 
-__all__ = ['zfs', 'hardlinks']
+__all__ = ['zfs', 'hardlinks', 'chunks']
 
 import zfs
 import hardlinks
+import chunks
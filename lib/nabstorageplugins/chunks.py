@@ -0,0 +1,394 @@
+#!/usr/bin/env python
+#
+#  Copyright (c) 2012, Sean Reifschneider, tummy.com, ltd.
+#  All Rights Reserved.
+
+import os
+import nabiostat
+import nabreaper
+import nabchunkstore
+
+#  directory of the chunk store shared by all the hosts
+CHUNK_DIRECTORY = '.nab-chunks'
+#  suffix of the tree files of snapshots
+TREE_SUFFIX = '.tree'
+
+
+class Storage:
+    def __init__(self, args):
+        '''Chunk store back-end.
+
+        rsync updates the "data" directory of the host in place, and each
+        snapshot stores the changed files as compressed, content-defined
+        chunks in a store shared by all the hosts, see
+        :py:mod:`nabchunkstore`.  Snapshots are read by mounting them,
+        which restores them to the "mounted" directory of the host, or by
+        extracting just the paths needed to a temporary directory.
+
+        :param list args: Arguments to the storage plugin, for chunks this
+                is a string specifying the top-level directory.
+        '''
+        self.top_directory = args[0]
+
+    def storage_path(self):
+        '''Return a path on the file-system that holds the backups.
+
+        :rtype: str
+        '''
+        return self.top_directory
+
+    def rsync_inplace_compatible(self):
+        '''Is this storage back-end compatible with "rsync --inplace"?
+        Snapshots do not share files with the "data" directory, so it is.
+
+        :rtype: boolean
+        '''
+        return True
+
+    def open_store(self, write=True, wait=True):
+        '''Open the chunk store.  Writers wait for each other, readers only
+        for garbage collection.
+
+        :param boolean write: (Default True)  Open it for writing.
+
+        :param boolean wait: (Default True)  Wait for the other users of
+                the store, otherwise raise IOError if it is busy.
+
+        :rtype: :py:class:`nabchunkstore.ChunkStore`
+        '''
+        return nabchunkstore.ChunkStore(os.path.join(self.top_directory,
+                CHUNK_DIRECTORY), write=write, wait=wait)
+
+    def get_backup_top_directory(self, hostname):
+        '''Return the top level directory that backups should be stored
+        under.
+
+        :param str hostname: Name of the host.
+
+        :rtype: str -- The path to the top of the host's backup directory.
+        '''
+        return os.path.join(self.top_directory, hostname)
+
+    def get_backup_destination(self, hostname, snapshotname):
+        '''Return the directory that rsync should write the backup to.
+
+        :param str hostname: Name of the host.
+
+        :param str snapshotname: Name of the snapshot this backup will be.
+
+        :rtype: str
+        '''
+        return os.path.join(self.get_backup_top_directory(hostname), 'data')
+
+    def get_rsync_arguments(self, hostname, snapshotname,
+            previous_snapshotname):
+        '''Return additional arguments for rsync, none for chunks.
+
+        :rtype: list of str
+        '''
+        return []
+
+    def create_host(self, hostname):
+        '''Create the host backup directory.
+
+        :param str hostname: Name of the host.
+
+        :rtype: None
+        '''
+        topdir = self.get_backup_top_directory(hostname)
+        os.mkdir(topdir)
+        os.chmod(topdir, 0700)
+        for name in ['data', 'keys', 'logs', 'snapshots', 'manifests',
+                'mounted']:
+            os.mkdir(os.path.join(topdir, name))
+
+    def trash_directory(self):
+        '''Return the directory that destroyed hosts and mounted snapshots
+        are moved to, until they are removed by the reaper.
+
+        :rtype: str
+        '''
+        return os.path.join(self.top_directory, nabreaper.TRASH_DIRECTORY)
+
+    def destroy_host(self, hostname):
+        '''Destroy the host backup directory and release the chunks of its
+        snapshots.  The directory is moved to the trash directory, to be
+        removed by the reaper.
+
+        :param str hostname: Name of the host.
+
+        :rtype: None
+        '''
+        topdir = self.get_backup_top_directory(hostname)
+        if not os.path.exists(topdir):
+            raise ValueError('Host directory does not exist')
+
+        self.destroy_snapshots(hostname, self.list_snapshots(hostname))
+        nabreaper.move_to_trash(topdir, self.top_directory)
+
+    def snapshot_name(self, host, backup):
+        '''Return the name to use for the snapshot.
+
+        :param Host host: Host of the backup.
+
+        :param Backup backup: Backup being run.
+
+        :rtype: str
+        '''
+        import datetime
+        return datetime.datetime.now().strftime('%Y-%m-%d_%H%M%S'
+                ) + '-' + backup.generation
+
+    def get_tree_path(self, hostname, snapshotname):
+        '''Return the path of the tree file of a snapshot.
+
+        :param str hostname: Name of the host.
+
+        :param str snapshotname: Name of the snapshot.
+
+        :rtype: str
+        '''
+        return os.path.join(self.get_backup_top_directory(hostname),
+                'snapshots', snapshotname + TREE_SUFFIX)
+
+    def get_manifest_path(self, hostname, snapshotname):
+        '''Return the path of the manifest of a snapshot, see
+        :py:mod:`nabmanifest`.
+
+        :param str hostname: Name of the host.
+
+        :param str snapshotname: Name of the snapshot.
+
+        :rtype: str
+        '''
+        return os.path.join(self.get_backup_top_directory(hostname),
+                'manifests', snapshotname)
+
+    def get_snapshot_directory(self, hostname, snapshotname):
+        '''Return the directory a snapshot is restored to when it is
+        mounted.
+
+        :param str hostname: Name of the host.
+
+        :param str snapshotname: Name of the snapshot.
+
+        :rtype: str
+        '''
+        return os.path.join(self.get_backup_top_directory(hostname),
+                'mounted', snapshotname)
+
+    def list_snapshots(self, hostname):
+        '''Return the names of the snapshots of a host, oldest first.
+
+        :param str hostname: Name of the host.
+
+        :rtype: list of str
+        '''
+        directory = os.path.join(self.get_backup_top_directory(hostname),
+                'snapshots')
+        snapshots = []
+        for name in os.listdir(directory):
+            if name.endswith(TREE_SUFFIX):
+                snapshots.append((os.path.getmtime(os.path.join(directory,
+                        name)), name[:-len(TREE_SUFFIX)]))
+        return [x[1] for x in sorted(snapshots)]
+
+    def create_snapshot(self, hostname, snapshotname):
+        '''Store the last backup as a snapshot, and write its manifest.
+        Only the files changed since the previous snapshot are read.
+
+        :param str hostname: Name of the host.
+
+        :param str snapshotname: Name of the snapshot.
+
+        :rtype: :py:class:`nabchunkstore.SnapshotStatistics`
+        '''
+        tree = self.get_tree_path(hostname, snapshotname)
+        if os.path.exists(tree):
+            raise ValueError('Snapshot "%s" already exists for host "%s"' %
+                    (snapshotname, hostname))
+        previous = None
+        snapshots = self.list_snapshots(hostname)
+        if snapshots:
+            previous = self.get_tree_path(hostname, snapshots[-1])
+
+        store = self.open_store()
+        try:
+            return store.snapshot(os.path.join(
+                    self.get_backup_top_directory(hostname), 'data'), tree,
+                    self.get_manifest_path(hostname, snapshotname),
+                    previous)
+        finally:
+            store.close()
+
+    def destroy_snapshots(self, hostname, snapshotnames):
+        '''Destroy snapshots of a host, releasing their chunks, which are
+        removed by :py:meth:`collect_garbage`.  Snapshots that do not
+        exist are skipped.
+
+        :param str hostname: Name of the host.
+
+        :param list snapshotnames: Names of the snapshots.
+
+        :rtype: list of str The names of the snapshots destroyed.
+        '''
+        destroyed = []
+        store = self.open_store()
+        try:
+            for name in snapshotnames:
+                tree = self.get_tree_path(hostname, name)
+                if not os.path.exists(tree):
+                    continue
+                self.unmount_snapshot(hostname, name)
+                store.remove_snapshot(tree)
+                manifest = self.get_manifest_path(hostname, name)
+                if os.path.exists(manifest):
+                    os.remove(manifest)
+                destroyed.append(name)
+        finally:
+            store.close()
+        return destroyed
+
+    def destroy_snapshot(self, hostname, snapshotname):
+        '''Destroy a snapshot.
+
+        :param str hostname: Name of the host.
+
+        :param str snapshotname: Name of the snapshot.
+
+        :rtype: None
+        '''
+        if not self.destroy_snapshots(hostname, [snapshotname]):
+            raise ValueError('Snapshot "%s" does not exist for host "%s"' %
+                    (snapshotname, hostname))
+
+    def mount_snapshot(self, hostname, snapshotname):
+        '''Restore a snapshot to :py:meth:`get_snapshot_directory`, if it
+        is not already there.
+
+        :param str hostname: Name of the host.
+
+        :param str snapshotname: Name of the snapshot.
+
+        :rtype: None
+        '''
+        tree = self.get_tree_path(hostname, snapshotname)
+        if not os.path.exists(tree):
+            raise ValueError('Snapshot "%s" does not exist for host "%s"' %
+                    (snapshotname, hostname))
+        directory = self.get_snapshot_directory(hostname, snapshotname)
+        if os.path.exists(directory):
+            return
+        partial = directory + '.tmp'
+        if os.path.exists(partial):
+            nabreaper.move_to_trash(partial, self.top_directory)
+        store = self.open_store(write=False)
+        try:
+            store.restore(tree, os.path.join(partial, 'data'))
+        finally:
+            store.close()
+        os.rename(partial, directory)
+
+    def extract_snapshot(self, hostname, snapshotname, destination,
+            paths=None):
+        '''Restore the files of a snapshot to a directory, without
+        mounting it.
+
+        :param str hostname: Name of the host.
+
+        :param str snapshotname: Name of the snapshot.
+
+        :param str destination: Directory to restore the files to.
+
+        :param list paths: (Default None)  Only restore these paths, see
+                :py:meth:`nabchunkstore.ChunkStore.restore`.
+
+        :rtype: :py:class:`nabrestore.RestoreStatistics`
+        '''
+        tree = self.get_tree_path(hostname, snapshotname)
+        if not os.path.exists(tree):
+            raise ValueError('Snapshot "%s" does not exist for host "%s"' %
+                    (snapshotname, hostname))
+        store = self.open_store(write=False)
+        try:
+            return store.restore(tree, destination, paths)
+        finally:
+            store.close()
+
+    def unmount_snapshot(self, hostname, snapshotname):
+        '''Remove a restored snapshot.  It is moved to the trash directory,
+        to be removed by the reaper.
+
+        :param str hostname: Name of the host.
+
+        :param str snapshotname: Name of the snapshot.
+
+        :rtype: None
+        '''
+        directory = self.get_snapshot_directory(hostname, snapshotname)
+        if os.path.exists(directory):
+            nabreaper.move_to_trash(directory, self.top_directory)
+
+    def reclaimable_bytes(self, hostname, snapshotnames):
+        '''Return the bytes that destroying the snapshots and collecting
+        the garbage would free.
+
+        :param str hostname: Name of the host.
+
+        :param list snapshotnames: Names of the snapshots.
+
+        :rtype: int
+        '''
+        counts = {}
+        for name in snapshotnames:
+            tree = self.get_tree_path(hostname, name)
+            if not os.path.exists(tree):
+                continue
+            for chunk_id, count in nabchunkstore.tree_chunk_counts(
+                    tree).iteritems():
+                counts[chunk_id] = counts.get(chunk_id, 0) + count
+        store = self.open_store(write=False)
+        try:
+            return store.reclaimable_bytes(counts)
+        finally:
+            store.close()
+
+    def collect_garbage(self, max_packs=4, min_garbage_percent=20):
+        '''Remove unreferenced chunks from a few of the packs, see
+        :py:meth:`nabchunkstore.ChunkStore.collect_garbage`.
+
+        :rtype: :py:class:`nabchunkstore.GarbageStatistics`
+        '''
+        store = self.open_store()
+        try:
+            return store.collect_garbage(max_packs, min_garbage_percent)
+        finally:
+            store.close()
+
+    def storage_statistics(self, wait=True):
+        '''Get the space and inode counts of the storage.  The
+        deduplication ratio is of the bytes the snapshots refer to over the
+        compressed bytes stored, so it includes the compression.
+
+        :param boolean wait: (Default True)  Wait for garbage collection
+                of the store, otherwise raise IOError while it runs.
+
+        :rtype: :py:class:`nabiostat.CapacityStatistics`
+        '''
+        statistics = nabiostat.capacity_statistics(self.top_directory)
+        store = self.open_store(write=False, wait=wait)
+        try:
+            logical, stored = store.usage()
+        finally:
+            store.close()
+        if stored:
+            statistics.dedup_ratio_percent = int(round(
+                    logical * 100.0 / stored))
+        return statistics
+
+    def storage_usage(self):
+        '''Get the percentage utilization of the storage.
+
+        :rtype: int The percentage utilization of the storage.
+        '''
+        return self.storage_statistics().usage_percent()
@@ -4,18 +4,51 @@
 #  All Rights Reserved.
 
 import os
-import subprocess
-import re
+import nabiostat
+import nabaccounting
+import nabdedup
+import nabmanifest
+import nabreaper
+import nablinktree
+
+
+#  modes of making backups, the first is the default
+MODES = ['snapshot', 'link-dest']
+#  cache of the deduplication of files between hosts
+DEDUP_CACHE = '.nab-dedup.sqlite'
 
 
 class Storage:
+    #  number of threads used to link the files of a snapshot
+    snapshot_threads = 8
+
     def __init__(self, args):
         '''Hardlinks storage back-end.
 
-        :param list args: Arguments to the storage plugin, for hardlinks this
-                is only a string specifying the top-level directory.
+        In the default "snapshot" mode, rsync updates the "data" directory
+        of the host, which is then copied to the snapshot with hard-links.
+        In "link-dest" mode, rsync writes each backup directly into its
+        snapshot, hard-linking the files that are unchanged since the
+        previous backup.
+
+        :param list args: Arguments to the storage plugin, for hardlinks
+                this is a string specifying the top-level directory, and
+                optionally the mode: "snapshot" or "link-dest".
         '''
         self.top_directory = args[0]
+        self.mode = MODES[0]
+        if len(args) > 1 and args[1]:
+            self.mode = args[1]
+        if self.mode not in MODES:
+            raise ValueError('Unknown hardlinks mode "%s", expecting one of: '
+                    '%s' % (self.mode, ', '.join(MODES)))
+
+    def storage_path(self):
+        '''Return a path on the file-system that holds the backups.
+
+        :rtype: str
+        '''
+        return self.top_directory
 
     def rsync_inplace_compatible(self):
         '''Is this storage back-end compatible with "rsync --inplace"?
@@ -34,6 +67,56 @@ class Storage:
         '''
         return os.path.join(self.top_directory, hostname)
 
+    def get_backup_destination(self, hostname, snapshotname):
+        '''Return the directory that rsync should write the backup to,
+        creating it if necessary.
+
+        :param str hostname: Name of the host.
+
+        :param str snapshotname: Name of the snapshot this backup will be.
+
+        :rtype: str
+        '''
+        topdir = self.get_backup_top_directory(hostname)
+        if self.mode == 'snapshot':
+            return os.path.join(topdir, 'data')
+
+        destination = os.path.join(topdir, 'snapshots', snapshotname, 'data')
+        if not os.path.exists(destination):
+            os.makedirs(destination)
+        return destination
+
+    def get_rsync_arguments(self, hostname, snapshotname,
+            previous_snapshotname):
+        '''Return additional arguments for rsync.  In "link-dest" mode,
+        unchanged files are linked from the previous snapshot, or the most
+        recent snapshot if the previous one no longer exists.
+
+        :param str hostname: Name of the host.
+
+        :param str snapshotname: Name of the snapshot this backup will be.
+
+        :param str previous_snapshotname: Name of the snapshot of the last
+                successful backup, or None.
+
+        :rtype: list of str
+        '''
+        if self.mode == 'snapshot':
+            return []
+
+        snapshots = os.path.join(self.get_backup_top_directory(hostname),
+                'snapshots')
+        candidates = [previous_snapshotname] + sorted([x
+                for x in os.listdir(snapshots) if x != snapshotname],
+                reverse=True)
+        for name in candidates:
+            if name == None:
+                continue
+            link_dest = os.path.abspath(os.path.join(snapshots, name, 'data'))
+            if os.path.isdir(link_dest):
+                return ['--link-dest=%s' % link_dest]
+        return []
+
     def create_host(self, hostname):
         '''Create the host backup directory.
 
@@ -49,8 +132,17 @@ class Storage:
         os.mkdir(os.path.join(topdir, 'logs'))
         os.mkdir(os.path.join(topdir, 'snapshots'))
 
+    def trash_directory(self):
+        '''Return the directory that destroyed hosts and snapshots are
+        moved to, until they are removed by the reaper.
+
+        :rtype: str
+        '''
+        return os.path.join(self.top_directory, nabreaper.TRASH_DIRECTORY)
+
     def destroy_host(self, hostname):
-        '''Destroy the host backup directory.
+        '''Destroy the host backup directory.  It is moved to the trash
+        directory, to be removed by the reaper.
 
         :param str hostname: Name of the host.
 
@@ -60,9 +152,7 @@ class Storage:
         if not os.path.exists(topdir):
             raise ValueError('Host directory does not exist')
 
-        remove = topdir + '.nab-remove-in-progress'
-        os.rename(topdir, remove)
-        subprocess.call(['rm', '-rf', remove])
+        nabreaper.move_to_trash(topdir, self.top_directory)
 
     def snapshot_name(self, host, backup):
         '''Return the name to use for the snapshot.
@@ -77,30 +167,61 @@ class Storage:
         return datetime.datetime.now().strftime('%Y-%m-%d_%H%M%S'
                 ) + '-' + backup.generation
 
+    def get_manifest_path(self, hostname, snapshotname):
+        '''Return the path of the manifest of a snapshot, see
+        :py:mod:`nabmanifest`.
+
+        :param str hostname: Name of the host.
+
+        :param str snapshotname: Name of the snapshot.
+
+        :rtype: str
+        '''
+        return os.path.join(self.get_backup_top_directory(hostname),
+                'snapshots', snapshotname, 'manifest')
+
     def create_snapshot(self, hostname, snapshotname):
-        '''Create a snapshot of the last backup.
+        '''Create a snapshot of the last backup, and its manifest.
 
         :param str hostname: Name of the host.
 
         :param str snapshotname: Name of the snapshot.
 
-        :rtype: None
+        :rtype: :py:class:`nablinktree.LinkTreeStatistics` of the data
+                directory, or None in "link-dest" mode.
         '''
         topdir = self.get_backup_top_directory(hostname)
         snapshotdir = os.path.join(topdir, 'snapshots', snapshotname)
 
+        if self.mode == 'link-dest':
+            #  rsync has already written the data to the snapshot
+            if os.path.exists(os.path.join(snapshotdir, 'logs')):
+                raise ValueError('Snapshot "%s" already exists for host '
+                        '"%s"' % (snapshotname, hostname))
+            nablinktree.link_tree(os.path.join(topdir, 'logs'),
+                    os.path.join(snapshotdir, 'logs'), threads=1)
+            nabmanifest.write_tree_manifest(os.path.join(snapshotdir, 'data'),
+                    self.get_manifest_path(hostname, snapshotname))
+            return None
+
         if os.path.exists(snapshotdir):
             raise ValueError('Snapshot "%s" already exists for host "%s"' %
                     (snapshotname, hostname))
 
         os.mkdir(snapshotdir)
-        subprocess.call(['cp', '-al', os.path.join(topdir, 'logs', '.'),
-                os.path.join(snapshotdir, 'logs')])
-        subprocess.call(['cp', '-al', os.path.join(topdir, 'data', '.'),
-                os.path.join(snapshotdir, 'data')])
+        nablinktree.link_tree(os.path.join(topdir, 'logs'),
+                os.path.join(snapshotdir, 'logs'), threads=1)
+        manifest = nabmanifest.ManifestBuilder(
+                self.get_manifest_path(hostname, snapshotname))
+        statistics = nablinktree.link_tree(os.path.join(topdir, 'data'),
+                os.path.join(snapshotdir, 'data'),
+                threads=self.snapshot_threads, manifest=manifest)
+        manifest.finish()
+        return statistics
 
     def destroy_snapshot(self, hostname, snapshotname):
-        '''Destroy a snapshot.
+        '''Destroy a snapshot.  It is moved to the trash directory, to be
+        removed by the reaper.
 
         :param str hostname: Name of the host.
 
@@ -115,9 +236,38 @@ class Storage:
             raise ValueError('Snapshot "%s" does not exist for host "%s"' %
                     (snapshotname, hostname))
 
-        remove = snapshotdir + '.nab-remove-in-progress'
-        os.rename(snapshotdir, remove)
-        subprocess.call(['rm', '-rf', remove])
+        nabreaper.move_to_trash(snapshotdir, self.top_directory)
+
+    def destroy_snapshots(self, hostname, snapshotnames):
+        '''Destroy snapshots of a host.  Snapshots that do not exist are
+        skipped.
+
+        :param str hostname: Name of the host.
+
+        :param list snapshotnames: Names of the snapshots.
+
+        :rtype: list of str The names of the snapshots destroyed.
+        '''
+        destroyed = []
+        for name in snapshotnames:
+            try:
+                self.destroy_snapshot(hostname, name)
+            except ValueError:
+                continue
+            destroyed.append(name)
+        return destroyed
+
+    def get_snapshot_directory(self, hostname, snapshotname):
+        '''Return the directory a snapshot is stored in.
+
+        :param str hostname: Name of the host.
+
+        :param str snapshotname: Name of the snapshot.
+
+        :rtype: str
+        '''
+        return os.path.join(self.get_backup_top_directory(hostname),
+                'snapshots', snapshotname)
 
     def mount_snapshot(self, hostname, snapshotname):
         '''Mount a snapshot (noop on hardlinks backend)
@@ -141,19 +291,124 @@ class Storage:
         '''
         return
 
+    def account_usage(self, hostname, removing=None):
+        '''Work out the space used by the host's backup and by each of its
+        snapshots.  Only snapshots made since the last call are scanned.
+
+        :param str hostname: Name of the host.
+
+        :param list removing: (Default None)  Names of snapshots to work
+                out the space freed by removing them all.
+
+        :rtype: :py:class:`nabaccounting.AccountingReport`
+        '''
+        topdir = self.get_backup_top_directory(hostname)
+        snapshotsdir = os.path.join(topdir, 'snapshots')
+        snapshots = []
+        for name in sorted(os.listdir(snapshotsdir)):
+            path = os.path.join(snapshotsdir, name, 'data')
+            if os.path.isdir(path):
+                snapshots.append((name, path))
+        return nabaccounting.account_snapshots(snapshots,
+                os.path.join(topdir, 'accounting'),
+                mirror_newest=self.mode == 'snapshot', removing=removing)
+
+    def reclaimable_bytes(self, hostname, snapshotnames):
+        '''Return the bytes that destroying the snapshots would free.
+
+        :param str hostname: Name of the host.
+
+        :param list snapshotnames: Names of the snapshots.
+
+        :rtype: int
+        '''
+        return self.account_usage(hostname, snapshotnames).removable_bytes
+
+    def forget_accounting(self, snapshots):
+        '''Remove the saved accounting scans of snapshots whose inodes have
+        changed, so they are scanned again.
+
+        :param list snapshots: (hostname, snapshot name) of each snapshot.
+
+        :rtype: None
+        '''
+        for hostname, name in snapshots:
+            cache = os.path.join(self.get_backup_top_directory(hostname),
+                    'accounting', name + nabaccounting.CACHE_SUFFIX)
+            if os.path.exists(cache):
+                os.remove(cache)
+
+    def deduplicate(self, hostnames, processes=4, min_size=4096):
+        '''Replace files in the snapshots of the hosts which are identical
+        to files of other hosts (or of the same host) with hard-links.
+        Only snapshots made since the last run are examined.
+
+        This needs the "link-dest" mode.  In "snapshot" mode the files of
+        the newest snapshot are also in the "data" directory, whose
+        attributes rsync changes in place, and that would change the
+        files of the other hosts linked to them.
+
+        :param list hostnames: Names of the hosts to deduplicate.
+
+        :param int processes: (Default 4)  Number of processes hashing
+                files.
+
+        :param int min_size: (Default 4096)  Smaller files are left alone.
+
+        :rtype: :py:class:`nabdedup.DedupStatistics`
+        '''
+        if self.mode != 'link-dest':
+            raise ValueError('Deduplication needs the "link-dest" hardlinks '
+                    'mode, not "%s"' % self.mode)
+        dedup = nabdedup.Deduplicator(
+                os.path.join(self.top_directory, DEDUP_CACHE),
+                processes=processes, min_size=min_size)
+        try:
+            for hostname in hostnames:
+                topdir = self.get_backup_top_directory(hostname)
+                snapshots = []
+                for name in sorted(os.listdir(os.path.join(topdir,
+                        'snapshots'))):
+                    path = os.path.join(topdir, 'snapshots', name, 'data')
+                    if os.path.isdir(path):
+                        snapshots.append((name, path,
+                                self.get_manifest_path(hostname, name)))
+                dedup.forget_missing(hostname, [x[0] for x in snapshots])
+                changed = [(hostname, x) for x in dedup.process_host(
+                        hostname, snapshots)]
+                self.forget_accounting(changed)
+            #  files of other hosts were linked to, so are no longer
+            #  exclusive to their snapshots
+            self.forget_accounting(dedup.linked_snapshots)
+        finally:
+            dedup.close()
+        return dedup.statistics
+
+    def storage_statistics(self, wait=True):
+        '''Get the space and inode counts of the storage, and its
+        deduplication ratio if it has been deduplicated.
+
+        :param boolean wait: (Default True)  Unused, nothing here waits
+                for other users of the storage.
+
+        :rtype: :py:class:`nabiostat.CapacityStatistics`
+        '''
+        statistics = nabiostat.capacity_statistics(self.top_directory)
+        cache = os.path.join(self.top_directory, DEDUP_CACHE)
+        if os.path.exists(cache):
+            dedup = nabdedup.Deduplicator(cache)
+            try:
+                statistics.dedup_ratio_percent = dedup.dedup_ratio_percent()
+            finally:
+                dedup.close()
+        return statistics
+
     def storage_usage(self):
         '''Get the percentage utilization of the storage.
 
         :rtype: int The percentage utilization of the storage.
         '''
-        data = None
-        for line in subprocess.check_output(
-                ['df', self.top_directory]).split('\n'):
-            match = re.search('(\d+)%', line)
-            if match:
-                data = int(match.group(1))
-
-        return data
+        return self.storage_statistics().usage_percent()
 
 #  methods that are needed:
 #    get host usage
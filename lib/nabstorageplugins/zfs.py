@@ -3,6 +3,455 @@
 #  Copyright (c) 2012, Sean Reifschneider, tummy.com, ltd.
 #  All Rights Reserved.
 
+import os
+import subprocess
+import nabiostat
+import nabmanifest
+
+
+#  properties of the host file-systems recorded by :py:func:`collect_usage`
+USAGE_PROPERTIES = ['used', 'usedbysnapshots', 'compressratio']
+
+
+def parse_usage(lines, filesystems):
+    '''Parse the output of "zfs get -H -p -o name,property,value" of the
+    :py:data:`USAGE_PROPERTIES`, as it is read.  zfs lists the properties
+    of each data-set together, so each host is yielded once its last
+    property has been read.
+
+    :param iterable lines: Lines of the output of zfs.
+
+    :param list filesystems: The backup file-systems, whose direct
+            children are the hosts.
+
+    :rtype: generator of (filesystem, hostname, used_by_dataset,
+            used_by_snapshots, compression_ratio_percent)
+    '''
+    prefixes = [(x + '/', x) for x in filesystems]
+    current = None
+    properties = {}
+    for line in lines:
+        name, prop, value = line.rstrip('\n').split('\t')
+        if name != current:
+            current = name
+            properties = {}
+        properties[prop] = value
+        if len(properties) != len(USAGE_PROPERTIES):
+            continue
+
+        for prefix, filesystem in prefixes:
+            if name.startswith(prefix) and '/' not in name[len(prefix):]:
+                used = int(properties['used'])
+                snapshots = int(properties['usedbysnapshots'])
+                ratio = int(round(float(
+                        properties['compressratio'].rstrip('x')) * 100))
+                yield (filesystem, name[len(prefix):], used - snapshots,
+                        snapshots, ratio)
+                break
+
+
+def collect_usage(plugins):
+    '''Collect the space used by every host of the zfs storages, with one
+    recursive "zfs get" of each pool, whose output is parsed as it arrives.
+
+    :param list plugins: :py:class:`Storage` instances.
+
+    :rtype: generator of (:py:class:`Storage`, hostname, used_by_dataset,
+            used_by_snapshots, compression_ratio_percent)
+    '''
+    pools = {}
+    for plugin in plugins:
+        pools.setdefault(plugin.pool, []).append(plugin)
+    for pool in sorted(pools):
+        by_filesystem = dict([(x.filesystem, x) for x in pools[pool]])
+        process = subprocess.Popen(['zfs', 'get', '-H', '-p', '-r',
+                '-t', 'filesystem', '-o', 'name,property,value',
+                ','.join(USAGE_PROPERTIES)] + sorted(by_filesystem),
+                stdout=subprocess.PIPE)
+        try:
+            for row in parse_usage(iter(process.stdout.readline, ''),
+                    by_filesystem.keys()):
+                yield (by_filesystem[row[0]], ) + row[1:]
+        finally:
+            process.stdout.close()
+            returncode = process.wait()
+        if returncode != 0:
+            raise subprocess.CalledProcessError(returncode, 'zfs get')
+
+
+class Dataset:
+    '''A zfs data-set, as listed by :py:meth:`Storage.list_datasets`.
+
+    .. py:attribute:: name
+
+    Name of the host, or of the snapshot.
+
+    .. py:attribute:: used
+
+    Bytes used by the data-set, including its snapshots, or for a
+    snapshot the bytes only it uses.
+
+    .. py:attribute:: referenced
+
+    Bytes of the data the data-set or snapshot refers to.
+
+    .. py:attribute:: creation
+
+    Creation time in seconds since the epoch.
+
+    .. py:attribute:: snapshots
+
+    List of the :py:class:`Dataset` of the snapshots of a host, oldest
+    first.
+    '''
+
+    def __init__(self, name, used, referenced, creation):
+        self.name = name
+        self.used = used
+        self.referenced = referenced
+        self.creation = creation
+        self.snapshots = []
+
+    def __repr__(self):
+        return '<Dataset(%s: %s)>' % (self.name, self.used)
+
 
 class Storage:
-    pass
+    def __init__(self, args):
+        '''ZFS storage back-end.
+
+        Each host is a file-system under the backup file-system, and each
+        snapshot a zfs snapshot of it.  rsync writes the backup into the
+        "data" directory in place, and the snapshot's manifest is written
+        to the "manifests" directory of the host.
+
+        :param list args: Arguments to the storage plugin, for zfs these
+                are the pool name, file-system name, and mount-point.
+        '''
+        self.pool = args[0]
+        self.filesystem = args[1]
+        self.mountpoint = args[2]
+
+    def zfs(self, args):
+        '''Run a zfs command.
+
+        :param list args: Arguments to "zfs".
+
+        :rtype: str The output of the command.
+        '''
+        return subprocess.check_output(['zfs'] + args)
+
+    def storage_path(self):
+        '''Return a path on the file-system that holds the backups.
+
+        :rtype: str
+        '''
+        return self.mountpoint
+
+    def rsync_inplace_compatible(self):
+        '''Is this storage back-end compatible with "rsync --inplace"?
+
+        :rtype: boolean
+        '''
+        return True
+
+    def get_dataset(self, hostname):
+        '''Return the name of the zfs file-system of a host.
+
+        :param str hostname: Name of the host.
+
+        :rtype: str
+        '''
+        return '%s/%s' % (self.filesystem, hostname)
+
+    def get_backup_top_directory(self, hostname):
+        '''Return the top level directory that backups should be stored
+        under.
+
+        :param str hostname: Name of the host.
+
+        :rtype: str -- The path to the top of the host's backup directory.
+        '''
+        return os.path.join(self.mountpoint, hostname)
+
+    def get_backup_destination(self, hostname, snapshotname):
+        '''Return the directory that rsync should write the backup to.
+
+        :param str hostname: Name of the host.
+
+        :param str snapshotname: Name of the snapshot this backup will be.
+
+        :rtype: str
+        '''
+        return os.path.join(self.get_backup_top_directory(hostname), 'data')
+
+    def get_rsync_arguments(self, hostname, snapshotname,
+            previous_snapshotname):
+        '''Return additional arguments for rsync, none for zfs.
+
+        :rtype: list of str
+        '''
+        return []
+
+    def get_snapshot_directory(self, hostname, snapshotname):
+        '''Return the directory a snapshot is visible under.
+
+        :param str hostname: Name of the host.
+
+        :param str snapshotname: Name of the snapshot.
+
+        :rtype: str
+        '''
+        return os.path.join(self.get_backup_top_directory(hostname), '.zfs',
+                'snapshot', snapshotname)
+
+    def list_datasets(self, hostname=None):
+        '''List the file-systems of the hosts and their snapshots, with a
+        single "zfs list" of the backup file-system.
+
+        :param str hostname: (Default None)  Only list this host.
+
+        :rtype: dict Mapping the host name to its :py:class:`Dataset`.
+        '''
+        top = self.filesystem
+        if hostname != None:
+            top = self.get_dataset(hostname)
+        prefix = self.filesystem + '/'
+        output = self.zfs(['list', '-H', '-p', '-r', '-t',
+                'filesystem,snapshot', '-o', 'name,used,referenced,creation',
+                '-s', 'creation', top])
+
+        hosts = {}
+        snapshots = []
+        for line in output.splitlines():
+            name, used, referenced, creation = line.split('\t')
+            if not name.startswith(prefix):
+                continue
+            name, _, snapshotname = name[len(prefix):].partition('@')
+            if '/' in name:
+                continue
+            dataset = Dataset(snapshotname or name, int(used),
+                    int(referenced), int(creation))
+            if snapshotname:
+                snapshots.append((name, dataset))
+            else:
+                hosts[name] = dataset
+        for name, dataset in snapshots:
+            if name in hosts:
+                hosts[name].snapshots.append(dataset)
+        return hosts
+
+    def list_snapshots(self, hostname):
+        '''Return the names of the snapshots of a host, oldest first.
+
+        :param str hostname: Name of the host.
+
+        :rtype: list of str
+        '''
+        dataset = self.list_datasets(hostname).get(hostname)
+        if dataset == None:
+            raise ValueError('Host file-system does not exist')
+        return [x.name for x in dataset.snapshots]
+
+    def create_host(self, hostname):
+        '''Create the host file-system and its directories.
+
+        :param str hostname: Name of the host.
+
+        :rtype: None
+        '''
+        self.zfs(['create', self.get_dataset(hostname)])
+        topdir = self.get_backup_top_directory(hostname)
+        os.chmod(topdir, 0700)
+        os.mkdir(os.path.join(topdir, 'data'))
+        os.mkdir(os.path.join(topdir, 'keys'))
+        os.mkdir(os.path.join(topdir, 'logs'))
+        os.mkdir(os.path.join(topdir, 'manifests'))
+
+    def destroy_host(self, hostname):
+        '''Destroy the host file-system and all its snapshots.
+
+        :param str hostname: Name of the host.
+
+        :rtype: None
+        '''
+        if hostname not in self.list_datasets():
+            raise ValueError('Host file-system does not exist')
+        self.zfs(['destroy', '-r', self.get_dataset(hostname)])
+
+    def snapshot_name(self, host, backup):
+        '''Return the name to use for the snapshot.
+
+        :param Host host: Host of the backup.
+
+        :param Backup backup: Backup being run.
+
+        :rtype: str
+        '''
+        import datetime
+        return datetime.datetime.now().strftime('%Y-%m-%d_%H%M%S'
+                ) + '-' + backup.generation
+
+    def get_manifest_path(self, hostname, snapshotname):
+        '''Return the path of the manifest of a snapshot, see
+        :py:mod:`nabmanifest`.
+
+        :param str hostname: Name of the host.
+
+        :param str snapshotname: Name of the snapshot.
+
+        :rtype: str
+        '''
+        return os.path.join(self.get_backup_top_directory(hostname),
+                'manifests', snapshotname)
+
+    def create_snapshots(self, snapshots):
+        '''Snapshot several hosts at once, with a single "zfs snapshot".
+
+        :param list snapshots: (hostname, snapshotname) of each snapshot.
+
+        :rtype: None
+        '''
+        hosts = self.list_datasets()
+        for hostname, snapshotname in snapshots:
+            if hostname not in hosts:
+                raise ValueError('Host file-system "%s" does not exist'
+                        % hostname)
+            if snapshotname in [x.name for x in hosts[hostname].snapshots]:
+                raise ValueError('Snapshot "%s" already exists for host "%s"'
+                        % (snapshotname, hostname))
+        self.zfs(['snapshot'] + ['%s@%s' % (self.get_dataset(hostname),
+                snapshotname) for hostname, snapshotname in snapshots])
+
+    def create_snapshot(self, hostname, snapshotname):
+        '''Create a snapshot of the last backup, and its manifest.
+
+        :param str hostname: Name of the host.
+
+        :param str snapshotname: Name of the snapshot.
+
+        :rtype: None
+        '''
+        self.create_snapshots([(hostname, snapshotname)])
+        nabmanifest.write_tree_manifest(os.path.join(
+                self.get_snapshot_directory(hostname, snapshotname), 'data'),
+                self.get_manifest_path(hostname, snapshotname))
+        return None
+
+    def destroy_snapshots(self, hostname, snapshotnames):
+        '''Destroy snapshots of a host with a single "zfs destroy".
+        Snapshots that do not exist are skipped.
+
+        :param str hostname: Name of the host.
+
+        :param list snapshotnames: Names of the snapshots.
+
+        :rtype: list of str The names of the snapshots destroyed.
+        '''
+        existing = set(self.list_snapshots(hostname))
+        names = [x for x in snapshotnames if x in existing]
+        if not names:
+            return []
+        self.zfs(['destroy', '%s@%s' % (self.get_dataset(hostname),
+                ','.join(names))])
+        for name in names:
+            manifest = self.get_manifest_path(hostname, name)
+            if os.path.exists(manifest):
+                os.remove(manifest)
+        return names
+
+    def destroy_snapshot(self, hostname, snapshotname):
+        '''Destroy a snapshot.
+
+        :param str hostname: Name of the host.
+
+        :param str snapshotname: Name of the snapshot.
+
+        :rtype: None
+        '''
+        if not self.destroy_snapshots(hostname, [snapshotname]):
+            raise ValueError('Snapshot "%s" does not exist for host "%s"' %
+                    (snapshotname, hostname))
+
+    def mount_snapshot(self, hostname, snapshotname):
+        '''Mount a snapshot.  zfs mounts snapshots under the ".zfs"
+        directory when they are first accessed.
+
+        :param str hostname: Name of the host.
+
+        :param str snapshotname: Name of the snapshot.
+
+        :rtype: None
+        '''
+        directory = self.get_snapshot_directory(hostname, snapshotname)
+        if not os.path.isdir(directory):
+            raise ValueError('Snapshot "%s" does not exist for host "%s"' %
+                    (snapshotname, hostname))
+        os.listdir(directory)
+
+    def unmount_snapshot(self, hostname, snapshotname):
+        '''Unmount a snapshot (noop, zfs unmounts idle snapshots itself)
+
+        :param str hostname: Name of the host.
+
+        :param str snapshotname: Name of the snapshot.
+
+        :rtype: None
+        '''
+        return
+
+    def reclaimable_bytes(self, hostname, snapshotnames):
+        '''Return the bytes that destroying the snapshots would free, from
+        a dry-run "zfs destroy".
+
+        :param str hostname: Name of the host.
+
+        :param list snapshotnames: Names of the snapshots.
+
+        :rtype: int
+        '''
+        existing = set(self.list_snapshots(hostname))
+        names = [x for x in snapshotnames if x in existing]
+        if not names:
+            return 0
+        output = self.zfs(['destroy', '-n', '-p', '-v', '%s@%s' % (
+                self.get_dataset(hostname), ','.join(names))])
+        for line in output.splitlines():
+            fields = line.split('\t')
+            if fields[0] == 'reclaim':
+                return int(fields[1])
+        return 0
+
+    def storage_statistics(self, wait=True):
+        '''Get the space and inode counts of the storage.  Space is what
+        zfs reports for the file-system, which unlike "statvfs" includes
+        its snapshots, and the deduplication ratio is that of the pool.
+
+        :param boolean wait: (Default True)  Unused, nothing here waits
+                for other users of the storage.
+
+        :rtype: :py:class:`nabiostat.CapacityStatistics`
+        '''
+        properties = {}
+        for line in self.zfs(['get', '-H', '-p',
+                '-o', 'property,value', 'used,available',
+                self.filesystem]).splitlines():
+            name, value = line.split('\t')
+            properties[name] = int(value)
+        dedup = subprocess.check_output(['zpool', 'get', '-H', '-p',
+                '-o', 'value', 'dedupratio', self.pool]).strip()
+
+        statistics = nabiostat.capacity_statistics(self.mountpoint)
+        statistics.used_bytes = properties['used']
+        statistics.free_bytes = properties['available']
+        statistics.total_bytes = properties['used'] + properties['available']
+        statistics.dedup_ratio_percent = int(
+                round(float(dedup.rstrip('x')) * 100))
+        return statistics
+
+    def storage_usage(self):
+        '''Get the percentage utilization of the storage.
+
+        :rtype: int The percentage utilization of the storage.
+        '''
+        return self.storage_statistics().usage_percent()
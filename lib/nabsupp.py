@@ -8,8 +8,15 @@
 from nabdb import *
 import os
 import sys
+import shutil
+import tempfile
+import contextlib
 import subprocess
 import datetime
+import time
+import sqlite3
+import nabiostat
+import nabrsync
 
 
 def clear_stale_backup_pids(db, host=None):
@@ -22,20 +29,20 @@ def clear_stale_backup_pids(db, host=None):
 
     :rtype: None
     '''
+    from nabmodel import Backup
+
+    query = db.query(Backup).filter(Backup.backup_pid != None)
     if host:
-        hostlist = [host]
-    else:
-        hostlist = db.query(Host)
+        query = query.filter(Backup.host_id == host.id)
 
-    for host in hostlist:
-        for backup in host.backups_with_pids():
-            try:
-                os.kill(backup.backup_pid, 0)
-            except OSError, e:
-                if e.errno == 3:
-                    backup.backup_pid = None
-                    db.flush()
-                    db.commit()
+    for backup in query.all():
+        try:
+            os.kill(backup.backup_pid, 0)
+        except OSError, e:
+            if e.errno == 3:
+                backup.backup_pid = None
+                db.flush()
+                db.commit()
 
 
 def setup_syslog():
@@ -90,6 +97,136 @@ def log_exceptions(syslog=True, stderr=True, filename=None):
             filename=filename)
 
 
+def wait_for_idle_storage(storage_row, storage):
+    '''Wait for the device a storage is on to be less busy than the
+    "max_io_busy_percent" of the storage, if it is set.
+
+    :param Storage storage_row: Database record of the storage.
+
+    :param Object storage: Storage plugin instance for the storage.
+
+    :rtype: None
+    '''
+    if storage_row.max_io_busy_percent == None:
+        return
+    monitor = nabiostat.DeviceMonitor(storage.storage_path())
+    if not monitor.available():
+        return
+
+    start_time = datetime.datetime.now()
+    if not monitor.wait_until_idle(storage_row.max_io_busy_percent):
+        print 'Storage still busy after waiting, continuing anyway'
+    waited = datetime.datetime.now() - start_time
+    if waited > datetime.timedelta(seconds=10):
+        print 'Waited %s for storage I/O to drop below %s%%' % (
+                waited, storage_row.max_io_busy_percent)
+
+
+class PhaseTimer:
+    '''Measure the time spent in each phase of a backup.  Phases that are
+    entered more than once, such as database commits, are totalled.  For
+    example:
+
+        timer = PhaseTimer()
+        with timer.phase('transfer'):
+            run_rsync()
+        timer.record(db, backup)
+    '''
+
+    def __init__(self):
+        self.phases = []
+        self.totals = {}
+
+    def phase(self, name):
+        '''Return a context manager which times the phase `name`.
+
+        :param str name: Name of the phase.
+        '''
+
+        @contextlib.contextmanager
+        def timed_phase():
+            start_time = datetime.datetime.now()
+            start = time.time()
+            try:
+                yield
+            finally:
+                if name not in self.totals:
+                    self.phases.append((name, start_time))
+                    self.totals[name] = 0.0
+                self.totals[name] += time.time() - start
+        return timed_phase()
+
+    def record(self, db, backup):
+        '''Add :py:class:`BackupPhase` records for the timed phases.
+
+        :param Session db: Database session.
+
+        :param Backup backup: Backup that the phases were part of.
+
+        :rtype: None
+        '''
+        from nabmodel import BackupPhase
+
+        for name, start_time in self.phases:
+            db.add(BackupPhase(backup, name, start_time, self.totals[name]))
+
+
+class ProgressReporter:
+    '''Save the progress of a backup from an `RsyncOutputParser` to its
+    :py:class:`BackupProgress` record, at most once every `interval`
+    seconds.
+
+    :param Session db: Database session.
+
+    :param Backup backup: Backup being made.
+
+    :param int interval: (Default 10)  Minimum seconds between updates.
+
+    :param function clock: (Default `time.time`)  Source of the current
+            time, in seconds.
+    '''
+
+    def __init__(self, db, backup, interval=10, clock=time.time):
+        from nabmodel import BackupProgress
+
+        self.db = db
+        self.interval = interval
+        self.clock = clock
+        self.last_update = None
+        self.record = backup.progress
+        if self.record == None:
+            self.record = BackupProgress(backup)
+            db.add(self.record)
+
+    def __call__(self, parser, force=False):
+        '''Save the progress if `interval` has passed since the last save.
+
+        :param RsyncOutputParser parser: Parser with the current progress.
+
+        :param Boolean force: (Default False)  Save regardless of the time
+                since the last save.
+
+        :rtype: Boolean True if the progress was saved.
+        '''
+        now = self.clock()
+        if (not force and self.last_update != None
+                and now - self.last_update < self.interval):
+            return False
+        self.last_update = now
+        self.record.update_time = datetime.datetime.now()
+        self.record.bytes_transferred = parser.transferred_bytes()
+        self.record.percent = parser.progress_percent
+        if parser.progress_files != None:
+            self.record.files_transferred = parser.progress_files
+        else:
+            self.record.files_transferred = (parser.files_created
+                    + parser.files_updated)
+        self.record.files_total = parser.progress_total_files
+        self.record.last_item = parser.last_item
+        self.db.commit()
+        return True
+
+
 def run_backup_for_host(db, hostname):
     '''Code for performing the backup.  Returns True if the backup completed
     (successful or not).
@@ -100,46 +237,48 @@ def run_backup_for_host(db, hostname):
 
     :rtype: Boolean
     '''
-    from nabmodel import Host, Backup
-    import tempfile
-
-    host = db.query(Host).filter_by(hostname=hostname).first()
-    extra_rsync_arguments = []
-    if host.merged_configs(db).rsync_compression:
-        extra_rsync_arguments.append('-z')
-
-    if host.are_backups_currently_running(db):
-        sys.stderr.write('ERROR: Backups are already running.  Aborting.\n')
-        return False
-
-    if not host.active:
-        sys.stderr.write('This host is not enabled for backups '
-                '(active=False)\n')
-        return False
-
-    backup = Backup(host, host.find_backup_generation(db),
-            full_checksum=host.ready_for_checksum(db))
+    from nabmodel import Host, Backup, HostUsage, BackupStatistics
+    import nabcatalog
+
+    timer = PhaseTimer()
+    with timer.phase('setup'):
+        host = db.query(Host).filter_by(hostname=hostname).first()
+        extra_rsync_arguments = []
+        if host.merged_configs(db).rsync_compression:
+            extra_rsync_arguments.append('-z')
+
+        if host.are_backups_currently_running(db):
+            sys.stderr.write('ERROR: Backups are already running.  '
+                    'Aborting.\n')
+            return False
+
+        if not host.active:
+            sys.stderr.write('This host is not enabled for backups '
+                    '(active=False)\n')
+            return False
+
+    with timer.phase('generation'):
+        backup = Backup(host, host.find_backup_generation(db),
+                full_checksum=host.ready_for_checksum(db))
     backup.backup_pid = os.getpid()
     db.add(backup)
-    db.commit()
+    with timer.phase('commit'):
+        db.commit()
 
-    import nabstorageplugins
-    storage_plugin = getattr(nabstorageplugins,
-            host.storage.method)
-    storage = storage_plugin.Storage([
-                host.storage.arg1,
-                host.storage.arg2,
-                host.storage.arg3,
-                host.storage.arg4,
-                host.storage.arg5,
-            ])
-    if storage.rsync_inplace_compatible():
-        extra_rsync_arguments.append('--inplace')
-    backup.snapshot_name = storage.snapshot_name(host, backup)
-
-    os.chdir(storage.get_backup_top_directory(host.hostname))
-    subprocess.check_call(['rm', '-rf', 'logs'])
-    os.mkdir('logs')
+    with timer.phase('setup'):
+        storage = host.storage.get_plugin()
+        if storage.rsync_inplace_compatible():
+            extra_rsync_arguments.append('--inplace')
+        backup.snapshot_name = storage.snapshot_name(host, backup)
+        extra_rsync_arguments.extend(storage.get_rsync_arguments(
+                host.hostname, backup.snapshot_name,
+                host.find_previous_snapshot(db)))
+
+        topdir = os.path.abspath(storage.get_backup_top_directory(
+                host.hostname))
+        os.chdir(topdir)
+        subprocess.check_call(['rm', '-rf', 'logs'])
+        os.mkdir('logs')
 
     old_stdout = sys.stdout
     old_stderr = sys.stderr
@@ -147,7 +286,8 @@ def run_backup_for_host(db, hostname):
         sys.stdout = fp
         sys.stderr = fp
 
-        os.chdir('data')
+        os.chdir(storage.get_backup_destination(host.hostname,
+                backup.snapshot_name))
 
         if backup.full_checksum:
             print '*** DOING FULL CHECKSUM RUN ***'
@@ -155,12 +295,9 @@ def run_backup_for_host(db, hostname):
             extra_rsync_arguments.append('--ignore-times')
             backup.full_checksum = True
 
-        rules_tmp = tempfile.mkstemp()
-        with open(rules_tmp[1], 'w') as rules_fp:
-            rules_fp.write(host.get_filter_rules(db))
-        print repr(host.get_filter_rules(db))
-        rules_fp = open(rules_tmp[1], 'r')
-        os.unlink(rules_tmp[1])
+        with timer.phase('filter_rules'):
+            filter_rules = host.get_filter_rules(db)
+            print repr(filter_rules)
 
         print 'Backing up host %s' % host.hostname
         start_time = datetime.datetime.now()
@@ -170,41 +307,53 @@ def run_backup_for_host(db, hostname):
 
         backup.backup_pid = os.getpid()
 
-        db.commit()
+        with timer.phase('commit'):
+            db.commit()
 
         #  do not run remote rsync if hostname is 'localhost'
         #  mostly used for tests
         remote_part = ['-e', 'ssh -i %s'
-                % os.path.join('..', 'keys', 'backup-identity')]
+                % os.path.join(topdir, 'keys', 'backup-identity')]
         source = 'root@%s:/' % host.hostname
         if host.hostname == 'localhost':
             remote_part = []
             source = '/'
 
-        with open(os.path.join('..', 'logs', 'rsync.out'), 'w') as rsync_fp:
-            backup.harness_returncode = subprocess.call([
-                    'rsync',
-                    '-av',
-                    ] + remote_part + [
-                    '--delete', '--delete-excluded',
-                    '--filter=merge -',
-                    '--ignore-errors',
-                    '--hard-links',
-                    '--itemize-changes',
-                    '--timeout=3600',
-                    '--numeric-ids',
-                    ] + extra_rsync_arguments + [
-                    source,
-                    '.'
-                    ],
-                    stdin=rules_fp,
-                    stdout=rsync_fp, stderr=rsync_fp)
+        progress = ProgressReporter(db, backup)
+        parser = nabrsync.RsyncOutputParser(progress=progress)
+        with timer.phase('transfer'):
+            with open(os.path.join(topdir, 'logs', 'rsync.out'),
+                    'w') as rsync_fp:
+                backup.harness_returncode = nabrsync.run_rsync([
+                        'rsync',
+                        '-av',
+                        ] + remote_part + [
+                        '--delete', '--delete-excluded',
+                        '--filter=merge -',
+                        '--ignore-errors',
+                        '--hard-links',
+                        '--itemize-changes',
+                        '--out-format=%s' % nabrsync.OUT_FORMAT,
+                        '--stats',
+                        '--info=progress2',
+                        '--timeout=3600',
+                        '--numeric-ids',
+                        ] + extra_rsync_arguments + [
+                        source,
+                        '.'
+                        ],
+                        parser, rsync_fp, input=filter_rules)
         end_time = datetime.datetime.now()
-        rsync_fp.close()
+        progress(parser, force=True)
+
+        statistics = BackupStatistics(backup)
+        parser.fill(statistics)
+        db.add(statistics)
 
         backup.successful = backup.harness_returncode in [0, 23, 24]
         backup.backup_pid = None
-        db.commit()
+        with timer.phase('commit'):
+            db.commit()
 
         print 'RSYNC_RETURNCODE=%s' % backup.harness_returncode
         print 'Completed rsync on %s' % (
@@ -215,13 +364,31 @@ def run_backup_for_host(db, hostname):
         print 'Starting snapshot on %s' % (
                 start_time.strftime('%a %b %d, %Y at %H:%M:%S'))
 
-        storage.create_snapshot(host.hostname, backup.snapshot_name)
+        with timer.phase('storage_wait'):
+            wait_for_idle_storage(host.storage, storage)
+        with timer.phase('snapshot'):
+            snapshot_statistics = storage.create_snapshot(host.hostname,
+                    backup.snapshot_name)
+        if snapshot_statistics != None:
+            print snapshot_statistics.summary()
+        with timer.phase('catalog'):
+            try:
+                nabcatalog.update_catalog(storage, host.hostname,
+                        [backup.snapshot_name])
+            except (sqlite3.Error, OSError, ValueError), e:
+                #  the backup is good even if it cannot be found by name
+                print ('WARNING: Could not add the snapshot to the '
+                        'catalog: %s' % e)
 
         end_time = datetime.datetime.now()
         print 'Completed snapshot on %s' % (
                 end_time.strftime('%a %b %d, %Y at %H:%M:%S'))
 
         backup.end_time = end_time
+        HostUsage.record_runtime(db, host, end_time - backup.start_time)
+        with timer.phase('commit'):
+            db.commit()
+        timer.record(db, backup)
         db.commit()
 
     sys.stdout = old_stdout
@@ -257,6 +424,24 @@ def run_command(args):
     return Return(stdout, stderr, exitcode)
 
 
+def format_bytes(count):
+    '''Format a number of bytes for people, such as "1.5G".
+
+    :param int count: Number of bytes, or None.
+
+    :rtype: str
+    '''
+    if count == None:
+        return '-'
+    for suffix in ['', 'K', 'M', 'G', 'T']:
+        if abs(count) < 1024 or suffix == 'T':
+            break
+        count /= 1024.0
+    if suffix == '':
+        return '%d' % count
+    return '%.1f%s' % (count, suffix)
+
+
 def get_storage_plugin(name):
     '''Return the Storage() class for the specified plugin.
 
@@ -268,3 +453,59 @@ def get_storage_plugin(name):
     '''
     import nabstorageplugins
     return getattr(nabstorageplugins, name)
+
+
+def snapshot_data_directory(plugin, hostname, snapshotname):
+    '''Mount a snapshot and return the directory of its backed up files.
+
+    :param Storage plugin: Storage plugin of the host.
+
+    :param str hostname: Name of the host.
+
+    :param str snapshotname: Name of the snapshot.
+
+    :rtype: str
+    '''
+    plugin.mount_snapshot(hostname, snapshotname)
+    directory = os.path.join(plugin.get_snapshot_directory(hostname,
+            snapshotname), 'data')
+    if not os.path.isdir(directory):
+        raise ValueError('Snapshot "%s" does not exist for host "%s"' %
+                (snapshotname, hostname))
+    return directory
+
+
+@contextlib.contextmanager
+def snapshot_data(plugin, hostname, snapshotname, paths=None):
+    '''Context manager giving the directory of the backed up files of a
+    snapshot while it is in use.  Storage which has to restore a snapshot
+    to read it, such as chunks, only restores the paths asked for, to a
+    temporary directory which is removed afterwards.  Other storage mounts
+    the snapshot, and unmounts it afterwards.  For example:
+
+        with snapshot_data(plugin, 'example.com', snapshot) as directory:
+            nabrestore.restore(directory, '/tmp/restore')
+
+    :param Storage plugin: Storage plugin of the host.
+
+    :param str hostname: Name of the host.
+
+    :param str snapshotname: Name of the snapshot.
+
+    :param list paths: (Default None)  Paths relative to the top of the
+            snapshot which will be read, or None for all of it.
+    '''
+    if hasattr(plugin, 'extract_snapshot'):
+        directory = tempfile.mkdtemp(prefix='extract-',
+                dir=plugin.get_backup_top_directory(hostname))
+        try:
+            plugin.extract_snapshot(hostname, snapshotname, directory, paths)
+            yield directory
+        finally:
+            shutil.rmtree(directory)
+        return
+
+    try:
+        yield snapshot_data_directory(plugin, hostname, snapshotname)
+    finally:
+        plugin.unmount_snapshot(hostname, snapshotname)
@@ -0,0 +1,169 @@
+#!/usr/bin/env python
+#
+#  Copyright (c) 2012, Sean Reifschneider, tummy.com, ltd.
+#  All Rights Reserved.
+
+#  allow the test to be run from the "tests" or "tests" parent directory
+import sys
+import os
+if os.path.basename(os.getcwd()) == 'tests':
+    sys.path.append('../lib')
+else:
+    sys.path.append('./lib')
+
+import unittest
+import subprocess
+import nabaccounting
+
+
+def size(path):
+    return os.lstat(path).st_blocks * 512
+
+
+class TestAccounting(unittest.TestCase):
+
+    def setUp(self):
+        self.testdir = '/tmp/nabaccountingtest'
+        subprocess.call(['rm', '-rf', self.testdir])
+        os.mkdir(self.testdir)
+        self.cache = os.path.join(self.testdir, 'cache')
+
+    def tearDown(self):
+        subprocess.call(['rm', '-rf', self.testdir])
+
+    def make_snapshot(self, name, files, links):
+        path = os.path.join(self.testdir, name)
+        os.mkdir(path)
+        for filename in files:
+            with open(os.path.join(path, filename), 'w') as fp:
+                fp.write(filename * 8192)
+        for source, filename in links:
+            os.link(os.path.join(self.testdir, source),
+                    os.path.join(path, filename))
+        return (name, path)
+
+    def test_ScanTree(self):
+        '''Inode tables of a tree, and saving them.'''
+
+        name, path = self.make_snapshot('s1', ['a', 'b'], [])
+        os.link(os.path.join(path, 'a'), os.path.join(path, 'a2'))
+        os.mkdir(os.path.join(path, 'sub'))
+        table = nabaccounting.scan_tree(path)
+        self.assertEqual(len(table), 4)
+        self.assertEqual(list(table.inodes), sorted(table.inodes))
+        st = os.lstat(os.path.join(path, 'a'))
+        self.assertEqual(table.links[list(table.inodes).index(st.st_ino)], 2)
+        self.assertEqual(table.total_bytes(), size(path)
+                + size(os.path.join(path, 'a')) + size(os.path.join(path, 'b'))
+                + size(os.path.join(path, 'sub')))
+
+        filename = os.path.join(self.testdir, 'table')
+        table.save(filename, (1, 2, 3))
+        self.assertEqual(nabaccounting.InodeTable.load(filename, (1, 2, 4)),
+                None)
+        loaded = nabaccounting.InodeTable.load(filename, (1, 2, 3))
+        self.assertEqual(loaded.inodes, table.inodes)
+        self.assertEqual(loaded.links, table.links)
+        self.assertEqual(loaded.sizes, table.sizes)
+        self.assertEqual(loaded.external, table.external)
+        self.assertEqual(nabaccounting.InodeTable.load(filename + '.missing',
+                (1, 2, 3)), None)
+
+        #  the same table is merged from several sorted runs
+        run_entries = nabaccounting.RUN_ENTRIES
+        nabaccounting.RUN_ENTRIES = 2
+        try:
+            merged = nabaccounting.scan_tree(path)
+        finally:
+            nabaccounting.RUN_ENTRIES = run_entries
+        self.assertEqual((merged.inodes, merged.links, merged.sizes,
+                merged.external), (table.inodes, table.links, table.sizes,
+                table.external))
+
+    def test_AccountSnapshots(self):
+        '''Exclusive and shared bytes of snapshots, rescanning only new
+        snapshots.'''
+
+        s1 = self.make_snapshot('s1', ['a', 'b'], [])
+        s2 = self.make_snapshot('s2', ['c'], [('s1/b', 'b')])
+        path1 = s1[1]
+        path2 = s2[1]
+
+        report = nabaccounting.account_snapshots([s1, s2], self.cache)
+        self.assertEqual((report.scanned, report.reused), (2, 0))
+        self.assertEqual([x.name for x in report.snapshots], ['s1', 's2'])
+        self.assertEqual(report.snapshots[0].exclusive_bytes,
+                size(path1) + size(os.path.join(path1, 'a')))
+        self.assertEqual(report.snapshots[0].shared_bytes,
+                size(os.path.join(path1, 'b')))
+        self.assertEqual(report.snapshots[1].exclusive_bytes,
+                size(path2) + size(os.path.join(path2, 'c')))
+        self.assertEqual(report.used_by_dataset,
+                report.snapshots[1].total_bytes)
+        self.assertEqual(report.used_by_snapshots,
+                report.snapshots[0].exclusive_bytes)
+
+        #  the newest snapshot is also linked from elsewhere
+        report = nabaccounting.account_snapshots([s1, s2], self.cache,
+                mirror_newest=True)
+        self.assertEqual((report.scanned, report.reused), (0, 2))
+        self.assertEqual(report.snapshots[1].exclusive_bytes, 0)
+
+        s3 = self.make_snapshot('s3', [], [('s2/c', 'c')])
+        report = nabaccounting.account_snapshots([s1, s2, s3], self.cache,
+                removing=['s1', 's2'])
+        self.assertEqual((report.scanned, report.reused), (1, 2))
+        self.assertEqual(report.snapshots[1].exclusive_bytes, size(path2))
+        #  "b" is only linked from the two snapshots being removed
+        self.assertEqual(report.removable_bytes,
+                report.snapshots[0].exclusive_bytes
+                + report.snapshots[1].exclusive_bytes
+                + size(os.path.join(path1, 'b')))
+        self.assertEqual(nabaccounting.account_snapshots([s1, s2, s3],
+                self.cache).removable_bytes, None)
+
+        #  removed snapshots are forgotten, replaced ones rescanned
+        subprocess.call(['rm', '-rf', path2])
+        s2 = self.make_snapshot('s2', [], [])
+        report = nabaccounting.account_snapshots([s2, s3], self.cache)
+        self.assertEqual((report.scanned, report.reused), (1, 1))
+        self.assertEqual(sorted(os.listdir(self.cache)),
+                ['s2.inodes', 's3.inodes'])
+        self.assertEqual(report.snapshots[1].exclusive_bytes,
+                report.snapshots[1].total_bytes)
+
+        report = nabaccounting.account_snapshots([], self.cache)
+        self.assertEqual(report.snapshots, [])
+        self.assertEqual(os.listdir(self.cache), [])
+
+    def test_ExternalLinks(self):
+        '''Inodes also linked from outside the snapshots are shared.'''
+
+        s1 = self.make_snapshot('s1', ['a', 'b'], [])
+        os.mkdir(os.path.join(self.testdir, 'other'))
+        os.link(os.path.join(self.testdir, 's1', 'b'),
+                os.path.join(self.testdir, 'other', 'b'))
+        s2 = self.make_snapshot('s2', [], [('s1/a', 'a'), ('s1/b', 'b')])
+        b = size(os.path.join(s1[1], 'b'))
+
+        report = nabaccounting.account_snapshots([s1, s2], self.cache,
+                removing=['s1', 's2'])
+        self.assertEqual(report.snapshots[0].exclusive_bytes, size(s1[1]))
+        self.assertEqual(report.removable_bytes, size(s1[1]) + size(s2[1])
+                + size(os.path.join(s1[1], 'a')))
+
+        #  the external links are kept as snapshots are removed
+        subprocess.call(['rm', '-rf', s1[1]])
+        s3 = self.make_snapshot('s3', [], [('s2/a', 'a')])
+        report = nabaccounting.account_snapshots([s2, s3], self.cache)
+        self.assertEqual((report.scanned, report.reused), (1, 1))
+        self.assertEqual(report.snapshots[0].exclusive_bytes, size(s2[1]))
+        self.assertEqual(report.snapshots[0].shared_bytes,
+                b + size(os.path.join(s2[1], 'a')))
+        report = nabaccounting.account_snapshots([s2], self.cache)
+        self.assertEqual(report.snapshots[0].exclusive_bytes, size(s2[1])
+                + size(os.path.join(s2[1], 'a')))
+
+
+if __name__ == '__main__':
+    print unittest.main()
@@ -0,0 +1,243 @@
+#!/usr/bin/env python
+#
+#  Copyright (c) 2012, Sean Reifschneider, tummy.com, ltd.
+#  All Rights Reserved.
+
+#  allow the test to be run from the "tests" or "tests" parent directory
+import sys
+import os
+if os.path.basename(os.getcwd()) == 'tests':
+    sys.path.append('../lib')
+else:
+    sys.path.append('./lib')
+
+import unittest
+import subprocess
+import nabmanifest
+import nabcatalog
+from nabstorageplugins import hardlinks
+
+DIRECTORY = 040755
+FILE = 0100644
+
+
+class TestCatalog(unittest.TestCase):
+    def setUp(self):
+        self.testdir = '/tmp/nabcatalogtest'
+        subprocess.call(['rm', '-rf', self.testdir])
+        os.mkdir(self.testdir)
+        self.catalog = nabcatalog.Catalog(os.path.join(self.testdir,
+                'catalog.sqlite'))
+
+    def tearDown(self):
+        self.catalog.close()
+        subprocess.call(['rm', '-rf', self.testdir])
+
+    def manifest(self, name, entries):
+        filename = os.path.join(self.testdir, name)
+        writer = nabmanifest.ManifestWriter(filename)
+        for entry in entries:
+            writer.add(*entry)
+        writer.close()
+        return filename
+
+    def add(self, name, entries, previous=True):
+        last = self.catalog.last_snapshot()
+        previous_manifest = None
+        if previous and last != None:
+            previous_manifest = os.path.join(self.testdir, last[1])
+        return self.catalog.add_snapshot(name, self.manifest(name, entries),
+                previous_manifest)
+
+    def versions(self, path):
+        return [(x.size, x.snapshots) for x in self.catalog.versions(path)]
+
+    def found(self, pattern, **kwargs):
+        return [(x.path, x.snapshots, x.first, x.last)
+                for x in self.catalog.find(pattern, **kwargs)]
+
+    def populate(self, previous=True):
+        etc = ('etc', 1, 0, 100, DIRECTORY)
+        nginx = ('etc/nginx', 2, 0, 100, DIRECTORY)
+        self.add('snap1', [etc, nginx, ('etc/nginx/nginx.conf', 3, 10, 100,
+                FILE), ('etc/passwd', 4, 20, 100, FILE)], previous)
+        statistics = self.add('snap2', [etc, nginx,
+                ('etc/nginx/Default.conf', 5, 30, 100, FILE),
+                ('etc/nginx/nginx.conf', 3, 10, 100, FILE),
+                ('etc/passwd', 6, 21, 200, FILE)], previous)
+        self.assertEqual((statistics.added, statistics.modified,
+                statistics.removed), (1, 1, 0))
+        self.add('snap3', [etc, ('etc/passwd', 6, 21, 200, FILE)], previous)
+        self.add('snap4', [etc, nginx, ('etc/nginx/nginx.conf', 7, 11, 300,
+                FILE), ('etc/passwd', 6, 21, 200, FILE)], previous)
+
+    def test_Patterns(self):
+        '''Splitting patterns into literals.'''
+
+        self.assertEqual(nabcatalog.pattern_literals('*.conf'),
+                ['', '.conf'])
+        self.assertEqual(nabcatalog.pattern_literals('etc/ng?nx/[abc]x*'),
+                ['etc/ng', 'nx/', 'x', ''])
+        self.assertEqual(nabcatalog.pattern_literals('a[b'), ['a[b'])
+        self.assertEqual(nabcatalog.trigrams('NGinx'),
+                set(['ngi', 'gin', 'inx']))
+
+    def test_Versions(self):
+        '''Version ranges, through changes, removals and reappearances.'''
+
+        self.populate()
+        self.assertEqual(self.catalog.snapshot_names(),
+                ['snap1', 'snap2', 'snap3', 'snap4'])
+        self.assertEqual(self.versions('/etc/passwd'), [
+                (20, ['snap1']), (21, ['snap2', 'snap3', 'snap4'])])
+        self.assertEqual(self.versions('etc/nginx/nginx.conf'), [
+                (10, ['snap1', 'snap2']), (11, ['snap4'])])
+        self.assertEqual(self.versions('etc/nginx'), [
+                (0, ['snap1', 'snap2']), (0, ['snap4'])])
+        self.assertEqual(self.versions('etc/missing'), [])
+        self.assertEqual(self.versions('missing/etc'), [])
+        self.assertRaises(ValueError, self.add, 'snap4', [])
+
+        #  the same catalog is built without the previous manifests
+        expected = [(x, self.versions(x)) for x in ['etc', 'etc/passwd',
+                'etc/nginx', 'etc/nginx/nginx.conf', 'etc/nginx/Default.conf']]
+        self.catalog.close()
+        subprocess.call(['rm', '-rf', self.testdir])
+        self.setUp()
+        self.populate(previous=False)
+        self.assertEqual([(x, self.versions(x)) for x in ['etc', 'etc/passwd',
+                'etc/nginx', 'etc/nginx/nginx.conf',
+                'etc/nginx/Default.conf']], expected)
+
+    def test_Find(self):
+        '''Finding paths by name and by whole path.'''
+
+        self.populate()
+        self.assertEqual(self.found('nginx.conf'), [
+                ('etc/nginx/nginx.conf', 3, 'snap1', 'snap4')])
+        self.assertEqual(self.found('*.conf'), [
+                ('etc/nginx/Default.conf', 1, 'snap2', 'snap2'),
+                ('etc/nginx/nginx.conf', 3, 'snap1', 'snap4')])
+        self.assertEqual(self.found('default*'), [])
+        self.assertEqual(self.found('default*', ignore_case=True), [
+                ('etc/nginx/Default.conf', 1, 'snap2', 'snap2')])
+        self.assertEqual(self.found('/etc/*/nginx*'), [
+                ('etc/nginx/nginx.conf', 3, 'snap1', 'snap4')])
+        self.assertEqual(self.found('etc/*'), [('etc/nginx', 3, 'snap1',
+                'snap4'), ('etc/nginx/Default.conf', 1, 'snap2', 'snap2'),
+                ('etc/nginx/nginx.conf', 3, 'snap1', 'snap4'),
+                ('etc/passwd', 4, 'snap1', 'snap4')])
+        self.assertEqual(self.found('p*', limit=1), [('etc/passwd', 4,
+                'snap1', 'snap4')])
+        self.assertEqual(self.found('*', limit=2), [('etc', 4, 'snap1',
+                'snap4'), ('etc/nginx', 3, 'snap1', 'snap4')])
+
+        #  only the paths under the directory before a wildcard are read
+        self.add('snap5', [('etc', 1, 0, 100, DIRECTORY),
+                ('etc/nginx', 2, 0, 100, DIRECTORY),
+                ('etc/nginx/nginx.conf', 7, 11, 300, FILE),
+                ('var', 8, 0, 100, DIRECTORY),
+                ('var/nginx.conf', 9, 12, 100, FILE)])
+        read = []
+        path_string = self.catalog.path_string
+
+        def record(path_id):
+            path = path_string(path_id)
+            read.append(path)
+            return path
+        self.catalog.path_string = record
+        self.assertEqual(self.found('etc/nginx/*'), [
+                ('etc/nginx/Default.conf', 1, 'snap2', 'snap2'),
+                ('etc/nginx/nginx.conf', 4, 'snap1', 'snap5')])
+        self.assertEqual(sorted(read), ['etc/nginx/Default.conf',
+                'etc/nginx/nginx.conf'])
+        self.assertEqual(self.found('etc/nginx/nginx.conf'), [
+                ('etc/nginx/nginx.conf', 4, 'snap1', 'snap5')])
+        self.assertEqual(self.found('etc/missing/*'), [])
+        self.assertEqual(self.found('*/nginx.conf'), [
+                ('etc/nginx/nginx.conf', 4, 'snap1', 'snap5'),
+                ('var/nginx.conf', 1, 'snap5', 'snap5')])
+        self.assertEqual(self.found('ETC/NGINX/N*', ignore_case=True), [
+                ('etc/nginx/nginx.conf', 4, 'snap1', 'snap5')])
+
+    def test_Remove(self):
+        '''Removing old, middle and newest snapshots.'''
+
+        self.populate()
+        self.assertEqual(self.catalog.remove_snapshots(['snap2', 'other']),
+                1)
+        self.assertEqual(self.versions('etc/nginx/Default.conf'), [])
+        self.assertEqual(self.versions('etc/nginx/nginx.conf'), [
+                (10, ['snap1']), (11, ['snap4'])])
+        self.assertEqual(self.found('*.conf'), [
+                ('etc/nginx/nginx.conf', 2, 'snap1', 'snap4')])
+
+        #  removing the newest rewinds, and the next snapshot follows on
+        self.catalog.remove_snapshots(['snap4'])
+        self.assertEqual(self.versions('etc/nginx/nginx.conf'), [
+                (10, ['snap1'])])
+        self.add('snap5', [('etc', 1, 0, 100, DIRECTORY),
+                ('etc/passwd', 6, 21, 200, FILE)])
+        self.assertEqual(self.versions('etc/passwd'), [
+                (20, ['snap1']), (21, ['snap3', 'snap5'])])
+
+        self.catalog.remove_snapshots(['snap1', 'snap3', 'snap5'])
+        self.assertEqual(self.catalog.db.execute('SELECT COUNT(*) FROM '
+                'versions').fetchone()[0], 0)
+
+    def test_Storage(self):
+        '''Updating the catalog of a host from its snapshots.'''
+
+        storage = hardlinks.Storage([self.testdir, None, None, None, None])
+        storage.create_host('example.com')
+        data = os.path.join(self.testdir, 'example.com', 'data')
+        for name, contents in [('snap1', 'first\n'), ('snap2', 'second\n')]:
+            with open(os.path.join(data, 'file'), 'w') as fp:
+                fp.write(contents)
+            storage.create_snapshot('example.com', name)
+
+        self.assertEqual(nabcatalog.update_catalog(storage, 'example.com',
+                ['snap1', 'snap2', 'missing']), 2)
+        self.assertEqual(nabcatalog.update_catalog(storage, 'example.com',
+                ['snap1', 'snap2']), 0)
+        catalog = nabcatalog.open_catalog(storage, 'example.com')
+        try:
+            self.assertEqual([(x.size, x.snapshots)
+                    for x in catalog.versions('file')],
+                    [(6, ['snap1']), (7, ['snap2'])])
+        finally:
+            catalog.close()
+        self.assertEqual(nabcatalog.remove_from_catalog(storage,
+                'example.com', ['snap1']), 1)
+
+    def test_Backfill(self):
+        '''Adding snapshots older than those already in the catalog.'''
+
+        storage = hardlinks.Storage([self.testdir, None, None, None, None])
+        storage.create_host('example.com')
+        data = os.path.join(self.testdir, 'example.com', 'data')
+        names = ['snap1', 'snap2', 'snap3']
+        for name, contents in zip(names, ['1\n', '22\n', '333\n']):
+            with open(os.path.join(data, 'file'), 'w') as fp:
+                fp.write(contents)
+            storage.create_snapshot('example.com', name)
+
+        #  the newest is cataloged by its backup, the older ones later
+        self.assertEqual(nabcatalog.update_catalog(storage, 'example.com',
+                ['snap3']), 1)
+        self.assertEqual(nabcatalog.update_catalog(storage, 'example.com',
+                ['snap1', 'snap3']), 1)
+        self.assertEqual(nabcatalog.update_catalog(storage, 'example.com',
+                names), 1)
+        catalog = nabcatalog.open_catalog(storage, 'example.com')
+        try:
+            self.assertEqual(catalog.snapshot_names(), names)
+            self.assertEqual([(x.size, x.snapshots)
+                    for x in catalog.versions('file')],
+                    [(2, ['snap1']), (3, ['snap2']), (4, ['snap3'])])
+        finally:
+            catalog.close()
+
+
+if __name__ == '__main__':
+    print unittest.main()
@@ -0,0 +1,377 @@
+#!/usr/bin/env python
+#
+#  Copyright (c) 2012, Sean Reifschneider, tummy.com, ltd.
+#  All Rights Reserved.
+
+#  allow the test to be run from the "tests" or "tests" parent directory
+import sys
+import os
+import stat
+import errno
+if os.path.basename(os.getcwd()) == 'tests':
+    sys.path.append('../lib')
+else:
+    sys.path.append('./lib')
+
+import unittest
+import random
+import zlib
+import StringIO
+import subprocess
+import nabmanifest
+import nabchunkstore
+import nabdiff
+import nabsupp
+from nabstorageplugins import chunks
+
+
+def random_data(size, seed):
+    generator = random.Random(seed)
+    return ''.join([chr(generator.randint(0, 255)) for x in xrange(size)])
+
+
+def write(path, data):
+    directory = os.path.dirname(path)
+    if not os.path.exists(directory):
+        os.makedirs(directory)
+    with open(path, 'wb') as fp:
+        fp.write(data)
+
+
+def read(path):
+    with open(path, 'rb') as fp:
+        return fp.read()
+
+
+class TestChunkStore(unittest.TestCase):
+    def setUp(self):
+        self.testdir = '/tmp/nabchunkstoretest'
+        subprocess.call(['rm', '-rf', self.testdir])
+        os.mkdir(self.testdir)
+        self.top = os.path.join(self.testdir, 'data')
+        os.mkdir(self.top)
+        self.store = nabchunkstore.ChunkStore(os.path.join(self.testdir,
+                'store'), pack_size=256 * 1024)
+
+    def tearDown(self):
+        self.store.close()
+        subprocess.call(['rm', '-rf', self.testdir])
+
+    def tree(self, name):
+        return os.path.join(self.testdir, name + '.tree')
+
+    def test_Chunking(self):
+        '''Chunk boundaries follow the contents, not the offsets.'''
+
+        data = random_data(600 * 1024, 1)
+        chunks = list(nabchunkstore.chunk_file(StringIO.StringIO(data)))
+        self.assertEqual(''.join(chunks), data)
+        self.assertEqual(len(chunks) > 3, True)
+        for chunk in chunks[:-1]:
+            self.assertEqual(nabchunkstore.MIN_CHUNK_SIZE <= len(chunk) <=
+                    nabchunkstore.MAX_CHUNK_SIZE, True)
+
+        #  inserting bytes near the start only changes the first chunk
+        changed = list(nabchunkstore.chunk_file(StringIO.StringIO(
+                data[:1000] + 'inserted' + data[1000:])))
+        self.assertEqual(changed[1:], chunks[1:])
+        self.assertNotEqual(changed[0], chunks[0])
+
+        #  and boundaries do not depend on where the chunk started
+        shifted = list(nabchunkstore.chunk_file(StringIO.StringIO(
+                data[len(chunks[0]) - 20000:])))
+        self.assertEqual(shifted[1:], chunks[1:])
+
+        self.assertEqual(list(nabchunkstore.chunk_file(
+                StringIO.StringIO(''))), [])
+        self.assertEqual(list(nabchunkstore.chunk_file(
+                StringIO.StringIO('small'))), ['small'])
+
+    def test_Tree(self):
+        '''Writing and reading trees, including records of large files.'''
+
+        entries = [nabchunkstore.TreeEntry('a', 040755, 0, 0, 0, 10, 11, 2),
+                nabchunkstore.TreeEntry('a/big', 0100644, 1000, 100,
+                    10 ** 10, -5, 12, 3,
+                    ['%020d' % x for x in range(10000)]),
+                nabchunkstore.TreeEntry('a/link', 0120777, 0, 0, 4, 10, 11,
+                    4, link='big'),
+                nabchunkstore.TreeEntry('a/null', 020666, 0, 0, 0, 10, 11,
+                    6, rdev=os.makedev(1, 3)),
+                nabchunkstore.TreeEntry('a/zero', 0100600, 0, 0, 0, 10, 11,
+                    5, nlink=2)]
+        writer = nabchunkstore.TreeWriter(self.tree('t'))
+        for entry in entries:
+            writer.add(entry)
+        writer.close()
+
+        entries_read = list(nabchunkstore.read_tree(self.tree('t')))
+        self.assertEqual([(x.path, x.mode, x.uid, x.gid, x.size, x.mtime,
+                x.ctime, x.inode, list(x.chunks), x.link, x.nlink, x.rdev)
+                for x in entries_read], [(x.path, x.mode, x.uid, x.gid,
+                x.size, x.mtime, x.ctime, x.inode, list(x.chunks), x.link,
+                x.nlink, x.rdev) for x in entries])
+        self.assertEqual(len(nabchunkstore.tree_chunk_counts(
+                self.tree('t'))), 10000)
+
+        #  trees written before link counts and devices were recorded
+        record = ''.join([nabmanifest.encode_number(x)
+                for x in (0, 1)]) + 'a' + ''.join([
+                nabmanifest.encode_number(x) for x in (0100644, 0, 0, 5)]) + \
+                nabmanifest.encode_signed(10) + \
+                nabmanifest.encode_signed(11) + ''.join([
+                nabmanifest.encode_number(x) for x in (7, 1)]) + 'c' * 20
+        with open(self.tree('v1'), 'wb') as fp:
+            fp.write(nabchunkstore.TREE_MAGIC_V1 + zlib.compress(
+                    nabmanifest.encode_number(len(record)) + record))
+        entry, = nabchunkstore.read_tree(self.tree('v1'))
+        self.assertEqual((entry.path, entry.size, entry.ctime, entry.inode,
+                entry.chunks, entry.nlink, entry.rdev),
+                ('a', 5, 11, 7, ['c' * 20], 0, 0))
+
+    def test_Snapshot(self):
+        '''Snapshots share chunks, skip unchanged files and restore.'''
+
+        big = random_data(512 * 1024, 2)
+        write(os.path.join(self.top, 'big'), big)
+        write(os.path.join(self.top, 'dir', 'small'), 'small file\n')
+        os.symlink('big', os.path.join(self.top, 'dir', 'link'))
+        os.chmod(os.path.join(self.top, 'dir', 'small'), 0640)
+        os.link(os.path.join(self.top, 'dir', 'small'),
+                os.path.join(self.top, 'dir', 'small2'))
+        os.mkfifo(os.path.join(self.top, 'dir', 'fifo'), 0600)
+
+        statistics = self.store.snapshot(self.top, self.tree('snap1'),
+                os.path.join(self.testdir, 'manifest1'))
+        self.assertEqual((statistics.files, statistics.files_read), (3, 3))
+        self.assertEqual(statistics.bytes_read, len(big) + 22)
+        self.assertEqual([x.path for x in nabmanifest.read_manifest(
+                os.path.join(self.testdir, 'manifest1'))],
+                ['big', 'dir', 'dir/fifo', 'dir/link', 'dir/small',
+                'dir/small2'])
+        logical, stored = self.store.usage()
+        self.assertEqual(logical, len(big) + 22)
+        self.assertEqual(stored, statistics.bytes_stored)
+
+        mtime = int(os.stat(os.path.join(self.top, 'big')).st_mtime)
+
+        #  unchanged files are not read, a changed file shares its chunks
+        big2 = big[:100] + 'changed' + big[100:]
+        write(os.path.join(self.top, 'big'), big2)
+        statistics = self.store.snapshot(self.top, self.tree('snap2'),
+                previous_tree=self.tree('snap1'))
+        self.assertEqual((statistics.files, statistics.files_read), (3, 1))
+        self.assertEqual(statistics.chunks_stored, 1)
+        self.assertEqual(statistics.bytes_stored < len(big) / 2, True)
+
+        restored = os.path.join(self.testdir, 'restored')
+        statistics = self.store.restore(self.tree('snap1'), restored)
+        self.assertEqual((statistics.files, statistics.hardlinks,
+                statistics.directories, statistics.symlinks,
+                statistics.skipped), (2, 1, 1, 1, 0))
+        self.assertEqual(statistics.bytes, len(big) + 11)
+        self.assertEqual(read(os.path.join(restored, 'big')), big)
+        self.assertEqual(read(os.path.join(restored, 'dir', 'small')),
+                'small file\n')
+        self.assertEqual(os.stat(os.path.join(restored, 'dir',
+                'small2')).st_ino, os.stat(os.path.join(restored, 'dir',
+                'small')).st_ino)
+        self.assertEqual(stat.S_ISFIFO(os.stat(os.path.join(restored, 'dir',
+                'fifo')).st_mode), True)
+        self.assertEqual(os.readlink(os.path.join(restored, 'dir', 'link')),
+                'big')
+        self.assertEqual(os.stat(os.path.join(restored, 'dir',
+                'small')).st_mode & 0777, 0640)
+        self.assertEqual(int(os.stat(os.path.join(restored, 'big')).st_mtime),
+                mtime)
+        self.store.restore(self.tree('snap2'), os.path.join(self.testdir,
+                'restored2'))
+        self.assertEqual(read(os.path.join(self.testdir, 'restored2',
+                'big')), big2)
+
+        #  only the paths asked for, and the directories above them
+        restored = os.path.join(self.testdir, 'restored3')
+        statistics = self.store.restore(self.tree('snap1'), restored,
+                ['dir/small'])
+        self.assertEqual((statistics.files, statistics.directories), (1, 1))
+        self.assertEqual(os.listdir(restored), ['dir'])
+        self.assertEqual(os.listdir(os.path.join(restored, 'dir')),
+                ['small'])
+
+        #  special files which cannot be created are counted
+        def mknod(*args):
+            raise OSError(errno.EPERM, 'Operation not permitted')
+        original = os.mknod
+        os.mknod = mknod
+        try:
+            statistics = self.store.restore(self.tree('snap1'),
+                    os.path.join(self.testdir, 'restored4'), ['dir'])
+        finally:
+            os.mknod = original
+        self.assertEqual((statistics.files, statistics.hardlinks,
+                statistics.skipped), (1, 1, 1))
+
+    def test_CollectGarbage(self):
+        '''Removing snapshots, then removing and rewriting packs.'''
+
+        write(os.path.join(self.top, 'a'), random_data(300 * 1024, 3))
+        self.store.snapshot(self.top, self.tree('snap1'))
+        write(os.path.join(self.top, 'b'), random_data(300 * 1024, 4))
+        self.store.snapshot(self.top, self.tree('snap2'),
+                previous_tree=self.tree('snap1'))
+        os.remove(os.path.join(self.top, 'a'))
+        write(os.path.join(self.top, 'c'), random_data(300 * 1024, 5))
+        self.store.snapshot(self.top, self.tree('snap3'),
+                previous_tree=self.tree('snap2'))
+        packs = sorted(os.listdir(self.store.packs_directory))
+        self.assertEqual(len(packs) >= 3, True)
+
+        #  nothing is garbage yet
+        statistics = self.store.collect_garbage()
+        self.assertEqual((statistics.packs_removed,
+                statistics.packs_rewritten), (0, 0))
+
+        #  "a" is only in the first two snapshots
+        counts = nabchunkstore.tree_chunk_counts(self.tree('snap1'))
+        self.assertEqual(self.store.reclaimable_bytes(counts), 0)
+        both = nabchunkstore.tree_chunk_counts(self.tree('snap2'))
+        for chunk_id, count in counts.items():
+            both[chunk_id] += count
+        reclaimable = self.store.reclaimable_bytes(both)
+        self.assertEqual(reclaimable > 200 * 1024, True)
+
+        self.store.remove_snapshot(self.tree('snap1'))
+        self.store.remove_snapshot(self.tree('snap2'))
+        self.assertEqual(os.path.exists(self.tree('snap1')), False)
+        statistics = self.store.collect_garbage(max_packs=10)
+        self.assertEqual(statistics.packs_removed +
+                statistics.packs_rewritten >= 1, True)
+        self.assertEqual(statistics.chunks_removed, len(counts))
+        self.assertEqual(statistics.bytes_freed, reclaimable)
+        self.assertEqual(packs[0] in os.listdir(self.store.packs_directory),
+                False)
+
+        #  the live chunks are still readable after being moved
+        restored = os.path.join(self.testdir, 'restored')
+        self.store.restore(self.tree('snap3'), restored)
+        self.assertEqual(read(os.path.join(restored, 'b')),
+                random_data(300 * 1024, 4))
+        self.assertEqual(read(os.path.join(restored, 'c')),
+                random_data(300 * 1024, 5))
+        statistics = self.store.collect_garbage()
+        self.assertEqual(statistics.chunks_removed, 0)
+
+    def test_Locking(self):
+        '''Readers share the store with a writer, but not with garbage
+        collection, and need not wait for a busy store.'''
+
+        write(os.path.join(self.top, 'a'), random_data(100 * 1024, 6))
+        self.store.snapshot(self.top, self.tree('snap1'))
+        directory = self.store.directory
+        self.assertRaises(IOError, nabchunkstore.ChunkStore, directory,
+                wait=False)
+        reader = nabchunkstore.ChunkStore(directory, write=False, wait=False)
+        try:
+            self.assertEqual(reader.usage(), self.store.usage())
+            restored = os.path.join(self.testdir, 'restored')
+            self.assertEqual(reader.restore(self.tree('snap1'),
+                    restored).files, 1)
+            self.assertEqual(read(os.path.join(restored, 'a')),
+                    random_data(100 * 1024, 6))
+            self.assertRaises(ValueError, reader.add_chunk, 'data')
+        finally:
+            reader.close()
+
+        def remove_garbage(*args):
+            self.assertRaises(IOError, nabchunkstore.ChunkStore, directory,
+                    write=False, wait=False)
+            return original(*args)
+        original = self.store.remove_garbage
+        self.store.remove_garbage = remove_garbage
+        self.store.collect_garbage()
+        nabchunkstore.ChunkStore(directory, write=False, wait=False).close()
+
+
+class TestChunkStorage(unittest.TestCase):
+    def setUp(self):
+        self.testdir = '/tmp/nabchunkstoragetest'
+        subprocess.call(['rm', '-rf', self.testdir])
+        os.mkdir(self.testdir)
+        self.storage = chunks.Storage([self.testdir, None, None, None, None])
+
+    def tearDown(self):
+        subprocess.call(['rm', '-rf', self.testdir])
+
+    def test_Basic(self):
+        '''Basic test of chunk storage back-end.'''
+
+        storage = self.storage
+        storage.create_host('example.com')
+        self.assertEqual(storage.rsync_inplace_compatible(), True)
+        self.assertEqual(os.stat(os.path.join(self.testdir,
+                'example.com')).st_mode & 0777, 0700)
+        self.assertEqual(storage.get_backup_destination('example.com',
+                'snap1'), os.path.join(self.testdir, 'example.com', 'data'))
+
+        datafile = os.path.join(self.testdir, 'example.com', 'data',
+                'testfile')
+        write(datafile, 'This is a test\n')
+        storage.create_snapshot('example.com', 'snap1')
+        self.assertRaises(ValueError, storage.create_snapshot, 'example.com',
+                'snap1')
+        self.assertEqual([x.path for x in nabmanifest.read_manifest(
+                storage.get_manifest_path('example.com', 'snap1'))],
+                ['testfile'])
+        write(datafile, 'This is another test\n')
+        statistics = storage.create_snapshot('example.com', 'snap2')
+        self.assertEqual(statistics.files_read, 1)
+        self.assertEqual(storage.list_snapshots('example.com'),
+                ['snap1', 'snap2'])
+
+        storage.mount_snapshot('example.com', 'snap1')
+        self.assertEqual(read(os.path.join(storage.get_snapshot_directory(
+                'example.com', 'snap1'), 'data', 'testfile')),
+                'This is a test\n')
+        self.assertEqual(storage.reclaimable_bytes('example.com',
+                ['snap1']) > 0, True)
+        self.assertEqual(storage.storage_statistics().dedup_ratio_percent > 0,
+                True)
+        storage.unmount_snapshot('example.com', 'snap1')
+
+        #  reading a snapshot only extracts what is needed, and cleans up
+        top = storage.get_backup_top_directory('example.com')
+        entries = sorted(os.listdir(top))
+        with nabsupp.snapshot_data(storage, 'example.com', 'snap2',
+                ['testfile']) as directory:
+            self.assertEqual(read(os.path.join(directory, 'testfile')),
+                    'This is another test\n')
+        self.assertEqual(sorted(os.listdir(top)), entries)
+        self.assertEqual([x[0] for x in nabdiff.diff_snapshots(storage,
+                'example.com', 'snap1', 'snap2', contents=True)], ['M'])
+        self.assertEqual(sorted(os.listdir(top)), entries)
+        self.assertEqual(os.path.exists(storage.get_snapshot_directory(
+                'example.com', 'snap1')), False)
+
+        storage.destroy_snapshot('example.com', 'snap1')
+        self.assertEqual(os.path.exists(storage.get_snapshot_directory(
+                'example.com', 'snap1')), False)
+        self.assertEqual(os.path.exists(storage.get_manifest_path(
+                'example.com', 'snap1')), False)
+        self.assertRaises(ValueError, storage.destroy_snapshot,
+                'example.com', 'snap1')
+        #  the current pack is being written to, so it is left alone
+        self.assertEqual(storage.collect_garbage().chunks_removed, 0)
+
+        storage.destroy_host('example.com')
+        self.assertEqual(os.path.exists(os.path.join(self.testdir,
+                'example.com')), False)
+        self.assertEqual(len(os.listdir(storage.trash_directory())), 2)
+        store = storage.open_store()
+        try:
+            self.assertEqual(store.usage()[0], 0)
+        finally:
+            store.close()
+
+
+if __name__ == '__main__':
+    print unittest.main()
@@ -0,0 +1,194 @@
+#!/usr/bin/env python
+#
+#  Copyright (c) 2012, Sean Reifschneider, tummy.com, ltd.
+#  All Rights Reserved.
+
+#  allow the test to be run from the "tests" or "tests" parent directory
+import sys
+import os
+if os.path.basename(os.getcwd()) == 'tests':
+    sys.path.append('../lib')
+else:
+    sys.path.append('./lib')
+
+import unittest
+import subprocess
+import nabmanifest
+import nabdedup
+from nabstorageplugins import hardlinks
+
+
+class TestDedup(unittest.TestCase):
+
+    def setUp(self):
+        self.testdir = '/tmp/nabdeduptest'
+        subprocess.call(['rm', '-rf', self.testdir])
+        os.mkdir(self.testdir)
+        self.storage = hardlinks.Storage([self.testdir, 'link-dest'])
+        for hostname in ['host1', 'host2']:
+            self.storage.create_host(hostname)
+
+    def tearDown(self):
+        subprocess.call(['rm', '-rf', self.testdir])
+
+    def path(self, hostname, *args):
+        return os.path.join(self.testdir, hostname, *args)
+
+    def data(self, hostname, snapshotname, *args):
+        return self.path(hostname, 'snapshots', snapshotname, 'data', 'usr',
+                *args)
+
+    def backup(self, hostname, snapshotname, previous=None):
+        #  as rsync --link-dest, which links the unchanged files
+        destination = self.storage.get_backup_destination(hostname,
+                snapshotname)
+        if previous == None:
+            os.mkdir(os.path.join(destination, 'usr'))
+        else:
+            subprocess.check_call(['cp', '-al', self.data(hostname,
+                    previous), destination])
+
+    def write(self, hostname, snapshotname, name, data, mode=0644):
+        filename = self.data(hostname, snapshotname, name)
+        with open(filename, 'w') as fp:
+            fp.write(data)
+        os.chmod(filename, mode)
+        os.utime(filename, (1341100800, 1341100800))
+
+    def inode(self, *args):
+        return os.lstat(self.data(*args)).st_ino
+
+    def test_Deduplicate(self):
+        '''Linking identical files of different hosts.'''
+
+        for hostname in ['host1', 'host2']:
+            self.backup(hostname, 'snap1')
+            self.write(hostname, 'snap1', 'ls', 'ls' * 8192)
+            self.write(hostname, 'snap1', 'small', 'small')
+            self.write(hostname, 'snap1', 'unique', hostname * 4096)
+        self.write('host1', 'snap1', 'cp', 'cp' * 8192)
+        self.write('host2', 'snap1', 'cp', 'cp' * 8192, mode=0600)
+        self.storage.create_snapshot('host1', 'snap1')
+        self.storage.create_snapshot('host2', 'snap1')
+        os.utime(self.data('host2', 'snap1'), (1341100800, 1341100800))
+        self.storage.account_usage('host1')
+        self.storage.account_usage('host2')
+
+        statistics = self.storage.deduplicate(['host1', 'host2'],
+                processes=2)
+        self.assertEqual(statistics.snapshots, 2)
+        self.assertEqual(statistics.files_hashed, 6)
+        self.assertEqual(statistics.files_linked, 1)
+        self.assertEqual(statistics.bytes_freed,
+                os.lstat(self.data('host1', 'snap1', 'ls')).st_size)
+
+        ls = self.inode('host1', 'snap1', 'ls')
+        self.assertEqual(self.inode('host2', 'snap1', 'ls'), ls)
+        self.assertNotEqual(self.inode('host2', 'snap1', 'small'),
+                self.inode('host1', 'snap1', 'small'))
+        self.assertNotEqual(self.inode('host2', 'snap1', 'cp'),
+                self.inode('host1', 'snap1', 'cp'))
+        self.assertEqual(os.lstat(self.data('host2', 'snap1')).st_mtime,
+                1341100800)
+        self.assertEqual(sorted(os.listdir(self.data('host2', 'snap1'))),
+                ['cp', 'ls', 'small', 'unique'])
+
+        #  the manifest and accounting follow the new inodes
+        manifest = self.storage.get_manifest_path('host2', 'snap1')
+        self.assertEqual([x.inode for x in nabmanifest.read_manifest(manifest)
+                if x.path == 'usr/ls'], [ls])
+        self.assertEqual(os.listdir(self.path('host2', 'accounting')), [])
+        self.assertEqual(os.listdir(self.path('host1', 'accounting')), [])
+
+        #  "ls" is stored once for two hosts, "cp" and "unique" twice
+        self.assertEqual(self.storage.storage_statistics(
+                ).dedup_ratio_percent, 118)
+
+        #  only new snapshots and new files are examined
+        statistics = self.storage.deduplicate(['host1', 'host2'],
+                processes=1)
+        self.assertEqual(statistics.snapshots, 0)
+        self.assertEqual(statistics.files_hashed, 0)
+
+        self.backup('host2', 'snap2', 'snap1')
+        self.write('host2', 'snap2', 'ls2', 'ls' * 8192)
+        self.storage.create_snapshot('host2', 'snap2')
+        statistics = self.storage.deduplicate(['host2'], processes=1)
+        self.assertEqual(statistics.snapshots, 1)
+        self.assertEqual(statistics.files_hashed, 1)
+        self.assertEqual(statistics.files_linked, 1)
+        self.assertEqual(self.inode('host2', 'snap2', 'ls2'), ls)
+
+        #  "ls" is not freed by removing the snapshot of host1 that has it
+        self.backup('host1', 'snap2', 'snap1')
+        os.remove(self.data('host1', 'snap2', 'ls'))
+        self.storage.create_snapshot('host1', 'snap2')
+        report = self.storage.account_usage('host1', ['snap1'])
+        self.assertEqual(report.snapshots[0].exclusive_bytes,
+                sum([os.lstat(self.path('host1', 'snapshots', 'snap1',
+                *x)).st_blocks * 512 for x in [['data'], ['data', 'usr']]]))
+        self.assertEqual(report.removable_bytes,
+                report.snapshots[0].exclusive_bytes)
+
+        #  removed snapshots are forgotten, "ls" was last seen on host2
+        subprocess.call(['rm', '-rf', self.path('host1', 'snapshots')])
+        os.mkdir(self.path('host1', 'snapshots'))
+        statistics = self.storage.deduplicate(['host1'], processes=1)
+        self.assertEqual(statistics.snapshots, 0)
+        #  "ls" and "ls2" of host2 are two copies, "cp" and "unique" one
+        self.assertEqual(self.storage.storage_statistics(
+                ).dedup_ratio_percent, 131)
+
+    def test_Mismatch(self):
+        '''Files are compared before they are linked.'''
+
+        for hostname in ['host1', 'host2']:
+            self.backup(hostname, 'snap1')
+            self.write(hostname, 'snap1', 'file', hostname * 8192)
+        self.storage.create_snapshot('host1', 'snap1')
+        self.storage.create_snapshot('host2', 'snap1')
+        self.storage.deduplicate(['host1'], processes=1)
+
+        #  the cache says the file of host1 has the digest of host2's
+        dedup = nabdedup.Deduplicator(os.path.join(self.testdir,
+                hardlinks.DEDUP_CACHE))
+        dedup.db.execute('UPDATE inodes SET digest = ?, mode = ?, uid = ?, '
+                'gid = ?', nabdedup.hash_file((self.inode('host2', 'snap1',
+                'file'), self.data('host2', 'snap1', 'file')))[1:])
+        dedup.db.commit()
+        dedup.close()
+
+        statistics = self.storage.deduplicate(['host2'], processes=1)
+        self.assertEqual((statistics.files_linked,
+                statistics.files_mismatched), (0, 1))
+        self.assertNotEqual(self.inode('host1', 'snap1', 'file'),
+                self.inode('host2', 'snap1', 'file'))
+        with open(self.data('host2', 'snap1', 'file')) as fp:
+            self.assertEqual(fp.read(), 'host2' * 8192)
+
+    def test_SnapshotMode(self):
+        '''Files rsync updates in place are not linked between hosts.'''
+
+        storage = hardlinks.Storage([self.testdir])
+        for hostname in ['host1', 'host2']:
+            os.mkdir(self.path(hostname, 'data', 'usr'))
+            with open(self.path(hostname, 'data', 'usr', 'ls'), 'w') as fp:
+                fp.write('ls' * 8192)
+            os.chmod(self.path(hostname, 'data', 'usr', 'ls'), 0644)
+            os.utime(self.path(hostname, 'data', 'usr', 'ls'),
+                    (1341100800, 1341100800))
+            storage.create_snapshot(hostname, 'snap1')
+        self.assertRaises(ValueError, storage.deduplicate,
+                ['host1', 'host2'])
+
+        #  rsync changes the mode of the file of host2 in place, which
+        #  leaves the snapshot of host1 alone
+        os.chmod(self.path('host2', 'data', 'usr', 'ls'), 0600)
+        self.assertEqual(os.lstat(self.data('host1', 'snap1',
+                'ls')).st_mode & 0777, 0644)
+        self.assertEqual(os.lstat(self.data('host2', 'snap1',
+                'ls')).st_mode & 0777, 0600)
+
+
+if __name__ == '__main__':
+    print unittest.main()
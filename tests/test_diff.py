@@ -0,0 +1,132 @@
+#!/usr/bin/env python
+#
+#  Copyright (c) 2012, Sean Reifschneider, tummy.com, ltd.
+#  All Rights Reserved.
+
+#  allow the test to be run from the "tests" or "tests" parent directory
+import sys
+import os
+if os.path.basename(os.getcwd()) == 'tests':
+    sys.path.append('../lib')
+else:
+    sys.path.append('./lib')
+
+import unittest
+import subprocess
+import nabdiff
+from nabmanifest import ManifestEntry
+from nabstorageplugins import hardlinks
+
+
+class TestDiff(unittest.TestCase):
+    def setUp(self):
+        self.testdir = '/tmp/nabdifftest'
+        subprocess.call(['rm', '-rf', self.testdir])
+        os.mkdir(self.testdir)
+        self.storage = hardlinks.Storage([self.testdir, None, None, None,
+                None])
+        self.storage.create_host('example.com')
+        self.data = os.path.join(self.testdir, 'example.com', 'data')
+
+    def tearDown(self):
+        subprocess.call(['rm', '-rf', self.testdir])
+
+    def write(self, path, data, mtime=1341100800):
+        filename = os.path.join(self.data, path)
+        #  rsync replaces changed files, it does not rewrite them
+        if os.path.exists(filename):
+            os.remove(filename)
+        with open(filename, 'w') as fp:
+            fp.write(data)
+        os.utime(filename, (mtime, mtime))
+
+    def diff(self, old, new, contents=False):
+        statistics = nabdiff.DiffStatistics()
+        changes = [(x[0], (x[2] or x[1]).path) for x in
+                nabdiff.diff_snapshots(self.storage, 'example.com', old, new,
+                contents=contents, statistics=statistics)]
+        return changes, statistics
+
+    def test_Entries(self):
+        '''Merging listings, with and without trusting inodes.'''
+
+        old = [ManifestEntry('a', 1, 0, 10, 040755),
+                ManifestEntry('a/b', 2, 5, 10, 0100644),
+                ManifestEntry('a/c', 3, 5, 10, 0100644),
+                ManifestEntry('a-b', 4, 5, 10, 0100644),
+                ManifestEntry('link', 5, 3, 10, 0120777)]
+        new = [ManifestEntry('a', 11, 0, 20, 040755),
+                ManifestEntry('a/b', 2, 5, 10, 0100644),
+                ManifestEntry('a/c', 13, 5, 10, 0100644),
+                ManifestEntry('a/d', 14, 5, 10, 0100644),
+                ManifestEntry('a-b', 15, 6, 10, 0100644),
+                ManifestEntry('link', 16, 3, 20, 0120777)]
+        self.assertEqual([(x[0], (x[2] or x[1]).path)
+                for x in nabdiff.diff_entries(old, new)],
+                [('A', 'a/d'), ('M', 'a-b')])
+
+        compared = []
+
+        def compare(path):
+            compared.append(path)
+            return path != 'a/c'
+
+        statistics = nabdiff.DiffStatistics()
+        self.assertEqual([(x[0], (x[2] or x[1]).path)
+                for x in nabdiff.diff_entries(old, new, trust_inodes=True,
+                compare=compare, statistics=statistics)],
+                [('M', 'a/c'), ('A', 'a/d'), ('M', 'a-b')])
+        self.assertEqual(compared, ['a/c', 'link'])
+        self.assertEqual((statistics.entries, statistics.added,
+                statistics.removed, statistics.modified,
+                statistics.files_compared), (6, 1, 0, 2, 2))
+
+        #  the same inode only saves reading, the metadata is compared
+        chmod = [ManifestEntry('a/b', 2, 5, 10, 0100600)]
+        self.assertEqual([x[0] for x in nabdiff.diff_entries(old[1:2],
+                chmod, trust_inodes=True, compare=compare)], ['M'])
+        self.assertEqual([x[0] for x in nabdiff.diff_entries(old[1:2],
+                old[1:2], trust_inodes=True, compare=compare)], [])
+        self.assertEqual(compared, ['a/c', 'link'])
+
+        self.assertEqual([x[0] for x in nabdiff.diff_entries(new, [])],
+                ['D'] * 6)
+        self.assertEqual(list(nabdiff.diff_entries([], [])), [])
+
+    def test_Snapshots(self):
+        '''Differences between snapshots of hardlinks storage.'''
+
+        os.mkdir(os.path.join(self.data, 'dir'))
+        self.write('dir/same', 'unchanged\n')
+        self.write('dir/changed', 'first\n')
+        self.write('dir/rewritten', 'aaaa\n')
+        self.write('removed', 'removed\n')
+        self.storage.create_snapshot('example.com', 'snap1')
+
+        self.write('dir/changed', 'second\n', mtime=1341100900)
+        self.write('dir/rewritten', 'bbbb\n')
+        self.write('dir/added', 'added\n')
+        os.remove(os.path.join(self.data, 'removed'))
+        self.storage.create_snapshot('example.com', 'snap2')
+
+        changes, statistics = self.diff('snap1', 'snap2')
+        self.assertEqual(changes, [('A', 'dir/added'), ('M', 'dir/changed'),
+                ('D', 'removed')])
+        self.assertEqual((statistics.bytes_added, statistics.bytes_removed),
+                (13, 14))
+
+        #  only the file with a new inode and the same size and time is read
+        changes, statistics = self.diff('snap1', 'snap2', contents=True)
+        self.assertEqual(changes, [('A', 'dir/added'), ('M', 'dir/changed'),
+                ('M', 'dir/rewritten'), ('D', 'removed')])
+        self.assertEqual(statistics.files_compared, 1)
+
+        #  snapshots without manifests are walked
+        os.remove(self.storage.get_manifest_path('example.com', 'snap1'))
+        self.assertEqual(self.diff('snap1', 'snap2')[0], [('A', 'dir/added'),
+                ('M', 'dir/changed'), ('D', 'removed')])
+        self.assertRaises(ValueError, self.diff, 'snap1', 'missing')
+
+
+if __name__ == '__main__':
+    print unittest.main()
@@ -126,5 +126,43 @@ class TestHardlinksStorage(unittest.TestCase):
         with open(filename, 'r') as fp:
             self.assertEqual(fp.readline(), 'This is a test')
 
+    def test_LinkDest(self):
+        '''Test backups written directly to snapshots with --link-dest.'''
+
+        os.system('rm -rf /tmp/nabhardlinksbackuptest/')
+        os.mkdir('/tmp/nabhardlinksbackuptest/')
+        os.mkdir('/tmp/nabhardlinksbackuptest/backups')
+        os.mkdir('/tmp/nabhardlinksbackuptest/root')
+        with open('/tmp/nabhardlinksbackuptest/root/testfile', 'w') as fp:
+            fp.write('This is a test')
+        with open('/tmp/nabhardlinksbackuptest/root/unchanged', 'w') as fp:
+            fp.write('This does not change')
+
+        db = self.create_database()
+        host = db.query(Host).filter_by(hostname='localhost').first()
+        host.storage.arg2 = 'link-dest'
+        db.commit()
+        host.storage.get_plugin().create_host('localhost')
+
+        nabsupp.run_backup_for_host(db, 'localhost')
+        first_snapshotname = host.backups[0].snapshot_name
+        time.sleep(1.1)
+        with open('/tmp/nabhardlinksbackuptest/root/testfile', 'w') as fp:
+            fp.write('This is another test')
+        nabsupp.run_backup_for_host(db, 'localhost')
+        second_snapshotname = host.backups[-1].snapshot_name
+
+        snapshots = '/tmp/nabhardlinksbackuptest/backups/localhost/snapshots'
+        path = 'data/tmp/nabhardlinksbackuptest/root'
+        for name, data in [(first_snapshotname, 'This is a test'),
+                (second_snapshotname, 'This is another test')]:
+            with open(os.path.join(snapshots, name, path, 'testfile'),
+                    'r') as fp:
+                self.assertEqual(fp.readline(), data)
+            self.assertEqual(os.path.exists(os.path.join(snapshots, name,
+                    'logs', 'rsync.out')), True)
+        self.assertEqual(os.stat(os.path.join(snapshots, first_snapshotname,
+                path, 'unchanged')).st_ino, os.stat(os.path.join(snapshots,
+                second_snapshotname, path, 'unchanged')).st_ino)
 
 print unittest.main()
@@ -0,0 +1,133 @@
+#!/usr/bin/env python
+#
+#  Copyright (c) 2012, Sean Reifschneider, tummy.com, ltd.
+#  All Rights Reserved.
+
+#  allow the test to be run from the "tests" or "tests" parent directory
+import sys
+import os
+if os.path.basename(os.getcwd()) == 'tests':
+    sys.path.append('../lib')
+else:
+    sys.path.append('./lib')
+
+import unittest
+import errno
+import subprocess
+import nablinktree
+
+
+class TestLinkTree(unittest.TestCase):
+
+    def setUp(self):
+        self.testdir = '/tmp/nablinktreetest'
+        subprocess.call(['rm', '-rf', self.testdir])
+        os.mkdir(self.testdir)
+
+    def tearDown(self):
+        subprocess.call(['rm', '-rf', self.testdir])
+
+    def test_LinkTree(self):
+        '''Hard-link copy of a tree with several threads.'''
+
+        source = os.path.join(self.testdir, 'source')
+        os.mkdir(source)
+        for i in range(20):
+            directory = os.path.join(source, 'dir%d' % i, 'sub')
+            os.makedirs(directory)
+            for j in range(10):
+                with open(os.path.join(directory, 'file%d' % j), 'w') as fp:
+                    fp.write('%d %d\n' % (i, j))
+        os.symlink('dir0/sub/file0', os.path.join(source, 'link'))
+        os.symlink('/nonexistent', os.path.join(source, 'dir1', 'dangling'))
+        os.mkdir(os.path.join(source, 'empty'))
+        os.chmod(os.path.join(source, 'empty'), 0750)
+        os.utime(os.path.join(source, 'dir3'), (1000000000, 1000000000))
+        os.utime(source, (1000000000, 1000000001))
+
+        destination = os.path.join(self.testdir, 'destination')
+        statistics = nablinktree.link_tree(source, destination, threads=4)
+        self.assertEqual(statistics.files, 200)
+        self.assertEqual(statistics.directories, 42)
+        self.assertEqual(statistics.symlinks, 2)
+        self.assertTrue(statistics.seconds >= 0)
+        repr(statistics)
+
+        self.assertEqual(os.stat(os.path.join(source, 'dir5', 'sub',
+                'file3')).st_ino, os.stat(os.path.join(destination, 'dir5',
+                'sub', 'file3')).st_ino)
+        self.assertEqual(os.readlink(os.path.join(destination, 'link')),
+                'dir0/sub/file0')
+        self.assertEqual(os.readlink(os.path.join(destination, 'dir1',
+                'dangling')), '/nonexistent')
+        self.assertEqual(os.stat(os.path.join(destination, 'empty')).st_mode
+                & 0777, 0750)
+        self.assertEqual(os.stat(os.path.join(destination, 'dir3')).st_mtime,
+                1000000000)
+        self.assertEqual(os.stat(destination).st_mtime, 1000000001)
+        self.assertEqual(subprocess.call(['diff', '-r', '--no-dereference',
+                source, destination]), 0)
+
+    def test_LinkLimit(self):
+        '''Files that cannot be given another link are copied.'''
+
+        source = os.path.join(self.testdir, 'source')
+        os.makedirs(os.path.join(source, 'dir'))
+        for name in ['full', 'dir/other']:
+            with open(os.path.join(source, name), 'w') as fp:
+                fp.write('%s\n' % name)
+            os.utime(os.path.join(source, name), (1000000000, 1000000000))
+        full = os.path.join(source, 'full')
+        link = os.link
+
+        def limited_link(source_path, destination_path):
+            if source_path == full:
+                raise OSError(errno.EMLINK, 'Too many links')
+            link(source_path, destination_path)
+
+        destination = os.path.join(self.testdir, 'destination')
+        nablinktree.os.link = limited_link
+        try:
+            statistics = nablinktree.link_tree(source, destination)
+        finally:
+            nablinktree.os.link = link
+        self.assertEqual((statistics.files, statistics.copied), (2, 1))
+        self.assertTrue('1 files copied' in statistics.summary())
+        copy = os.stat(os.path.join(destination, 'full'))
+        self.assertNotEqual(copy.st_ino, os.stat(full).st_ino)
+        self.assertEqual(copy.st_mtime, 1000000000)
+        self.assertEqual(os.stat(os.path.join(destination, 'dir',
+                'other')).st_ino, os.stat(os.path.join(source, 'dir',
+                'other')).st_ino)
+        self.assertEqual(subprocess.call(['diff', '-r', source,
+                destination]), 0)
+
+    def test_Errors(self):
+        '''Errors in the workers are raised to the caller.'''
+
+        source = os.path.join(self.testdir, 'source')
+        os.makedirs(os.path.join(source, 'a', 'b'))
+        destination = os.path.join(self.testdir, 'destination')
+        os.makedirs(os.path.join(destination))
+        with self.assertRaises(OSError):
+            nablinktree.link_tree(source, destination)
+
+        with self.assertRaises(OSError):
+            nablinktree.link_tree(os.path.join(self.testdir, 'missing'),
+                    os.path.join(self.testdir, 'other'))
+
+        #  fails in a worker thread: files cannot be linked across devices
+        with open(os.path.join(source, 'a', 'b', 'file'), 'w') as fp:
+            fp.write('data\n')
+        if os.path.isdir('/dev/shm') and (os.stat('/dev/shm').st_dev
+                != os.stat(source).st_dev):
+            other = '/dev/shm/nablinktreetest'
+            subprocess.call(['rm', '-rf', other])
+            try:
+                with self.assertRaises(OSError):
+                    nablinktree.link_tree(source, other, threads=2)
+            finally:
+                subprocess.call(['rm', '-rf', other])
+
+if __name__ == '__main__':
+    print unittest.main()
@@ -0,0 +1,121 @@
+#!/usr/bin/env python
+#
+#  Copyright (c) 2012, Sean Reifschneider, tummy.com, ltd.
+#  All Rights Reserved.
+
+#  allow the test to be run from the "tests" or "tests" parent directory
+import sys
+import os
+if os.path.basename(os.getcwd()) == 'tests':
+    sys.path.append('../lib')
+else:
+    sys.path.append('./lib')
+
+import unittest
+import subprocess
+import nabmanifest
+import nablinktree
+
+
+class TestManifest(unittest.TestCase):
+
+    def setUp(self):
+        self.testdir = '/tmp/nabmanifesttest'
+        subprocess.call(['rm', '-rf', self.testdir])
+        os.mkdir(self.testdir)
+        self.filename = os.path.join(self.testdir, 'manifest')
+
+    def tearDown(self):
+        subprocess.call(['rm', '-rf', self.testdir])
+
+    def test_Numbers(self):
+        '''Variable-length encoding of numbers.'''
+
+        for value in [0, 1, 127, 128, 300, 2 ** 32, 2 ** 63 - 1]:
+            data = 'x' + nabmanifest.encode_number(value)
+            self.assertEqual(nabmanifest.decode_number(data, 1),
+                    (value, len(data)))
+        for value in [0, -1, 1, -1000000, 1341100800]:
+            data = nabmanifest.encode_signed(value)
+            self.assertEqual(nabmanifest.decode_signed(data, 0),
+                    (value, len(data)))
+
+    def test_WriteRead(self):
+        '''Writing and reading back a manifest.'''
+
+        entries = [('a', 10, 0, 1341100800, 040755),
+                ('a/b', 11, 5, 1341100801, 0100644),
+                ('a/b-c', 12, 2 ** 40, -5, 0100600),
+                ('a-b', 13, 6, 0, 0120777)]
+        entries += [('d/file%05d' % i, 100 + i, i, i, 0100644)
+                for i in range(20000)]
+        writer = nabmanifest.ManifestWriter(self.filename)
+        for entry in entries:
+            writer.add(*entry)
+        self.assertEqual(os.path.exists(self.filename), False)
+        writer.close()
+        self.assertEqual(writer.count, len(entries))
+        self.assertEqual([(x.path, x.inode, x.size, x.mtime, x.mode)
+                for x in nabmanifest.read_manifest(self.filename)], entries)
+
+        writer = nabmanifest.ManifestWriter(self.filename + '2')
+        writer.add('b', 1, 1, 1, 0100644)
+        self.assertRaises(ValueError, writer.add, 'a', 2, 1, 1, 0100644)
+        self.assertRaises(ValueError, writer.add, 'b', 2, 1, 1, 0100644)
+        writer.abort()
+        self.assertEqual(os.path.exists(self.filename + '2.tmp'), False)
+
+        with open(self.filename + '3', 'w') as fp:
+            fp.write('not a manifest\n')
+        self.assertRaises(ValueError, list,
+                nabmanifest.read_manifest(self.filename + '3'))
+
+    def test_Builder(self):
+        '''Manifests of a tree, written directly and from a link copy.'''
+
+        source = os.path.join(self.testdir, 'source')
+        for i in range(5):
+            directory = os.path.join(source, 'dir%d' % i, 'sub')
+            os.makedirs(directory)
+            for j in range(5):
+                with open(os.path.join(directory, 'file%d' % j), 'w') as fp:
+                    fp.write('%d %d\n' % (i, j))
+        os.mkdir(os.path.join(source, 'dir1-x'))
+        os.symlink('dir0/sub/file0', os.path.join(source, 'link'))
+
+        count = nabmanifest.write_tree_manifest(source, self.filename)
+        self.assertEqual(count, 5 * 7 + 2)
+        walked = [(x.path, x.inode, x.size, x.mtime, x.mode)
+                for x in nabmanifest.read_manifest(self.filename)]
+        self.assertEqual(walked[:3], [('dir0', ) + walked[0][1:],
+                ('dir0/sub', ) + walked[1][1:],
+                ('dir0/sub/file0', ) + walked[2][1:]])
+        self.assertEqual([x[0] for x in walked].index('dir1-x'), 14)
+        st = os.lstat(os.path.join(source, 'dir2', 'sub', 'file3'))
+        self.assertEqual(('dir2/sub/file3', st.st_ino, st.st_size,
+                int(st.st_mtime), st.st_mode) in walked, True)
+
+        builder = nabmanifest.ManifestBuilder(self.filename + '2')
+        nablinktree.link_tree(source, os.path.join(self.testdir, 'copy'),
+                threads=4, manifest=builder)
+        self.assertEqual(builder.finish(), count)
+        built = [(x.path, x.inode, x.size, x.mtime, x.mode)
+                for x in nabmanifest.read_manifest(self.filename + '2')]
+        self.assertEqual(built, walked)
+
+        #  unicode paths, as from the database, give the same manifest
+        nabmanifest.write_tree_manifest(unicode(source), self.filename + '3')
+        self.assertEqual([(x.path, x.inode, x.size, x.mtime, x.mode)
+                for x in nabmanifest.read_manifest(self.filename + '3')],
+                walked)
+        builder = nabmanifest.ManifestBuilder(self.filename + '4')
+        nablinktree.link_tree(unicode(source),
+                unicode(os.path.join(self.testdir, 'copy2')), manifest=builder)
+        builder.finish()
+        self.assertEqual([(x.path, x.inode, x.size, x.mtime, x.mode)
+                for x in nabmanifest.read_manifest(self.filename + '4')],
+                walked)
+
+
+if __name__ == '__main__':
+    print unittest.main()
@@ -326,6 +326,10 @@ class TestModel(unittest.TestCase):
         repr(db.query(Metadata).first())
         repr(db.query(HostConfig).first())
         repr(db.query(Backup).first())
+        repr(BackupPhase(db.query(Backup).first(), 'transfer',
+                datetime.datetime(2012, 1, 1), 1.5))
+        repr(BackupStatistics(db.query(Backup).first()))
+        repr(BackupProgress(db.query(Backup).first()))
 
     def test_MergedConfigs(self):
         '''Test the merging of global and host configurations.'''
@@ -432,6 +436,68 @@ class TestModel(unittest.TestCase):
         db.commit()
         self.assertEqual(client1.merged_configs(db).rsync_compression, True)
 
+    def test_ResolveConfigs(self):
+        '''Test resolving and caching the configs of many hosts at once.'''
+        from sqlalchemy import event
+
+        db = nabdb.session()
+
+        #  load the database with the schema test
+        schema_basic(db)
+
+        client1 = db.query(Host).filter_by(hostname='client1.example.com'
+                ).first()
+        client2 = db.query(Host).filter_by(hostname='client2.example.com'
+                ).first()
+        client3 = Host()
+        client3.hostname = 'client3.example.com'
+        db.add(client3)
+        db.commit()
+        ids = [client1.id, client2.id, client3.id]
+
+        queries = []
+
+        def count_queries(*args):
+            queries.append(args[2])
+        event.listen(nabdb.engine, 'before_cursor_execute', count_queries)
+
+        configs = Host.resolve_configs(db, ids)
+        self.assertEqual(len(queries), 1)
+        self.assertEqual(configs[client1.id].priority, 4)
+        self.assertEqual(configs[client1.id].use_global_filters, True)
+        self.assertEqual(configs[client2.id].use_global_filters, False)
+        self.assertEqual(configs[client2.id].alerts_mail_address,
+                'sysadmin@example.com')
+        self.assertEqual(configs[client3.id].alerts_mail_address,
+                'sysadmin@example.com')
+        self.assertEqual(configs[client3.id].priority, None)
+        with self.assertRaises(AttributeError):
+            configs[client1.id].priority = 1
+
+        #  served from the cache
+        self.assertEqual(client1.merged_configs(db).priority, 4)
+        self.assertEqual(client2.ready_for_checksum(db), False)
+        self.assertEqual(Host.resolve_configs(db, ids[:1]).keys(), ids[:1])
+        self.assertEqual(len(queries), 1)
+
+        #  changing any config discards the cache
+        client1.configs[0].priority = 2
+        db.commit()
+        self.assertEqual(client1.merged_configs(db).priority, 2)
+        self.assertEqual(client2.merged_configs(db).use_global_filters,
+                False)
+
+        config = db.query(HostConfig).filter_by(host_id=None).first()
+        config.alerts_mail_address = 'ops@example.com'
+        db.flush()
+        self.assertEqual(client3.merged_configs(db).alerts_mail_address,
+                'ops@example.com')
+        db.rollback()
+        self.assertEqual(client3.merged_configs(db).alerts_mail_address,
+                'sysadmin@example.com')
+
+        event.remove(nabdb.engine, 'before_cursor_execute', count_queries)
+
     def add_generation_backups(self, db, client1, generation):
         '''Helper for testing with FindBackupGeneration*'''
         backup = Backup(client1, generation, full_checksum=False)
@@ -674,6 +740,83 @@ class TestModel(unittest.TestCase):
         db.commit()
         self.assertEqual(client1.ready_for_checksum(db), False)
 
+    def test_StorageBackupsRunning(self):
+        '''Test checking for backups running on a storage.
+        '''
+        import os
+
+        db = nabdb.session()
+
+        #  load the database with the schema test
+        schema_basic(db)
+
+        storage = db.query(Storage).first()
+        client1 = db.query(Host).filter_by(hostname='client1.example.com'
+                ).first()
+        client1.storage = storage
+        backup = Backup(client1, 'daily', full_checksum=False)
+        db.add(backup)
+        db.commit()
+        self.assertEqual(storage.are_backups_currently_running(db), False)
+
+        backup.backup_pid = os.getpid()
+        db.commit()
+        self.assertEqual(storage.are_backups_currently_running(db), True)
+
+        client1.storage = None
+        db.commit()
+        self.assertEqual(storage.are_backups_currently_running(db), False)
+
+    def test_StorageBackupWindow(self):
+        '''Test checking for backup windows open on a storage.
+        '''
+        import datetime
+
+        db = nabdb.session()
+        schema_basic(db)
+
+        storage = db.query(Storage).first()
+        client1 = db.query(Host).filter_by(hostname='client1.example.com'
+                ).first()
+        client1.storage = storage
+        client1.window_start = None
+        client1.window_end = None
+        db.commit()
+        night = datetime.datetime(2012, 1, 1, 2, 0)
+        noon = datetime.datetime(2012, 1, 1, 12, 0)
+        self.assertEqual(storage.in_backup_window(db, night), False)
+
+        client1.window_start = datetime.time(22, 0)
+        client1.window_end = datetime.time(4, 0)
+        db.commit()
+        self.assertEqual(storage.in_backup_window(db, night), True)
+        self.assertEqual(storage.in_backup_window(db, noon), False)
+
+        client1.active = False
+        db.commit()
+        self.assertEqual(storage.in_backup_window(db, night), False)
+
+    def test_FindPreviousSnapshot(self):
+        '''Test finding the snapshot of the last successful backup.
+        '''
+        db = nabdb.session()
+
+        #  load the database with the schema test
+        schema_additional(db)
+
+        client1 = db.query(Host).filter_by(hostname='client1.example.com'
+                ).first()
+        self.assertEqual(client1.find_previous_snapshot(db), None)
+
+        for day, successful in [(3, True), (5, True), (6, False)]:
+            backup = Backup(client1, 'daily', full_checksum=False)
+            backup.start_time = datetime.datetime(2012, 1, day)
+            backup.successful = successful
+            backup.snapshot_name = 'snap%d' % day
+            db.add(backup)
+        db.commit()
+        self.assertEqual(client1.find_previous_snapshot(db), 'snap5')
+
     def test_FilterRules(self):
         '''Test filter rules code and model.
         '''
@@ -720,5 +863,463 @@ class TestModel(unittest.TestCase):
                 'exclude /global/rule55\nexclude /local/rule55\n'
                 'exclude /post/global/rule55\nexclude /local/rule6\n')
 
+    def test_FilterRulesCache(self):
+        '''Test caching of the compiled filter rules by revision.
+        '''
+        from sqlalchemy import event
+
+        db = nabdb.session()
+
+        #  load the database with the schema test
+        schema_additional(db)
+
+        client1 = db.query(Host).filter_by(hostname='client1.example.com'
+                ).first()
+        client2 = db.query(Host).filter_by(hostname='client2.example.com'
+                ).first()
+        rules1 = client1.get_filter_rules(db)
+        rules2 = client2.get_filter_rules(db)
+        self.assertTrue('exclude /tmp/\n' in rules1)
+        self.assertFalse('exclude /tmp/\n' in rules2)
+
+        queries = []
+
+        def count_queries(*args):
+            queries.append(args[2])
+        event.listen(nabdb.engine, 'before_cursor_execute', count_queries)
+        self.assertEqual(client1.get_filter_rules(db), rules1)
+        self.assertEqual(nabdb.session().query(Host).get(client1.id
+                ).get_filter_rules(db), rules1)
+        self.assertEqual([x for x in queries if 'filter_rules' in x], [])
+        event.remove(nabdb.engine, 'before_cursor_execute', count_queries)
+
+        #  host rules only affect that host
+        rule = FilterRule()
+        rule.host = client2
+        rule.rsync_rule = 'exclude /srv/'
+        db.add(rule)
+        db.commit()
+        self.assertEqual(client1.get_filter_rules(db), rules1)
+        self.assertTrue('exclude /srv/\n' in client2.get_filter_rules(db))
+
+        #  global rules affect all hosts that use them
+        revision = Metadata.get(db).filter_revision
+        rule = db.query(FilterRule).filter_by(rsync_rule='exclude /tmp/'
+                ).one()
+        rule.rsync_rule = 'exclude /var/tmp/'
+        db.commit()
+        self.assertTrue('exclude /var/tmp/\n'
+                in client1.get_filter_rules(db))
+        self.assertEqual(Metadata.get(db).filter_revision, revision + 1)
+
+        #  moving a rule changes both hosts
+        rule = db.query(FilterRule).filter_by(rsync_rule='exclude /srv/'
+                ).one()
+        rule.host = client1
+        db.commit()
+        self.assertTrue('exclude /srv/\n' in client1.get_filter_rules(db))
+        self.assertFalse('exclude /srv/\n' in client2.get_filter_rules(db))
+
+        db.delete(rule)
+        db.commit()
+        self.assertFalse('exclude /srv/\n' in client1.get_filter_rules(db))
+
+        #  changing whether global rules are used
+        client1.configs[0].use_global_filters = False
+        db.commit()
+        self.assertFalse('exclude /var/tmp/\n'
+                in client1.get_filter_rules(db))
+
+    def test_FindDue(self):
+        '''Test the single-query selection of hosts due for backup.
+        '''
+
+        db = nabdb.session()
+
+        #  load the database with the schema test
+        schema_additional(db)
+
+        client1 = db.query(Host).filter_by(hostname='client1.example.com'
+                ).first()
+        client2 = db.query(Host).filter_by(hostname='client2.example.com'
+                ).first()
+        client2.storage = client1.storage = db.query(Storage).first()
+        db.query(HostConfig).filter_by(host_id=None).first().priority = 6
+        db.commit()
+
+        now = datetime.datetime(2012, 1, 3, 1, 0)
+        rows = Host.find_due(db, now)
+        self.assertEqual([x.hostname for x in rows],
+                ['client1.example.com', 'client2.example.com'])
+        self.assertEqual([x.priority for x in rows], [4, 6])
+        self.assertEqual(rows[0].last_successful_backup,
+                datetime.datetime(2012, 1, 2, 0, 0, 0))
+        self.assertEqual(rows[0].running, False)
+        self.assertEqual(len(Host.find_due(db, now,
+                backup_server_id=client1.storage.backup_server_id)), 2)
+        self.assertEqual(len(Host.find_due(db, now, backup_server_id=0)), 0)
+
+        #  outside of the backup window
+        self.assertEqual(Host.find_due(db, datetime.datetime(
+                2012, 1, 3, 6, 0)), [])
+
+        client1.backups[0].backup_pid = os.getpid()
+        client2.next_backup = datetime.datetime(2012, 1, 3, 2, 0)
+        db.commit()
+        rows = Host.find_due(db, now)
+        self.assertEqual([x.hostname for x in rows], ['client1.example.com'])
+        self.assertEqual(rows[0].running, True)
+
+        client1.active = False
+        db.commit()
+        self.assertEqual(Host.find_due(db, now), [])
+
+    def test_RuntimeEstimates(self):
+        '''Test recording backup runtimes and estimating the next one.
+        '''
+
+        db = nabdb.session()
+
+        #  load the database with the schema test
+        schema_additional(db)
+
+        client1 = db.query(Host).filter_by(hostname='client1.example.com'
+                ).first()
+        client2 = db.query(Host).filter_by(hostname='client2.example.com'
+                ).first()
+
+        self.assertEqual(HostUsage.runtime_estimates(db, []), {})
+        self.assertEqual(HostUsage.runtime_estimates(db,
+                [client1.id, client2.id]), {
+                client1.id: datetime.timedelta(minutes=8, seconds=10),
+                client2.id: datetime.timedelta(minutes=6, seconds=32)})
+
+        #  replaces the runtime for the existing day
+        HostUsage.record_runtime(db, client1, datetime.timedelta(minutes=10),
+                datetime.date(2012, 1, 1))
+        db.commit()
+        self.assertEqual(len(client1.usage), 1)
+        self.assertEqual(client1.usage[0].used_by_dataset, 100000)
+
+        HostUsage.record_space(db, client1, 200000, 30000,
+                datetime.date(2012, 1, 1))
+        db.commit()
+        self.assertEqual(len(client1.usage), 1)
+        self.assertEqual(client1.usage[0].used_by_dataset, 200000)
+        self.assertEqual(client1.usage[0].used_by_snapshots, 30000)
+        self.assertEqual(client1.usage[0].runtime,
+                datetime.timedelta(minutes=10))
+
+        for day in range(2, 9):
+            HostUsage.record_runtime(db, client1,
+                    datetime.timedelta(minutes=day), datetime.date(2012, 1,
+                        day))
+        db.commit()
+        self.assertEqual(HostUsage.runtime_estimates(db, [client1.id]), {
+                client1.id: datetime.timedelta(minutes=6)})
+        self.assertEqual(HostUsage.runtime_estimates(db, [client1.id],
+                samples=1), {client1.id: datetime.timedelta(minutes=8)})
+
+        self.assertEqual(HostUsage.runtime_estimates(db, [client1.id,
+                client2.id], samples=2), {
+                client1.id: datetime.timedelta(minutes=7, seconds=30),
+                client2.id: datetime.timedelta(minutes=6, seconds=32)})
+
+    def test_HostUsageRecordMany(self):
+        '''Test recording the space used by many hosts at once.
+        '''
+
+        db = nabdb.session()
+
+        #  load the database with the schema test
+        schema_additional(db)
+
+        client1 = db.query(Host).filter_by(hostname='client1.example.com'
+                ).first()
+        client2 = db.query(Host).filter_by(hostname='client2.example.com'
+                ).first()
+
+        #  updates the existing day, keeping the runtime
+        self.assertEqual(HostUsage.record_many(db, iter([
+                (client1.id, 1000, 2000, 150), (client2.id, 3000, 4000, 200)]),
+                datetime.date(2012, 1, 1), chunk_size=1), 2)
+        db.commit()
+        self.assertEqual(db.query(HostUsage).count(), 2)
+        self.assertEqual(client1.usage[0].used_by_dataset, 1000)
+        self.assertEqual(client1.usage[0].used_by_snapshots, 2000)
+        self.assertEqual(client1.usage[0].compression_ratio_percent, 150)
+        self.assertEqual(client1.usage[0].runtime,
+                datetime.timedelta(minutes=8, seconds=10))
+        self.assertEqual(client2.usage[0].compression_ratio_percent, 200)
+
+        HostUsage.record_runtime(db, client2, datetime.timedelta(minutes=1),
+                datetime.date(2012, 1, 2))
+        self.assertEqual(HostUsage.record_many(db, [
+                (client1.id, 5000, 6000, 100), (client2.id, 7000, 8000, 100)],
+                datetime.date(2012, 1, 2)), 2)
+        db.commit()
+        self.assertEqual(db.query(HostUsage).count(), 4)
+        usage = db.query(HostUsage).filter_by(host=client2,
+                sample_date=datetime.date(2012, 1, 2)).one()
+        self.assertEqual(usage.used_by_dataset, 7000)
+        self.assertEqual(usage.runtime, datetime.timedelta(minutes=1))
+
+        #  only storages whose plugin can collect the usage of all its hosts
+        self.assertEqual(HostUsage.sample_storages(db, db.query(Storage
+                ).filter_by(method='hardlinks').all()), 0)
+
+    def test_StorageUsageRecord(self):
+        '''Test recording samples of the capacity of a storage.
+        '''
+        import nabiostat
+
+        db = nabdb.session()
+
+        #  load the database with the schema test
+        schema_additional(db)
+
+        storage = db.query(Storage).filter_by(method='zfs').first()
+
+        #  replaces the sample for the existing day
+        statistics = nabiostat.CapacityStatistics(100000000, 70000000,
+                30000000, 1000, 400, 600, 150)
+        StorageUsage.record(db, storage, statistics, datetime.date(2012, 1, 1))
+        db.commit()
+        self.assertEqual(len(storage.usage), 1)
+        self.assertEqual(storage.usage[0].used_bytes, 30000000)
+        self.assertEqual(storage.usage[0].usage_percent, 30)
+        self.assertEqual(storage.usage[0].used_inodes, 600)
+        self.assertEqual(storage.usage[0].dedup_ratio_percent, 150)
+
+        statistics = nabiostat.CapacityStatistics(100, 0, 0)
+        usage = StorageUsage.record(db, storage, statistics,
+                datetime.date(2012, 1, 2))
+        db.commit()
+        self.assertEqual(len(storage.usage), 2)
+        self.assertEqual(usage.usage_percent, 0)
+        self.assertEqual(usage.total_inodes, None)
+
+        statistics = nabiostat.CapacityStatistics(1000, 999, 1)
+        self.assertEqual(statistics.usage_percent(), 1)
+
+    def test_BackupPhases(self):
+        '''Test recording and summarizing the phases of backups.
+        '''
+        import nabsupp
+
+        db = nabdb.session()
+
+        #  load the database with the schema test
+        schema_additional(db)
+
+        client1 = db.query(Host).filter_by(hostname='client1.example.com'
+                ).first()
+        client2 = db.query(Host).filter_by(hostname='client2.example.com'
+                ).first()
+
+        timer = nabsupp.PhaseTimer()
+        with timer.phase('setup'):
+            pass
+        for i in range(3):
+            with timer.phase('commit'):
+                pass
+        with self.assertRaises(ValueError):
+            with timer.phase('transfer'):
+                raise ValueError('Testing')
+        self.assertEqual([x[0] for x in timer.phases],
+                ['setup', 'commit', 'transfer'])
+
+        backup1 = Backup(client1, 'daily', False)
+        backup1.start_time = datetime.datetime(2012, 1, 2)
+        db.add(backup1)
+        timer.record(db, backup1)
+        db.commit()
+        self.assertEqual(sorted([x.name for x in backup1.phases]),
+                ['commit', 'setup', 'transfer'])
+
+        backup2 = Backup(client2, 'daily', False)
+        backup2.start_time = datetime.datetime(2012, 1, 5)
+        db.add(backup2)
+        db.add(BackupPhase(backup2, 'transfer', backup2.start_time, 10.0))
+        db.add(BackupPhase(backup2, 'setup', backup2.start_time, 2.0))
+        db.commit()
+
+        rows = BackupPhase.summarize(db)
+        self.assertEqual([(x.hostname, x.name, x.count) for x in rows], [
+                (None, 'transfer', 2), (None, 'setup', 2),
+                (None, 'commit', 1)])
+        self.assertTrue(rows[0].maximum >= 10.0)
+
+        rows = BackupPhase.summarize(db, by_host=True)
+        self.assertEqual([(x.hostname, x.name) for x in rows][-2:], [
+                ('client2.example.com', 'transfer'),
+                ('client2.example.com', 'setup')])
+
+        rows = BackupPhase.summarize(db, hostname='client2.example.com')
+        self.assertEqual([(x.name, x.total) for x in rows],
+                [('transfer', 10.0), ('setup', 2.0)])
+        rows = BackupPhase.summarize(db,
+                since=datetime.datetime(2012, 1, 3))
+        self.assertEqual([x.name for x in rows], ['transfer', 'setup'])
+
+    def test_BackupProgress(self):
+        '''Test saving the progress of a backup at a limited rate.
+        '''
+        import nabsupp
+        import nabrsync
+
+        db = nabdb.session()
+
+        #  load the database with the schema test
+        schema_additional(db)
+
+        client1 = db.query(Host).filter_by(hostname='client1.example.com'
+                ).first()
+        backup = Backup(client1, 'daily', False)
+        backup.start_time = datetime.datetime.now() - datetime.timedelta(
+                seconds=100)
+        db.add(backup)
+        db.commit()
+
+        now = [1000.0]
+        reporter = nabsupp.ProgressReporter(db, backup, interval=10,
+                clock=lambda: now[0])
+        parser = nabrsync.RsyncOutputParser(progress=reporter)
+        parser.feed('  1,000,000  25%    1.00MB/s    0:00:07 '
+                '(xfr#5, ir-chk=10/20)')
+        self.assertEqual(backup.progress.bytes_transferred, 1000000)
+        self.assertEqual(backup.progress.files_total, 20)
+
+        now[0] += 5
+        parser.feed('>f+++++++++ 1000 etc/hosts')
+        self.assertEqual(backup.progress.last_item, None)
+        now[0] += 5
+        parser.feed('  2,000,000  50%    1.00MB/s    0:00:07 '
+                '(xfr#6, ir-chk=10/20)')
+        self.assertEqual(backup.progress.bytes_transferred, 2000000)
+        self.assertEqual(backup.progress.percent, 50)
+        self.assertEqual(backup.progress.files_transferred, 6)
+        self.assertEqual(backup.progress.last_item, 'etc/hosts')
+
+        db.expire_all()
+        progress = db.query(BackupProgress).filter_by(backup=backup).one()
+        self.assertEqual(progress.bytes_transferred, 2000000)
+        self.assertTrue(19000 < progress.throughput() < 21000)
+        eta = progress.eta() - progress.update_time
+        self.assertTrue(99 <= eta.seconds <= 101)
+
+        progress.percent = None
+        self.assertEqual(progress.eta(), None)
+        self.assertEqual(nabsupp.format_bytes(None), '-')
+        self.assertEqual(nabsupp.format_bytes(1000), '1000')
+        self.assertEqual(nabsupp.format_bytes(1536 * 1024), '1.5M')
+
+
+#  tables that have since gained columns, as the first version created them
+VERSION_1_SCHEMA = '''
+CREATE TABLE config (
+        id INTEGER NOT NULL CHECK (id = 1),
+        database_version INTEGER,
+        PRIMARY KEY (id), UNIQUE (id));
+CREATE TABLE backup_servers (
+        id INTEGER NOT NULL,
+        hostname VARCHAR NOT NULL,
+        scheduler_slots INTEGER NOT NULL,
+        ssh_supports_y BOOLEAN,
+        PRIMARY KEY (id), UNIQUE (hostname));
+CREATE TABLE storage (
+        id INTEGER NOT NULL,
+        backup_server_id INTEGER,
+        method VARCHAR NOT NULL,
+        arg1 VARCHAR, arg2 VARCHAR, arg3 VARCHAR, arg4 VARCHAR, arg5 VARCHAR,
+        PRIMARY KEY (id));
+CREATE TABLE hosts (
+        id INTEGER NOT NULL,
+        storage_id INTEGER,
+        hostname VARCHAR NOT NULL,
+        ip_address VARCHAR,
+        active BOOLEAN,
+        next_backup DATETIME,
+        window_start TIME,
+        window_end TIME,
+        last_rsync_checksum DATETIME,
+        PRIMARY KEY (id), UNIQUE (hostname));
+CREATE TABLE storage_usage (
+        id INTEGER NOT NULL,
+        storage_id INTEGER,
+        sample_date DATE NOT NULL,
+        total_bytes BIGINT,
+        free_bytes BIGINT,
+        used_bytes BIGINT,
+        usage_percent SMALLINT,
+        dedup_ratio_percent SMALLINT,
+        PRIMARY KEY (id));
+CREATE TABLE backups (
+        id INTEGER NOT NULL,
+        host_id INTEGER,
+        storage_id INTEGER,
+        start_time DATETIME,
+        end_time DATETIME,
+        backup_pid INTEGER,
+        generation VARCHAR NOT NULL,
+        successful BOOLEAN,
+        full_checksum BOOLEAN NOT NULL,
+        harness_returncode INTEGER,
+        snapshot_name VARCHAR,
+        PRIMARY KEY (id));
+INSERT INTO config VALUES (1, 1);
+INSERT INTO backup_servers VALUES (1, 'server', 1, 1);
+INSERT INTO storage VALUES (1, 1, 'hardlinks', '/tmp', NULL, NULL, NULL,
+        NULL);
+INSERT INTO hosts VALUES (1, 1, 'client', NULL, 1, NULL, NULL, NULL, NULL);
+INSERT INTO storage_usage VALUES (1, 1, '2012-07-01', 100, 60, 40, 40, 100);
+INSERT INTO backups VALUES (1, 1, 1, '2012-07-01 01:00:00.000000',
+        '2012-07-01 02:00:00.000000', NULL, 'daily', 1, 0, 0, 'snap');
+'''
+
+
+class TestUpgrade(unittest.TestCase):
+    def setUp(self):
+        self.dbfile = '/tmp/nabupgradetest.sqlite'
+        if os.path.exists(self.dbfile):
+            os.remove(self.dbfile)
+
+    def tearDown(self):
+        nabdb.close()
+        os.remove(self.dbfile)
+
+    def test_Upgrade(self):
+        '''Upgrading a database created by the first version.'''
+        import sqlite3
+
+        connection = sqlite3.connect(self.dbfile)
+        connection.executescript(VERSION_1_SCHEMA)
+        connection.close()
+
+        db = nabdb.connect(connect='sqlite:///%s' % self.dbfile)
+        self.assertEqual(Metadata.get(db).database_version, DATABASE_VERSION)
+        self.assertEqual(Metadata.get(db).filter_revision, 0)
+        storage = db.query(Storage).one()
+        self.assertEqual(storage.arg1, '/tmp')
+        self.assertEqual(storage.max_concurrent_backups, None)
+        host = db.query(Host).one()
+        self.assertEqual((host.hostname, host.filter_revision), ('client', 0))
+        backup = db.query(Backup).one()
+        self.assertEqual((backup.snapshot_name, backup.expired),
+                ('snap', False))
+        backup.expired = True
+        db.commit()
+        usage = db.query(StorageUsage).one()
+        self.assertEqual((usage.free_bytes, usage.free_inodes), (60, None))
+        self.assertEqual(db.query(HostUsage).all(), [])
+        self.assertTrue('ix_hosts_active_next_backup' in [x['name'] for x in
+                inspect(nabdb.engine).get_indexes('hosts')])
+        self.assertTrue('ix_storage_usage_storage_date' in [x['name'] for x
+                in inspect(nabdb.engine).get_indexes('storage_usage')])
+
+        #  an up to date database is left alone
+        db.close()
+        self.assertEqual(upgrade_database(nabdb.engine), DATABASE_VERSION)
+
 if __name__ == '__main__':
     print unittest.main()
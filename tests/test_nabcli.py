@@ -93,5 +93,21 @@ class TestNabCli(unittest.TestCase):
         self.assertEqual(nabsupp.run_command([nabcmd, 'listservers']).stdout,
                 'testserver.example.com\n')
 
+    def test_CreateStorage(self):
+        '''Creation of storage with method arguments.'''
+
+        self.assertEqual(nabsupp.run_command([nabcmd, 'newserver', '-y', 'no',
+                'testserver.example.com']).exitcode, 0)
+        self.assertEqual(nabsupp.run_command([nabcmd, 'newstorage',
+                'testserver.example.com']).exitcode, 1)
+        self.assertEqual(nabsupp.run_command([nabcmd, 'newstorage',
+                'testserver.example.com', 'hardlinks', '/backups',
+                'link-dest']).exitcode, 0)
+        self.assertEqual(nabsupp.run_command([nabcmd, 'newstorage', '-c',
+                '2', 'testserver.example.com', 'zfs', 'tank', 'tank/backups',
+                '/tank/backups']).exitcode, 0)
+        self.assertEqual(nabsupp.run_command([nabcmd, 'liststorage']).stdout,
+                '1 (hardlinks: /backups, link-dest)\n'
+                '2 (zfs: tank, tank/backups, /tank/backups)\n')
 
 print unittest.main()
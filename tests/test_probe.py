@@ -0,0 +1,89 @@
+#!/usr/bin/env python
+#
+#  Copyright (c) 2012, Sean Reifschneider, tummy.com, ltd.
+#  All Rights Reserved.
+
+#  allow the test to be run from the "tests" or "tests" parent directory
+import sys
+import os
+if os.path.basename(os.getcwd()) == 'tests':
+    sys.path.append('../lib')
+else:
+    sys.path.append('./lib')
+
+import unittest
+import socket
+import time
+import nabprobe
+
+
+class TestProbe(unittest.TestCase):
+
+    def test_ProbeHosts(self):
+        '''Concurrent probing of listening, closed and unknown hosts.'''
+
+        listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        listener.bind(('127.0.0.1', 0))
+        listener.listen(5)
+        port = listener.getsockname()[1]
+
+        closed = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        closed.bind(('127.0.0.1', 0))
+        closed_port = closed.getsockname()[1]
+
+        for icmp in [False, True]:
+            start = time.time()
+            results = nabprobe.probe_hosts(['127.0.0.1', 'localhost',
+                    'nonexistent.invalid'], port=port, timeout=1.0,
+                    icmp=icmp)
+            self.assertTrue(time.time() - start < 5)
+            self.assertEqual(results['127.0.0.1'].reachable, True)
+            self.assertTrue(results['127.0.0.1'].rtt_ms >= 0)
+            self.assertEqual(results['localhost'].reachable, True)
+            self.assertEqual(results['nonexistent.invalid'].reachable, False)
+            self.assertEqual(results['nonexistent.invalid'].rtt_ms, None)
+
+        results = nabprobe.probe_hosts(['127.0.0.1'], port=closed_port,
+                timeout=1.0, icmp=False)
+        self.assertEqual(results['127.0.0.1'].reachable, False)
+        self.assertEqual(nabprobe.probe_hosts([]), {})
+
+        listener.close()
+        closed.close()
+
+    def test_ProbeCache(self):
+        '''Caching of probe results and connectivity decisions.'''
+
+        probed = []
+        now = [1000.0]
+
+        def fake_probe(addresses):
+            probed.append(sorted(addresses))
+            results = {}
+            for address in addresses:
+                rtt = {'near': 1.0, 'far': 80.0}.get(address)
+                results[address] = nabprobe.ProbeResult(address,
+                        rtt != None, rtt, now[0])
+            return results
+
+        cache = nabprobe.ProbeCache(ttl=60, probe_function=fake_probe,
+                clock=lambda: now[0])
+        cache.probe(['near', 'far', 'off'])
+        self.assertEqual(probed, [['far', 'near', 'off']])
+
+        self.assertEqual(cache.acceptable('off', False, None), True)
+        self.assertEqual(cache.acceptable('off', True, None), False)
+        self.assertEqual(cache.acceptable('far', True, None), True)
+        self.assertEqual(cache.acceptable('far', False, 50), False)
+        self.assertEqual(cache.acceptable('near', False, 50), True)
+        self.assertEqual(len(probed), 1)
+
+        now[0] += 61
+        cache.probe(['near'])
+        self.assertEqual(probed[-1], ['near'])
+        self.assertEqual(cache.acceptable('far', True, None), True)
+        self.assertEqual(probed[-1], ['far'])
+
+
+if __name__ == '__main__':
+    print unittest.main()
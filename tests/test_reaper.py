@@ -0,0 +1,135 @@
+#!/usr/bin/env python
+#
+#  Copyright (c) 2012, Sean Reifschneider, tummy.com, ltd.
+#  All Rights Reserved.
+
+#  allow the test to be run from the "tests" or "tests" parent directory
+import sys
+import os
+if os.path.basename(os.getcwd()) == 'tests':
+    sys.path.append('../lib')
+else:
+    sys.path.append('./lib')
+
+import unittest
+import subprocess
+import nabreaper
+
+
+def make_tree(top, directories=10, files=20):
+    for i in range(directories):
+        directory = os.path.join(top, 'dir%d' % i, 'sub')
+        os.makedirs(directory)
+        for j in range(files):
+            with open(os.path.join(directory, 'file%d' % j), 'w') as fp:
+                fp.write('data\n')
+    os.symlink('/nonexistent', os.path.join(top, 'link'))
+
+
+class TestReaper(unittest.TestCase):
+
+    def setUp(self):
+        self.testdir = '/tmp/nabreapertest'
+        subprocess.call(['rm', '-rf', self.testdir])
+        os.mkdir(self.testdir)
+        self.trash = os.path.join(self.testdir, nabreaper.TRASH_DIRECTORY)
+
+    def tearDown(self):
+        subprocess.call(['rm', '-rf', self.testdir])
+
+    def test_Reap(self):
+        '''Move trees to the trash and remove them.'''
+
+        for name in ['one', 'two']:
+            make_tree(os.path.join(self.testdir, name, 'data'))
+            path = nabreaper.move_to_trash(os.path.join(self.testdir, name),
+                    self.testdir)
+            self.assertEqual(os.path.dirname(path), self.trash)
+            self.assertFalse(os.path.exists(os.path.join(self.testdir, name)))
+        with open(os.path.join(self.testdir, 'file'), 'w') as fp:
+            fp.write('data\n')
+        nabreaper.move_to_trash(os.path.join(self.testdir, 'file'),
+                self.testdir)
+
+        #  names do not collide
+        os.mkdir(os.path.join(self.testdir, 'one'))
+        nabreaper.move_to_trash(os.path.join(self.testdir, 'one'),
+                self.testdir)
+        self.assertEqual(len(os.listdir(self.trash)), 4)
+
+        reaper = nabreaper.Reaper(self.trash, workers=3)
+        self.assertEqual(len(reaper.pending()), 4)
+        statistics = reaper.reap()
+        self.assertEqual(statistics.entries, 4)
+        self.assertEqual(statistics.files, 2 * 201 + 1)
+        self.assertEqual(statistics.directories, 2 * 22 + 1)
+        self.assertEqual(os.listdir(self.trash), [])
+        self.assertEqual(reaper.pending(), [])
+        repr(statistics)
+
+        self.assertEqual(nabreaper.Reaper(os.path.join(self.testdir,
+                'missing')).reap().entries, 0)
+
+    def test_Pause(self):
+        '''Removal waits while paused and stops when asked.'''
+
+        make_tree(os.path.join(self.testdir, 'one'), 2, 5)
+        nabreaper.move_to_trash(os.path.join(self.testdir, 'one'),
+                self.testdir)
+
+        checks = []
+        sleeps = []
+
+        def paused():
+            checks.append(len(checks))
+            return len(checks) <= 3
+
+        reaper = nabreaper.Reaper(self.trash, paused=paused,
+                sleep=sleeps.append, check_interval=60)
+        self.assertEqual(reaper.reap().entries, 1)
+        self.assertEqual(sleeps, [60, 60, 60])
+        self.assertEqual(os.listdir(self.trash), [])
+
+        make_tree(os.path.join(self.testdir, 'two'), 2, 5)
+        nabreaper.move_to_trash(os.path.join(self.testdir, 'two'),
+                self.testdir)
+        reaper = nabreaper.Reaper(self.trash, paused=lambda: True,
+                sleep=lambda x: reaper.stop())
+        self.assertEqual(reaper.reap().entries, 0)
+        self.assertEqual(len(reaper.pending()), 1)
+
+    def test_RateLimiter(self):
+        '''Operations are spread out to the rate.'''
+
+        now = [100.0]
+        sleeps = []
+
+        def sleep(seconds):
+            sleeps.append(seconds)
+        limiter = nabreaper.RateLimiter(10, clock=lambda: now[0],
+                sleep=sleep)
+        limiter.acquire(5)
+        limiter.acquire(5)
+        limiter.acquire(1)
+        self.assertEqual(sleeps, [0.5, 1.0])
+        now[0] += 10
+        limiter.acquire(1)
+        self.assertEqual(len(sleeps), 2)
+
+        limiter = nabreaper.RateLimiter(None, sleep=sleep)
+        limiter.acquire(1000)
+        self.assertEqual(len(sleeps), 2)
+
+        make_tree(os.path.join(self.testdir, 'one'), 2, 5)
+        nabreaper.move_to_trash(os.path.join(self.testdir, 'one'),
+                self.testdir)
+        sleeps = []
+        reaper = nabreaper.Reaper(self.trash, workers=1, ops_per_second=5,
+                clock=lambda: now[0], sleep=sleep)
+        reaper.reap()
+        self.assertEqual(os.listdir(self.trash), [])
+        self.assertTrue(sum(sleeps) >= 2.0)
+
+
+if __name__ == '__main__':
+    print unittest.main()
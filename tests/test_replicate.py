@@ -0,0 +1,258 @@
+#!/usr/bin/env python
+#
+#  Copyright (c) 2012, Sean Reifschneider, tummy.com, ltd.
+#  All Rights Reserved.
+
+#  allow the test to be run from the "tests" or "tests" parent directory
+import sys
+import os
+if os.path.basename(os.getcwd()) == 'tests':
+    sys.path.append('../lib')
+else:
+    sys.path.append('./lib')
+
+import unittest
+import datetime
+import subprocess
+from nabdb import *
+import nabreaper
+import nabreplicate
+
+TARGET = 'offsite.example.com:offsite/nab'
+
+
+class TestReplicate(unittest.TestCase):
+    def setUp(self):
+        self.testdir = '/tmp/nabreplicatetest'
+        subprocess.call(['rm', '-rf', self.testdir])
+        self.root = os.path.join(self.testdir, 'backups')
+        self.target_root = os.path.join(self.testdir, 'offsite')
+        self.log = os.path.join(self.testdir, 'zfs.log')
+        bindir = os.path.join(self.testdir, 'bin')
+        os.makedirs(self.root)
+        os.mkdir(self.target_root)
+        os.mkdir(bindir)
+        helper = os.path.abspath(os.path.join(os.path.dirname(__file__),
+                'helper_fake_zfs'))
+        for command in ['zfs', 'ssh']:
+            os.symlink(helper, os.path.join(bindir, command))
+
+        self.environ = os.environ.copy()
+        os.environ['PATH'] = bindir + os.pathsep + os.environ['PATH']
+        os.environ['NAB_FAKE_ZFS_ROOT'] = self.root
+        os.environ['NAB_FAKE_ZFS_FILESYSTEM'] = 'tank/backups'
+        os.environ['NAB_FAKE_ZFS_TARGET_ROOT'] = self.target_root
+        os.environ['NAB_FAKE_ZFS_TARGET_FILESYSTEM'] = 'offsite/nab'
+        os.environ['NAB_FAKE_ZFS_LOG'] = self.log
+
+        nabdb.connect(connect='sqlite:///%s' % os.path.join(self.testdir,
+                'database'))
+        nabdb.Base.metadata.create_all()
+        db = nabdb.session()
+        server = BackupServer()
+        server.hostname = 'server.example.com'
+        db.add(server)
+        storage = Storage()
+        storage.backup_server = server
+        storage.method = 'zfs'
+        storage.arg1 = 'tank'
+        storage.arg2 = 'tank/backups'
+        storage.arg3 = self.root
+        db.add(storage)
+
+        self.plugin = storage.get_plugin()
+        self.hosts = {}
+        for hostname in ['host1', 'host2', 'host3']:
+            host = Host()
+            host.storage = storage
+            host.hostname = hostname
+            db.add(host)
+            self.hosts[hostname] = host
+            self.plugin.create_host(hostname)
+            self.write(hostname, 'first %s\n' % hostname)
+        db.commit()
+        self.db = db
+
+    def tearDown(self):
+        self.db.close()
+        nabdb.close()
+        os.environ.clear()
+        os.environ.update(self.environ)
+        subprocess.call(['rm', '-rf', self.testdir])
+
+    def write(self, hostname, data):
+        with open(os.path.join(self.root, hostname, 'data', 'file'),
+                'w') as fp:
+            fp.write(data)
+
+    def target_file(self, hostname, snapshotname=None):
+        path = os.path.join(self.target_root, hostname)
+        if snapshotname != None:
+            path = os.path.join(path, '.zfs', 'snapshot', snapshotname)
+        with open(os.path.join(path, 'data', 'file'), 'r') as fp:
+            return fp.read()
+
+    def commands(self):
+        with open(self.log, 'r') as fp:
+            commands = [x for x in fp.read().splitlines()
+                    if x.startswith('zfs send') or x.startswith('ssh')]
+        os.remove(self.log)
+        return sorted(commands)
+
+    def test_Commands(self):
+        '''Building the send and receive commands.'''
+
+        self.assertEqual(nabreplicate.parse_target('tank/nab'),
+                (None, 'tank/nab'))
+        self.assertEqual(nabreplicate.parse_target(TARGET),
+                ('offsite.example.com', 'offsite/nab'))
+        self.assertEqual(nabreplicate.send_command(self.plugin, 'host1',
+                'snap2', 'snap1'), ['zfs', 'send', '-i', '@snap1',
+                'tank/backups/host1@snap2'])
+        self.assertEqual(nabreplicate.receive_command(TARGET, 'host1'),
+                ['ssh', 'offsite.example.com', 'zfs', 'receive', '-F',
+                'offsite/nab/host1'])
+        self.assertEqual(nabreplicate.receive_command('tank/nab', 'host1'),
+                ['zfs', 'receive', '-F', 'tank/nab/host1'])
+
+    def test_BufferedPipe(self):
+        '''Copying a stream through a buffer, within a bandwidth limit.'''
+
+        source = os.path.join(self.testdir, 'source')
+        destination = os.path.join(self.testdir, 'destination')
+        data = ''.join([chr(x % 256) * 1000 for x in range(100)])
+        with open(source, 'w') as fp:
+            fp.write(data)
+
+        sleeps = []
+        limiter = nabreaper.RateLimiter(10000, clock=lambda: 0.0,
+                sleep=sleeps.append)
+        with open(source, 'r') as source_fp:
+            with open(destination, 'w') as destination_fp:
+                pipe = nabreplicate.BufferedPipe(source_fp, destination_fp,
+                        buffer_size=4096, chunk_size=1024, limiter=limiter)
+                self.assertEqual(pipe.run(), len(data))
+        with open(destination, 'r') as fp:
+            self.assertEqual(fp.read(), data)
+        self.assertEqual(pipe.peak_buffered <= 4, True)
+        #  100000 bytes at 10000 per second, waiting before the last 672
+        self.assertAlmostEqual(sleeps[-1], (len(data) - 672) / 10000.0)
+
+    def test_Replicate(self):
+        '''Full and incremental replication, and recording the lag.'''
+
+        db = self.db
+        self.plugin.create_snapshots([('host1', 'snap1'), ('host2', 'snap1')])
+        now = datetime.datetime.now()
+
+        replicator = nabreplicate.Replicator(db, TARGET, streams=2,
+                buffer_size=1024)
+        os.remove(self.log)
+        results = replicator.run(now=now)
+        self.assertEqual([(x.hostname, x.snapshot.name, x.base, x.error)
+                for x in results], [('host1', 'snap1', None, None),
+                ('host2', 'snap1', None, None)])
+        self.assertEqual(results[0].bytes_sent > 0, True)
+        self.assertEqual(self.commands(), [
+                'ssh offsite.example.com zfs list -H -r -t snapshot -o name '
+                'offsite/nab',
+                'ssh offsite.example.com zfs receive -F offsite/nab/host1',
+                'ssh offsite.example.com zfs receive -F offsite/nab/host2',
+                'zfs send tank/backups/host1@snap1',
+                'zfs send tank/backups/host2@snap1'])
+        self.assertEqual(self.target_file('host1', 'snap1'), 'first host1\n')
+        self.assertEqual(self.target_file('host2'), 'first host2\n')
+
+        replication = Replication.get(db, self.hosts['host1'], TARGET)
+        self.assertEqual(replication.snapshot_name, 'snap1')
+        self.assertEqual(replication.error, None)
+        self.assertEqual(replication.replicated_time, now)
+        self.assertEqual(replication.lag, now - replication.snapshot_time)
+        self.assertEqual(db.query(Replication).count(), 2)
+
+        #  up to date hosts are not sent, but their lag grows
+        later = now + datetime.timedelta(hours=1)
+        self.assertEqual(replicator.run(now=later), [])
+        self.assertEqual(replication.replicated_time, now)
+        self.assertEqual(replication.lag, later - replication.snapshot_time)
+
+        #  new snapshots are sent incrementally
+        self.write('host1', 'second host1\n')
+        self.write('host2', 'second host2\n')
+        self.plugin.create_snapshots([('host1', 'snap2'), ('host2', 'snap2')])
+        snapshots = os.path.join(self.target_root, 'host2', '.zfs',
+                'snapshot')
+        os.rename(os.path.join(snapshots, 'snap1'),
+                os.path.join(snapshots, 'stray'))
+        os.remove(self.log)
+        results = nabreplicate.Replicator(db, TARGET).run(['host1', 'host2'],
+                now=later)
+        self.assertEqual([(x.hostname, x.base) for x in results],
+                [('host1', 'snap1'), ('host2', None)])
+        self.assertEqual(self.commands()[1:], [
+                'ssh offsite.example.com zfs receive -F offsite/nab/host1',
+                'zfs send -i @snap1 tank/backups/host1@snap2'])
+        self.assertEqual(self.target_file('host1', 'snap2'),
+                'second host1\n')
+        self.assertEqual(self.target_file('host1', 'snap1'), 'first host1\n')
+        self.assertEqual(replication.snapshot_name, 'snap2')
+
+        #  the target no longer matches, the error is recorded
+        self.assertEqual(results[1].error.startswith('the target has no '
+                'snapshot in common'), True)
+        replication = Replication.get(db, self.hosts['host2'], TARGET)
+        self.assertEqual(replication.snapshot_name, 'snap1')
+        self.assertEqual(replication.error, results[1].error)
+        self.assertEqual(replication.replicated_time, now)
+
+        #  a full stream does not overwrite the snapshots on the target
+        snapshot = self.plugin.list_datasets('host2')['host2'].snapshots[-1]
+        result = nabreplicate.Replicator(db, TARGET).replicate(self.plugin,
+                'host2', snapshot, None)
+        self.assertEqual('destination has snapshots' in result.error, True)
+
+        #  the newest snapshot on both is sent from, whatever was recorded
+        self.write('host1', 'third host1\n')
+        self.plugin.create_snapshot('host1', 'snap3')
+        self.plugin.destroy_snapshot('host1', 'snap2')
+        results = nabreplicate.Replicator(db, TARGET).run(['host1'])
+        self.assertEqual([(x.base, x.error) for x in results],
+                [('snap1', None)])
+        self.assertEqual(self.target_file('host1', 'snap3'),
+                'third host1\n')
+
+        #  once the target has no snapshots, send it all again
+        subprocess.check_call(['rm', '-rf', os.path.join(snapshots,
+                'stray')])
+        results = nabreplicate.Replicator(db, TARGET).run(['host2'])
+        self.assertEqual([(x.base, x.error) for x in results], [(None, None)])
+        self.assertEqual(self.target_file('host2', 'snap2'),
+                'second host2\n')
+
+    def test_Failure(self):
+        '''A host that cannot be sent gets its error, the others go on.'''
+
+        db = self.db
+        self.plugin.create_snapshots([('host1', 'snap1'), ('host2', 'snap1')])
+        replicator = nabreplicate.Replicator(db, TARGET)
+        replicate = replicator.replicate
+
+        def failing(plugin, hostname, snapshot, base):
+            if hostname == 'host2':
+                raise OSError(2, 'No such file or directory')
+            return replicate(plugin, hostname, snapshot, base)
+        replicator.replicate = failing
+
+        results = replicator.run()
+        self.assertEqual([(x.hostname, x.error) for x in results],
+                [('host1', None), ('host2',
+                'OSError: [Errno 2] No such file or directory')])
+        replication = Replication.get(db, self.hosts['host2'], TARGET)
+        self.assertEqual(replication.error, results[1].error)
+        self.assertEqual(replication.snapshot_name, None)
+        self.assertEqual(Replication.get(db, self.hosts['host1'],
+                TARGET).snapshot_name, 'snap1')
+
+
+if __name__ == '__main__':
+    print unittest.main()
@@ -0,0 +1,196 @@
+#!/usr/bin/env python
+#
+#  Copyright (c) 2012, Sean Reifschneider, tummy.com, ltd.
+#  All Rights Reserved.
+
+#  allow the test to be run from the "tests" or "tests" parent directory
+import sys
+import os
+if os.path.basename(os.getcwd()) == 'tests':
+    sys.path.append('../lib')
+else:
+    sys.path.append('./lib')
+
+import unittest
+import errno
+import stat
+import tarfile
+import StringIO
+import subprocess
+import nabmanifest
+import nabrestore
+
+
+def write(path, data, mode=0644, mtime=1341100800):
+    with open(path, 'wb') as fp:
+        fp.write(data)
+    os.chmod(path, mode)
+    os.utime(path, (mtime, mtime))
+
+
+def read(path):
+    with open(path, 'rb') as fp:
+        return fp.read()
+
+
+def set_xattr(path, name, value):
+    '''Set an extended attribute, returning False if it is not supported.
+    '''
+    if nabrestore.libc_lsetxattr == None:
+        return False
+    try:
+        nabrestore.check_result(nabrestore.libc_lsetxattr(path, name, value,
+                len(value), 0))
+    except OSError:
+        return False
+    return True
+
+
+def get_xattr(path, name):
+    value = nabrestore.ctypes.create_string_buffer(256)
+    size = nabrestore.check_result(nabrestore.libc_lgetxattr(path, name,
+            value, 256))
+    return value.raw[:size]
+
+
+class TestRestore(unittest.TestCase):
+    def setUp(self):
+        self.testdir = '/tmp/nabrestoretest'
+        subprocess.call(['rm', '-rf', self.testdir])
+        os.mkdir(self.testdir)
+        self.source = os.path.join(self.testdir, 'source')
+        self.big = ''.join([chr(x % 251) for x in xrange(3 * 1024 * 1024)])
+
+        source = self.source
+        os.makedirs(os.path.join(source, 'dir', 'sub'))
+        write(os.path.join(source, 'dir', 'sub', 'small'), 'small\n', 0640)
+        write(os.path.join(source, 'dir', 'big'), self.big, 0600)
+        write(os.path.join(source, 'dir', 'linked'), 'linked\n')
+        os.link(os.path.join(source, 'dir', 'linked'),
+                os.path.join(source, 'other'))
+        os.symlink('dir/big', os.path.join(source, 'link'))
+        os.mkfifo(os.path.join(source, 'fifo'), 0600)
+        os.chmod(os.path.join(source, 'dir', 'sub'), 0750)
+        for path in ['dir/sub', 'dir']:
+            os.utime(os.path.join(source, path), (1341100000, 1341100000))
+
+    def tearDown(self):
+        subprocess.call(['rm', '-rf', self.testdir])
+
+    def listing(self, top):
+        return [(x.path, x.size, x.mode, x.mtime)
+                for x in nabmanifest.walk_tree(top)]
+
+    def test_CopyData(self):
+        '''Copying with the kernel, falling back to reading and writing.'''
+
+        source = os.path.join(self.source, 'dir', 'big')
+        destination = os.path.join(self.testdir, 'copy')
+        calls = []
+
+        def partial(source_fd, destination_fd, count):
+            #  copies some, then finds it cannot copy the rest
+            if calls:
+                raise OSError(errno.EXDEV, 'cross-device')
+            calls.append(count)
+            data = os.read(source_fd, 1000)
+            os.write(destination_fd, data)
+            return len(data)
+
+        def failing(source_fd, destination_fd, count):
+            raise OSError(errno.EIO, 'input/output error')
+
+        for kernel_copies in [None, [], [partial]]:
+            del calls[:]
+            source_fd = os.open(source, os.O_RDONLY)
+            destination_fd = os.open(destination, os.O_WRONLY | os.O_CREAT |
+                    os.O_TRUNC)
+            self.assertEqual(nabrestore.copy_data(source_fd, destination_fd,
+                    kernel_copies), len(self.big))
+            os.close(source_fd)
+            os.close(destination_fd)
+            self.assertEqual(read(destination), self.big)
+
+        source_fd = os.open(source, os.O_RDONLY)
+        destination_fd = os.open(destination, os.O_WRONLY)
+        self.assertRaises(OSError, nabrestore.copy_data, source_fd,
+                destination_fd, [failing])
+        os.close(source_fd)
+        os.close(destination_fd)
+
+    def test_Paths(self):
+        '''Cleaning up the paths to restore.'''
+
+        self.assertEqual(nabrestore.top_paths(None), [''])
+        self.assertEqual(nabrestore.top_paths(['/etc/', 'etc/passwd',
+                'var/../home/x', '../../root', 'etc-old']),
+                ['etc', 'etc-old', 'home/x', 'root'])
+        self.assertEqual(nabrestore.top_paths(['/', 'etc']), [''])
+
+    def test_Restore(self):
+        '''Restoring all of a snapshot, and parts of it.'''
+
+        xattrs = set_xattr(os.path.join(self.source, 'dir', 'sub', 'small'),
+                'user.nab', 'value')
+        destination = os.path.join(self.testdir, 'all')
+        statistics = nabrestore.restore(self.source, destination, threads=4)
+        self.assertEqual(self.listing(destination),
+                self.listing(self.source))
+        self.assertEqual(read(os.path.join(destination, 'dir', 'big')),
+                self.big)
+        self.assertEqual(os.readlink(os.path.join(destination, 'link')),
+                'dir/big')
+        linked = os.stat(os.path.join(destination, 'dir', 'linked'))
+        self.assertEqual(linked.st_ino, os.stat(os.path.join(destination,
+                'other')).st_ino)
+        self.assertNotEqual(linked.st_ino, os.stat(os.path.join(self.source,
+                'other')).st_ino)
+        self.assertEqual((statistics.files, statistics.hardlinks,
+                statistics.directories, statistics.symlinks,
+                statistics.bytes), (3, 1, 2, 1, len(self.big) + 13))
+        if xattrs:
+            self.assertEqual(get_xattr(os.path.join(destination, 'dir',
+                    'sub', 'small'), 'user.nab'), 'value')
+
+        #  parts, with the directories above them
+        destination = os.path.join(self.testdir, 'part')
+        statistics = nabrestore.restore(self.source, destination,
+                ['/dir/sub/small', 'dir/sub', 'other'], hardlinks=False)
+        self.assertEqual(self.listing(destination), [x for x in
+                self.listing(self.source) if x[0] in
+                ['dir', 'dir/sub', 'dir/sub/small', 'other']])
+        self.assertEqual((statistics.files, statistics.hardlinks), (2, 0))
+        self.assertEqual(os.stat(os.path.join(destination, 'dir',
+                'sub')).st_mode & 0777, 0750)
+
+        #  entries are not restored over existing ones
+        self.assertRaises(OSError, nabrestore.restore, self.source,
+                destination, ['other'])
+        self.assertRaises(ValueError, nabrestore.restore, self.source,
+                destination, ['missing'])
+
+    def test_Tar(self):
+        '''Streaming a tar archive.'''
+
+        fp = StringIO.StringIO()
+        self.assertEqual(nabrestore.write_tar(self.source, fp), 8)
+        fp.seek(0)
+        tar = tarfile.open(fileobj=fp, mode='r|')
+        self.assertEqual([(x.name, x.type) for x in tar], [
+                ('dir', tarfile.DIRTYPE), ('dir/big', tarfile.REGTYPE),
+                ('dir/linked', tarfile.REGTYPE), ('dir/sub', tarfile.DIRTYPE),
+                ('dir/sub/small', tarfile.REGTYPE),
+                ('fifo', tarfile.FIFOTYPE), ('link', tarfile.SYMTYPE),
+                ('other', tarfile.LNKTYPE)])
+
+        fp = StringIO.StringIO()
+        self.assertEqual(nabrestore.write_tar(self.source, fp, ['dir/sub']),
+                2)
+        fp.seek(0)
+        tar = tarfile.open(fileobj=fp, mode='r:')
+        self.assertEqual(tar.getnames(), ['dir/sub', 'dir/sub/small'])
+        self.assertEqual(tar.extractfile('dir/sub/small').read(), 'small\n')
+
+
+if __name__ == '__main__':
+    print unittest.main()
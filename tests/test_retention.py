@@ -0,0 +1,191 @@
+#!/usr/bin/env python
+#
+#  Copyright (c) 2012, Sean Reifschneider, tummy.com, ltd.
+#  All Rights Reserved.
+
+#  allow the test to be run from the "tests" or "tests" parent directory
+import sys
+import os
+if os.path.basename(os.getcwd()) == 'tests':
+    sys.path.append('../lib')
+else:
+    sys.path.append('./lib')
+
+import unittest
+import datetime
+import subprocess
+from nabdb import *
+import nabretention
+
+
+def add_backup(db, host, generation, day, successful=True, pid=None):
+    backup = Backup(host, generation, False)
+    backup.start_time = datetime.datetime(2012, 1, 1, 2, 0) + \
+            datetime.timedelta(days=day)
+    backup.successful = successful
+    backup.backup_pid = pid
+    backup.snapshot_name = '%s-%s' % (backup.start_time.strftime('%Y-%m-%d'),
+            generation)
+    db.add(backup)
+    return backup
+
+
+class TestRetention(unittest.TestCase):
+    def setUp(self):
+        self.testdir = '/tmp/nabretentiontest'
+        subprocess.call(['rm', '-rf', self.testdir])
+        os.mkdir(self.testdir)
+        self.dbfile = os.path.join(self.testdir, 'database')
+        nabdb.connect(connect='sqlite:///%s' % self.dbfile)
+        nabdb.Base.metadata.create_all()
+
+        db = nabdb.session()
+        server = BackupServer()
+        server.hostname = 'server.example.com'
+        db.add(server)
+
+        storage = Storage()
+        storage.backup_server = server
+        storage.method = 'hardlinks'
+        storage.arg1 = self.testdir
+        db.add(storage)
+
+        config = HostConfig()
+        config.daily_history = 3
+        config.weekly_history = 2
+        db.add(config)
+
+        self.hosts = {}
+        for hostname, window in [('window.example.com', (1, 5)),
+                ('anytime.example.com', None),
+                ('inwindow.example.com', (11, 13)),
+                ('running.example.com', None)]:
+            host = Host()
+            host.storage = storage
+            host.hostname = hostname
+            if window:
+                host.window_start = datetime.time(window[0], 0)
+                host.window_end = datetime.time(window[1], 0)
+            db.add(host)
+            self.hosts[hostname] = host
+
+        self.db = db
+        self.storage = storage
+
+    def tearDown(self):
+        self.db.close()
+        nabdb.close()
+        subprocess.call(['rm', '-rf', self.testdir])
+
+    def test_FindExpired(self):
+        '''Backups outside the retention policy of each host.'''
+
+        db = self.db
+        host = self.hosts['window.example.com']
+        backups = {}
+        for day in range(1, 7):
+            backups['d%d' % day] = add_backup(db, host, 'daily', day,
+                    successful=day != 4)
+        for week in range(1, 4):
+            backups['w%d' % week] = add_backup(db, host, 'weekly',
+                    week * 7 - 30)
+        for month in range(1, 3):
+            backups['m%d' % month] = add_backup(db, host, 'monthly',
+                    month * 30 - 90)
+        expired_backup = add_backup(db, host, 'daily', -100)
+        expired_backup.expired = True
+
+        #  nothing has succeeded, so nothing is expired
+        other = self.hosts['anytime.example.com']
+        add_backup(db, other, 'daily', 1, successful=False)
+        add_backup(db, other, 'daily', 2, successful=False)
+        db.commit()
+
+        expired = nabretention.find_expired(db)
+        self.assertEqual(expired.keys(), [host.id])
+        self.assertEqual([x.backup_id for x in expired[host.id]],
+                [backups[x].id for x in ['w1', 'd1', 'd2', 'd4']])
+        self.assertEqual(nabretention.find_expired(db, [other.id]), {})
+
+        #  the host config overrides the global one, monthlies are unlimited
+        config = HostConfig()
+        config.host = host
+        config.daily_history = 1
+        config.weekly_history = None
+        db.add(config)
+        db.commit()
+        self.assertEqual([x.backup_id
+                for x in nabretention.find_expired(db)[host.id]],
+                [backups[x].id for x in ['w1', 'd1', 'd2', 'd3', 'd4',
+                'd5']])
+
+        #  the last snapshot replicated is kept for the next replication
+        replication = Replication(host, 'offsite.example.com:tank/nab')
+        replication.snapshot_name = backups['d2'].snapshot_name
+        db.add(replication)
+        db.commit()
+        self.assertEqual([x.backup_id
+                for x in nabretention.find_expired(db)[host.id]],
+                [backups[x].id for x in ['w1', 'd1', 'd3', 'd4', 'd5']])
+
+    def test_ExpireSnapshots(self):
+        '''Planning and destroying expired snapshots.'''
+
+        db = self.db
+        plugin = self.storage.get_plugin()
+        for hostname, host in self.hosts.items():
+            plugin.create_host(hostname)
+            pid = None
+            if hostname == 'running.example.com':
+                pid = os.getpid()
+            for day in range(1, 6):
+                backup = add_backup(db, host, 'daily', day)
+                if day == 5:
+                    backup.backup_pid = pid
+                if day == 1:
+                    continue
+                data = os.path.join(self.testdir, hostname, 'snapshots',
+                        backup.snapshot_name, 'data')
+                os.makedirs(data)
+                with open(os.path.join(data, 'file'), 'w') as fp:
+                    fp.write('day %d\n' % day * 1000)
+        db.commit()
+
+        now = datetime.datetime(2012, 1, 10, 12, 0)
+        self.assertEqual(nabretention.time_until_window(
+                self.hosts['window.example.com'], now),
+                datetime.timedelta(hours=13))
+        self.assertEqual(nabretention.time_until_window(
+                self.hosts['anytime.example.com'], now), None)
+
+        batch, deferred = nabretention.plan_expiry(db, now)
+        self.assertEqual([x[0].hostname for x in batch],
+                ['window.example.com', 'anytime.example.com'])
+        self.assertEqual([x[0].hostname for x in deferred],
+                ['inwindow.example.com', 'running.example.com'])
+        self.assertEqual([x.snapshot_name for x in batch[0][1]],
+                ['2012-01-02-daily', '2012-01-03-daily'])
+        #  forced, "inwindow" opens again in 23 hours, "window" in 13
+        batch, deferred = nabretention.plan_expiry(db, now, force=True)
+        self.assertEqual([x[0].hostname for x in batch],
+                ['inwindow.example.com', 'window.example.com',
+                'anytime.example.com'])
+        batch = batch[1:]
+
+        host = self.hosts['window.example.com']
+        reclaimable = nabretention.reclaimable_bytes(host, batch[0][1])
+        self.assertEqual(reclaimable > 0, True)
+
+        self.assertEqual(nabretention.expire_snapshots(db, batch[:1]), 2)
+        self.assertEqual(sorted(os.listdir(os.path.join(self.testdir,
+                'window.example.com', 'snapshots'))),
+                ['2012-01-04-daily', '2012-01-05-daily', '2012-01-06-daily'])
+        self.assertEqual(len(os.listdir(plugin.trash_directory())), 1)
+        self.assertEqual([x.snapshot_name for x in db.query(Backup).filter_by(
+                host=host, expired=True).order_by(Backup.start_time)],
+                ['2012-01-02-daily', '2012-01-03-daily'])
+        self.assertEqual(nabretention.find_expired(db, [host.id]), {})
+
+
+if __name__ == '__main__':
+    print unittest.main()
@@ -0,0 +1,154 @@
+#!/usr/bin/env python
+#
+#  Copyright (c) 2012, Sean Reifschneider, tummy.com, ltd.
+#  All Rights Reserved.
+
+#  allow the test to be run from the "tests" or "tests" parent directory
+import sys
+import os
+if os.path.basename(os.getcwd()) == 'tests':
+    sys.path.append('../lib')
+else:
+    sys.path.append('./lib')
+
+import unittest
+import StringIO
+import nabrsync
+
+rsync_output = '''receiving incremental file list
+.d..t...... 4096 ./
+cd+++++++++ 4096 etc/
+>f+++++++++ 1000 etc/hosts
+>f+++++++++ 2500 etc/with space
+>f.st...... 300 etc/passwd
+.f...p..... 10 etc/shadow
+cL+++++++++ 7 etc/localtime -> /usr/share/zoneinfo/UTC
+hf+++++++++ 1000 etc/hosts.bak => etc/hosts
+*deleting   0 etc/old/
+*deleting   0 etc/old/file
+rsync: send_files failed to open "/etc/secret": Permission denied (13)
+
+Number of files: 1,234 (reg: 1,000, dir: 234)
+Number of created files: 4 (reg: 3, dir: 1)
+Number of deleted files: 2 (reg: 1, dir: 1)
+Number of regular files transferred: 3
+Total file size: 12,345,678 bytes
+Total transferred file size: 3,800 bytes
+Literal data: 3,500 bytes
+Matched data: 300 bytes
+File list size: 23,456
+File list generation time: 0.125 seconds
+File list transfer time: 0.000 seconds
+Total bytes sent: 1,234
+Total bytes received: 56,789
+
+sent 1,234 bytes  received 56,789 bytes  116,046.00 bytes/sec
+total size is 12,345,678  speedup is 212.77
+rsync error: some files/attrs were not transferred (code 23)
+'''
+
+
+class Record:
+    pass
+
+
+class TestRsync(unittest.TestCase):
+
+    def test_Parser(self):
+        '''Parse itemized changes and "--stats" totals.'''
+
+        parser = nabrsync.RsyncOutputParser()
+        for line in StringIO.StringIO(rsync_output):
+            parser.feed(line)
+
+        self.assertEqual(parser.files_created, 2)
+        self.assertEqual(parser.bytes_created, 3500)
+        self.assertEqual(parser.files_updated, 1)
+        self.assertEqual(parser.bytes_updated, 300)
+        self.assertEqual(parser.files_deleted, 2)
+        self.assertEqual(parser.directories_created, 1)
+        self.assertEqual(parser.links_created, 2)
+        self.assertEqual(parser.attributes_changed, 2)
+        self.assertEqual(parser.errors, 2)
+
+        self.assertEqual(parser.stats['total_files'], 1234)
+        self.assertEqual(parser.stats['files_transferred'], 3)
+        self.assertEqual(parser.stats['total_file_size'], 12345678)
+        self.assertEqual(parser.stats['literal_data'], 3500)
+        self.assertEqual(parser.stats['matched_data'], 300)
+        self.assertEqual(parser.stats['file_list_size'], 23456)
+        self.assertEqual(parser.stats['file_list_generation_seconds'], 0.125)
+        self.assertEqual(parser.stats['bytes_received'], 56789)
+
+        record = Record()
+        parser.fill(record)
+        self.assertEqual(record.files_created, 2)
+        self.assertEqual(record.literal_data, 3500)
+
+        record = Record()
+        nabrsync.RsyncOutputParser().fill(record)
+        self.assertEqual(record.files_created, 0)
+        self.assertEqual(record.literal_data, None)
+
+    def test_RunRsync(self):
+        '''Stream the output of a command through the parser.'''
+
+        parser = nabrsync.RsyncOutputParser()
+        log_fp = StringIO.StringIO()
+        returncode = nabrsync.run_rsync(['sh', '-c',
+                'cat; echo "Literal data: 10 bytes" >&2; exit 23'],
+                parser, log_fp)
+        self.assertEqual(returncode, 23)
+        self.assertEqual(parser.stats, {'literal_data': 10})
+        self.assertEqual(log_fp.getvalue(), 'Literal data: 10 bytes\n')
+
+        #  input is piped to the command, even if it does not read it
+        log_fp = StringIO.StringIO()
+        returncode = nabrsync.run_rsync(['cat'], parser, log_fp,
+                input='exclude /tmp/\n')
+        self.assertEqual(returncode, 0)
+        self.assertEqual(log_fp.getvalue(), 'exclude /tmp/\n')
+        returncode = nabrsync.run_rsync(['true'], parser, log_fp,
+                input='x' * 1000000)
+        self.assertEqual(returncode, 0)
+
+        #  input larger than the pipe buffers, echoed back as it is read
+        rules = ''.join(['exclude /home/user%d/\n' % x for x in
+                xrange(50000)])
+        log_fp = StringIO.StringIO()
+        returncode = nabrsync.run_rsync(['cat'], parser, log_fp, input=rules)
+        self.assertEqual(returncode, 0)
+        self.assertEqual(log_fp.getvalue(), rules)
+
+    def test_Progress(self):
+        '''Parse "--info=progress2" reports separated by carriage returns.
+        '''
+
+        reports = []
+        parser = nabrsync.RsyncOutputParser(progress=lambda x: reports.append(
+                (x.transferred_bytes(), x.progress_percent, x.progress_files,
+                x.progress_total_files, x.last_item)))
+        log_fp = StringIO.StringIO()
+        output = ('\r     32,768   0%    0.00kB/s    0:00:00\r'
+                '  1,048,576  12%    1.02MB/s    0:00:07 '
+                '(xfr#5, ir-chk=1000/2000)\n'
+                '>f+++++++++ 1000 etc/hosts\n'
+                '\r  2,097,152 100%    2.00MB/s    0:00:01 '
+                '(xfr#10, to-chk=0/20)\n')
+        returncode = nabrsync.run_rsync(['printf', '%s', output], parser,
+                log_fp)
+        self.assertEqual(returncode, 0)
+        self.assertEqual(log_fp.getvalue(), output)
+        self.assertEqual(reports, [
+                (32768, 0, None, None, None),
+                (1048576, 12, 5, 2000, None),
+                (1048576, 12, 5, 2000, 'etc/hosts'),
+                (2097152, 100, 10, 20, 'etc/hosts')])
+
+        parser = nabrsync.RsyncOutputParser()
+        parser.feed('>f+++++++++ 1000 etc/hosts')
+        parser.feed('>f..t...... 24 etc/motd')
+        self.assertEqual(parser.transferred_bytes(), 1024)
+
+if __name__ == '__main__':
+    print unittest.main()
@@ -0,0 +1,370 @@
+#!/usr/bin/env python
+#
+#  Copyright (c) 2012, Sean Reifschneider, tummy.com, ltd.
+#  All Rights Reserved.
+
+#  allow the test to be run from the "tests" or "tests" parent directory
+import sys
+import os
+if os.path.basename(os.getcwd()) == 'tests':
+    sys.path.append('../lib')
+else:
+    sys.path.append('./lib')
+
+import unittest
+import datetime
+import fcntl
+import subprocess
+from nabdb import *
+import nabscheduler
+import nabiostat
+import nabprobe
+
+
+def fake_backup(db, hostname):
+    '''Stand-in for `run_backup_for_host()` used by the scheduler tests.'''
+    return hostname != 'fails.example.com'
+
+
+def add_host(db, storage, hostname, priority=None, window=None,
+        next_backup=None, active=True):
+    host = Host()
+    host.storage = storage
+    host.hostname = hostname
+    host.active = active
+    host.next_backup = next_backup
+    if window:
+        host.window_start = datetime.time(window[0], 0)
+        host.window_end = datetime.time(window[1], 0)
+    db.add(host)
+
+    config = HostConfig()
+    config.host = host
+    config.priority = priority
+    db.add(config)
+    return host
+
+
+class TestScheduler(unittest.TestCase):
+    def setUp(self):
+        self.dbfile = '/tmp/nabschedulertestdatabase'
+        if os.path.exists(self.dbfile):
+            os.remove(self.dbfile)
+        nabdb.connect(connect='sqlite:///%s' % self.dbfile)
+        nabdb.Base.metadata.create_all()
+
+        db = nabdb.session()
+        server = BackupServer()
+        server.hostname = 'server.example.com'
+        server.scheduler_slots = 2
+        db.add(server)
+
+        storage = Storage()
+        storage.backup_server = server
+        storage.method = 'hardlinks'
+        storage.arg1 = '/tmp/nabschedulertest'
+        db.add(storage)
+
+        config_default = HostConfig()
+        config_default.priority = 5
+        db.add(config_default)
+        db.commit()
+
+        self.db = db
+        self.server = server
+        self.storage = storage
+
+    def tearDown(self):
+        self.db.close()
+        nabdb.close()
+        os.remove(self.dbfile)
+
+    def test_BackupWindow(self):
+        '''Host backup windows, including windows spanning midnight.'''
+
+        host = Host()
+        self.assertEqual(host.in_backup_window(), True)
+
+        host.window_start = datetime.time(1, 0)
+        host.window_end = datetime.time(5, 0)
+        self.assertEqual(host.in_backup_window(
+                datetime.datetime(2012, 1, 1, 0, 59)), False)
+        self.assertEqual(host.in_backup_window(
+                datetime.datetime(2012, 1, 1, 1, 0)), True)
+        self.assertEqual(host.in_backup_window(
+                datetime.datetime(2012, 1, 1, 5, 0)), False)
+
+        host.window_start = datetime.time(22, 0)
+        self.assertEqual(host.in_backup_window(
+                datetime.datetime(2012, 1, 1, 23, 0)), True)
+        self.assertEqual(host.in_backup_window(
+                datetime.datetime(2012, 1, 1, 3, 0)), True)
+        self.assertEqual(host.in_backup_window(
+                datetime.datetime(2012, 1, 1, 12, 0)), False)
+
+    def test_ComputeNextBackup(self):
+        '''Scheduling of the next backup after one completes.'''
+
+        host = Host()
+        now = datetime.datetime(2012, 1, 1, 3, 0)
+        self.assertEqual(host.compute_next_backup(now),
+                datetime.datetime(2012, 1, 2, 3, 0))
+        self.assertEqual(host.compute_next_backup(now, successful=False),
+                datetime.datetime(2012, 1, 1, 4, 0))
+
+        host.window_start = datetime.time(1, 0)
+        host.window_end = datetime.time(5, 0)
+        self.assertEqual(host.compute_next_backup(now),
+                datetime.datetime(2012, 1, 2, 1, 0))
+
+        host.window_start = datetime.time(22, 0)
+        self.assertEqual(host.compute_next_backup(now),
+                datetime.datetime(2012, 1, 1, 22, 0))
+        self.assertEqual(host.compute_next_backup(
+                datetime.datetime(2012, 1, 1, 23, 0)),
+                datetime.datetime(2012, 1, 2, 22, 0))
+
+    def test_DueHosts(self):
+        '''Selection and ordering of hosts that are due for backup.'''
+
+        now = datetime.datetime(2012, 1, 1, 2, 0)
+        add_host(self.db, self.storage, 'default.example.com')
+        add_host(self.db, self.storage, 'first.example.com', priority=1)
+        add_host(self.db, self.storage, 'inactive.example.com', priority=1,
+                active=False)
+        add_host(self.db, self.storage, 'window.example.com', priority=1,
+                window=(3, 5))
+        add_host(self.db, self.storage, 'future.example.com', priority=1,
+                next_backup=datetime.datetime(2012, 1, 1, 2, 1))
+        add_host(self.db, self.storage, 'past.example.com', priority=9,
+                next_backup=datetime.datetime(2012, 1, 1, 1, 59))
+        self.db.commit()
+
+        scheduler = nabscheduler.Scheduler(self.db, self.server)
+        self.assertEqual([x.hostname for x in scheduler.due_hosts(now)], [
+                'first.example.com', 'default.example.com',
+                'past.example.com'])
+
+    def test_RunOnce(self):
+        '''Filling the scheduler slots and recording completed backups.'''
+
+        for i in range(3):
+            add_host(self.db, self.storage, 'client%d.example.com' % i,
+                    priority=i + 1)
+        add_host(self.db, self.storage, 'fails.example.com', priority=0)
+        self.db.commit()
+
+        scheduler = nabscheduler.Scheduler(self.db, self.server,
+                backup_function=fake_backup)
+        started = scheduler.run_once()
+        self.assertEqual([x.hostname for x in started],
+                ['fails.example.com', 'client0.example.com'])
+        self.assertEqual(scheduler.free_slots(), 0)
+
+        scheduler.wait()
+        self.assertEqual(scheduler.free_slots(), 2)
+        before = datetime.datetime.now()
+        failed = self.db.query(Host).filter_by(
+                hostname='fails.example.com').first()
+        self.assertTrue(failed.next_backup < before
+                + datetime.timedelta(hours=1))
+        succeeded = self.db.query(Host).filter_by(
+                hostname='client0.example.com').first()
+        self.assertTrue(succeeded.next_backup > before
+                + datetime.timedelta(hours=23))
+
+        started = scheduler.run_once()
+        self.assertEqual([x.hostname for x in started],
+                ['client1.example.com', 'client2.example.com'])
+        scheduler.wait()
+        self.assertEqual(scheduler.run_once(), [])
+
+    def test_StorageConcurrency(self):
+        '''Per-storage limits on the number of running backups.'''
+
+        self.storage.max_concurrent_backups = 1
+        storage2 = Storage()
+        storage2.backup_server = self.server
+        storage2.method = 'hardlinks'
+        storage2.arg1 = '/tmp/nabschedulertest2'
+        db = self.db
+        db.add(storage2)
+        add_host(db, self.storage, 'client1.example.com', priority=1)
+        add_host(db, self.storage, 'client2.example.com', priority=2)
+        add_host(db, storage2, 'client3.example.com', priority=3)
+        db.commit()
+
+        scheduler = nabscheduler.Scheduler(self.db, self.server,
+                backup_function=fake_backup)
+        started = scheduler.run_once()
+        self.assertEqual([x.hostname for x in started],
+                ['client1.example.com', 'client3.example.com'])
+        scheduler.wait()
+
+        started = scheduler.run_once()
+        self.assertEqual([x.hostname for x in started],
+                ['client2.example.com'])
+        scheduler.wait()
+
+    def test_CheckConnectivity(self):
+        '''Hosts are only started if they pass their connectivity check.'''
+
+        def fake_probe(addresses):
+            return dict([(x, nabprobe.ProbeResult(x, x != 'off.example.com',
+                    {'192.0.2.1': 5.0, 'far.example.com': 100.0}.get(x),
+                    0)) for x in addresses])
+
+        db = self.db
+        db.query(HostConfig).filter_by(host_id=None).first(
+                ).check_connectivity = True
+        off = add_host(db, self.storage, 'off.example.com', priority=1)
+        far = add_host(db, self.storage, 'far.example.com', priority=2)
+        far.configs[0].ping_max_ms = 50
+        near = add_host(db, self.storage, 'near.example.com', priority=3)
+        near.ip_address = '192.0.2.1'
+        near.configs[0].ping_max_ms = 50
+        db.commit()
+
+        self.server.scheduler_slots = 3
+        scheduler = nabscheduler.Scheduler(self.db, self.server,
+                backup_function=fake_backup,
+                prober=nabprobe.ProbeCache(probe_function=fake_probe))
+        started = scheduler.run_once()
+        self.assertEqual([x.hostname for x in started], ['near.example.com'])
+        scheduler.wait()
+
+    def test_OrderByRuntime(self):
+        '''Longest expected backups first, skipping ones that will not fit
+        in the remaining window.'''
+
+        class Row:
+            def __init__(self, id, priority, window=None):
+                self.id = id
+                self.priority = priority
+                self.window_start = self.window_end = None
+                if window:
+                    self.window_start = datetime.time(window[0], 0)
+                    self.window_end = datetime.time(window[1], 0)
+
+        self.assertEqual(nabscheduler.window_length(datetime.time(22, 0),
+                datetime.time(2, 0)), datetime.timedelta(hours=4))
+        self.assertEqual(nabscheduler.window_remaining(datetime.time(22, 0),
+                datetime.time(2, 0), datetime.datetime(2012, 1, 1, 23, 30)),
+                datetime.timedelta(hours=2, minutes=30))
+        self.assertEqual(nabscheduler.window_remaining(None, None,
+                datetime.datetime(2012, 1, 1, 23, 30)), None)
+
+        hours = lambda x: datetime.timedelta(hours=x)
+        rows = [Row(1, 1), Row(2, 1), Row(3, 1), Row(4, 2), Row(5, 2),
+                Row(6, 2, window=(0, 5)), Row(7, 2, window=(0, 2)),
+                Row(8, None)]
+        estimates = {1: hours(1), 2: hours(3), 4: hours(1), 5: hours(2),
+                6: hours(5), 7: hours(3), 8: hours(9)}
+        ordered = nabscheduler.order_by_runtime(rows, estimates,
+                datetime.datetime(2012, 1, 1, 0, 30))
+        self.assertEqual([x.id for x in ordered], [3, 2, 1, 7, 5, 4, 8])
+
+    def test_DeviceMonitor(self):
+        '''Sampling device utilization from diskstats.'''
+
+        st_dev = os.stat('/tmp').st_dev
+        diskstats = '/tmp/nabschedulertestdiskstats'
+        now = [1000.0]
+
+        def write_diskstats(ios, sectors, ms_io, ms_doing_io):
+            with open(diskstats, 'w') as fp:
+                fp.write('   1       0 other 1 2 3 4 5 6 7 8 9 10 11\n')
+                fp.write('%4d %7d test %d 0 %d %d %d 0 %d %d 0 %d %d\n' % (
+                        os.major(st_dev), os.minor(st_dev), ios, sectors,
+                        ms_io, ios, sectors, ms_io, ms_doing_io,
+                        ms_doing_io))
+
+        write_diskstats(0, 0, 0, 0)
+        monitor = nabiostat.DeviceMonitor('/tmp', diskstats,
+                clock=lambda: now[0])
+        self.assertEqual(monitor.available(), True)
+        self.assertEqual(monitor.sample(), None)
+        self.assertEqual(monitor.is_saturated(50), False)
+
+        write_diskstats(100, 2048, 500, 9500)
+        now[0] += 10
+        self.assertEqual(monitor.sample(), 95.0)
+        self.assertEqual(monitor.bytes_per_second, 4096 * 512 / 10.0)
+        self.assertEqual(monitor.latency_ms, 5.0)
+        self.assertEqual(monitor.is_saturated(90), True)
+        self.assertEqual(monitor.is_saturated(None), False)
+
+        #  counters are unchanged, so the device is now idle
+        def fake_sleep(seconds):
+            now[0] += seconds
+        self.assertEqual(monitor.wait_until_idle(90, interval=5, timeout=20,
+                sleep=fake_sleep), True)
+        self.assertEqual(monitor.wait_until_idle(None), True)
+
+        admission = nabscheduler.StorageAdmission(diskstats)
+        self.storage.arg1 = '/tmp'
+        self.storage.max_io_busy_percent = 90
+        self.assertEqual(admission.admit(self.storage, 0), True)
+        admission.monitors[self.storage.id] = monitor
+        write_diskstats(100, 2048, 500, 19500)
+        now[0] += 10
+        admission.sample([self.storage])
+        self.assertEqual(admission.admit(self.storage, 0), False)
+        self.storage.max_io_busy_percent = None
+        self.assertEqual(admission.admit(self.storage, 0), True)
+        os.remove(diskstats)
+
+    def test_SampleUsage(self):
+        '''The scheduler records the usage of each storage once a day.'''
+
+        storage2 = Storage()
+        storage2.backup_server = self.server
+        storage2.method = 'hardlinks'
+        storage2.arg1 = '/tmp/nabschedulertest-missing'
+        self.db.add(storage2)
+        self.storage.arg1 = '/tmp'
+        self.db.commit()
+
+        scheduler = nabscheduler.Scheduler(self.db, self.server,
+                backup_function=lambda db, hostname: True)
+        scheduler.run_once(datetime.datetime(2012, 1, 1, 3, 0))
+        usage = list(self.db.query(StorageUsage))
+        self.assertEqual(len(usage), 1)
+        self.assertEqual(usage[0].storage_id, self.storage.id)
+        self.assertEqual(usage[0].sample_date, datetime.date(2012, 1, 1))
+        self.assertEqual(scheduler.usage_sampled_date,
+                datetime.date(2012, 1, 1))
+
+        scheduler.run_once(datetime.datetime(2012, 1, 1, 4, 0))
+        self.assertEqual(self.db.query(StorageUsage).count(), 1)
+        scheduler.run_once(datetime.datetime(2012, 1, 2, 3, 0))
+        self.assertEqual(self.db.query(StorageUsage).count(), 2)
+
+    def test_SampleUsageBusy(self):
+        '''A busy storage is not waited for, but sampled on a later pass.'''
+
+        directory = '/tmp/nabschedulertest-chunks'
+        subprocess.call(['rm', '-rf', directory])
+        self.storage.method = 'chunks'
+        self.storage.arg1 = directory
+        self.db.commit()
+        self.storage.get_plugin().open_store().close()
+
+        #  as if collecting garbage
+        fp = open(os.path.join(directory, '.nab-chunks', 'lock'), 'a')
+        fcntl.flock(fp, fcntl.LOCK_EX)
+        scheduler = nabscheduler.Scheduler(self.db, self.server,
+                backup_function=lambda db, hostname: True)
+        scheduler.run_once(datetime.datetime(2012, 1, 1, 3, 0))
+        self.assertEqual(self.db.query(StorageUsage).count(), 0)
+        self.assertEqual(scheduler.usage_busy, set([self.storage.id]))
+
+        fp.close()
+        scheduler.run_once(datetime.datetime(2012, 1, 1, 3, 1))
+        self.assertEqual(self.db.query(StorageUsage).count(), 1)
+        self.assertEqual(scheduler.usage_busy, set())
+        subprocess.call(['rm', '-rf', directory])
+
+
+if __name__ == '__main__':
+    print unittest.main()
@@ -14,6 +14,7 @@ else:
 import unittest
 import os
 import subprocess
+import nabmanifest
 
 
 class TestHardlinkStorage(unittest.TestCase):
@@ -50,6 +51,9 @@ class TestHardlinkStorage(unittest.TestCase):
         with open(datafile, 'w') as fp:
             fp.write('This is a test\n')
         storage.create_snapshot('example.com', 'snap1')
+        self.assertEqual([x.path for x in nabmanifest.read_manifest(
+                storage.get_manifest_path('example.com', 'snap1'))],
+                ['testfile'])
         storage.mount_snapshot('example.com', 'snap1')
         with open(os.path.join(testdirname, 'example.com', 'snapshots',
                 'snap1', 'data', 'testfile'), 'r') as fp:
@@ -63,16 +67,238 @@ class TestHardlinkStorage(unittest.TestCase):
                 'snap2', 'data', 'testfile'), 'r') as fp:
             self.assertEqual(fp.readline(), 'This is another test\n')
 
+        report = storage.account_usage('example.com')
+        self.assertEqual([x.name for x in report.snapshots],
+                ['snap1', 'snap2'])
+        self.assertEqual(report.snapshots[1].exclusive_bytes, 0)
+        self.assertEqual(report.used_by_dataset > 0, True)
+
         storage.destroy_snapshot('example.com', 'snap1')
         self.assertEqual(os.path.exists(os.path.join(testdirname,
                 'example.com', 'snapshots', 'snap1')), False)
+        self.assertEqual(len(os.listdir(storage.trash_directory())), 1)
 
         self.assertEqual(storage.storage_usage() >= 0, True)
         self.assertEqual(storage.storage_usage() <= 100, True)
+        statistics = storage.storage_statistics()
+        self.assertEqual(statistics.total_bytes > 0, True)
+        self.assertEqual(statistics.used_bytes + statistics.free_bytes
+                <= statistics.total_bytes, True)
+        self.assertEqual(statistics.usage_percent(),
+                storage.storage_usage())
 
         storage.destroy_host('example.com')
         self.assertEqual(os.path.exists(os.path.join(testdirname,
                 'example.com')), False)
 
+    def test_LinkDest(self):
+        '''Hardlink storage writing backups directly to snapshots.'''
+
+        from nabstorageplugins import hardlinks
+
+        testdirname = '/tmp/nabhardlinkstoragetest'
+        subprocess.call(['rm', '-rf', testdirname])
+        os.mkdir(testdirname)
+
+        with self.assertRaises(ValueError):
+            hardlinks.Storage([testdirname, 'unknown', None, None, None])
+        self.assertEqual(hardlinks.Storage([testdirname, None, None, None,
+                None]).mode, 'snapshot')
+        self.assertEqual(hardlinks.Storage([testdirname, None, None, None,
+                None]).get_rsync_arguments('example.com', 'snap1', None), [])
+
+        storage = hardlinks.Storage([testdirname, 'link-dest', None, None,
+                None])
+        storage.create_host('example.com')
+        snapshots = os.path.join(testdirname, 'example.com', 'snapshots')
+
+        destination = storage.get_backup_destination('example.com', 'snap1')
+        self.assertEqual(destination, os.path.join(snapshots, 'snap1',
+                'data'))
+        self.assertEqual(os.path.isdir(destination), True)
+        self.assertEqual(storage.get_rsync_arguments('example.com', 'snap1',
+                None), [])
+        with open(os.path.join(destination, 'testfile'), 'w') as fp:
+            fp.write('This is a test\n')
+        with open(os.path.join(testdirname, 'example.com', 'logs',
+                'status.out'), 'w') as fp:
+            fp.write('Done\n')
+        self.assertEqual(storage.create_snapshot('example.com', 'snap1'),
+                None)
+        self.assertEqual(os.path.exists(os.path.join(snapshots, 'snap1',
+                'logs', 'status.out')), True)
+        self.assertEqual([x.path for x in nabmanifest.read_manifest(
+                storage.get_manifest_path('example.com', 'snap1'))],
+                ['testfile'])
+        with self.assertRaises(ValueError):
+            storage.create_snapshot('example.com', 'snap1')
+
+        storage.get_backup_destination('example.com', 'snap2')
+        self.assertEqual(storage.get_rsync_arguments('example.com', 'snap2',
+                'snap1'), ['--link-dest=%s' % os.path.join(snapshots,
+                'snap1', 'data')])
+
+        #  the previous snapshot has been removed, use the most recent
+        storage.get_backup_destination('example.com', 'snap3')
+        self.assertEqual(storage.get_rsync_arguments('example.com', 'snap3',
+                'snap0'), ['--link-dest=%s' % os.path.join(snapshots,
+                'snap2', 'data')])
+
+        subprocess.call(['rm', '-rf', testdirname])
+
+
+class TestZfsStorage(unittest.TestCase):
+
+    def setUp(self):
+        self.testdir = '/tmp/nabzfsstoragetest'
+        subprocess.call(['rm', '-rf', self.testdir])
+        self.root = os.path.join(self.testdir, 'backups')
+        self.log = os.path.join(self.testdir, 'zfs.log')
+        bindir = os.path.join(self.testdir, 'bin')
+        os.makedirs(self.root)
+        os.mkdir(bindir)
+        helper = os.path.abspath(os.path.join(os.path.dirname(__file__),
+                'helper_fake_zfs'))
+        os.symlink(helper, os.path.join(bindir, 'zfs'))
+        os.symlink(helper, os.path.join(bindir, 'zpool'))
+
+        self.environ = os.environ.copy()
+        os.environ['PATH'] = bindir + os.pathsep + os.environ['PATH']
+        os.environ['NAB_FAKE_ZFS_ROOT'] = self.root
+        os.environ['NAB_FAKE_ZFS_FILESYSTEM'] = 'tank/backups'
+        os.environ['NAB_FAKE_ZFS_LOG'] = self.log
+
+    def tearDown(self):
+        os.environ.clear()
+        os.environ.update(self.environ)
+        subprocess.call(['rm', '-rf', self.testdir])
+
+    def commands(self):
+        with open(self.log, 'r') as fp:
+            commands = [x.split() for x in fp.read().splitlines()]
+        os.remove(self.log)
+        return [x[:2] for x in commands], commands
+
+    def test_Basic(self):
+        '''zfs storage back-end against a stand-in "zfs" command.'''
+
+        from nabstorageplugins import zfs
+
+        storage = zfs.Storage(['tank', 'tank/backups', self.root, None,
+                None])
+        self.assertEqual(storage.rsync_inplace_compatible(), True)
+        for hostname in ['host1', 'host2']:
+            storage.create_host(hostname)
+            self.assertEqual(storage.get_backup_destination(hostname,
+                    'snap1'), os.path.join(self.root, hostname, 'data'))
+            with open(os.path.join(self.root, hostname, 'data', 'testfile'),
+                    'w') as fp:
+                fp.write('Backup of %s\n' % hostname)
+        stat = os.stat(os.path.join(self.root, 'host1'))
+        self.assertEqual(stat.st_mode & 0777, 0700)
+        self.assertEqual(self.commands()[1], [
+                ['zfs', 'create', 'tank/backups/host1'],
+                ['zfs', 'create', 'tank/backups/host2']])
+
+        #  several hosts are snapshotted with one command
+        storage.create_snapshots([('host1', 'snap1'), ('host2', 'snap1')])
+        self.assertEqual(self.commands()[1][1:], [['zfs', 'snapshot',
+                'tank/backups/host1@snap1', 'tank/backups/host2@snap1']])
+        with self.assertRaises(ValueError):
+            storage.create_snapshots([('host1', 'snap2'),
+                    ('host2', 'snap1')])
+        with self.assertRaises(ValueError):
+            storage.create_snapshots([('host3', 'snap1')])
+
+        with open(os.path.join(self.root, 'host1', 'data', 'testfile'),
+                'w') as fp:
+            fp.write('Another backup\n')
+        self.commands()
+        self.assertEqual(storage.create_snapshot('host1', 'snap2'), None)
+        self.assertEqual(self.commands()[0], [['zfs', 'list'],
+                ['zfs', 'snapshot']])
+        self.assertEqual([x.path for x in nabmanifest.read_manifest(
+                storage.get_manifest_path('host1', 'snap2'))],
+                ['testfile'])
+        storage.mount_snapshot('host1', 'snap2')
+        with open(os.path.join(storage.get_snapshot_directory('host1',
+                'snap2'), 'data', 'testfile'), 'r') as fp:
+            self.assertEqual(fp.readline(), 'Another backup\n')
+        with self.assertRaises(ValueError):
+            storage.mount_snapshot('host1', 'snap3')
+
+        #  one listing covers all the hosts
+        storage.create_snapshot('host1', 'snap3')
+        self.commands()
+        datasets = storage.list_datasets()
+        self.assertEqual(len(self.commands()[0]), 1)
+        self.assertEqual(sorted(datasets.keys()), ['host1', 'host2'])
+        self.assertEqual([x.name for x in datasets['host1'].snapshots],
+                ['snap1', 'snap2', 'snap3'])
+        self.assertEqual(datasets['host2'].snapshots[0].used > 0, True)
+        self.assertEqual(storage.list_snapshots('host2'), ['snap1'])
+
+        self.assertEqual(storage.reclaimable_bytes('host1',
+                ['snap1', 'snap2', 'missing']), len('Backup of host1\n') +
+                len('Another backup\n'))
+        self.assertEqual(os.path.isdir(storage.get_snapshot_directory('host1',
+                'snap1')), True)
+
+        #  several snapshots are destroyed with one command
+        self.commands()
+        self.assertEqual(storage.destroy_snapshots('host1',
+                ['snap1', 'snap2', 'missing']), ['snap1', 'snap2'])
+        self.assertEqual(self.commands()[1][1:], [['zfs', 'destroy',
+                'tank/backups/host1@snap1,snap2']])
+        self.assertEqual(storage.list_snapshots('host1'), ['snap3'])
+        self.assertEqual(os.path.exists(storage.get_manifest_path('host1',
+                'snap2')), False)
+        with self.assertRaises(ValueError):
+            storage.destroy_snapshot('host1', 'snap2')
+        storage.destroy_snapshot('host1', 'snap3')
+        self.assertEqual(storage.list_snapshots('host1'), [])
+
+        statistics = storage.storage_statistics()
+        self.assertEqual(statistics.free_bytes, 10 ** 9)
+        self.assertEqual(statistics.dedup_ratio_percent, 150)
+
+        storage.destroy_host('host2')
+        self.assertEqual(storage.list_datasets().keys(), ['host1'])
+        with self.assertRaises(ValueError):
+            storage.destroy_host('host2')
+
+    def test_CollectUsage(self):
+        '''Usage of all the hosts from one "zfs get".'''
+
+        from nabstorageplugins import zfs
+
+        output = ['tank/a\tused\t100\n', 'tank/a\tusedbysnapshots\t0\n',
+                'tank/a\tcompressratio\t1.00x\n']
+        for name in ['tank/a/host1', 'tank/a/host1/child', 'tank/b/host2']:
+            output += ['%s\tused\t1000\n' % name,
+                    '%s\tusedbysnapshots\t400\n' % name,
+                    '%s\tcompressratio\t2.05\n' % name]
+        self.assertEqual(list(zfs.parse_usage(output, ['tank/a', 'tank/b'])),
+                [('tank/a', 'host1', 600, 400, 205),
+                ('tank/b', 'host2', 600, 400, 205)])
+
+        storage = zfs.Storage(['tank', 'tank/backups', self.root, None,
+                None])
+        for hostname in ['host1', 'host2']:
+            storage.create_host(hostname)
+            with open(os.path.join(self.root, hostname, 'data', 'testfile'),
+                    'w') as fp:
+                fp.write('x' * 100)
+        storage.create_snapshot('host1', 'snap1')
+        with open(os.path.join(self.root, 'host1', 'data', 'testfile'),
+                'w') as fp:
+            fp.write('x' * 10)
+        self.commands()
+
+        manifest = os.path.getsize(storage.get_manifest_path('host1',
+                'snap1'))
+        self.assertEqual([x[1:] for x in zfs.collect_usage([storage])],
+                [('host1', 10 + manifest, 100, 125), ('host2', 100, 0, 125)])
+        self.assertEqual(self.commands()[0], [['zfs', 'get']])
 
 print unittest.main()